@@ -0,0 +1,285 @@
+"""
+SmartScope
+Threaded live view for the GUI windows.
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future
+
+import cv2
+import numpy as np
+import PIL.Image
+import PIL.ImageTk
+
+from smartscope.source import sc_utils
+
+
+# number: increasing frame number
+# image: downscaled 8-bit PIL image for display
+# frame: raw frame as captured, binned with a binned profile
+# captured: time.perf_counter() when the exposure was requested
+# ready: time.perf_counter() when the frame was ready to display
+Frame = namedtuple('Frame', ['number', 'image', 'frame', 'captured', 'ready'])
+
+
+class FrameBuffer:
+    ''' Triple buffer shared by the capture thread and the Tk thread.
+    The capture thread always writes into a free slot and never waits
+    for the display. The display only ever reads the newest complete
+    frame, any frame that is replaced before it is read is dropped.
+    '''
+    def __init__(self, slots=3):
+        self._lock = threading.Lock()
+        self._slots = [None] * slots
+        self._newest = None
+        self._reading = None
+        self.written = 0
+        self.dropped = 0
+        self._last_read = 0
+
+    def write(self, frame):
+        ''' Stores a frame in a slot that is not being displayed '''
+        with self._lock:
+            for i in range(len(self._slots)):
+                if i != self._newest and i != self._reading:
+                    break
+            self._slots[i] = frame
+            if self._newest is not None and self._slots[self._newest].number > self._last_read:
+                self.dropped += 1
+            self._newest = i
+            self.written += 1
+
+    def read(self):
+        ''' Returns the newest frame if it has not been read yet,
+        otherwise None
+        '''
+        with self._lock:
+            if self._newest is None:
+                return None
+            frame = self._slots[self._newest]
+            if frame.number <= self._last_read:
+                return None
+            self._reading = self._newest
+            self._last_read = frame.number
+            return frame
+
+
+class RateMeter:
+    ''' Rolling frames per second and latency over the last few seconds '''
+    def __init__(self, window=2.0):
+        self.window = window
+        self._events = deque()
+
+    def add(self, latency, now=None):
+        if now is None:
+            now = time.perf_counter()
+        self._events.append((now, latency))
+        while self._events and now - self._events[0][0] > self.window:
+            self._events.popleft()
+
+    @property
+    def fps(self):
+        if len(self._events) < 2:
+            return 0.0
+        span = self._events[-1][0] - self._events[0][0]
+        if span <= 0:
+            return 0.0
+        return (len(self._events) - 1) / span
+
+    @property
+    def latency(self):
+        ''' Mean latency in ms '''
+        if not self._events:
+            return 0.0
+        return 1000 * sum(e[1] for e in self._events) / len(self._events)
+
+
+class LiveView:
+    ''' Acquires frames from the camera on a background thread so the Tk
+    main loop never blocks on an exposure.
+
+    args:
+        dim: (width, height) of the displayed image
+        exposure: exposure time (ms)
+        flip: flip the frame vertically to match the saved images
+        cam: an open camera to use instead of sc_utils.start_cam(). It 
+            is not closed when the live view stops.
+        profile: sc_utils.CAMERA_PROFILES entry to capture with. The 
+            display is smaller than the sensor, so a binned profile 
+            shows the same image with a much shorter readout.
+    '''
+    def __init__(self, dim, exposure=1, flip=True, cam=None, profile=sc_utils.DEFAULT_PROFILE):
+        self.dim = tuple(int(d) for d in dim)
+        self.exposure = exposure
+        self.flip = flip
+        self.cam = cam
+        self.profile = profile
+        self.buffer = FrameBuffer()
+        self.capture_rate = RateMeter()
+        self.display_rate = RateMeter()
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._count = 0
+        self._snapshots = queue.Queue()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='LiveView', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        ''' Stops the capture thread and waits for the camera to close '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.exposure / 1000.0 + 5)
+            self._thread = None
+
+    def set_exposure(self, exposure):
+        self.exposure = exposure
+
+    def snapshot(self, profile=sc_utils.DEFAULT_PROFILE):
+        ''' Asks the capture thread, which owns the camera, for one frame 
+        with another camera profile. It then goes back to the live 
+        profile. Does not wait, so the Tk thread can poll the result.
+
+        args:
+            profile: sc_utils.CAMERA_PROFILES entry of the frame, full 
+                resolution by default
+        returns:
+            concurrent.futures.Future of the raw frame, flipped like the 
+            displayed frames
+        '''
+        if self._thread is None:
+            raise RuntimeError('Live view is not running')
+        request = Future()
+        self._snapshots.put((profile, request))
+        return request
+
+    def _take_snapshots(self, cam):
+        ''' Answers the snapshot() requests made since the last frame '''
+        while True:
+            try:
+                profile, request = self._snapshots.get_nowait()
+            except queue.Empty:
+                return
+            # Given up on by the Tk thread
+            if not request.set_running_or_notify_cancel():
+                continue
+            try:
+                frame = sc_utils.get_live_frame(cam, self.exposure, profile).reshape(
+                    cam.shape[::-1])
+                request.set_result(np.flipud(frame) if self.flip else frame)
+            except Exception as e:
+                request.set_exception(e)
+            finally:
+                sc_utils.set_camera_profile(cam, self.profile)
+
+    def _run(self):
+        cam = self.cam
+        if cam is None:
+            try:
+                cam = sc_utils.start_cam(self.profile)
+            except Exception as e:
+                self.error = e
+                return
+        try:
+            sc_utils.set_camera_profile(cam, self.profile)
+            while not self._stop.is_set():
+                self._take_snapshots(cam)
+                captured = time.perf_counter()
+                frame = cam.get_frame(exp_time=self.exposure).reshape(
+                    cam.shape[::-1])
+                self.buffer.write(self.process(frame, captured))
+                self.capture_rate.add(time.perf_counter() - captured)
+        except Exception as e:
+            self.error = e
+        finally:
+            if self.cam is None:
+                sc_utils.close_cam(cam)
+            # Requests made while stopping are not answered
+            while not self._snapshots.empty():
+                request = self._snapshots.get_nowait()[1]
+                if request.set_running_or_notify_cancel():
+                    request.set_exception(RuntimeError('Live view stopped'))
+
+    def process(self, frame, captured):
+        ''' Converts a raw camera frame into a displayable Frame. The frame 
+        is downscaled before the 8-bit conversion so only the displayed 
+        pixels are rescaled.
+        '''
+        if self.flip:
+            frame = np.flipud(frame)
+        small = cv2.resize(frame, self.dim, interpolation=cv2.INTER_AREA)
+        image = PIL.Image.fromarray(sc_utils.bytescale(small, high=255))
+        self._count += 1
+        return Frame(self._count, image, frame, captured, time.perf_counter())
+
+    def latest(self):
+        ''' Returns the newest frame that has not been displayed yet or
+        None. Call from the Tk thread.
+        '''
+        frame = self.buffer.read()
+        if frame is not None:
+            self.display_rate.add(time.perf_counter() - frame.captured)
+        return frame
+
+    def status(self):
+        ''' Text for the FPS and latency readout '''
+        return ('Camera: {:.1f} fps   Display: {:.1f} fps   Latency: {:.0f} ms   Dropped: {}'
+                .format(self.capture_rate.fps, self.display_rate.fps,
+                        self.display_rate.latency, self.buffer.dropped))
+
+
+class CanvasView:
+    ''' Draws live frames and overlays on a Tk canvas. The image and 
+    overlay items are created once and then updated in place, so the 
+    canvas does not grow for as long as the window is open.
+
+    args:
+        canvas: tk.Canvas to draw on
+        dim: (width, height) of the displayed image
+    '''
+    def __init__(self, canvas, dim):
+        self.canvas = canvas
+        self.photo = PIL.ImageTk.PhotoImage('L', tuple(int(d) for d in dim))
+        self.image_item = canvas.create_image(0, 0, image=self.photo, anchor='nw')
+        self.overlays = {}
+
+    def show(self, frame):
+        ''' Copies a Frame into the existing canvas image '''
+        self.photo.paste(frame.image)
+
+    def line(self, name, x1, y1, x2, y2):
+        ''' Creates the named line the first time, afterwards moves it '''
+        self._draw(name, self.canvas.create_line, (x1, y1, x2, y2))
+
+    def rectangle(self, name, x1, y1, x2, y2):
+        ''' Creates the named rectangle the first time, afterwards moves it '''
+        self._draw(name, self.canvas.create_rectangle, (x1, y1, x2, y2))
+
+    def cross(self, name, x, y, size=70):
+        ''' Draws a cross centered on (x, y) '''
+        self.line(name + '_h', x - size, y, x + size, y)
+        self.line(name + '_v', x, y - size, x, y + size)
+
+    def hide(self, name):
+        ''' Hides every overlay whose name starts with name '''
+        for key, item in self.overlays.items():
+            if key.startswith(name):
+                self.canvas.itemconfig(item, state='hidden')
+
+    def _draw(self, name, create, coords):
+        if name not in self.overlays:
+            self.overlays[name] = create(*coords)
+        else:
+            self.canvas.coords(self.overlays[name], *coords)
+            self.canvas.itemconfig(self.overlays[name], state='normal')
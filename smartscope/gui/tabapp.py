@@ -2,8 +2,14 @@ import sys
 sys.path.append('C:\\Program Files\\Micro-Manager-2.0beta')
 
 from smartscope.source import run
+from smartscope.source import drift
 from smartscope.source import sc_utils
 from smartscope.source import position as pos
+from smartscope.source import progress as prog
+from smartscope.source import inference
+from smartscope.source import jobs
+from smartscope.source.miq import miq
+from smartscope.gui import live_view
 import os
 from tkinter import ttk
 import tkinter as tk
@@ -11,8 +17,6 @@ from tkinter import filedialog
 import tkinter.messagebox
 import csv
 import cv2
-import PIL.Image
-import PIL.ImageTk
 from imutils.video import VideoStream
 from pyzbar import pyzbar
 import time
@@ -21,6 +25,8 @@ from collections import OrderedDict
 import yaml
 import numpy as np
 import tifffile as tif
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
 
 BARCODE_PATH = os.path.join(os.path.dirname(sys.argv[0]), '../../config/barcode_data/')
@@ -31,6 +37,9 @@ LED_YAML_PATH = os.path.join(os.path.dirname(sys.argv[0]), '../../config/led_int
 # CONFIG_YAML_PATH = '../../config/experiment_config.yml'
 # LED_YAML_PATH = '../../config/led_intensities.yml'
 vid_open = False
+# Camera profile of the live views. They are shown at a third of the 
+# sensor size, so 2x2 binned frames look the same and read out faster.
+LIVE_VIEW_PROFILE = 'bin2'
 # stage_to_pixel_ratio = 0
 # first_position = [-1, -1]
 
@@ -75,6 +84,22 @@ class Main(tk.Frame):
         self.master.title("Smart Scope")
         self.live_class = None
 
+        # Imaging runs on a worker thread so the window stays responsive
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.running = None
+        self.progress = None
+        self.progress_events = queue.Queue()
+        # Models stay loaded between runs, in the inference server if
+        # one is running
+        try:
+            client = inference.connect()
+        except Exception as e:
+            # eg. an unreadable key file or a server with another key
+            sc_utils.print_error('Could not connect to the inference server, '
+                                 'loading the models here: ' + str(e))
+            client = None
+        self.models = jobs.ModelCache(client)
+
         ######################################################
         # Layout the frames and notebooks
         ######################################################
@@ -83,7 +108,7 @@ class Main(tk.Frame):
         self.Sidebar = tk.Frame(self.master)
         self.Sidebar.grid(row=0, column=3, rowspan=4,
                           columnspan=1, sticky=tk.W+tk.E+tk.N+tk.S)
-        row_col_config(self.Sidebar, 8, 1)
+        row_col_config(self.Sidebar, 11, 1)
         self.BarcodeFrame = tk.Frame(
             self.Sidebar, highlightbackground="black", highlightcolor="black", highlightthickness=1)
         self.BarcodeFrame.grid(row=0, column=0, rowspan=4,
@@ -122,9 +147,17 @@ class Main(tk.Frame):
             row=4, column=0, ipadx=18, ipady=3, padx=3, pady=3)
         tk.Button(self.BarcodeFrame, text="Load", command=self.load_barcode).grid(
             row=5, column=0, ipadx=18, ipady=3, padx=3, pady=3)
-        start = tk.Button(self.Sidebar, text="Start", font=(
+        self.start_button = tk.Button(self.Sidebar, text="Start", font=(
             'Sans', '10', 'bold'), command=self.image)
-        start.grid(row=8, column=0, ipadx=23, ipady=3, padx=3, pady=3)
+        self.start_button.grid(row=8, column=0, ipadx=23, ipady=3, padx=3, pady=3)
+        self.stop_button = tk.Button(self.Sidebar, text="Stop", command=self.stop,
+                                     state=tk.DISABLED)
+        self.stop_button.grid(row=9, column=0, ipadx=25, ipady=3, padx=3, pady=3)
+        self.progress_bar = ttk.Progressbar(self.Sidebar, mode='determinate', length=150)
+        self.progress_bar.grid(row=10, column=0, padx=3, pady=3)
+        self.progress_text = tk.StringVar(self.Sidebar, value='')
+        tk.Label(self.Sidebar, textvariable=self.progress_text, wraplength=200).grid(
+            row=11, column=0, padx=3, pady=3)
 
         # Imaging
         # Experiment
@@ -308,6 +341,9 @@ class Main(tk.Frame):
 
     def camera(self):
         global vid_open
+        if self.running is not None:
+            sc_utils.print_error('Cannot open the live camera while imaging')
+            return
         if not vid_open:
             vid_open = True
             live_cam = tk.Toplevel(self.master)
@@ -316,6 +352,9 @@ class Main(tk.Frame):
 
     def first_point_calibration(self):
         global vid_open
+        if self.running is not None:
+            sc_utils.print_error('Cannot calibrate while imaging')
+            return
         if not vid_open:
             if self.calibration_params['Frame to Pixel Ratio'].entry.get() == '':
                 sc_utils.print_error(
@@ -330,6 +369,9 @@ class Main(tk.Frame):
 
     def ratio_calibrate(self):
         global vid_open
+        if self.running is not None:
+            sc_utils.print_error('Cannot calibrate while imaging')
+            return
         if not vid_open:
             vid_open = True
             live_cam = tk.Toplevel(self.master)
@@ -390,29 +432,25 @@ class Main(tk.Frame):
                 print(f"{k}: {v.entry.get()}", file=file)
 
     def image(self):
+        if self.running is not None:
+            sc_utils.print_error('Imaging is already running')
+            return
         # Delete Live Camera
         if self.live_class is not None:
             self.live_class.delete()
 
-        save_dir = (self.saving_params['Folder'].entry.get()
-                    + '/' + self.experiment_params['Start Date'].entry.get()
-                    + '-' + self.experiment_params['Chip'].entry.get()
-                    + '-' + self.experiment_params['Cell'].entry.get()
-                    + '-' + self.experiment_params['Drug'].entry.get()
-                    + '/' + self.experiment_params['Concentration'].entry.get(
-        ) + '-' + self.experiment_params['Drug'].entry.get()
-            + '/' + self.experiment_params['Chip Index'].entry.get()
-            + '/').replace(' ', '-')
-
-        saved_focus = False
+        save_dir = run.get_chip_dir(self.saving_params['Folder'].entry.get(),
+                                    self.experiment_params['Start Date'].entry.get(),
+                                    self.experiment_params['Chip'].entry.get(),
+                                    self.experiment_params['Cell'].entry.get(),
+                                    self.experiment_params['Drug'].entry.get(),
+                                    self.experiment_params['Concentration'].entry.get(),
+                                    self.experiment_params['Chip Index'].entry.get())
+
         # use the directories in save_dir to determine the number of times this
         # chip has been imaged
-        if not os.path.isdir(save_dir):
-            time_point = 't00'
-        else:
-            points = len(next(os.walk(save_dir))[1])
-            time_point = "t{0:0=2d}".format(points)
-            saved_focus = True
+        time_point = run.get_time_point(save_dir)
+        saved_focus = time_point != 't00'
         positions_dir = save_dir + 't00'
         save_dir = save_dir + time_point
         sc_utils.print_info("Set saving directory to "+save_dir)
@@ -443,61 +481,142 @@ class Main(tk.Frame):
         else:
             focus_points_y = int(self.focus_params['Focus Points Y'].entry.get())
 
+        # Read every parameter here on the Tk thread, the run itself 
+        # happens on the worker thread
+        led_intensities = read_yaml(LED_YAML_PATH)
+        channels = [(val, led_intensities[val][0], int(self.exposure_params[val].entry.get()))
+                    for val, check in self.exposure_checkboxes.items() if check.get()]
+        if channels and not saved_focus == True and not channels[0][0] == 'BFF':
+            sc_utils.print_error(
+                'Must image in BFF first when aligning and focusing')
+            return
+
+        first_position = [float(self.calibration_params['First Position X'].entry.get()),
+                          float(self.calibration_params['First Position Y'].entry.get())]
+        output_pixels = [int(self.saving_params['Output Image Pixel Width'].entry.get()),
+                         int(self.saving_params['Output Image Pixel Height'].entry.get())]
+        params = {
+            'cur_chip': cur_chip,
+            'save_dir': save_dir,
+            'positions_dir': positions_dir,
+            'saved_focus': saved_focus == True,
+            'chip_number': self.experiment_params['Chip Index'].entry.get(),
+            'alignment_model_path': self.system_params['Alignment Model'].entry.get(),
+            'focus_model_path': miq.checkpoint_path(self.system_params['Focus Model'].entry.get()),
+            'focus_delta_z': float(self.focus_params['Step Size (um)'].entry.get()),
+            'focus_total_z': int(self.focus_params['Initial Focus Range (um)'].entry.get()),
+            'focus_next_point_range': int(self.focus_params['Focus Range (um)'].entry.get()),
+            'number_of_focus_points_x': focus_points_x,
+            'number_of_focus_points_y': focus_points_y,
+            'focus_exposure': int(self.focus_params['Focus Exposure'].entry.get()),
+            'image_rotation': int(self.system_params['Image Rotation (degrees)'].entry.get()),
+            'frame_to_pixel_ratio': float(self.calibration_params['Frame to Pixel Ratio'].entry.get()),
+            'first_position': first_position,
+            'number_of_apartments_in_frame_x': int(self.system_params['Apartments in Image X'].entry.get()),
+            'number_of_apartments_in_frame_y': int(self.system_params['Apartments in Image Y'].entry.get()),
+            'output_pixels': output_pixels,
+        }
+
+        self.progress_events = queue.Queue()
+        self.progress = prog.Progress(callback=self.progress_events.put)
+        self.start_button['state'] = tk.DISABLED
+        self.stop_button['state'] = tk.NORMAL
+        self.running = self.executor.submit(self.run_channels, channels, params, self.progress)
+        self.poll_progress()
+
+    def run_channels(self, channels, params, progress):
+        ''' Images every selected channel. Runs on the worker thread. '''
         sc_utils.before_imaging()
 
-        first_through = True
         original_point = pos.current(self.mmc)
-        for val, check in self.exposure_checkboxes.items():
-            if check.get() and first_through and not saved_focus == True:
-                if not val == 'BFF':
-                    sc_utils.print_error(
-                        'Must image in BFF first when aligning and focusing')
-                    return
-                sc_utils.set_led_and_shutter(
-                    self.mmc, read_yaml(LED_YAML_PATH)[val][0])
-                run.auto_image_chip(cur_chip,
-                                    self.mmc,
-                                    save_dir,
-                                    self.experiment_params['Chip Index'].entry.get(),
-                                    self.system_params['Alignment Model'].entry.get(),
-                                    os.path.splitext(self.system_params['Focus Model'].entry.get())[0],
-                                    val,
-                                    float(self.focus_params['Step Size (um)'].entry.get()),
-                                    int(self.focus_params['Initial Focus Range (um)'].entry.get()),
-                                    int(self.focus_params['Focus Range (um)'].entry.get()),
-                                    focus_points_x,
-                                    focus_points_y,
-                                    int(self.focus_params['Focus Exposure'].entry.get()),
-                                    int(self.system_params['Image Rotation (degrees)'].entry.get()),
-                                    float(self.calibration_params['Frame to Pixel Ratio'].entry.get()),
-                                    sc_utils.get_frame_size(),
-                                    int(self.exposure_params[val].entry.get()),
-                                    [float(self.calibration_params['First Position X'].entry.get()),
-                                     float(self.calibration_params['First Position Y'].entry.get())],
-                                    int(self.system_params['Apartments in Image X'].entry.get()),
-                                    int(self.system_params['Apartments in Image Y'].entry.get()),
-                                    [int(self.saving_params['Output Image Pixel Width'].entry.get()),
-                                    int(self.saving_params['Output Image Pixel Height'].entry.get())])
-                                    
-                first_through = False
-
-            elif check.get():
-                sc_utils.set_led_and_shutter(
-                    self.mmc, read_yaml(LED_YAML_PATH)[val][0])
-                run.image_from_saved_positions(cur_chip, positions_dir, save_dir, self.mmc,
-                                               val, int(self.system_params['Image Rotation (degrees)'].entry.get()),
-                                               int(self.exposure_params[val].entry.get()),
-                                               [float(self.calibration_params['First Position X'].entry.get()),
-                                                   float(self.calibration_params['First Position Y'].entry.get())],
-                                               int(self.system_params['Apartments in Image X'].entry.get()),
-                                               int(self.system_params['Apartments in Image Y'].entry.get()),
-                                               [int(self.saving_params['Output Image Pixel Width'].entry.get()),
-                                                int(self.saving_params['Output Image Pixel Height'].entry.get())])
-            sc_utils.in_between_channels()
+        try:
+            for i, (val, leds, exposure) in enumerate(channels):
+                if i == 0 and not params['saved_focus']:
+                    sc_utils.set_led_and_shutter(self.mmc, leds)
+                    alignment_model = self.models.mark_locator(params['alignment_model_path'],
+                                                               params['cur_chip']['name'])
+                    focus_model = self.models.focus_model(params['focus_model_path'])
+                    run.auto_image_chip(params['cur_chip'],
+                                        self.mmc,
+                                        params['save_dir'],
+                                        params['chip_number'],
+                                        params['alignment_model_path'],
+                                        params['focus_model_path'],
+                                        val,
+                                        params['focus_delta_z'],
+                                        params['focus_total_z'],
+                                        params['focus_next_point_range'],
+                                        params['number_of_focus_points_x'],
+                                        params['number_of_focus_points_y'],
+                                        params['focus_exposure'],
+                                        params['image_rotation'],
+                                        params['frame_to_pixel_ratio'],
+                                        sc_utils.get_frame_size(),
+                                        exposure,
+                                        params['first_position'],
+                                        params['number_of_apartments_in_frame_x'],
+                                        params['number_of_apartments_in_frame_y'],
+                                        params['output_pixels'],
+                                        progress=progress,
+                                        alignment_model=alignment_model,
+                                        focus_model=focus_model)
+                else:
+                    sc_utils.set_led_and_shutter(self.mmc, leds)
+                    # The reference fields were taken in brightfield
+                    if i == 0 and val == 'BFF':
+                        params['positions_dir'] = drift.correct_saved_positions(
+                            self.mmc, params['positions_dir'], params['save_dir'], exposure,
+                            params['frame_to_pixel_ratio'], progress=progress)
+                    run.image_from_saved_positions(params['cur_chip'], params['positions_dir'], 
+                                                   params['save_dir'], self.mmc, val, 
+                                                   params['image_rotation'], exposure,
+                                                   params['first_position'],
+                                                   params['number_of_apartments_in_frame_x'],
+                                                   params['number_of_apartments_in_frame_y'],
+                                                   params['output_pixels'],
+                                                   progress=progress)
+                sc_utils.in_between_channels()
+        except prog.RunCancelled:
+            sc_utils.print_info('Imaging stopped by user')
+            run.stop_safely(self.mmc, original_point)
+            return
+        except:
+            run.stop_safely(self.mmc, original_point)
+            raise
+        finally:
+            sc_utils.after_imaging()
         pos.set_pos(self.mmc, x=original_point.x,
                     y=original_point.y, z=original_point.z)
-        
-        sc_utils.after_imaging()
+
+    def stop(self):
+        if self.progress is not None:
+            self.progress.cancel()
+            self.progress_text.set('Stopping...')
+            self.stop_button['state'] = tk.DISABLED
+
+    def poll_progress(self):
+        ''' Shows the newest progress event and checks if the run finished '''
+        event = None
+        while not self.progress_events.empty():
+            event = self.progress_events.get()
+        if event is not None and not self.progress.cancelled:
+            self.progress_text.set(prog.format_event(event))
+            self.progress_bar['maximum'] = max(event.total, 1)
+            self.progress_bar['value'] = event.done
+
+        if self.running.done():
+            if self.running.exception() is not None:
+                sc_utils.print_error('Imaging failed: ' + str(self.running.exception()))
+                self.progress_text.set('Failed')
+            elif self.progress.cancelled:
+                self.progress_text.set('Stopped')
+            else:
+                self.progress_text.set('Done')
+            self.running = None
+            self.start_button['state'] = tk.NORMAL
+            self.stop_button['state'] = tk.DISABLED
+            return
+        self.master.after(200, self.poll_progress)
 
 
 def read_yaml(filename):
@@ -575,10 +694,16 @@ class Live_Camera:
             (np.asarray(sc_utils.get_frame_size()) / self.scale).astype(int))
         # self.dim = (int(self.width / self.scale), int(self.height / self.scale))
 
-        self.vid = VideoCapture(mmc)
+        self.vid = VideoCapture(mmc, self.dim)
+        self.frame = None
 
         self.canvas = tk.Canvas(self.Image, width=self.dim[0], height=self.dim[1])
         self.canvas.grid()
+        self.view = live_view.CanvasView(self.canvas, self.dim)
+
+        # Frame rate and latency readout
+        self.status = tk.Label(self.Options, text='')
+        self.status.grid(row=len(self.led_intensities.keys())+8, column=0, columnspan=2)
 
         # Button that lets the user take a snapshot
         self.btn_snapshot = tk.Button(
@@ -594,7 +719,33 @@ class Live_Camera:
         self.update()
     
     def snapshot(self):
-        frame = self.vid.get_frame(self.exp)
+        # The live view is binned, the snapshot is a full resolution frame
+        try:
+            request = self.vid.snapshot()
+        except Exception as e:
+            sc_utils.print_error('Could not take snapshot: ' + str(e))
+            return
+        self.btn_snapshot['state'] = 'disabled'
+        self.save_snapshot(request, time.time() + self.exp / 1000.0 + 5)
+
+    def save_snapshot(self, request, deadline):
+        ''' Polled from the Tk loop, so the window keeps drawing while the 
+        capture thread takes the snapshot 
+        '''
+        if not request.done() and time.time() < deadline:
+            self.window.after(self.delay, self.save_snapshot, request, deadline)
+            return
+        self.btn_snapshot['state'] = 'normal'
+        if not request.done():
+            request.cancel()
+            sc_utils.print_error('Could not take snapshot: no frame from the camera')
+            return
+        try:
+            frame = request.result()
+        except Exception as e:
+            sc_utils.print_error('Could not take snapshot: ' + str(e))
+            return
+        frame = sc_utils.bytescale(frame, high=255)
         file = filedialog.asksaveasfilename(title='Choose a file')
         
         tif.imwrite(file+'.tif', frame)
@@ -607,13 +758,14 @@ class Live_Camera:
         if self.last_channel != self.channel.get():
             sc_utils.set_led_and_shutter(self.mmc, self.led_intensities[self.channel.get()][0])
             self.last_channel = self.channel.get()
-
-        frame = self.vid.get_frame(self.exp)
-        frame = cv2.resize(frame, self.dim, interpolation=cv2.INTER_AREA)
-        # img8 = (frame/4).astype('uint8')
-        frame = PIL.Image.fromarray(frame)
-        self.photo = PIL.ImageTk.PhotoImage(image=frame)
-        self.canvas.create_image(0, 0, image=self.photo, anchor=tk.NW)
+        self.vid.set_exposure(self.exp)
+
+        # Only draw when the capture thread has a new frame
+        frame = self.vid.latest()
+        if frame is not None:
+            self.frame = frame
+            self.view.show(frame)
+        self.status['text'] = self.vid.status()
         self.window.after(self.delay, self.update)
 
     def delete(self):
@@ -624,22 +776,39 @@ class Live_Camera:
 
 
 class VideoCapture:
-    def __init__(self, mmc):
+    ''' Runs the camera on a capture thread (see live_view.py) so that 
+    the windows only draw the newest frame and never wait on an exposure 
+    '''
+    def __init__(self, mmc, dim, exposure=1, profile=LIVE_VIEW_PROFILE):
         self.mmc = mmc
         # sc_utils.set_led_and_shutter(
         #     self.mmc, read_yaml(LED_YAML_PATH)['BFF'][0])
-        self.cam = sc_utils.start_cam()
+        self.live = live_view.LiveView(dim, exposure, profile=profile).start()
 
-    def get_frame(self, exposure):
-        frame = self.cam.get_frame(exp_time=exposure).reshape(
-            self.cam.sensor_size[::-1])
-        frame = np.flipud(frame)
-        frame = sc_utils.bytescale(frame, high=255)
-        return frame
+    def set_exposure(self, exposure):
+        self.live.set_exposure(exposure)
+
+    def latest(self):
+        ''' Returns the newest live_view.Frame or None if there is no 
+        new frame since the last call 
+        '''
+        if self.live.error is not None:
+            sc_utils.print_error('Live view stopped: ' + str(self.live.error))
+            self.live.error = None
+        return self.live.latest()
+
+    def status(self):
+        return self.live.status()
+
+    def snapshot(self, profile=sc_utils.DEFAULT_PROFILE):
+        ''' Future of a raw frame taken with profile, full resolution by 
+        default 
+        '''
+        return self.live.snapshot(profile)
 
     def delete(self):
         try:
-            sc_utils.close_cam(self.cam)
+            self.live.stop()
         except:
             pass
         try:
@@ -661,7 +830,7 @@ class Ratio_Calibration:
         self.dim = (int(self.width / self.scale),
                     int(self.height / self.scale))
         self.mmc = mmc
-        self.vid = VideoCapture(self.mmc)
+        self.vid = VideoCapture(self.mmc, self.dim)
         self.pixel_label = pixel_label
 
         self.pixel_val_1 = np.array([self.width, self.height]) / 5 / self.scale
@@ -670,8 +839,10 @@ class Ratio_Calibration:
 
         self.canvas = tk.Canvas(window, width=self.dim[0], height=self.dim[1])
         self.canvas.pack()
+        self.view = live_view.CanvasView(self.canvas, self.dim)
 
         self.first_cross = True
+        self.draw_overlay()
 
         self.label = tk.Label(
             window, text="Align point on chip with cross, then press OK")
@@ -689,27 +860,21 @@ class Ratio_Calibration:
             self.btn['text'] = 'Finish'
             self.first_cross = False
             self.first_point = pos.current(self.mmc, axis='xy')
+            self.draw_overlay()
         else:
             self.second_point = pos.current(self.mmc, axis='xy')
             self.delete()
 
-    def update(self):
-        exp = 1
-        frame = self.vid.get_frame(exp)
-        frame = cv2.resize(frame, self.dim, interpolation=cv2.INTER_AREA)
-        frame = PIL.Image.fromarray(frame)
-        self.photo = PIL.ImageTk.PhotoImage(image=frame)
-        self.canvas.create_image(0, 0, image=self.photo, anchor=tk.NW)
+    def draw_overlay(self):
         if self.first_cross:
-            self.canvas.create_line(self.pixel_val_1[0]-70, self.pixel_val_1[1],
-                                    self.pixel_val_1[0]+70, self.pixel_val_1[1])
-            self.canvas.create_line(self.pixel_val_1[0], self.pixel_val_1[1]-70,
-                                    self.pixel_val_1[0], self.pixel_val_1[1]+70)
+            self.view.cross('cross', self.pixel_val_1[0], self.pixel_val_1[1])
         else:
-            self.canvas.create_line(self.pixel_val_2[0]-70, self.pixel_val_2[1],
-                                    self.pixel_val_2[0]+70, self.pixel_val_2[1])
-            self.canvas.create_line(self.pixel_val_2[0], self.pixel_val_2[1]-70,
-                                    self.pixel_val_2[0], self.pixel_val_2[1]+70)
+            self.view.cross('cross', self.pixel_val_2[0], self.pixel_val_2[1])
+
+    def update(self):
+        frame = self.vid.latest()
+        if frame is not None:
+            self.view.show(frame)
         self.window.after(self.delay, self.update)
 
     def delete(self):
@@ -740,7 +905,7 @@ class First_Point_Calibration:
         self.dim = (int(self.width / self.scale),
                     int(self.height / self.scale))
         self.mmc = mmc
-        self.vid = VideoCapture(self.mmc)
+        self.vid = VideoCapture(self.mmc, self.dim)
 
         self.point_label_x = point_label_x
         self.point_label_y = point_label_y
@@ -761,8 +926,10 @@ class First_Point_Calibration:
 
         self.canvas = tk.Canvas(window, width=self.dim[0], height=self.dim[1])
         self.canvas.pack()
+        self.view = live_view.CanvasView(self.canvas, self.dim)
 
         self.first_cross = True
+        self.draw_overlay()
 
         self.label = tk.Label(
             window, text="Align first alignment mark on chip with cross, then press OK")
@@ -780,32 +947,24 @@ class First_Point_Calibration:
             self.btn['text'] = 'Finish'
             self.first_cross = False
             self.first_point = pos.current(self.mmc, axis='xy')
+            self.draw_overlay()
         else:
             self.second_point = pos.current(self.mmc, axis='xy')
             self.delete()
 
-    def update(self):
-        exp = 1
-        frame = self.vid.get_frame(exp)
-        frame = cv2.resize(frame, self.dim, interpolation=cv2.INTER_AREA)
-        frame = PIL.Image.fromarray(frame)
-        self.photo = PIL.ImageTk.PhotoImage(image=frame)
-        self.canvas.create_image(0, 0, image=self.photo, anchor=tk.NW)
+    def draw_overlay(self):
         if self.first_cross:
-            self.canvas.create_line(self.pixel_val_1[0]-70, self.pixel_val_1[1],
-                                    self.pixel_val_1[0]+70, self.pixel_val_1[1])
-            self.canvas.create_line(self.pixel_val_1[0], self.pixel_val_1[1]-70,
-                                    self.pixel_val_1[0], self.pixel_val_1[1]+70)
+            self.view.cross('cross', self.pixel_val_1[0], self.pixel_val_1[1])
         else:
-            self.canvas.create_line(self.pixel_val_1[0]-self.rect_width/2, self.pixel_val_1[1]+self.rect_height/2,
-                                    self.pixel_val_1[0]+self.rect_width/2, self.pixel_val_1[1]+self.rect_height/2)
-            self.canvas.create_line(self.pixel_val_1[0]-self.rect_width/2, self.pixel_val_1[1]-self.rect_height/2,
-                                    self.pixel_val_1[0]+self.rect_width/2, self.pixel_val_1[1]-self.rect_height/2)
-            self.canvas.create_line(self.pixel_val_1[0]+self.rect_width/2, self.pixel_val_1[1]-self.rect_height/2,
-                                    self.pixel_val_1[0]+self.rect_width/2, self.pixel_val_1[1]+self.rect_height/2)
-            self.canvas.create_line(self.pixel_val_1[0]-self.rect_width/2, self.pixel_val_1[1]-self.rect_height/2,
-                                    self.pixel_val_1[0]-self.rect_width/2, self.pixel_val_1[1]+self.rect_height/2)
+            self.view.hide('cross')
+            self.view.rectangle('apartment',
+                                self.pixel_val_1[0]-self.rect_width/2, self.pixel_val_1[1]-self.rect_height/2,
+                                self.pixel_val_1[0]+self.rect_width/2, self.pixel_val_1[1]+self.rect_height/2)
 
+    def update(self):
+        frame = self.vid.latest()
+        if frame is not None:
+            self.view.show(frame)
         self.window.after(self.delay, self.update)
 
     def delete(self):
@@ -10,6 +10,7 @@ Written by Caleb Sanford
 import os
 import random
 import math
+import cv2
 import numpy as np
 import skimage.io
 import matplotlib
@@ -22,15 +23,73 @@ from smartscope.source.maskrcnn import visualize
 from smartscope.source.maskrcnn import config
 
 from smartscope.source.dataset import mark_dataset
+from smartscope.source import frozen
 from smartscope.source import sc_utils
 from smartscope.source import position as pos
+from smartscope.source import progress as prog
 
 classnames = ['BG', 'mark']
 
-def get_inference_model(model_dir):
-    ''' Loads weights and returns an inference model '''
+# Reference images of the alignment mark for each chip type
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../config/alignment_templates')
+# Full resolution size (pixels) of the square cut around a mark for its template
+TEMPLATE_SIZE = 400
+# Resolution the whole frame is searched at
+TEMPLATE_SCALE = 0.25
+# Correlation below which Mask R-CNN is used instead of the template
+MIN_CONFIDENCE = 0.6
+# Lowest Mask R-CNN score of a mark a template is learned from. The 
+# template is kept for every later run, so a false detection (debris, 
+# the chip edge) must not become one.
+TEMPLATE_MIN_SCORE = 0.95
+# Largest distance (um) between a mark and where the mark layout puts it, 
+# once the offset of its field is known
+MATCH_TOLERANCE = 25.0
+# Expected error (um) of a single mark position
+MARK_ERROR = 0.5
+# Largest expected error (um) at the far side of the chip from the 
+# rotation, more fields are visited until the marks are far enough apart
+MAX_CORNER_ERROR = 20.0
+# Largest rms error (um) of the chip pose fit before more fields are used
+MAX_POSE_RESIDUAL = 10.0
+# Batch size of the alignment model in batch alignment, the fields 
+# needed for a chip with a mark at its corners
+BATCH_SIZE = 2
 
-    inference_config = mark_dataset.InferenceConfig()
+def frozen_model_path(model_dir, detection_only=True, profile='default'):
+    ''' Path of the frozen model export_models.py makes from model_dir '''
+    return frozen.frozen_path(model_dir, profile, 'detection' if detection_only else '')
+
+def get_inference_model(model_dir, detection_only=True, profile='default', use_frozen=True,
+                        batch_size=1):
+    ''' Loads weights and returns an inference model 
+
+    args:
+        model_dir: path to the model weights
+        detection_only: build the model without the mask head, alignment 
+            only uses the boxes
+        profile: name of the configuration in 
+            mark_dataset.INFERENCE_PROFILES. 'fast' runs the standard 
+            model on a smaller input, 'light' needs a model trained with 
+            mark_dataset.LightMarkConfig
+        use_frozen: load the frozen model from export_models.py instead 
+            of building the model if there is one for these weights
+        batch_size: images in each detect() call, frozen models are 
+            exported with a batch of one
+    '''
+    if profile not in mark_dataset.INFERENCE_PROFILES:
+        raise ValueError('Unknown alignment profile "' + profile + '", use one of ' +
+                         ', '.join(mark_dataset.INFERENCE_PROFILES))
+    inference_config = mark_dataset.INFERENCE_PROFILES[profile]()
+    inference_config.DETECTION_ONLY = detection_only
+    inference_config.IMAGES_PER_GPU = batch_size
+    inference_config.BATCH_SIZE = batch_size * inference_config.GPU_COUNT
+
+    path = frozen_model_path(model_dir, detection_only, profile)
+    info = frozen.read_info(path, model_dir) if use_frozen and batch_size == 1 else None
+    if info is not None:
+        sc_utils.print_info("Loading frozen model from "+ path)
+        return modellib.FrozenMaskRCNN(path, inference_config, info['inputs'], info['outputs'])
     model = modellib.MaskRCNN(mode="inference", 
                               config=inference_config,
                               model_dir=os.path.join(os.path.dirname(model_dir),'logs'))
@@ -45,35 +104,295 @@ def get_mark_center(rois):
     ], -1)
     return centroids
 
+def detect_frames(model, frames, verbose=0):
+    ''' model.detect() on any number of frames, in batches of the 
+    model's BATCH_SIZE. The last batch is filled up with its last frame. 
+    Models without a config, like inference.RemoteAlignmentModel, get 
+    every frame at once.
+    '''
+    model_config = getattr(model, 'config', None)
+    if model_config is None:
+        return model.detect(frames, verbose=verbose)
+    n = model_config.BATCH_SIZE
+    results = []
+    for i in range(0, len(frames), n):
+        batch = list(frames[i:i + n])
+        results += model.detect(batch + [batch[-1]] * (n - len(batch)), verbose=verbose)[:len(batch)]
+    return results
+
+def template_path(chip_name):
+    ''' Path of the mark template for a chip type '''
+    return os.path.join(TEMPLATE_DIR, chip_name.replace(' ', '_') + '.tif')
+
+def _peak_offset(corr, x, y):
+    ''' Sub-pixel offset of a correlation peak from a parabola fit '''
+    offset = []
+    for axis, i in ((1, x), (0, y)):
+        if i == 0 or i == corr.shape[axis] - 1:
+            offset.append(0.0)
+            continue
+        if axis == 1:
+            left, mid, right = corr[y, i - 1], corr[y, i], corr[y, i + 1]
+        else:
+            left, mid, right = corr[i - 1, x], corr[i, x], corr[i + 1, x]
+        denom = left - 2 * mid + right
+        offset.append(0.0 if denom == 0 else 0.5 * (left - right) / denom)
+    return offset
+
+class TemplateMatcher:
+    ''' Finds an alignment mark by normalized cross correlation with a 
+    reference image of the mark. The frame is searched at a reduced 
+    resolution and the match is then refined at full resolution in a 
+    small window around it.
+
+    args:
+        template: 2D image of the mark, centered on the mark
+        scale: resolution of the coarse search
+    '''
+    def __init__(self, template, scale=TEMPLATE_SCALE):
+        self.template = np.asarray(template, dtype=np.float32)
+        self.scale = scale
+        self.small = self._resize(self.template)
+
+    @classmethod
+    def load(cls, path, scale=TEMPLATE_SCALE):
+        return cls(skimage.io.imread(path), scale)
+
+    @classmethod
+    def from_frame(cls, frame, center, size=TEMPLATE_SIZE, scale=TEMPLATE_SCALE):
+        ''' Cuts a template around center (x, y) from a frame '''
+        x = int(round(center[0])) - size // 2
+        y = int(round(center[1])) - size // 2
+        if x < 0 or y < 0 or x + size > frame.shape[1] or y + size > frame.shape[0]:
+            raise NoMarkError('The mark is too close to the edge of the frame for a template')
+        return cls(frame[y:y + size, x:x + size], scale)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        skimage.io.imsave(path, self.template.astype(np.uint16))
+
+    def _resize(self, image):
+        size = (max(1, int(image.shape[1] * self.scale)), max(1, int(image.shape[0] * self.scale)))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    def match(self, frame):
+        ''' Locates the mark in a frame
+
+        args:
+            frame: 2D camera frame
+        returns:
+            (x, y) center of the mark in frame pixels, confidence 
+            (normalized correlation of the coarse match, -1 to 1)
+        '''
+        frame = np.asarray(frame, dtype=np.float32)
+        corr = self._correlate(frame)
+        if corr is None:
+            return None, -1.0
+        _, confidence, _, (x, y) = cv2.minMaxLoc(corr)
+        return self._refine(frame, corr, x, y), confidence
+
+    def match_all(self, frame, min_confidence=MIN_CONFIDENCE):
+        ''' Locates every mark in a frame
+
+        returns:
+            list of ((x, y) center, confidence), best match first
+        '''
+        frame = np.asarray(frame, dtype=np.float32)
+        corr = self._correlate(frame)
+        if corr is None:
+            return []
+        search = corr.copy()
+        th, tw = self.small.shape
+        matches = []
+        while True:
+            _, confidence, _, (x, y) = cv2.minMaxLoc(search)
+            if confidence < min_confidence:
+                return matches
+            matches.append((self._refine(frame, corr, x, y), confidence))
+            # Marks can not overlap, clear the area of this one
+            search[max(0, y - th // 2):y + th // 2 + 1, max(0, x - tw // 2):x + tw // 2 + 1] = -1
+
+    def _correlate(self, frame):
+        ''' Coarse correlation of the template with the whole frame '''
+        small = self._resize(frame)
+        if small.shape[0] < self.small.shape[0] or small.shape[1] < self.small.shape[1]:
+            return None
+        return cv2.matchTemplate(small, self.small, cv2.TM_CCOEFF_NORMED)
+
+    def _refine(self, frame, corr, x, y):
+        ''' Refines the coarse match at (x, y) at full resolution '''
+        th, tw = self.template.shape
+        margin = int(2 / self.scale)
+        x0 = max(0, int(x / self.scale) - margin)
+        y0 = max(0, int(y / self.scale) - margin)
+        x1 = min(frame.shape[1], int(x / self.scale) + tw + margin)
+        y1 = min(frame.shape[0], int(y / self.scale) + th + margin)
+        window = frame[y0:y1, x0:x1]
+        if window.shape[0] < th or window.shape[1] < tw:
+            dx, dy = _peak_offset(corr, x, y)
+            return (float((x + dx + self.small.shape[1] / 2.0) / self.scale),
+                    float((y + dy + self.small.shape[0] / 2.0) / self.scale))
+        fine = cv2.matchTemplate(window, self.template, cv2.TM_CCOEFF_NORMED)
+        _, _, _, (fx, fy) = cv2.minMaxLoc(fine)
+        dx, dy = _peak_offset(fine, fx, fy)
+        return (float(x0 + fx + dx + tw / 2.0), float(y0 + fy + dy + th / 2.0))
+
+class MarkLocator:
+    ''' Finds alignment marks with a template match and only runs Mask 
+    R-CNN when the match is not confident. If a chip type has no 
+    template yet, one is cut from the first mark Mask R-CNN finds with a 
+    score of at least template_min_score and saved for next time.
+
+    args:
+        model: loaded Mask R-CNN inference model
+        model_loader: function that loads the model the first time it is 
+            needed, used when model is None
+        template_path: template image for this chip type
+        min_confidence: lowest template correlation that is accepted
+        learn: save a template when there is none
+        template_min_score: lowest Mask R-CNN score of a mark a template 
+            is learned from
+    '''
+    def __init__(self, model=None, model_loader=None, template_path=None,
+                 min_confidence=MIN_CONFIDENCE, learn=True,
+                 template_min_score=TEMPLATE_MIN_SCORE):
+        self._model = model
+        self.model_loader = model_loader
+        self.template_path = template_path
+        self.min_confidence = min_confidence
+        self.learn = learn
+        self.template_min_score = template_min_score
+        self.matcher = None
+        if template_path is not None and os.path.isfile(template_path):
+            self.matcher = TemplateMatcher.load(template_path)
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = self.model_loader()
+        return self._model
+
+    def locate(self, orig_frame):
+        ''' Finds the mark in a camera frame
+
+        returns:
+            (x, y) center of the mark, Mask R-CNN style results dict with 
+            the mark's box and score, and 'method' set to 'template' or 
+            'maskrcnn'
+        '''
+        centers, r = self.locate_all(orig_frame)
+        return centers[0], r
+
+    def locate_all(self, orig_frame):
+        ''' Finds every mark in a camera frame
+
+        returns:
+            (N, 2) array of (x, y) mark centers, most confident first, 
+            and the results dict as in locate()
+        '''
+        centers, r = self.locate_many([orig_frame])[0]
+        if len(centers) == 0:
+            raise NoMarkError('No alignment mark found')
+        return centers, r
+
+    def locate_many(self, orig_frames):
+        ''' Finds every mark in several camera frames. The frames the 
+        template does not match go through Mask R-CNN together, in batches 
+        of the model's BATCH_SIZE.
+
+        returns:
+            list of (centers, results dict) as returned by locate_all(), 
+            centers is empty for a frame without a mark
+        '''
+        found = [self._match_template(frame) for frame in orig_frames]
+        missing = [i for i, f in enumerate(found) if f is None]
+        if missing:
+            frames = [sc_utils.convert_frame_to_mrcnn_format(orig_frames[i]) for i in missing]
+            for i, r in zip(missing, detect_frames(self.model, frames, verbose=1)):
+                found[i] = self._from_detection(orig_frames[i], r)
+        return found
+
+    def _match_template(self, orig_frame):
+        ''' (centers, results) from the template, None if there is no 
+        template or the match is not confident
+        '''
+        if self.matcher is None:
+            return None
+        start = time.time()
+        matches = self.matcher.match_all(orig_frame, self.min_confidence)
+        if not matches:
+            sc_utils.print_info('Template match is too low, using Mask R-CNN')
+            return None
+        sc_utils.print_info('Template match: {:.2f} in {:.3f}s ({} marks)'.format(
+            matches[0][1], time.time() - start, len(matches)))
+        th, tw = self.matcher.template.shape
+        centers = np.array([center for center, _ in matches])
+        boxes = [[y - th / 2.0, x - tw / 2.0, y + th / 2.0, x + tw / 2.0]
+                 for x, y in centers]
+        r = {'rois': np.array(boxes), 'class_ids': np.ones(len(matches), dtype=int),
+             'scores': np.array([c for _, c in matches]), 'method': 'template'}
+        return centers, r
+
+    def _from_detection(self, orig_frame, r):
+        ''' (centers, results) from Mask R-CNN. If there is no template, 
+        one is cut from the highest scoring mark when its score is at 
+        least template_min_score.
+        '''
+        r['method'] = 'maskrcnn'
+        if len(r['rois']) == 0:
+            return np.zeros((0, 2)), r
+        centers = np.array([get_mark_center(roi) for roi in r['rois']])
+        best = int(np.argmax(r['scores']))
+        if (self.learn and self.matcher is None and self.template_path is not None
+                and r['scores'][best] >= self.template_min_score):
+            try:
+                self.matcher = TemplateMatcher.from_frame(orig_frame, centers[best])
+                self.matcher.save(self.template_path)
+                sc_utils.print_info('Saved alignment template ' + self.template_path)
+            except NoMarkError:
+                pass
+        return centers, r
+
 def find_alignment_mark(stage_controller, 
                     estimate_pos, 
                     alignment_model,
                     exposure,
                     frame_to_pixel_ratio,
                     camera_pixel_width=2688, 
-                    camera_pixel_height=2200):
+                    camera_pixel_height=2200,
+                    camera_profile=sc_utils.DEFAULT_PROFILE):
+    ''' Goes to estimate_pos and finds the alignment mark in the frame
+
+    args:
+        alignment_model: MarkLocator or Mask R-CNN inference model
+        camera_profile: sc_utils.CAMERA_PROFILES entry to take the frame 
+            with, binned frames are scaled back up to sensor pixels
+    returns:
+        (x, y) center of the mark in pixels, camera frame, results dict
+    '''
+    if not isinstance(alignment_model, MarkLocator):
+        alignment_model = MarkLocator(alignment_model)
     # go to the estimate position
     estimate_pos.goto(stage_controller)
-    orig_frame = sc_utils.get_frame(exposure)
-    frame = sc_utils.convert_frame_to_mrcnn_format(orig_frame)
-    
-    results = alignment_model.detect([frame], verbose=1)
-    r = results[0]
-    if len(r['rois']) > 0:
-        centroids = get_mark_center(r['rois'][0])
-        return centroids, orig_frame, frame, r
-    else:
-        # TODO
-        pass
+    orig_frame = sc_utils.to_sensor_pixels(sc_utils.get_frame(exposure, camera_profile), 
+                                           camera_profile)
+    centroids, r = alignment_model.locate(orig_frame)
+    return centroids, orig_frame, r
 
 def get_center(mmc, center, frame_to_pixel_ratio, 
                 camera_pixel_width, camera_pixel_height):
-    cur_position = pos.current(mmc)
+    x, y = pixel_to_stage(pos.current(mmc), center, frame_to_pixel_ratio,
+                          camera_pixel_width, camera_pixel_height)
+    return pos.StagePosition(x=x, y=y)
+
+def pixel_to_stage(position, center, frame_to_pixel_ratio,
+                   camera_pixel_width, camera_pixel_height):
+    ''' Stage (x, y) that puts pixel center of a frame taken at position 
+    in the middle of the frame 
+    '''
     x_change = (center[0]-(float(camera_pixel_width)/2))*frame_to_pixel_ratio
     y_change = (center[1]-(float(camera_pixel_height)/2))*frame_to_pixel_ratio
-    new_x = cur_position.x-x_change
-    new_y = cur_position.y-y_change
-    return pos.StagePosition(x=new_x, y=new_y)
+    return position.x-x_change, position.y-y_change
 
 def search_and_find_center(stage_controller, 
                     estimate_pos, 
@@ -81,12 +400,219 @@ def search_and_find_center(stage_controller,
                     exposure,
                     frame_to_pixel_ratio,
                     camera_pixel_width=2688, 
-                    camera_pixel_height=2200):
-    center, img, frame, r = find_alignment_mark(stage_controller, estimate_pos, alignment_model, exposure, frame_to_pixel_ratio, camera_pixel_width, camera_pixel_height)
+                    camera_pixel_height=2200,
+                    camera_profile=sc_utils.DEFAULT_PROFILE):
+    center, img, r = find_alignment_mark(stage_controller, estimate_pos, alignment_model, exposure, frame_to_pixel_ratio, camera_pixel_width, camera_pixel_height, camera_profile)
+    camera_pixel_width, camera_pixel_height = sc_utils.profile_field(
+        (camera_pixel_width, camera_pixel_height), camera_profile)
     pos = get_center(stage_controller, center, frame_to_pixel_ratio, camera_pixel_width, camera_pixel_height)
     pos.z = estimate_pos.z
     return pos
 
+def mark_layout(cur_chip):
+    ''' (x, y) in um of every alignment mark relative to the first mark 
+    of an unrotated chip. A chip type lists its marks under 
+    'alignment_marks' in experiment_config.yml, otherwise there is one 
+    mark at each of the three corners used to make a chip.Chip.
+    '''
+    if cur_chip.get('alignment_marks'):
+        return np.array(cur_chip['alignment_marks'], dtype=float)
+    w = cur_chip['chip_width']
+    h = cur_chip['chip_height']
+    return np.array([[0, 0], [w, 0], [w, -h]], dtype=float)
+
+def match_field(marks, layout, pose, field, field_size):
+    ''' Pairs the marks found in one field with marks of the layout. 
+    The pose can be off by more than the spacing of the marks, so every 
+    pairing of a found mark with a layout mark near the field is tried as 
+    the field offset and the one that pairs the most marks, then the 
+    smallest offset, is used.
+
+    args:
+        marks: (N, 2) stage (x, y) of the marks found in the field
+        layout: (M, 2) mark layout of the chip
+        pose: position.RigidTransform estimate from layout to stage
+        field: stage (x, y) of the field center
+        field_size: (width, height) of the field in um
+    returns:
+        list of (mark index, layout index) pairs
+    '''
+    predicted = pose.apply(layout)
+    near = np.flatnonzero(np.hypot(predicted[:, 0] - field[0], predicted[:, 1] - field[1])
+                          < np.hypot(*field_size))
+    best, best_score = [], None
+    for i in range(len(marks)):
+        for j in near:
+            offset = marks[i] - predicted[j]
+            moved = predicted[near] + offset
+            dist = np.hypot(marks[:, None, 0] - moved[None, :, 0],
+                            marks[:, None, 1] - moved[None, :, 1])
+            pairs = []
+            for k in np.argsort(dist.min(axis=1)):
+                n = int(np.argmin(dist[k]))
+                if dist[k, n] < MATCH_TOLERANCE and near[n] not in [l for _, l in pairs]:
+                    pairs.append((int(k), int(near[n])))
+            score = (len(pairs), -np.hypot(*offset))
+            if best_score is None or score > best_score:
+                best, best_score = pairs, score
+    return best
+
+def plan_fields(layout, chip_size):
+    ''' Marks align_chip() visits if every mark is found: the first 
+    mark, then the mark farthest from the ones before until they are far 
+    enough apart to fix the rotation
+    '''
+    plan = [0]
+    while len(plan) < len(layout):
+        found = layout[plan]
+        baseline = np.max(np.hypot(found[:, None, 0] - found[None, :, 0],
+                                   found[:, None, 1] - found[None, :, 1]))
+        if baseline > 0 and MARK_ERROR * chip_size / baseline <= MAX_CORNER_ERROR:
+            break
+        remaining = [l for l in range(len(layout)) if l not in plan]
+        distance = [np.min(np.hypot(found[:, 0] - layout[l, 0], found[:, 1] - layout[l, 1]))
+                    for l in remaining]
+        plan.append(remaining[int(np.argmax(distance))])
+    return plan
+
+def align_chip(stage_controller,
+               first_mark,
+               cur_chip,
+               alignment_model,
+               exposure,
+               frame_to_pixel_ratio,
+               camera_pixel_width=2688,
+               camera_pixel_height=2200,
+               z_at=None,
+               progress=None,
+               batch=False,
+               camera_profile=sc_utils.DEFAULT_PROFILE):
+    ''' Finds the chip's position and rotation from its alignment marks.
+
+    Every mark found in a field is paired with the chip's mark layout 
+    and the rotation and translation are fitted to all pairs by least 
+    squares. More fields are only visited, starting with the mark 
+    farthest from the ones found, until the marks found are far enough 
+    apart to fix the rotation and the fit agrees with the layout.
+
+    args:
+        first_mark: StagePosition estimate of the first alignment mark
+        cur_chip: chip dict from experiment_config.yml
+        alignment_model: MarkLocator or Mask R-CNN inference model
+        z_at: function of (x, y) giving the z of a field, first_mark.z is 
+            used if None
+        progress: progress.Progress instance
+        batch: capture the fields of plan_fields() first and find their 
+            marks together, so Mask R-CNN runs once for all of them. 
+            Fields are then visited one at a time if the fit needs more.
+        camera_profile: sc_utils.CAMERA_PROFILES entry to take the fields 
+            with. Binned frames are scaled back up to sensor pixels so 
+            the mark template and model see marks of the usual size, a 
+            profile with an roi gives smaller fields.
+    returns:
+        PositionList of the three corners used by chip.Chip, the fitted 
+        position.RigidTransform (with its residual in um) and the 
+        (frames, StagePositions) of the visited fields
+    '''
+    if not isinstance(alignment_model, MarkLocator):
+        alignment_model = MarkLocator(alignment_model)
+    if progress is None:
+        progress = prog.Progress()
+    if z_at is None:
+        z_at = lambda x, y: first_mark.z
+    layout = mark_layout(cur_chip)
+    camera_pixel_width, camera_pixel_height = sc_utils.profile_field(
+        (camera_pixel_width, camera_pixel_height), camera_profile)
+    field_size = (camera_pixel_width * frame_to_pixel_ratio,
+                  camera_pixel_height * frame_to_pixel_ratio)
+    chip_size = np.hypot(cur_chip['chip_width'], cur_chip['chip_height'])
+    pose = pos.RigidTransform(tx=first_mark.x, ty=first_mark.y)
+    src, dst = [], []
+    frames, fields = [], []
+    visited = []
+    progress.phase('Alignment', len(layout))
+
+    def capture(target):
+        visited.append(target)
+        x, y = pose.apply([layout[target]])[0]
+        field = pos.StagePosition(x=float(x), y=float(y), z=z_at(x, y))
+        field.goto(stage_controller)
+        frame = sc_utils.get_frame(exposure, camera_profile)
+        return field, sc_utils.to_sensor_pixels(frame, camera_profile)
+
+    def add_field(field, frame, centers):
+        nonlocal pose
+        progress.step()
+        if len(centers) == 0:
+            sc_utils.print_info('No alignment mark at ' + str(field))
+        else:
+            frames.append(frame)
+            fields.append(field)
+            marks = np.array([pixel_to_stage(field, c, frame_to_pixel_ratio, camera_pixel_width,
+                                             camera_pixel_height) for c in centers])
+            for k, l in match_field(marks, layout, pose, (field.x, field.y), field_size):
+                if l not in src:
+                    src.append(l)
+                    dst.append(marks[k])
+        if src:
+            pose = pos.fit_rigid_transform(layout[src], dst)
+
+    def done():
+        if len(src) < 2:
+            return False
+        found = layout[src]
+        baseline = np.max(np.hypot(found[:, None, 0] - found[None, :, 0],
+                                   found[:, None, 1] - found[None, :, 1]))
+        return (MARK_ERROR * chip_size / baseline <= MAX_CORNER_ERROR 
+                and pose.residual <= MAX_POSE_RESIDUAL)
+
+    def next_target():
+        # Next is the mark farthest from the marks already found
+        remaining = [l for l in range(len(layout)) if l not in visited and l not in src]
+        if remaining and src:
+            found = layout[src]
+            distance = [np.min(np.hypot(found[:, 0] - layout[l, 0], found[:, 1] - layout[l, 1]))
+                        for l in remaining]
+            return remaining[int(np.argmax(distance))]
+        elif remaining:
+            return remaining[0]
+        return None
+
+    if batch:
+        captured = [capture(target) for target in plan_fields(layout, chip_size)]
+        located = alignment_model.locate_many([frame for _, frame in captured])
+        for (field, frame), (centers, _) in zip(captured, located):
+            add_field(field, frame, centers)
+        target = None if done() else next_target()
+    else:
+        target = 0
+    while target is not None:
+        field, frame = capture(target)
+        try:
+            centers, _ = alignment_model.locate_all(frame)
+        except NoMarkError:
+            centers = []
+        add_field(field, frame, centers)
+        if done():
+            break
+        target = next_target()
+
+    if not src:
+        raise NoMarkError('No alignment mark found')
+    if len(src) < 2:
+        raise NoMarkError('Only one alignment mark found, the chip rotation is unknown')
+    if pose.residual > MAX_POSE_RESIDUAL:
+        sc_utils.print_error('Alignment marks do not match the mark layout, rms error ' +
+                             str(round(pose.residual, 1)) + 'um')
+    sc_utils.print_info('Chip pose: ' + str(pose) + ' from ' + str(len(src)) + ' marks in ' +
+                        str(len(fields)) + ' fields, rms error ' + str(round(pose.residual, 2)) + 'um')
+    w = cur_chip['chip_width']
+    h = cur_chip['chip_height']
+    corners = pos.PositionList(positions=[
+        pos.StagePosition(x=float(x), y=float(y), z=z_at(x, y))
+        for x, y in pose.apply([[0, 0], [w, 0], [w, -h]])])
+    return corners, pose, (frames, fields)
+
 def extended_search(stage_controller):
     center = pos.current(stage_controller)
     keep_searching = True
@@ -0,0 +1,198 @@
+"""
+SmartScope
+Cached alignment mark annotations for MarkDataset.
+
+Building a MarkDataset from a Labelbox export reads every image just to
+get its size, and load_mask() rasterizes every polygon again on every
+epoch. build_store() does both once. It writes an index of the image
+sizes, polygons and class IDs, and a memory-mapped array of the
+rasterized masks. Each mask is cropped to its box, so the store is about
+the size of the marks, not of the frames.
+
+An entry is rebuilt when its annotation or its image file changes. When
+the export has not changed, the index is read without parsing the
+export or opening any image.
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import skimage.draw
+import skimage.io
+
+# Written to the index, a store with a different version is rebuilt
+STORE_VERSION = 1
+
+
+def labels_polygons(label, class_names):
+    ''' Polygons and class IDs of a Labelbox label
+
+    args:
+        label: the 'Label' of a Labelbox annotation
+        class_names: class names, their class IDs start at 1
+    returns:
+        (polygons, class_ids), polygons are dicts of all_points_x and
+        all_points_y
+    '''
+    polygons = []
+    class_ids = []
+    # Skipped images are labeled 'Skip'
+    if not isinstance(label, dict):
+        return polygons, class_ids
+    for class_id, name in enumerate(class_names, 1):
+        for r in label.get(name, []):
+            polygons.append({'all_points_x': [p['x'] for p in r['geometry']],
+                             'all_points_y': [p['y'] for p in r['geometry']]})
+            class_ids.append(class_id)
+    return polygons, class_ids
+
+
+def rasterize(polygons, height, width):
+    ''' returns:
+        [(box, mask)] of every polygon, box is (y1, x1, y2, x2) and mask
+        the bool crop of the polygon inside it
+    '''
+    crops = []
+    for p in polygons:
+        rr, cc = skimage.draw.polygon(p['all_points_y'], p['all_points_x'], shape=(height, width))
+        if len(rr) == 0:
+            crops.append(((0, 0, 0, 0), np.zeros((0, 0), dtype=bool)))
+            continue
+        y1, x1, y2, x2 = rr.min(), cc.min(), rr.max() + 1, cc.max() + 1
+        mask = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+        mask[rr - y1, cc - x1] = True
+        crops.append(((int(y1), int(x1), int(y2), int(x2)), mask))
+    return crops
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def store_paths(labels_path, cache_dir):
+    ''' (index, masks) paths of the store of a Labelbox export '''
+    name = os.path.splitext(os.path.basename(labels_path))[0]
+    return (os.path.join(cache_dir, name + '.index.json'),
+            os.path.join(cache_dir, name + '.masks.npy'))
+
+
+def build_store(labels_path, dataset_dir, cache_dir, class_names=('Mark',)):
+    ''' Builds or updates the store of a Labelbox export
+
+    args:
+        labels_path: Labelbox json export
+        dataset_dir: folder of the labeled images
+        cache_dir: folder of the store
+        class_names: classes to load from the labels
+    returns:
+        MaskStore
+    '''
+    index_path, masks_path = store_paths(labels_path, cache_dir)
+    labels_hash = file_hash(labels_path)
+    settings = {'version': STORE_VERSION, 'dataset_dir': os.path.abspath(dataset_dir),
+                'class_names': list(class_names)}
+    old = None
+    if os.path.isfile(index_path) and os.path.isfile(masks_path):
+        old = MaskStore(index_path, masks_path)
+        if old.index['settings'] != settings:
+            old = None
+        elif old.index['labels_hash'] == labels_hash and all(
+                _image_time(e['path']) == e['image_time'] for e in old.entries):
+            return old
+
+    previous = {e['id']: e for e in old.entries} if old is not None else {}
+    with open(labels_path, 'r') as f:
+        annotations = json.load(f)
+    entries = []
+    chunks = []
+    offset = 0
+    rasterized = 0
+    for a in annotations:
+        polygons, class_ids = labels_polygons(a['Label'], class_names)
+        if not polygons:
+            continue
+        path = os.path.join(dataset_dir, a['External ID'])
+        key = hashlib.md5(json.dumps(a['Label'], sort_keys=True).encode()).hexdigest()
+        image_time = _image_time(path)
+        entry = previous.get(a['External ID'])
+        if entry is not None and entry['key'] == key and entry['image_time'] == image_time:
+            crops = [(box, old.crop(box, start)) for box, start in entry['instances']]
+            height, width = entry['height'], entry['width']
+        else:
+            height, width = skimage.io.imread(path).shape[:2]
+            crops = rasterize(polygons, height, width)
+            rasterized += 1
+        instances = []
+        for box, mask in crops:
+            instances.append([list(box), offset])
+            chunks.append(mask.ravel())
+            offset += mask.size
+        entries.append({'id': a['External ID'], 'path': path, 'image_time': image_time,
+                        'key': key, 'height': int(height), 'width': int(width),
+                        'polygons': polygons, 'class_ids': class_ids, 'instances': instances})
+    if old is not None:
+        old.close()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    masks = np.concatenate(chunks) if chunks else np.zeros(0, dtype=bool)
+    np.save(masks_path, masks)
+    with open(index_path, 'w') as f:
+        json.dump({'settings': settings, 'labels_hash': labels_hash, 'entries': entries}, f)
+    store = MaskStore(index_path, masks_path)
+    store.rasterized = rasterized
+    return store
+
+
+def _image_time(path):
+    return os.path.getmtime(path) if os.path.isfile(path) else None
+
+
+class MaskStore:
+    ''' Image sizes, polygons and rasterized masks of a Labelbox export,
+    written by build_store()
+    '''
+
+    def __init__(self, index_path, masks_path):
+        self.index_path = index_path
+        self.masks_path = masks_path
+        with open(index_path, 'r') as f:
+            self.index = json.load(f)
+        self.entries = self.index['entries']
+        # Images rasterized by the build_store() that returned this store
+        self.rasterized = 0
+        self._masks = None
+
+    @property
+    def masks(self):
+        if self._masks is None:
+            self._masks = np.load(self.masks_path, mmap_mode='r')
+        return self._masks
+
+    def __getstate__(self):
+        # The memory map is opened again after unpickling
+        state = dict(self.__dict__)
+        state['_masks'] = None
+        return state
+
+    def close(self):
+        self._masks = None
+
+    def crop(self, box, start):
+        y1, x1, y2, x2 = box
+        size = (y2 - y1) * (x2 - x1)
+        return np.array(self.masks[start:start + size]).reshape(y2 - y1, x2 - x1)
+
+    def load_mask(self, i):
+        ''' Masks of entry i, as returned by MarkDataset.load_mask() '''
+        entry = self.entries[i]
+        mask = np.zeros([entry['height'], entry['width'], len(entry['instances'])], dtype=bool)
+        for j, ((y1, x1, y2, x2), start) in enumerate(entry['instances']):
+            mask[y1:y2, x1:x2, j] = self.crop((y1, x1, y2, x2), start)
+        return mask, np.array(entry['class_ids'], dtype=np.int32)
@@ -8,7 +8,12 @@ Written by Caleb Sanford
 """
 
 import os
+import json
+import numpy as np
+import skimage.draw
+from skimage.io import imread
 
+from smartscope.source.dataset import mark_cache
 from smartscope.source.maskrcnn import utils
 from smartscope.source.maskrcnn import model as modellib
 from smartscope.source.maskrcnn import visualize
@@ -38,41 +43,54 @@ class MarkConfig(Config):
 
 class MarkDataset(utils.Dataset):
 
-    def load_shapes(self, subset):
+    def load_shapes(self, subset, dataset_dir='.', labels_path=None, cache_dir=None):
+        """Adds the labeled images of a Labelbox export.
+        subset: 'train' or 'val', loads train.json or val.json
+        dataset_dir: folder of the labeled images
+        labels_path: Optional. Labelbox export to load instead of the subset
+        cache_dir: Optional. Keep the image sizes and rasterized masks in a
+            mark_cache.MaskStore in this folder
+        """
         # Add classes. We have only one class to add.
         self.add_class("Mark", 1, "Mark")
 
         # Train or validation dataset?
-        dataset_dir = dataset_path
-        
-        if subset == 'train':
-            annotations = json.load(open('train.json', 'r'))
-        else:
-            annotations = json.load(open('val.json', 'r'))
-        
-        # Add images annotated with Labelbox 
-        for a in annotations:
-            print(a['Label'])
-            if 'Mark' in a['Label']:
-                polys = [r['geometry'] for r in a['Label']['Mark']] 
-                polygons = []
-
-                for i, p in enumerate(polys):
-                    x_points = [x['x'] for x in p]
-                    y_points = [y['y'] for y in p]
-                    polygons.append({'all_points_x': x_points, 'all_points_y': y_points})
-
-                # Get Image Size 
-                image_path = os.path.join(dataset_dir, a['External ID'])
-                image = imread(image_path)
-                height, width = image.shape[:2]
+        if labels_path is None:
+            labels_path = 'train.json' if subset == 'train' else 'val.json'
 
+        if cache_dir is not None:
+            self.mask_store = mark_cache.build_store(labels_path, dataset_dir, cache_dir)
+            for i, e in enumerate(self.mask_store.entries):
                 self.add_image(
                     "Mark",
-                    image_id=a['External ID'],  # use file name as a unique image id
-                    path=image_path,
-                    width=width, height=height,
-                    polygons=polygons)
+                    image_id=e['id'],
+                    path=e['path'],
+                    width=e['width'], height=e['height'],
+                    polygons=e['polygons'],
+                    store_index=i)
+            return
+
+        annotations = json.load(open(labels_path, 'r'))
+
+        # Add images annotated with Labelbox 
+        for a in annotations:
+            # Skipped images and images without a mark are left out, the
+            # same as in mark_cache.build_store()
+            polygons, _ = mark_cache.labels_polygons(a['Label'], ['Mark'])
+            if not polygons:
+                continue
+
+            # Get Image Size 
+            image_path = os.path.join(dataset_dir, a['External ID'])
+            image = imread(image_path)
+            height, width = image.shape[:2]
+
+            self.add_image(
+                "Mark",
+                image_id=a['External ID'],  # use file name as a unique image id
+                path=image_path,
+                width=width, height=height,
+                polygons=polygons)
         
     def load_mask(self, image_id):
         """Generate instance masks for an image.
@@ -86,19 +104,25 @@ class MarkDataset(utils.Dataset):
         if image_info["source"] != "Mark":
             return super(self.__class__, self).load_mask(image_id)
 
+        # Masks rasterized by mark_cache.build_store()
+        info = self.image_info[image_id]
+        if 'store_index' in info:
+            return self.mask_store.load_mask(info['store_index'])
+
         # Convert polygons to a bitmap mask of shape
         # [height, width, instance_count]
-        info = self.image_info[image_id]
         mask = np.zeros([info["height"], info["width"], len(info["polygons"])],
                         dtype=np.uint8)
         for i, p in enumerate(info["polygons"]):
-            # Get indexes of pixels inside the polygon and set them to 1
-            rr, cc = skimage.draw.polygon(p['all_points_y'], p['all_points_x'])
+            # Get indexes of pixels inside the polygon and set them to 1,
+            # clipped to the image like the masks of mark_cache.rasterize()
+            rr, cc = skimage.draw.polygon(p['all_points_y'], p['all_points_x'],
+                                          shape=(info["height"], info["width"]))
             mask[rr, cc, i] = 1
 
         # Return mask, and array of class IDs of each instance. Since we have
         # one class ID only, we return an array of 1s
-        return mask.astype(np.bool), np.ones([mask.shape[-1]], dtype=np.int32)
+        return mask.astype(bool), np.ones([mask.shape[-1]], dtype=np.int32)
 
     def image_reference(self, image_id):
         """Return the path of the image."""
@@ -113,4 +137,40 @@ class InferenceConfig(MarkConfig):
     # Set batch size to 1 since we'll be running inference on
     # one image at a time. Batch size = GPU_COUNT * IMAGES_PER_GPU
     GPU_COUNT = 1
-    IMAGES_PER_GPU = 1
\ No newline at end of file
+    IMAGES_PER_GPU = 1
+
+
+class FastInferenceConfig(InferenceConfig):
+    """CPU friendly inference with the standard ResNet-101 weights.
+    There are only a few marks in a frame, so the input is smaller and
+    far fewer proposals and detections are kept.
+    """
+    IMAGE_MIN_DIM = 512
+    IMAGE_MAX_DIM = 512
+    PRE_NMS_LIMIT = 1000
+    POST_NMS_ROIS_INFERENCE = 100
+    DETECTION_MAX_INSTANCES = 10
+
+
+class LightMarkConfig(MarkConfig):
+    """Training configuration for the light profile. Models trained with
+    it must be loaded with LightInferenceConfig.
+    """
+    BACKBONE = "resnet50"
+    IMAGE_MIN_DIM = 512
+    IMAGE_MAX_DIM = 512
+
+
+class LightInferenceConfig(FastInferenceConfig):
+    """FastInferenceConfig with a ResNet-50 backbone, for models trained
+    with LightMarkConfig.
+    """
+    BACKBONE = "resnet50"
+
+
+# Inference configurations by profile name
+INFERENCE_PROFILES = {
+    'default': InferenceConfig,
+    'fast': FastInferenceConfig,
+    'light': LightInferenceConfig,
+}
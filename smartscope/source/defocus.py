@@ -0,0 +1,272 @@
+"""
+SmartScope
+Single-shot defocus estimation.
+
+The focus model gives the probability of each of its defocus levels.
+A level says how far a frame is from focus but not on which side, so
+two frames a known z offset apart are used. A calibration for each chip
+type stores the mean probabilities the model gives at each signed
+distance from focus. The focus z is the one whose calibrated
+probabilities best explain both frames. The drive moves straight there
+and one frame checks the result. Most points then take three frames
+instead of a scan of fifteen or more.
+
+Calibrate a chip type from the focused positions of an earlier run:
+
+    python -m smartscope.source.defocus --chip "KL Chip" \\
+        --focus-model path/to/model.ckpt-1000042 --positions path/to/focused_pl.json
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from smartscope.source import position as pos
+from smartscope.source import progress as prog
+from smartscope.source import sc_utils
+
+# Calibrations of each chip type
+CALIBRATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../config/focus_calibrations')
+# z distance (um) between the two frames of an estimate
+OFFSET = 10.0
+# Largest distance (um) from focus that a checked frame can be at
+TOLERANCE = 3.0
+# Step (um) of the distances tried when estimating
+RESOLUTION = 0.25
+# Keeps the log of a calibrated probability finite
+EPSILON = 1e-6
+
+
+def calibration_path(chip_name):
+    ''' Path of the defocus calibration for a chip type '''
+    return os.path.join(CALIBRATION_DIR, chip_name.replace(' ', '_') + '.json')
+
+
+def load_calibration(chip_name):
+    ''' returns:
+        the chip type's DefocusCalibration, None if it has not been
+        calibrated
+    '''
+    path = calibration_path(chip_name)
+    if not os.path.isfile(path):
+        return None
+    return DefocusCalibration.load(path)
+
+
+class DefocusCalibration:
+    ''' Mean focus model probabilities at each signed distance from focus
+
+    args:
+        distances: increasing z - focus z (um) of each row
+        probabilities: [distances, classes] mean class probabilities
+        model: checkpoint name of the focus model the calibration was 
+            made with
+        camera_profile: sc_utils.CAMERA_PROFILES entry the calibration 
+            was made with
+    '''
+    def __init__(self, distances, probabilities, model=None, camera_profile=None):
+        self.distances = np.asarray(distances, dtype=np.float64)
+        self.probabilities = np.asarray(probabilities, dtype=np.float64)
+        self.model = model
+        self.camera_profile = camera_profile
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return cls(data['distances'], data['probabilities'], data.get('model'),
+                   data.get('camera_profile'))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'distances': self.distances.tolist(),
+                       'probabilities': self.probabilities.tolist(),
+                       'model': self.model,
+                       'camera_profile': self.camera_profile}, f)
+
+    def mismatch(self, model_path, camera_profile):
+        ''' Why the calibration can not be used to focus with a focus 
+        model and camera profile. The class probabilities of another 
+        model or profile are not the ones calibrated.
+
+        args:
+            model_path: checkpoint of the focus model
+            camera_profile: sc_utils.CAMERA_PROFILES entry of the focus 
+                frames
+        returns:
+            the reason, None if the calibration can be used
+        '''
+        if self.model != os.path.basename(model_path):
+            return 'made with focus model ' + str(self.model)
+        if self.camera_profile != camera_profile:
+            return 'made with camera profile ' + str(self.camera_profile)
+        return None
+
+    def expected(self, distances):
+        ''' Calibrated probabilities at any distances, the end rows are
+        used beyond the calibrated range
+
+        returns:
+            [..., classes] array
+        '''
+        distances = np.asarray(distances, dtype=np.float64)
+        columns = [np.interp(distances.ravel(), self.distances, p) for p in self.probabilities.T]
+        return np.stack(columns, -1).reshape(distances.shape + (len(columns),))
+
+    def _costs(self, probabilities, z, focus_z):
+        ''' Cross entropy of the frames' probabilities with the calibration
+        for every focus z
+        '''
+        q = self.expected(z[np.newaxis, :] - focus_z[:, np.newaxis])
+        return -(probabilities[np.newaxis] * np.log(q + EPSILON)).sum(axis=(1, 2))
+
+    def estimate(self, probabilities, z, resolution=RESOLUTION):
+        ''' Estimates the focus z from frames taken at known z
+
+        args:
+            probabilities: [frames, classes] focus model probabilities
+            z: z of each frame, two frames at different z fix the side
+                of focus
+        returns:
+            focus z
+        '''
+        probabilities = np.asarray(probabilities, dtype=np.float64)
+        z = np.asarray(z, dtype=np.float64)
+        # Every focus z that puts the first frame in the calibrated range
+        grid = np.arange(self.distances[0], self.distances[-1] + resolution / 2.0, resolution)
+        focus_z = z[0] - grid
+        return float(focus_z[np.argmin(self._costs(probabilities, z, focus_z))])
+
+    def distance(self, probabilities, resolution=RESOLUTION):
+        ''' Distance (um) from focus of one frame, without its sign '''
+        return abs(self.estimate([probabilities], [0.0], resolution))
+
+
+def calibrate(mmc, focus_model, positions, total_z=40, delta_z=2, exposure=1,
+              camera_profile=sc_utils.DEFAULT_PROFILE, progress=None):
+    ''' Records the focus model probabilities through focus
+
+    At each position frames are taken every delta_z through total_z
+    around its z. The frame with the best score is taken as the focus,
+    so the z of the positions only has to be close. The probabilities
+    are averaged over the positions at each distance from focus.
+
+    args:
+        mmc: Micro-manager instance
+        focus_model: focus model with predict()
+        positions: PositionList of points near focus, eg. the
+            focused_pl.json of a run
+        total_z: z range (um) recorded around each position
+        delta_z: z step (um)
+        camera_profile: sc_utils.CAMERA_PROFILES entry, use the one
+            focusing will use
+        progress: progress.Progress instance
+    returns:
+        DefocusCalibration
+    '''
+    if progress is None:
+        progress = prog.Progress()
+    steps = np.arange(-total_z / 2.0, total_z / 2.0 + delta_z / 2.0, delta_z)
+    sums = {}
+    counts = {}
+    progress.phase('Defocus calibration', len(positions))
+    cam = sc_utils.start_cam(camera_profile)
+    try:
+        for p in positions:
+            pos.set_pos(mmc, x=p.x, y=p.y)
+            probabilities = []
+            for step in steps:
+                progress.check()
+                pos.set_pos(mmc, z=p.z + step)
+                frame = sc_utils.get_live_frame(cam, exposure)
+                probabilities.append(_probabilities(focus_model, frame))
+            probabilities = np.array(probabilities)
+            scores = probabilities.dot(np.arange(probabilities.shape[1]))
+            best = int(np.argmin(scores))
+            for i, p_i in enumerate(probabilities):
+                k = i - best
+                sums[k] = sums.get(k, 0) + p_i
+                counts[k] = counts.get(k, 0) + 1
+            progress.step()
+    finally:
+        sc_utils.close_cam(cam)
+    keys = sorted(sums)
+    return DefocusCalibration([k * delta_z for k in keys],
+                              [sums[k] / counts[k] for k in keys],
+                              camera_profile=camera_profile)
+
+
+def jump_focus(mmc, cam, focus_model, calibration, z=None, offset=OFFSET, exposure=1,
+               tolerance=TOLERANCE, progress=None):
+    ''' Moves straight to focus from two frames offset apart
+
+    The focus is estimated from frames at z and z + offset. One frame
+    at the estimate checks it. If that frame is out of focus, the
+    estimate is made again from all three frames and checked once more.
+
+    args:
+        mmc: Micro-manager instance
+        cam: open camera
+        focus_model: focus model with predict()
+        calibration: DefocusCalibration of the chip type
+        z: z of the first frame, the current z if None
+        offset: z distance (um) between the first two frames
+        tolerance: largest distance (um) from focus of the checked frame
+        progress: progress.Progress instance
+    returns:
+        focus z, True if a frame there was in focus
+    '''
+    if progress is None:
+        progress = prog.Progress()
+    if z is None:
+        z = pos.current(mmc).z
+    zs, probabilities = [], []
+
+    def capture(target):
+        progress.check()
+        pos.set_pos(mmc, z=target)
+        zs.append(target)
+        probabilities.append(_probabilities(focus_model, sc_utils.get_live_frame(cam, exposure)))
+
+    capture(z)
+    capture(z + offset)
+    for _ in range(2):
+        target = calibration.estimate(probabilities, zs)
+        capture(target)
+        if calibration.distance(probabilities[-1]) <= tolerance:
+            return target, True
+    return target, False
+
+
+def _probabilities(focus_model, frame):
+    return focus_model.predict(sc_utils.bytescale(frame, high=65535)).probabilities
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Calibrate defocus estimation for a chip type')
+    parser.add_argument('--chip', required=True, help='chip type in experiment_config.yml')
+    parser.add_argument('--focus-model', required=True, help='focus model checkpoint')
+    parser.add_argument('--positions', required=True, help='PositionList json of focused points')
+    parser.add_argument('--range', type=float, default=40, help='z range (um) around each point')
+    parser.add_argument('--step', type=float, default=2, help='z step (um)')
+    parser.add_argument('--exposure', type=int, default=1)
+    parser.add_argument('--camera', default=sc_utils.DEFAULT_PROFILE, help='camera profile')
+    parser.add_argument('--stage-config', default='../../config/scope_stage2.cfg')
+    args = parser.parse_args()
+
+    from smartscope.source.miq import miq
+    path = os.path.abspath(args.positions)
+    positions = pos.load(os.path.splitext(os.path.basename(path))[0], os.path.dirname(path))
+    mmc = sc_utils.get_stage_controller(args.stage_config)
+    calibration = calibrate(mmc, miq.get_classifier(miq.checkpoint_path(args.focus_model)),
+                            positions, args.range, args.step, args.exposure, args.camera)
+    calibration.model = os.path.basename(miq.checkpoint_path(args.focus_model))
+    calibration.save(calibration_path(args.chip))
+    print('Saved ' + calibration_path(args.chip))
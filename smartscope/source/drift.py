@@ -0,0 +1,200 @@
+"""
+SmartScope
+Drift correction between timepoints.
+
+At t00 the frames used to find the alignment marks are saved next to
+the corner positions as reference fields. At a later timepoint the
+stage returns to the same positions and each new frame is registered
+against its reference with sub-pixel phase correlation. The shift of
+every field gives a measured point on the chip, and the rotation and
+translation that best fits those points is applied to the saved corner
+and focus positions. This keeps track of the chip creeping on the
+stage without running the alignment model again.
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+import os
+import json
+import cv2
+import numpy as np
+import tifffile as tif
+
+from smartscope.source import position as pos
+from smartscope.source import sc_utils
+from smartscope.source import progress as prog
+
+# Position list of the stage positions the reference fields were taken at
+REFERENCE_PL = 'reference_pl'
+# Camera profile the reference fields were taken with
+REFERENCE_INFO = 'reference.json'
+# Reference fields are saved and registered at this fraction of full size
+REFERENCE_SCALE = 0.5
+# Phase correlation peak below which a field is not used
+MIN_RESPONSE = 0.05
+# Largest rms error (um) of the fitted drift before it is rejected
+MAX_RESIDUAL = 10.0
+
+
+def reference_path(positions_dir, i):
+    return os.path.join(positions_dir, 'reference_' + str(i) + '.tif')
+
+
+def _prepare(frame, binning=1):
+    ''' Float32 frame at REFERENCE_SCALE of the sensor pixels for 
+    registration
+
+    args:
+        binning: sensor pixels per frame pixel in each direction
+    '''
+    frame = np.asarray(frame, dtype=np.float32)
+    scale = REFERENCE_SCALE * binning
+    if scale != 1:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale,
+                           interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+    return frame
+
+
+def save_references(frames, positions, save_dir, camera_profile=sc_utils.DEFAULT_PROFILE):
+    ''' Saves the reference fields for drift correction
+
+    args:
+        frames: camera frames in sensor pixels, as returned by 
+            alignment.align_chip()
+        positions: StagePositions the frames were taken at
+        save_dir: directory the corner positions are saved to
+        camera_profile: sc_utils.CAMERA_PROFILES entry the frames were 
+            taken with, later frames are taken with it too
+    '''
+    for i, frame in enumerate(frames):
+        tif.imwrite(reference_path(save_dir, i), _prepare(frame))
+    pos.PositionList(positions=list(positions)).save(REFERENCE_PL, save_dir)
+    with open(os.path.join(save_dir, REFERENCE_INFO), 'w') as f:
+        json.dump({'camera_profile': camera_profile}, f, indent=2)
+
+
+def load_references(positions_dir):
+    ''' returns:
+        (frames, PositionList, camera profile) of the reference fields, 
+        None if positions_dir has no reference fields
+    '''
+    if not os.path.isfile(os.path.join(positions_dir, REFERENCE_PL + '.json')):
+        return None
+    positions = pos.load(REFERENCE_PL, positions_dir)
+    frames = [tif.imread(reference_path(positions_dir, i)) for i in range(len(positions))]
+    # References saved before the profile was recorded are full frames
+    profile = sc_utils.DEFAULT_PROFILE
+    info_path = os.path.join(positions_dir, REFERENCE_INFO)
+    if os.path.isfile(info_path):
+        with open(info_path, 'r') as f:
+            profile = json.load(f)['camera_profile']
+    return frames, positions, profile
+
+
+def phase_correlate(reference, frame, binning=1):
+    ''' Sub-pixel shift of frame relative to reference
+
+    args:
+        reference: prepared reference field (see save_references)
+        frame: camera frame, taken with the profile of the reference
+        binning: binning of the frame
+    returns:
+        ((dx, dy) shift in sensor pixels, peak response)
+    '''
+    frame = _prepare(frame, binning)
+    if frame.shape != reference.shape:
+        raise DriftError('Reference field is ' + str(reference.shape) + ' but the frame is ' +
+                         str(frame.shape) + ', the camera profile changed')
+    window = cv2.createHanningWindow(frame.shape[::-1], cv2.CV_32F)
+    reference = reference.astype(np.float32)
+    (dx, dy), response = cv2.phaseCorrelate(reference - reference.mean(),
+                                            frame - frame.mean(), window)
+    return (dx / REFERENCE_SCALE, dy / REFERENCE_SCALE), response
+
+
+def estimate_drift(mmc, references, exposure, frame_to_pixel_ratio, progress=None):
+    ''' Goes to every reference field and measures how far the chip has
+    moved since it was taken
+
+    args:
+        mmc: Micro-Manager instance
+        references: (frames, PositionList, camera profile) from 
+            load_references()
+        exposure: camera exposure, same as at t00
+        frame_to_pixel_ratio: um per sensor pixel
+        progress: progress.Progress instance
+    returns:
+        position.RigidTransform from the t00 positions to where they
+        are now
+    '''
+    if progress is None:
+        progress = prog.Progress()
+    frames, positions, profile = references
+    binning = sc_utils.CAMERA_PROFILES[profile]['binning']
+    progress.phase('Drift', len(positions))
+    src, dst, weights = [], [], []
+    cam = sc_utils.start_cam(profile)
+    try:
+        for reference, p in zip(frames, positions):
+            p.goto(mmc)
+            frame = sc_utils.get_live_frame(cam, exposure)
+            (dx, dy), response = phase_correlate(reference, frame, binning)
+            progress.step()
+            if response < MIN_RESPONSE:
+                sc_utils.print_info('Drift: no match at ' + str(p) +
+                                    ' (response ' + str(round(response, 3)) + ')')
+                continue
+            # The chip moves the opposite way to its image (see alignment.get_center)
+            src.append([p.x, p.y])
+            dst.append([p.x - dx * frame_to_pixel_ratio, p.y - dy * frame_to_pixel_ratio])
+            weights.append(response)
+    finally:
+        sc_utils.close_cam(cam)
+    if not src:
+        raise DriftError('No reference field matched')
+    transform = pos.fit_rigid_transform(src, dst, weights)
+    if transform.residual > MAX_RESIDUAL:
+        raise DriftError('Reference fields do not agree, rms error ' +
+                         str(round(transform.residual, 1)) + 'um')
+    return transform
+
+
+def correct_saved_positions(mmc, positions_dir, save_dir, exposure, frame_to_pixel_ratio,
+                            progress=None):
+    ''' Moves the saved corner and focus positions with the chip
+
+    The corrected corners_pl and focused_pl are saved to save_dir along
+    with the measured drift. The saved positions are used unchanged if
+    there are no reference fields or the drift can not be measured.
+
+    returns:
+        directory to load the positions from
+    '''
+    if os.path.abspath(positions_dir) == os.path.abspath(save_dir):
+        return positions_dir
+    references = load_references(positions_dir)
+    if references is None:
+        sc_utils.print_info('No reference fields in ' + positions_dir + ', drift not corrected')
+        return positions_dir
+    try:
+        transform = estimate_drift(mmc, references, exposure, frame_to_pixel_ratio, progress)
+    except DriftError as e:
+        sc_utils.print_error('Drift not corrected: ' + e.message)
+        return positions_dir
+    sc_utils.print_info('Drift since t00: ' + str(transform))
+    os.makedirs(save_dir, exist_ok=True)
+    for name in ['corners_pl', 'focused_pl']:
+        transform.apply_to(pos.load(name, positions_dir)).save(name, save_dir)
+    with open(os.path.join(save_dir, 'drift.json'), 'w') as f:
+        json.dump(transform.to_dict(), f, indent=2)
+    return save_dir
+
+
+class DriftError(Exception):
+    ''' Raised when the drift of a chip can not be measured '''
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
@@ -0,0 +1,243 @@
+"""
+SmartScope
+Evaluation of alignment models on a labeled validation set.
+
+The model runs over the whole set in batches. While a batch is being
+detected, a pool of worker processes loads the next images and scores
+the finished ones. Each image's overlap matrix is computed once and
+matched at every IoU threshold. The summary has the mAP, the error of
+the mark centers in microns, and the detection latency per image.
+
+    python -m smartscope.source.evaluation --model alignment_30.h5 \\
+        --model alignment_50_v2.h5 --labels val.json --images path/to/images
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from smartscope.source.maskrcnn import model as modellib
+from smartscope.source.maskrcnn import utils
+
+# IoU thresholds of the mAP, the first one is also used for the center error
+IOU_THRESHOLDS = [0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95]
+
+
+def box_centers(boxes):
+    ''' (x, y) centers of [N, (y1, x1, y2, x2)] boxes, as in
+    alignment.get_mark_center()
+    '''
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return np.stack([(boxes[:, 1] + boxes[:, 3]) / 2.0, (boxes[:, 0] + boxes[:, 2]) / 2.0], -1)
+
+
+def score_image(gt_boxes, gt_class_ids, gt_masks, pred_boxes, pred_class_ids, pred_scores,
+                pred_masks, iou_thresholds=IOU_THRESHOLDS):
+    ''' Scores the detections of one image
+
+    args:
+        gt_masks, pred_masks: [H, W, N] masks, or None to match the boxes
+        iou_thresholds: thresholds to compute the AP at
+    returns:
+        dict of the AP at each threshold, the center error (px) of every
+        GT instance matched at the first threshold and the number missed
+    '''
+    gt_class_ids, sorted_class_ids, overlaps = utils.compute_match_overlaps(
+        gt_boxes, gt_class_ids, gt_masks, pred_boxes, pred_class_ids, pred_scores, pred_masks)
+    aps = []
+    for i, iou_threshold in enumerate(iou_thresholds):
+        gt_match, pred_match = utils.match_overlaps(overlaps, gt_class_ids, sorted_class_ids,
+                                                    iou_threshold)
+        aps.append(utils.compute_ap_from_matches(gt_match, pred_match)[0])
+        if i == 0:
+            first_match = gt_match
+    # The predictions in the order of the overlaps
+    pred_boxes = utils.trim_zeros(pred_boxes)
+    order = np.argsort(pred_scores[:pred_boxes.shape[0]])[::-1]
+    matched = first_match > -1
+    gt_centers = box_centers(utils.trim_zeros(gt_boxes)[matched])
+    pred_centers = box_centers(pred_boxes[order][first_match[matched].astype(int)])
+    errors = np.hypot(*(gt_centers - pred_centers).T) if matched.any() else np.zeros(0)
+    return {'ap': aps, 'center_errors': errors.tolist(), 'missed': int((~matched).sum())}
+
+
+# Set in each worker process by _init_worker()
+_worker = {}
+
+
+def _init_worker(dataset, config, use_masks, iou_thresholds):
+    _worker.update(dataset=dataset, config=config, use_masks=use_masks,
+                   iou_thresholds=iou_thresholds)
+
+
+def _load(image_id):
+    ''' Image and GT of image_id, resized like the training samples '''
+    image, image_meta, class_ids, boxes, masks = modellib.load_image_gt(
+        _worker['dataset'], _worker['config'], image_id, use_mini_mask=False)
+    return image_id, image, image_meta, class_ids, boxes, masks if _worker['use_masks'] else None
+
+
+def _score(gt, r):
+    class_ids, boxes, masks = gt
+    return score_image(boxes, class_ids, masks, r['rois'], r['class_ids'], r['scores'],
+                       r['masks'] if _worker['use_masks'] else None, _worker['iou_thresholds'])
+
+
+def evaluate(model, dataset, iou_thresholds=IOU_THRESHOLDS, workers=None, limit=None):
+    ''' Runs an inference model over a dataset and scores every image
+
+    args:
+        model: inference MaskRCNN or FrozenMaskRCNN, images are detected
+            in batches of model.config.BATCH_SIZE
+        dataset: prepared Dataset with the GT instances
+        iou_thresholds: thresholds to compute the AP at
+        workers: processes loading and scoring images, 0 does it in this
+            process. Defaults to one less than the number of CPUs.
+        limit: evaluate only the first limit images
+    returns:
+        list of score_image() dicts with the image_id, the scale of the
+        image to the model input and the detection latency (s)
+    '''
+    config = model.config
+    use_masks = not getattr(config, 'DETECTION_ONLY', False)
+    if workers is None:
+        workers = max(1, multiprocessing.cpu_count() - 1)
+    image_ids = list(dataset.image_ids[:limit])
+    if workers:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                    initargs=(dataset, config, use_masks, iou_thresholds))
+        samples = pool.imap(_load, image_ids)
+    else:
+        pool = None
+        _init_worker(dataset, config, use_masks, iou_thresholds)
+        samples = map(_load, image_ids)
+
+    pending = []
+    try:
+        batch = []
+        for i, sample in enumerate(samples):
+            # Images without instances can not be scored
+            if len(sample[3]) and np.any(sample[3] > 0):
+                batch.append(sample)
+            if len(batch) < config.BATCH_SIZE and i < len(image_ids) - 1:
+                continue
+            if not batch:
+                continue
+            images = [s[1] for s in batch]
+            # detect() needs a full batch
+            images += [images[-1]] * (config.BATCH_SIZE - len(images))
+            start = time.perf_counter()
+            results = model.detect(images)
+            latency = (time.perf_counter() - start) / config.BATCH_SIZE
+            for (image_id, _, image_meta, class_ids, boxes, masks), r in zip(batch, results):
+                info = {'image_id': int(image_id), 'latency': latency,
+                        'scale': float(modellib.parse_image_meta(image_meta[np.newaxis])['scale'][0])}
+                args = ((class_ids, boxes, masks), r)
+                if pool is not None:
+                    pending.append((info, pool.apply_async(_score, args)))
+                else:
+                    pending.append((info, utils.DoneResult(_score(*args))))
+            batch = []
+        scores = []
+        for info, job in pending:
+            info.update(job.get())
+            scores.append(info)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return scores
+
+
+def summarize(scores, frame_to_pixel_ratio, iou_thresholds=IOU_THRESHOLDS):
+    ''' returns:
+        dict of the mAP at the first threshold and over all thresholds,
+        the mean and 95th percentile of the center error (um) and of the
+        latency (ms), and the GT instances missed
+    '''
+    ap = np.array([s['ap'] for s in scores]).reshape(-1, len(iou_thresholds))
+    # Back to camera pixels, then to microns
+    errors = np.concatenate([np.array(s['center_errors']) / s['scale'] for s in scores] +
+                            [np.zeros(0)]) * frame_to_pixel_ratio
+    latency = np.array([s['latency'] for s in scores]) * 1000
+    nan = float('nan')
+    return {
+        'images': len(scores),
+        'mAP@' + str(iou_thresholds[0]): float(ap[:, 0].mean()) if len(ap) else nan,
+        'mAP': float(ap.mean()) if len(ap) else nan,
+        'error_um': float(errors.mean()) if len(errors) else nan,
+        'error_um_p95': float(np.percentile(errors, 95)) if len(errors) else nan,
+        'missed': int(sum(s['missed'] for s in scores)),
+        'latency_ms': float(latency.mean()) if len(latency) else nan,
+        'latency_ms_p95': float(np.percentile(latency, 95)) if len(latency) else nan,
+    }
+
+
+def run_model(model_path, args):
+    ''' Evaluates one model, run in its own process so every model gets
+    a fresh TF session
+    '''
+    from smartscope.source import alignment
+    from smartscope.source.dataset import mark_dataset
+    model = alignment.get_inference_model(model_path, detection_only=not args.masks,
+                                          profile=args.profile, batch_size=args.batch_size)
+    dataset = mark_dataset.MarkDataset()
+    dataset.load_shapes('val', dataset_dir=args.images, labels_path=args.labels,
+                        cache_dir=args.cache_dir)
+    dataset.prepare()
+    scores = evaluate(model, dataset, workers=args.workers, limit=args.limit)
+    return summarize(scores, args.ratio)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluate alignment models on a labeled set')
+    parser.add_argument('--model', action='append', required=True, help='model weights')
+    parser.add_argument('--labels', required=True, help='Labelbox json of the validation marks')
+    parser.add_argument('--images', required=True, help='folder of the validation images')
+    parser.add_argument('--profile', default='default', help='alignment inference profile')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--ratio', type=float, default=0.45, help='um per camera pixel')
+    parser.add_argument('--masks', action='store_true', help='score the masks instead of the boxes')
+    parser.add_argument('--cache-dir', default=None, help='mark_cache folder of the labels')
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run_model(args.model[0], args), f)
+        sys.exit(0)
+
+    out = tempfile.mkdtemp()
+    columns = ['images', 'mAP@0.5', 'mAP', 'error_um', 'error_um_p95', 'missed',
+               'latency_ms', 'latency_ms_p95']
+    print('{:<30}'.format('model') + ''.join('{:>15}'.format(c) for c in columns))
+    for i, path in enumerate(args.model):
+        output = os.path.join(out, str(i) + '.json')
+        command = [sys.executable, '-m', 'smartscope.source.evaluation', '--model', path,
+                   '--labels', args.labels, '--images', args.images, '--profile', args.profile,
+                   '--batch-size', str(args.batch_size), '--ratio', str(args.ratio),
+                   '--output', output]
+        for name in ['workers', 'limit', 'cache_dir']:
+            if getattr(args, name) is not None:
+                command += ['--' + name.replace('_', '-'), str(getattr(args, name))]
+        if args.masks:
+            command.append('--masks')
+        subprocess.check_call(command)
+        with open(output) as f:
+            summary = json.load(f)
+        print('{:<30}'.format(os.path.basename(path)) +
+              ''.join('{:>15.3f}'.format(summary[c]) if isinstance(summary[c], float)
+                      else '{:>15}'.format(summary[c]) for c in columns))
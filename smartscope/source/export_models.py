@@ -0,0 +1,88 @@
+"""
+SmartScope
+Exports the alignment and focus models as frozen graphs.
+
+Building the Mask R-CNN graph and loading the h5 weights, or building
+the MIQ graph and restoring its checkpoint, happens every time a model
+is loaded. A frozen graph has the weights folded in as constants and
+the training only nodes removed, so loading it is a single file read.
+get_inference_model() and get_classifier() use a frozen model when one
+matches the weights next to it. Run again after retraining, a frozen
+model older than its weights is ignored.
+
+    python -m smartscope.source.export_models --alignment-model path/to/alignment_30.h5 \\
+        --focus-model path/to/model.ckpt-1000042
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+import sys
+sys.path.append('C:\\Program Files\\Micro-Manager-2.0beta')
+import argparse
+
+from smartscope.source import frozen
+from smartscope.source import sc_utils
+
+
+def export_alignment_model(model_dir, profile='default', detection_only=True):
+    ''' Writes the frozen alignment model next to its weights
+
+    returns:
+        path of the frozen model
+    '''
+    # The graph must not depend on the learning phase placeholder
+    import keras.backend as K
+    K.clear_session()
+    K.set_learning_phase(0)
+    from smartscope.source import alignment
+    model = alignment.get_inference_model(model_dir, detection_only=detection_only,
+                                          profile=profile, use_frozen=False)
+    path = alignment.frozen_model_path(model_dir, detection_only, profile)
+    inputs, outputs = model.export_frozen(path)
+    frozen.write_info(path, model_dir, inputs=inputs, outputs=outputs,
+                      profile=profile, detection_only=detection_only)
+    sc_utils.print_info('Wrote ' + path)
+    return path
+
+
+def export_focus_model(model_path):
+    ''' Writes the frozen focus model next to its checkpoint
+
+    returns:
+        path of the frozen model
+    '''
+    from smartscope.source.miq import miq
+    classifier = miq.get_classifier(model_path, use_frozen=False)
+    path = frozen.frozen_path(model_path, 'frozen')
+    inputs, outputs = classifier.export_frozen(path)
+    frozen.write_info(path, model_path, inputs=inputs, outputs=outputs)
+    sc_utils.print_info('Wrote ' + path)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export frozen SmartScope models')
+    parser.add_argument('--alignment-model', action='append', default=[],
+                        help='alignment model weights (.h5)')
+    parser.add_argument('--profile', action='append',
+                        help='alignment inference profile (default: default)')
+    parser.add_argument('--with-masks', action='store_true',
+                        help='keep the mask head in the alignment model')
+    parser.add_argument('--focus-model', action='append', default=[],
+                        help='focus model checkpoint')
+    args = parser.parse_args(argv)
+
+    for model_dir in args.alignment_model:
+        for profile in args.profile or ['default']:
+            export_alignment_model(model_dir, profile, detection_only=not args.with_masks)
+    if args.focus_model:
+        from smartscope.source.miq import miq
+        for model_path in args.focus_model:
+            export_focus_model(miq.checkpoint_path(model_path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
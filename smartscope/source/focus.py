@@ -4,10 +4,16 @@ import numpy as np
 from smartscope.source.miq import miq
 
 from smartscope.source import sc_utils
+from smartscope.source import defocus
 from smartscope.source import position as pos
+from smartscope.source import progress as prog
 import scipy.interpolate
 import time
 
+# MIQ scores of a focus point, lower is closer to focus
+GOOD_FOCUS_SCORE = 2
+BAD_FOCUS_SCORE = 5
+
 def get_z_list(center, delta_z, total_z):
     ''' Gets an evenly spaced list
 
@@ -21,9 +27,10 @@ def get_z_list(center, delta_z, total_z):
     start_pos = center + total_z/2
     end_pos = center - total_z/2
     num_steps = (start_pos-end_pos) / delta_z
-    return np.linspace(start_pos, end_pos, num_steps)
+    return np.linspace(start_pos, end_pos, int(num_steps))
 
-def focus_from_image_stack(xy_points, mmc, delta_z=5, total_z=150, exposure=1):
+def focus_from_image_stack(xy_points, mmc, delta_z=5, total_z=150, exposure=1,
+                           camera_profile=sc_utils.DEFAULT_PROFILE):
     ''' Brute force focus algorthim 
     
     args: 
@@ -33,6 +40,7 @@ def focus_from_image_stack(xy_points, mmc, delta_z=5, total_z=150, exposure=1):
         delta_z: distacne between images (um)
         total_z: total imaging distance (all focused points on 
             chip should be in this range)
+        camera_profile: sc_utils.CAMERA_PROFILES entry to focus with
     
     returns:
         focused PositionList()
@@ -43,7 +51,7 @@ def focus_from_image_stack(xy_points, mmc, delta_z=5, total_z=150, exposure=1):
     # make z position array
     cur_pos = pos.current(mmc)
     z = get_z_list(cur_pos.z, delta_z, total_z)
-    cam = sc_utils.start_cam()
+    cam = sc_utils.start_cam(camera_profile)
     for posit in xy_points:
         # Go to the x,y position 
         pos.set_pos(mmc, x=posit.x, y=posit.y)
@@ -51,7 +59,7 @@ def focus_from_image_stack(xy_points, mmc, delta_z=5, total_z=150, exposure=1):
         for curr_z in z:
             mmc.setPosition(curr_z)
             mmc.waitForSystem()
-            frame = cam.get_frame(exp_time=exposure).reshape(cam.sensor_size[::-1])
+            frame = cam.get_frame(exp_time=exposure).reshape(cam.shape[::-1])
             preds.append(focus_model.score(sc_utils.bytescale(frame, high=65535)))
         # find the index of the min focus prediction
         best_focus_index = np.argmin(preds)
@@ -63,7 +71,10 @@ def focus_from_image_stack(xy_points, mmc, delta_z=5, total_z=150, exposure=1):
     sc_utils.close_cam(cam)
     return pos_list
 
-def focus_from_last_point(xy_points, mmc, model_path, delta_z=10, total_z=150, next_point_range=35, exposure=1):
+def focus_from_last_point(xy_points, mmc, model_path, delta_z=10, total_z=150, next_point_range=35, exposure=1,
+                          progress=None, focus_model=None,
+                          camera_profile=sc_utils.DEFAULT_PROFILE, sweep=False,
+                          calibration=None):
     ''' Gets a focused position list using a brute force method to find the 
     first focus point, then after that, used the last focused point as the 
     center of the new, shorter focus range. 
@@ -77,42 +88,85 @@ def focus_from_last_point(xy_points, mmc, model_path, delta_z=10, total_z=150, n
             chip should be in this range)
         nex_point_range: range to look (um) for point other than the 
             first point
+        progress: progress.Progress instance used to report each 
+            point and to cancel the run
+        focus_model: an already loaded focus model to use instead of 
+            loading model_path
+        camera_profile: sc_utils.CAMERA_PROFILES entry to focus with, 
+            'center' only reads the middle of the sensor
+        sweep: take each point's frames in one continuous move of the 
+            focus drive (see sweep_frames()) instead of stopping at every z
+        calibration: defocus.DefocusCalibration of the chip type. Each 
+            point is first focused from two frames with 
+            defocus.jump_focus(), the search is only used when that fails.
     
     returns:
         focused PositionList()
 
     '''
-    focus_model = miq.get_classifier(model_path)
+    if progress is None:
+        progress = prog.Progress()
+    if focus_model is None:
+        focus_model = miq.get_classifier(model_path)
     pos_list = pos.PositionList()
 
     # Focus the first point 
+    progress.phase('Focus', len(xy_points))
     pos.set_pos(mmc, x=xy_points[0].x, y=xy_points[0].y)
-    last_z = focus_point(mmc, focus_model, delta_z=delta_z, total_z=total_z, exposure=exposure)
+    last_z = focus_point(mmc, focus_model, delta_z=delta_z, total_z=total_z, exposure=exposure,
+                         progress=progress, camera_profile=camera_profile, sweep=sweep,
+                         calibration=calibration)
     sp = pos.StagePosition(x=xy_points[0].x, y=xy_points[0].y,
                             z=last_z)
     pos_list.append(sp)
+    progress.step()
 
     z_range = np.arange(-next_point_range/2, next_point_range/2, delta_z)
-    cam = sc_utils.start_cam()
+    cam = sc_utils.start_cam(camera_profile)
+    try:
+        _focus_remaining_points(xy_points, mmc, cam, focus_model, pos_list, last_z, 
+                                z_range, exposure, progress, sweep, calibration)
+    finally:
+        sc_utils.close_cam(cam)
+    return pos_list
+
+def _focus_remaining_points(xy_points, mmc, cam, focus_model, pos_list, last_z, 
+                            z_range, exposure, progress, sweep=False, calibration=None):
+    ''' Focuses every point after the first, starting each search from the 
+    focus of the previous point 
+    '''
+    # The next scan starts on the side of last_z the focus moved to
+    start_above = False
     for i, posit in enumerate(xy_points):
         # We already did the first point
         if i == 0:
-            best_focus_index = 0
             continue
         
         preds = []
         # Go to the next x,y position with the previous best focus 
         pos.set_pos(mmc, x=posit.x, y=posit.y, z=last_z)
-        
-        if best_focus_index > (len(z_range) / 2):
-            # Reverse the order of the list
-            z_range = z_range[::-1]
 
+        if calibration is not None:
+            jump_z, in_focus = defocus.jump_focus(mmc, cam, focus_model, calibration, z=last_z,
+                                                  exposure=exposure, progress=progress)
+            # The search starts from the estimate when it is not in focus
+            last_z = jump_z
+            if in_focus:
+                pos_list.append(pos.StagePosition(x=posit.x, y=posit.y, z=last_z))
+                progress.step()
+                sc_utils.print_info('(' + str(posit.x) + ',' + str(posit.y) + ') - Defocus estimate')
+                continue
+        
         # Build list from last position
         # in order that makes sense 
-        z_list = [(last_z+i) for i in z_range]
+        z_list = [(last_z+i) for i in sorted(z_range, reverse=start_above)]
 
-        for j, curr_z in enumerate(z_list):
+        if sweep:
+            frames, z_list = sweep_frames(mmc, cam, z_list[0], z_list[-1], exposure, 
+                                          abs(z_range[1] - z_range[0]), progress)
+            preds = [focus_model.score(sc_utils.bytescale(f, high=65535)) for f in frames]
+        for j, curr_z in enumerate([] if sweep else z_list):
+            progress.check()
             pos.set_pos(mmc, z=curr_z)
             frame = sc_utils.get_live_frame(cam, exposure)
             preds.append(focus_model.score(sc_utils.bytescale(frame, high=65535)))
@@ -124,21 +178,26 @@ def focus_from_last_point(xy_points, mmc, model_path, delta_z=10, total_z=150, n
                     break
         # find the index of the min focus prediction
         best_focus_index = np.argmin(preds)
+        start_above = bool(z_list[best_focus_index] > last_z)
         # append to the PositionList 
         last_z = z_list[best_focus_index]
         sp = pos.StagePosition(x=posit.x, y=posit.y,
                                 z=last_z)
         pos_list.append(sp)
+        progress.step()
 
-        if len(preds) < len(z_list):
+        if sweep:
+            # A sweep always covers the whole range, only its score tells
+            good = preds[best_focus_index] <= GOOD_FOCUS_SCORE
+        else:
+            # A step scan that stopped once focus got worse went through focus
+            good = len(preds) < len(z_list)
+        if good:
             sc_utils.print_info ('('+ str(posit.x) + ',' +  str(posit.y) +  ') - Score: ' + str(np.min(preds)) +  ' - Good focus')
-        elif preds[best_focus_index] > 5:
+        elif preds[best_focus_index] > BAD_FOCUS_SCORE:
             sc_utils.print_info ('('+ str(posit.x) + ',' +  str(posit.y) +  ') - Score: ' + str(np.min(preds)) +  ' - BAD FOCUS')
         else:
             sc_utils.print_info ('('+ str(posit.x) + ',' +  str(posit.y) +  ') - Score: ' + str(np.min(preds)) +  ' - OK focus')
-    
-    sc_utils.close_cam(cam)
-    return pos_list
 
 def predict_z_height(pos_list, xy_location=None):
     '''Interpolate the z value at xy_location
@@ -162,23 +221,85 @@ def predict_z_height(pos_list, xy_location=None):
         return f
     return f(xy_location[0], xy_location[1]), f
 
-def focus_point(mmc, focus_model, delta_z=10, total_z=250, exposure=1):
+def focus_point(mmc, focus_model, delta_z=10, total_z=250, exposure=1, progress=None,
+                camera_profile=sc_utils.DEFAULT_PROFILE, sweep=False, calibration=None):
+    if progress is None:
+        progress = prog.Progress()
     cur_z = pos.current(mmc).z
     if total_z == 0:
         return cur_z
+    if calibration is not None:
+        cam = sc_utils.start_cam(camera_profile)
+        try:
+            cur_z, in_focus = defocus.jump_focus(mmc, cam, focus_model, calibration,
+                                                 exposure=exposure, progress=progress)
+        finally:
+            sc_utils.close_cam(cam)
+        if in_focus:
+            return cur_z
+        sc_utils.print_info('Defocus estimate is not in focus, searching around it')
     z = get_z_list(cur_z, delta_z, total_z)
-    cam = sc_utils.start_cam()
+    cam = sc_utils.start_cam(camera_profile)
 
     preds = []
-    for curr_z in z:
-        pos.set_pos(mmc, z=curr_z)
-        frame = sc_utils.get_live_frame(cam, exposure)
-        preds.append(focus_model.score(sc_utils.bytescale(frame, high=65535)))
+    try:
+        if sweep:
+            frames, z = sweep_frames(mmc, cam, z[0], z[-1], exposure, delta_z, progress)
+            preds = [focus_model.score(sc_utils.bytescale(f, high=65535)) for f in frames]
+        for curr_z in [] if sweep else z:
+            progress.check()
+            pos.set_pos(mmc, z=curr_z)
+            frame = sc_utils.get_live_frame(cam, exposure)
+            preds.append(focus_model.score(sc_utils.bytescale(frame, high=65535)))
+    finally:
+        sc_utils.close_cam(cam)
     # find the index of the min focus prediction
     best_focus_index = np.argmin(preds)
     # append to the PositionList 
     last_z = z[best_focus_index]
-
-    sc_utils.close_cam(cam)
     return last_z
 
+
+def sweep_frames(mmc, cam, start_z, end_z, exposure, delta_z, progress=None):
+    ''' Moves the focus drive from start_z to end_z at a constant speed 
+    while the camera streams frames. The drive's position is read after 
+    every frame, and each frame gets the z interpolated at the middle of 
+    its exposure. A scan then costs one move instead of a move and a 
+    settle for every z.
+
+    args:
+        mmc: Micro-manager instance
+        cam: open camera
+        delta_z: z distance (um) between frames, sets the drive speed
+        progress: progress.Progress instance, checked after every frame
+    returns:
+        list of frames, array of their z
+    '''
+    if progress is None:
+        progress = prog.Progress()
+    pos.set_pos(mmc, z=start_z)
+    speed = sc_utils.get_focus_speed(mmc)
+    interval = exposure / 1000.0 + sc_utils.readout_time(cam)
+    frames, times = [], []
+    drive_times, drive_z = [], []
+    sc_utils.start_stream(cam, exposure)
+    try:
+        sc_utils.set_focus_speed(mmc, delta_z / interval)
+        drive_times.append(sc_utils.clock())
+        drive_z.append(sc_utils.get_z_pos(mmc))
+        sc_utils.set_z_pos(mmc, end_z)
+        moving = True
+        while moving:
+            # Checked before the frame, so the last frame is at end_z
+            moving = sc_utils.focus_busy(mmc)
+            frame, t = sc_utils.get_stream_frame(cam, exposure)
+            frames.append(frame)
+            times.append(t)
+            drive_times.append(sc_utils.clock())
+            drive_z.append(sc_utils.get_z_pos(mmc))
+            progress.check()
+    finally:
+        sc_utils.stop_stream(cam)
+        sc_utils.set_focus_speed(mmc, speed)
+        sc_utils.wait_for_system(mmc)
+    return frames, np.interp(times, drive_times, drive_z)
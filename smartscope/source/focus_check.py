@@ -0,0 +1,184 @@
+"""
+SmartScope
+Closed-loop focus check while imaging.
+
+PositionList.image() takes every frame at the z of the focus surface.
+With a FocusCheck, the sharpness of each frame is computed on a
+decimated copy on a worker thread while the frame is saved. A frame
+much less sharp than the frames before it is taken again with a small
+z search around its z, and the sharper frame replaces it. The z
+corrections the searches find are kept and added to the z of the
+positions near them, so one bad region of the surface is corrected as
+the run goes instead of needing a re-run of the chip.
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from smartscope.source import sc_utils
+
+# A frame fails when its sharpness is below this fraction of the
+# PERCENTILE of the recent frames that passed. The sharper frames are
+# the ones in focus, so a few blurry frames do not lower the limit.
+RELATIVE_THRESHOLD = 0.6
+PERCENTILE = 75
+# Frames that passed the percentile is taken over
+WINDOW = 20
+# z step (um) and most steps to each side of the search
+SEARCH_STEP = 2.0
+SEARCH_STEPS = 3
+# Distance (um) over which a correction fades out
+RADIUS = 1000.0
+# Weight of the focus surface itself against the corrections near a
+# position, far from every correction the surface is used as it is
+SURFACE_WEIGHT = 0.1
+
+
+class FocusCheck:
+    ''' Checks the frames of PositionList.image() and corrects the z of
+    the positions from what it finds. The corrections are kept between
+    image() calls, so the channels imaged after the first one use them.
+
+    args:
+        threshold: fixed sharpness a frame must reach, relative is
+            used instead if None
+        relative: fraction of the sharpness of the recent frames a frame
+            must reach
+        step: z step (um) of the search
+        steps: most steps to each side of the search
+        radius: distance (um) over which a correction fades out
+        decimation: block size of the decimated copy the sharpness is
+            computed on
+    '''
+    def __init__(self, threshold=None, relative=RELATIVE_THRESHOLD, step=SEARCH_STEP,
+                 steps=SEARCH_STEPS, radius=RADIUS, decimation=4):
+        self.threshold = threshold
+        self.relative = relative
+        self.step = step
+        self.steps = steps
+        self.radius = radius
+        self.decimation = decimation
+        # (x, y, dz) of every search that found a passing z, dz is the
+        # found z - the surface z
+        self.corrections = []
+        self.checked = 0
+        self.searched = 0
+        self.improved = 0
+        self.scores = []
+        self._worker = None
+
+    def start(self):
+        ''' Called by image() before the first frame. The recent scores
+        are cleared because each channel has its own sharpness.
+        '''
+        self.scores = []
+        if self._worker is None:
+            self._worker = ThreadPoolExecutor(max_workers=1)
+
+    def close(self):
+        if self._worker is not None:
+            self._worker.shutdown()
+            self._worker = None
+
+    def sharpness(self, frame):
+        return sc_utils.sharpness(frame, self.decimation)
+
+    def submit(self, frame):
+        ''' Starts computing the sharpness of a frame on the worker thread
+
+        returns:
+            concurrent.futures.Future of the sharpness
+        '''
+        return self._worker.submit(self.sharpness, frame)
+
+    def limit(self):
+        ''' Sharpness a frame must reach, None before the first frame '''
+        if self.threshold is not None:
+            return self.threshold
+        if not self.scores:
+            return None
+        return self.relative * float(np.percentile(self.scores[-WINDOW:], PERCENTILE))
+
+    def passes(self, score):
+        limit = self.limit()
+        return limit is None or score >= limit
+
+    def correction(self, x, y):
+        ''' z correction (um) at an xy position, the corrections nearby
+        weighted by their distance against the surface itself
+        '''
+        if not self.corrections:
+            return 0.0
+        c = np.array(self.corrections)
+        weights = np.exp(-((c[:, 0] - x) ** 2 + (c[:, 1] - y) ** 2) / self.radius ** 2)
+        return float(np.sum(weights * c[:, 2]) / (SURFACE_WEIGHT + np.sum(weights)))
+
+    def z_at(self, position):
+        ''' z to image a position at, the surface z plus the correction '''
+        return position.z + self.correction(position.x, position.y)
+
+    def check(self, result, frame, position, z, capture):
+        ''' Finishes the check of a frame. When it fails, a sharper z is
+        searched for. A z that passes is kept as a correction at the 
+        position.
+
+        args:
+            result: Future from submit() of the frame
+            frame: the frame
+            position: StagePosition of the frame, z is the surface z
+            z: z the frame was taken at
+            capture: function(z) that takes a frame at z at the same xy
+        returns:
+            (frame, z), the frame and z to keep
+        '''
+        score = result.result()
+        self.checked += 1
+        if self.passes(score):
+            self.scores.append(score)
+            return frame, z
+        self.searched += 1
+        best = self.search(frame, z, score, capture)
+        if best[2] != z:
+            self.improved += 1
+        # A sharper frame that still fails is kept, but neither used as a
+        # reference nor as a correction. A field that is never sharp, eg.
+        # debris or an empty field, would move the positions around it.
+        if self.passes(best[0]):
+            self.scores.append(best[0])
+            if best[2] != z:
+                self.corrections.append((position.x, position.y, best[2] - position.z))
+        return best[1], best[2]
+
+    def search(self, frame, z, score, capture):
+        ''' Climbs to the sharpest z near z, one step to each side first
+        and then on in the sharper direction
+
+        returns:
+            (sharpness, frame, z) of the sharpest frame
+        '''
+        best = (score, frame, z)
+        tried = {}
+        for direction in [-1, 1]:
+            z_i = z + direction * self.step
+            f = capture(z_i)
+            tried[direction] = (self.sharpness(f), f, z_i)
+        direction = max(tried, key=lambda d: tried[d][0])
+        for i in range(2, self.steps + 1):
+            if tried[direction][0] <= best[0]:
+                break
+            best = tried[direction]
+            z_i = z + direction * self.step * i
+            f = capture(z_i)
+            tried[direction] = (self.sharpness(f), f, z_i)
+        if tried[direction][0] > best[0]:
+            best = tried[direction]
+        return best
+
+    def summary(self):
+        return {'checked': self.checked, 'searched': self.searched, 'improved': self.improved,
+                'corrections': [list(c) for c in self.corrections]}
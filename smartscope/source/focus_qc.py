@@ -0,0 +1,391 @@
+"""
+SmartScope
+Offline focus QC of the images of a run.
+
+Walks the timepoint folders written by PositionList.image() and scores
+every tif with a fast classical sharpness metric, the focus model, or
+both. A pool of worker processes reads, hashes and scores the images.
+The scores are cached in each timepoint folder by the hash of the file
+contents and the version of the metric, so running the QC again only
+scores new or changed images. Files whose size and modification time
+have not changed are not read at all.
+
+Each timepoint folder gets a table of the scores of every position
+(focus_qc.csv) and a heatmap of each channel and metric over the chip.
+
+    python -m smartscope.source.focus_qc path/to/experiment \\
+        --metric sharpness --metric miq --focus-model path/to/model.ckpt-1000042
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+from collections import OrderedDict
+
+import numpy as np
+import tifffile as tif
+
+from smartscope.source import progress as prog
+from smartscope.source import sc_utils
+
+# Image names written by position.convert_and_save(), the naming scheme
+# (channel), the street and apartment of the position and the time
+IMAGE_PATTERN = re.compile(r'_ST_(?P<street>\d+)_APT_(?P<apartment>\d+)_(?P<time>\d{12})\.tif$')
+METRICS = ['sharpness', 'miq']
+# Columns each metric adds to the table
+METRIC_COLUMNS = OrderedDict([
+    ('sharpness', ['sharpness']),
+    ('miq', ['miq_score', 'miq_class', 'miq_certainty']),
+])
+# Columns drawn as heatmaps and whether higher values are better
+HEATMAP_COLUMNS = OrderedDict([('sharpness', True), ('miq_score', False)])
+CACHE_NAME = 'focus_qc_cache.json'
+TABLE_NAME = 'focus_qc.csv'
+# Written to the cache, a cache with a different version is ignored
+CACHE_VERSION = 1
+# Block size of the decimated copy the sharpness is computed on
+DECIMATION = 4
+# Results between cache writes, so an interrupted run keeps most of its work
+SAVE_EVERY = 2000
+
+
+def parse_image_name(name):
+    ''' returns:
+        (street, apartment, time) of an image name, None if it is not
+        an image written by convert_and_save()
+    '''
+    match = IMAGE_PATTERN.search(name)
+    if match is None:
+        return None
+    return int(match.group('street')), int(match.group('apartment')), match.group('time')
+
+
+def find_images(roots):
+    ''' Finds the images of every timepoint folder under roots
+
+    args:
+        roots: experiment, chip or timepoint folders
+    returns:
+        OrderedDict of timepoint folder: list of image dicts with the
+        path, channel, street, apartment and time. A position imaged
+        more than once in a channel keeps its latest image.
+    '''
+    found = {}
+    for root in roots:
+        for directory, folders, files in os.walk(root):
+            folders.sort()
+            for name in files:
+                parsed = parse_image_name(name)
+                if parsed is None:
+                    continue
+                street, apartment, stamp = parsed
+                directory = os.path.abspath(directory)
+                channel = os.path.basename(directory)
+                key = (channel, street, apartment)
+                images = found.setdefault(os.path.dirname(directory), {})
+                if key not in images or images[key]['time'] < stamp:
+                    images[key] = {'path': os.path.join(directory, name), 'channel': channel,
+                                   'street': street, 'apartment': apartment, 'time': stamp}
+    return OrderedDict((d, [found[d][k] for k in sorted(found[d])]) for d in sorted(found))
+
+
+def model_version(model_path):
+    ''' Name and hash of a focus model checkpoint, so scores of retrained
+    weights are not mixed up with the old ones
+    '''
+    from smartscope.source.miq import miq
+    model_path = miq.checkpoint_path(model_path)
+    weights = model_path if os.path.isfile(model_path) else model_path + '.index'
+    with open(weights, 'rb') as f:
+        digest = hashlib.md5(f.read()).hexdigest()
+    return os.path.basename(model_path) + '@' + digest[:12]
+
+
+def metric_keys(metrics, model_path=None, decimation=DECIMATION):
+    ''' Cache key of each metric, which changes with its version '''
+    keys = OrderedDict()
+    for metric in metrics:
+        if metric not in METRICS:
+            raise ValueError('Unknown metric "' + str(metric) + '", use one of ' + ', '.join(METRICS))
+        if metric == 'sharpness':
+            keys[metric] = 'sharpness/' + str(decimation)
+        else:
+            if model_path is None:
+                raise ValueError('The miq metric needs a focus model')
+            keys[metric] = 'miq/' + model_version(model_path)
+    return keys
+
+
+def load_cache(time_point):
+    path = os.path.join(time_point, CACHE_NAME)
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            cache = json.load(f)
+        if cache.get('version') == CACHE_VERSION:
+            return cache
+    return {'version': CACHE_VERSION, 'files': {}, 'scores': {}}
+
+
+def save_cache(time_point, cache):
+    ''' Writes the cache, keeping only the scores of the files it lists '''
+    hashes = set(entry[2] for entry in cache['files'].values())
+    cache['scores'] = {h: s for h, s in cache['scores'].items() if h in hashes}
+    path = os.path.join(time_point, CACHE_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(path + '.tmp', path)
+
+
+# Set in each worker process by _init_worker()
+_worker = {}
+
+
+def _init_worker(keys, model_path, decimation, done):
+    ''' keys: metric keys to compute, done: hashes already scored with
+    all of them
+    '''
+    _worker.update(keys=keys, decimation=decimation, done=done, model=None)
+    if 'miq' in keys:
+        import tensorflow
+        from smartscope.source.miq import miq
+        # One thread each, the pool already uses every core
+        config = tensorflow.ConfigProto(intra_op_parallelism_threads=1,
+                                        inter_op_parallelism_threads=1)
+        _worker['model'] = miq.get_classifier(miq.checkpoint_path(model_path), config)
+
+
+def score_image(image, keys, model=None, decimation=DECIMATION):
+    ''' Scores one image with each metric
+
+    args:
+        image: 2D array
+        keys: metric keys from metric_keys()
+        model: focus model with predict_patch_map(), needed for miq
+    returns:
+        dict of metric key: dict of its columns
+    '''
+    scores = {}
+    for metric, key in keys.items():
+        if metric == 'sharpness':
+            scores[key] = {'sharpness': sc_utils.sharpness(image, decimation)}
+        else:
+            prediction = model.predict_patch_map(image).aggregate()[0]
+            scores[key] = {'miq_score': float(np.dot(prediction.probabilities,
+                                                     np.arange(len(prediction.probabilities)))),
+                           'miq_class': int(prediction.predictions),
+                           'miq_certainty': float(prediction.certainties['aggregate'])}
+    return scores
+
+
+def _score(path):
+    ''' Reads and hashes one image, scoring it unless its hash is done
+
+    returns:
+        (path, size, mtime, hash, scores or None)
+    '''
+    stat = os.stat(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.md5(data).hexdigest()
+    if digest in _worker['done']:
+        return path, stat.st_size, stat.st_mtime, digest, None
+    image = tif.imread(io.BytesIO(data))
+    if image.ndim > 2:
+        image = image[..., 0]
+    return path, stat.st_size, stat.st_mtime, digest, score_image(
+        image, _worker['keys'], _worker['model'], _worker['decimation'])
+
+
+def score_images(images, keys, model_path=None, decimation=DECIMATION, workers=None,
+                 progress=None):
+    ''' Scores the images of every timepoint, using and updating the
+    cache of each timepoint folder
+
+    args:
+        images: find_images() result
+        keys: metric keys from metric_keys()
+        model_path: focus model checkpoint, needed for miq
+        workers: processes scoring the images, 0 scores them in this
+            process. Defaults to one less than the number of CPUs.
+        progress: progress.Progress instance
+    returns:
+        OrderedDict of timepoint folder: list of image dicts with the
+        columns of every metric added
+    '''
+    if progress is None:
+        progress = prog.Progress()
+    if workers is None:
+        workers = max(1, multiprocessing.cpu_count() - 1)
+    caches = OrderedDict((d, load_cache(d)) for d in images)
+    # Images whose file is unchanged and whose scores are all cached are skipped
+    owner = {}
+    todo = []
+    for time_point, records in images.items():
+        cache = caches[time_point]
+        for record in records:
+            name = os.path.relpath(record['path'], time_point)
+            entry = cache['files'].get(name)
+            if entry is not None:
+                stat = os.stat(record['path'])
+                scores = cache['scores'].get(entry[2], {})
+                if [stat.st_size, stat.st_mtime] == entry[:2] and all(k in scores for k in keys.values()):
+                    continue
+            owner[record['path']] = time_point
+            todo.append(record['path'])
+    # Hashes scored with every metric, a changed or moved file with the same contents is not scored again
+    known = {h: s for cache in caches.values() for h, s in cache['scores'].items()
+             if all(k in s for k in keys.values())}
+
+    progress.phase('Focus QC', len(todo))
+    if workers and todo:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                    initargs=(keys, model_path, decimation, set(known)))
+        results = pool.imap_unordered(_score, todo, chunksize=4)
+    else:
+        pool = None
+        _init_worker(keys, model_path, decimation, set(known))
+        results = map(_score, todo)
+    try:
+        for i, (path, size, mtime, digest, scores) in enumerate(results):
+            progress.check()
+            time_point = owner[path]
+            cache = caches[time_point]
+            cache['files'][os.path.relpath(path, time_point)] = [size, mtime, digest]
+            if scores is None:
+                # Scored under another name, possibly in another timepoint
+                scores = known[digest]
+            cache['scores'].setdefault(digest, {}).update(scores)
+            progress.step()
+            if (i + 1) % SAVE_EVERY == 0:
+                save_cache(time_point, cache)
+        # Forget the images that have been deleted
+        for time_point, records in images.items():
+            names = set(os.path.relpath(r['path'], time_point) for r in records)
+            files = caches[time_point]['files']
+            caches[time_point]['files'] = {n: e for n, e in files.items() if n in names}
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        for time_point, cache in caches.items():
+            save_cache(time_point, cache)
+
+    scored = OrderedDict()
+    for time_point, records in images.items():
+        cache = caches[time_point]
+        scored[time_point] = []
+        for record in records:
+            row = dict(record)
+            entry = cache['files'][os.path.relpath(record['path'], time_point)]
+            for key in keys.values():
+                row.update(cache['scores'][entry[2]][key])
+            scored[time_point].append(row)
+    return scored
+
+
+def write_table(path, rows, metrics):
+    ''' Writes the score of every image, one row per position and channel '''
+    columns = ['channel', 'street', 'apartment', 'file']
+    for metric in metrics:
+        columns += METRIC_COLUMNS[metric]
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            row = dict(row, file=os.path.basename(row['path']))
+            writer.writerow([row[c] for c in columns])
+
+
+def chip_grid(rows, column):
+    ''' Arranges the scores of one channel as they lie on the chip
+
+    returns:
+        (streets, apartments, grid), grid is [apartments, streets] with
+        nan where there is no image
+    '''
+    streets = sorted(set(r['street'] for r in rows))
+    apartments = sorted(set(r['apartment'] for r in rows))
+    grid = np.full((len(apartments), len(streets)), np.nan)
+    for r in rows:
+        grid[apartments.index(r['apartment']), streets.index(r['street'])] = r[column]
+    return streets, apartments, grid
+
+
+def write_heatmap(path, rows, column, title):
+    ''' Saves a heatmap of one channel's scores over the chip '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    streets, apartments, grid = chip_grid(rows, column)
+    fig, ax = plt.subplots(figsize=(2 + 0.3 * len(streets), 2 + 0.3 * len(apartments)))
+    image = ax.imshow(grid, cmap='viridis' if HEATMAP_COLUMNS[column] else 'viridis_r',
+                      interpolation='nearest')
+    fig.colorbar(image, ax=ax, label=column)
+    ax.set_xticks(range(len(streets)))
+    ax.set_xticklabels(streets, rotation=90, fontsize=6)
+    ax.set_yticks(range(len(apartments)))
+    ax.set_yticklabels(apartments, fontsize=6)
+    ax.set_xlabel('Street')
+    ax.set_ylabel('Apartment')
+    ax.set_title(title)
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def write_reports(scored, metrics, heatmaps=True):
+    ''' Writes the table and heatmaps of every timepoint folder
+
+    returns:
+        list of the files written
+    '''
+    written = []
+    for time_point, rows in scored.items():
+        path = os.path.join(time_point, TABLE_NAME)
+        write_table(path, rows, metrics)
+        written.append(path)
+        if not heatmaps:
+            continue
+        columns = [c for m in metrics for c in METRIC_COLUMNS[m] if c in HEATMAP_COLUMNS]
+        for channel in sorted(set(r['channel'] for r in rows)):
+            channel_rows = [r for r in rows if r['channel'] == channel]
+            for column in columns:
+                path = os.path.join(time_point, 'focus_qc_' + channel + '_' + column + '.png')
+                write_heatmap(path, channel_rows, column,
+                              os.path.basename(time_point) + ' ' + channel + ' ' + column)
+                written.append(path)
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Score the focus of the saved images of a run')
+    parser.add_argument('path', nargs='+', help='experiment, chip or timepoint folders')
+    parser.add_argument('--metric', action='append', choices=METRICS,
+                        help='metrics to score, sharpness if not given')
+    parser.add_argument('--focus-model', help='focus model checkpoint, needed for miq')
+    parser.add_argument('--decimation', type=int, default=DECIMATION)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--no-heatmaps', action='store_true')
+    args = parser.parse_args()
+
+    metrics = list(OrderedDict.fromkeys(args.metric or ['sharpness']))
+    if 'miq' in metrics and args.focus_model is None:
+        parser.error('--metric miq needs --focus-model')
+    keys = metric_keys(metrics, args.focus_model, args.decimation)
+    images = find_images(args.path)
+    sc_utils.print_info('Found ' + str(sum(len(r) for r in images.values())) + ' images in ' +
+                        str(len(images)) + ' timepoint folders')
+    progress = prog.Progress(callback=lambda event: print(prog.format_event(event), end='\r'))
+    scored = score_images(images, keys, args.focus_model, args.decimation, args.workers, progress)
+    print()
+    for path in write_reports(scored, metrics, not args.no_heatmaps):
+        sc_utils.print_info('Wrote ' + path)
@@ -0,0 +1,64 @@
+"""
+SmartScope
+Paths and info files of the frozen models written by export_models.py.
+
+A frozen model is a single GraphDef with the weights folded in as
+constants. Next to it is a json file with the names of its input and
+output tensors and the modification time of the weights it was made
+from, so a frozen model is only used while it matches its weights.
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+import json
+import os
+
+
+def frozen_path(weights, *tags):
+    ''' Path of the frozen model made from weights, eg.
+    alignment_30.h5 -> alignment_30.default.detection.pb
+    model.ckpt-1000042 -> model.ckpt-1000042.frozen.pb
+    '''
+    base, extension = os.path.splitext(weights)
+    if extension not in ['.h5', '.hdf5']:
+        base = weights
+    return '.'.join([base] + [t for t in tags if t] + ['pb'])
+
+
+def info_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def source_time(weights):
+    ''' Modification time of the weights, a TF checkpoint is checked
+    through its .index file
+    '''
+    if os.path.isfile(weights):
+        return os.path.getmtime(weights)
+    return os.path.getmtime(weights + '.index')
+
+
+def write_info(path, weights, **info):
+    info['weights'] = os.path.abspath(weights)
+    info['weights_time'] = source_time(weights)
+    with open(info_path(path), 'w') as f:
+        json.dump(info, f, indent=2)
+
+
+def read_info(path, weights):
+    ''' Returns the info of the frozen model at path, or None if there is
+    no frozen model or its weights have changed since it was made
+    '''
+    if not os.path.isfile(path) or not os.path.isfile(info_path(path)):
+        return None
+    with open(info_path(path), 'r') as f:
+        info = json.load(f)
+    try:
+        if info['weights_time'] != source_time(weights):
+            return None
+    except OSError:
+        # The frozen model can be used without its weights
+        pass
+    return info
@@ -0,0 +1,446 @@
+"""
+SmartScope
+Inference server that keeps the alignment and focus models loaded.
+
+The server is a separate process that loads each model once and then
+answers requests from the GUI, the headless jobs and notebooks over a
+local socket. Frames are not sent through the socket: the client writes
+them into a memory mapped file that the server maps too, so only a
+small reference crosses the connection.
+
+    python -m smartscope.source.inference --alignment-model path/to/alignment_30.h5 \\
+        --focus-model path/to/model.ckpt-1000042
+
+Clients get stand ins for the models that work wherever a loaded model
+is expected:
+
+    client = inference.connect()
+    model = client.alignment_model('path/to/alignment_30.h5')
+    results = model.detect([frame])
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+import sys
+sys.path.append('C:\\Program Files\\Micro-Manager-2.0beta')
+import argparse
+import os
+import secrets
+import subprocess
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from smartscope.source import sc_utils
+
+DEFAULT_ADDRESS = ('localhost', 6150)
+# Any process that knows the key can run requests in the server, so the
+# key is random and only readable by the user. start_server() hands it
+# to the server through AUTHKEY_ENV.
+AUTHKEY_ENV = 'SMARTSCOPE_AUTHKEY'
+AUTHKEY_PATH = os.path.join(os.path.expanduser('~'), '.smartscope', 'inference.key')
+# Key of older versions, the server refuses to start with it
+INSECURE_AUTHKEY = b'smartscope'
+
+
+class InferenceError(Exception):
+    """Raised when the inference server fails to run a request."""
+    pass
+
+
+def get_authkey(path=None):
+    ''' Key of the server and its clients, from AUTHKEY_ENV if it is set
+    and otherwise from a file only the user can read. The file is made
+    with a new random key the first time.
+
+    args:
+        path: key file, AUTHKEY_PATH if None
+    returns:
+        key as bytes
+    '''
+    if os.environ.get(AUTHKEY_ENV):
+        return os.environ[AUTHKEY_ENV].encode()
+    if path is None:
+        path = AUTHKEY_PATH
+    if not os.path.isfile(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            # Made by another process in the meantime
+            pass
+        else:
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(32))
+    if os.name != 'nt' and os.stat(path).st_mode & 0o077:
+        raise InferenceError('The inference key file ' + path + ' can be read by other users, '
+                             'run: chmod 600 ' + path)
+    with open(path) as f:
+        return f.read().strip().encode()
+
+
+class SharedFrames:
+    ''' Memory mapped file the client writes frames into for the server.
+    The file grows to fit the largest request, a bigger file gets a new
+    name so a mapping the server still holds is never resized.
+
+    args:
+        directory: where to make the file (the system temp folder if None)
+    '''
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.path = None
+        self.size = 0
+        self.map = None
+
+    def put(self, frames):
+        ''' Copies frames into the file
+
+        returns:
+            list of (path, offset, shape, dtype) references
+        '''
+        frames = [np.ascontiguousarray(f) for f in frames]
+        total = sum(f.nbytes for f in frames)
+        if total > self.size:
+            self._grow(total)
+        refs = []
+        offset = 0
+        for f in frames:
+            self.map[offset:offset + f.nbytes] = f.reshape(-1).view(np.uint8)
+            refs.append((self.path, offset, f.shape, f.dtype.str))
+            offset += f.nbytes
+        return refs
+
+    def _grow(self, size):
+        self.close()
+        fd, self.path = tempfile.mkstemp(prefix='smartscope_frames_', suffix='.bin',
+                                         dir=self.directory)
+        os.close(fd)
+        self.size = size
+        self.map = np.memmap(self.path, dtype=np.uint8, mode='w+', shape=(size,))
+
+    def close(self):
+        if self.map is not None:
+            self.map = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                # The server can still have it open on Windows
+                pass
+
+
+def read_frames(refs, maps):
+    ''' Views of the frames referenced by SharedFrames.put() without
+    copying them
+
+    args:
+        refs: references from SharedFrames.put()
+        maps: dict of the files this connection has mapped
+    '''
+    frames = []
+    for path, offset, shape, dtype in refs:
+        if path not in maps:
+            # The client moved to a bigger file, the old one is done
+            maps.clear()
+            maps[path] = np.memmap(path, dtype=np.uint8, mode='r')
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        frames.append(maps[path][offset:offset + nbytes].view(dtype).reshape(shape))
+    return frames
+
+
+class InferenceServer:
+    ''' Holds the models and serves requests. Every client gets its own
+    connection thread but all loading and inference runs on one worker
+    thread, which the TensorFlow graphs and sessions of the models need.
+
+    args:
+        address: (host, port) to listen on
+        authkey: key the clients must use, get_authkey() if None
+    '''
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        if authkey is None:
+            authkey = get_authkey()
+        if not authkey or authkey == INSECURE_AUTHKEY:
+            raise InferenceError('Refusing to start the inference server with the default key')
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.authkey = authkey
+        self.worker = ThreadPoolExecutor(max_workers=1)
+        self.alignment = {}
+        self.focus = {}
+        self.requests = 0
+        self._stop = threading.Event()
+
+    def serve_forever(self):
+        sc_utils.print_info('Inference server listening on ' + str(self.address))
+        while not self._stop.is_set():
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                # A client that failed to connect
+                continue
+            if self._stop.is_set():
+                conn.close()
+                break
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        self.listener.close()
+        self.worker.shutdown()
+
+    def shutdown(self):
+        ''' Stops serve_forever(), which is woken up by connecting to it '''
+        self._stop.set()
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+
+    def handle(self, conn):
+        ''' Answers the requests of one client until it disconnects '''
+        maps = {}
+        try:
+            while True:
+                request = conn.recv()
+                conn.send(self.dispatch(request, maps))
+                if request['cmd'] == 'shutdown':
+                    self.shutdown()
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            maps.clear()
+            conn.close()
+
+    def dispatch(self, request, maps):
+        ''' Runs one request
+
+        args:
+            request: dict with 'cmd', 'args' and the 'frames' references
+        returns:
+            dict with 'ok' and either 'result' or 'error'
+        '''
+        try:
+            self.requests += 1
+            cmd = request['cmd']
+            if cmd == 'ping':
+                result = self.status()
+            elif cmd == 'shutdown':
+                result = None
+            else:
+                method = getattr(self, 'do_' + cmd, None)
+                if method is None:
+                    raise InferenceError('Unknown command "' + cmd + '"')
+                frames = read_frames(request.get('frames', []), maps)
+                result = self.worker.submit(method, frames, **request.get('args', {})).result()
+            return {'ok': True, 'result': result}
+        except Exception as e:
+            return {'ok': False, 'error': repr(e), 'traceback': traceback.format_exc()}
+
+    def status(self):
+        return {'pid': os.getpid(),
+                'alignment': sorted(self.alignment),
+                'focus': sorted(self.focus),
+                'requests': self.requests}
+
+    def do_load_alignment(self, frames, path, profile='default', batch_size=1):
+        if (path, profile, batch_size) not in self.alignment:
+            from smartscope.source import alignment
+            self.alignment[(path, profile, batch_size)] = alignment.get_inference_model(
+                path, profile=profile, batch_size=batch_size)
+
+    def do_load_focus(self, frames, path):
+        if path not in self.focus:
+            from smartscope.source.miq import miq
+            self.focus[path] = miq.get_classifier(path)
+
+    def do_detect(self, frames, path, profile='default', batch_size=1):
+        from smartscope.source import alignment
+        self.do_load_alignment(frames, path, profile, batch_size)
+        return alignment.detect_frames(self.alignment[(path, profile, batch_size)], frames)
+
+    def do_score(self, frames, path):
+        self.do_load_focus(frames, path)
+        return [self.focus[path].score(f) for f in frames]
+
+    def do_predict(self, frames, path):
+        self.do_load_focus(frames, path)
+        return [self.focus[path].predict(f) for f in frames]
+
+    def do_patch_map(self, frames, path):
+        self.do_load_focus(frames, path)
+        return self.focus[path].predict_patch_map(frames)
+
+
+class InferenceClient:
+    ''' Connection to a running InferenceServer. It can be shared by
+    threads, requests are sent one at a time.
+
+    args:
+        address: (host, port) of the server
+        authkey: key of the server, get_authkey() if None
+    '''
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        self.address = address
+        self.conn = Client(address, authkey=authkey or get_authkey())
+        self.frames = SharedFrames()
+        self._lock = threading.Lock()
+
+    def call(self, cmd, frames=(), **args):
+        with self._lock:
+            refs = self.frames.put(frames) if len(frames) else []
+            self.conn.send({'cmd': cmd, 'args': args, 'frames': refs})
+            reply = self.conn.recv()
+        if not reply['ok']:
+            raise InferenceError(reply['error'] + '\n' + reply['traceback'])
+        return reply['result']
+
+    def ping(self):
+        return self.call('ping')
+
+    def alignment_model(self, path, profile='default', batch_size=1):
+        ''' Stand in for alignment.get_inference_model(), the server loads
+        the model now so the first detect() does not wait for it
+        '''
+        self.call('load_alignment', path=path, profile=profile, batch_size=batch_size)
+        return RemoteAlignmentModel(self, path, profile, batch_size)
+
+    def focus_model(self, path):
+        ''' Stand in for miq.get_classifier() '''
+        self.call('load_focus', path=path)
+        return RemoteFocusModel(self, path)
+
+    def shutdown(self):
+        ''' Stops the server '''
+        self.call('shutdown')
+        self.close()
+
+    def close(self):
+        self.conn.close()
+        self.frames.close()
+
+
+class RemoteAlignmentModel:
+    ''' Runs MaskRCNN.detect() on the inference server, which splits 
+    the images into batches of the model's batch size
+    '''
+    def __init__(self, client, path, profile='default', batch_size=1):
+        self.client = client
+        self.path = path
+        self.profile = profile
+        self.batch_size = batch_size
+
+    def detect(self, images, verbose=0):
+        return self.client.call('detect', images, path=self.path, profile=self.profile,
+                                batch_size=self.batch_size)
+
+
+class RemoteFocusModel:
+    ''' Runs ImageQualityClassifier.score(), predict() and
+    predict_patch_map() on the inference server
+    '''
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+
+    def score(self, image):
+        return self.client.call('score', [image], path=self.path)[0]
+
+    def score_many(self, images):
+        return self.client.call('score', images, path=self.path)
+
+    def predict(self, image):
+        return self.client.call('predict', [image], path=self.path)[0]
+
+    def predict_patch_map(self, images):
+        if isinstance(images, np.ndarray) and images.ndim == 2:
+            images = [images]
+        return self.client.call('patch_map', images, path=self.path)
+
+
+def connect(address=DEFAULT_ADDRESS, start=False, timeout=120):
+    ''' Connects to the inference server
+
+    args:
+        address: (host, port) of the server
+        start: start a server if none is running
+        timeout: seconds to wait for a started server
+    returns:
+        InferenceClient, or None if no server is running and start is False
+    '''
+    authkey = get_authkey()
+    try:
+        return InferenceClient(address, authkey)
+    except OSError:
+        if not start:
+            return None
+    start_server(address, authkey=authkey)
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            return InferenceClient(address, authkey)
+        except OSError:
+            time.sleep(0.5)
+    raise InferenceError('The inference server did not start within ' + str(timeout) + 's')
+
+
+def start_server(address=DEFAULT_ADDRESS, cores=None, authkey=None):
+    ''' Starts a server in a new process that outlives this one. The key
+    is passed in the environment rather than on the command line, where
+    other users could read it.
+    '''
+    command = [sys.executable, '-m', 'smartscope.source.inference',
+               '--address', address[0] + ':' + str(address[1])]
+    if cores:
+        command += ['--cores', ','.join(str(c) for c in cores)]
+    env = dict(os.environ)
+    env[AUTHKEY_ENV] = (authkey or get_authkey()).decode()
+    flags = getattr(subprocess, 'CREATE_NEW_PROCESS_GROUP', 0)
+    return subprocess.Popen(command, env=env, creationflags=flags, start_new_session=flags == 0)
+
+
+def set_cores(cores):
+    ''' Pins this process to the given CPU cores so inference does not
+    compete with the GUI and the camera
+    '''
+    try:
+        import psutil
+        psutil.Process().cpu_affinity(cores)
+    except ImportError:
+        os.sched_setaffinity(0, cores)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Keep the SmartScope models loaded for other processes')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS[0] + ':' + str(DEFAULT_ADDRESS[1]),
+                        help='host:port to listen on')
+    parser.add_argument('--alignment-model', action='append', default=[],
+                        help='alignment model to load at start')
+    parser.add_argument('--profile', default='default', help='alignment inference profile')
+    parser.add_argument('--focus-model', action='append', default=[],
+                        help='focus model to load at start')
+    parser.add_argument('--cores', help='comma separated CPU cores to run on, eg. 4,5,6,7')
+    args = parser.parse_args(argv)
+
+    if args.cores:
+        set_cores([int(c) for c in args.cores.split(',')])
+    host, port = args.address.rsplit(':', 1)
+    server = InferenceServer((host, int(port)))
+    for path in args.alignment_model:
+        server.worker.submit(server.do_load_alignment, [], path, args.profile)
+    for path in args.focus_model:
+        from smartscope.source.miq import miq
+        server.worker.submit(server.do_load_focus, [], miq.checkpoint_path(path))
+    server.serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
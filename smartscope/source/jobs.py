@@ -0,0 +1,490 @@
+"""
+SmartScope
+Headless imaging jobs read from YAML job specs.
+
+Runs one or more chips over one or more timepoints without the GUI and
+writes a JSON summary of every chip and timepoint. See
+config/job_example.yml for the job spec format.
+
+    python -m smartscope.source.jobs config/job_example.yml
+    python -m smartscope.source.jobs config/job_example.yml --simulate
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+import sys
+sys.path.append('C:\\Program Files\\Micro-Manager-2.0beta')
+import argparse
+import copy
+import json
+import os
+import time
+
+import yaml
+
+from smartscope.source import alignment
+from smartscope.source import defocus
+from smartscope.source import drift
+from smartscope.source import focus_check
+from smartscope.source import inference
+from smartscope.source import position as pos
+from smartscope.source import progress as prog
+from smartscope.source import run
+from smartscope.source import sc_utils
+from smartscope.source import simulation
+from smartscope.source.miq import miq
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../config')
+
+DEFAULTS = {
+    'experiment_config': os.path.join(CONFIG_DIR, 'experiment_config.yml'),
+    'led_intensities': os.path.join(CONFIG_DIR, 'led_intensities.yml'),
+    'stage_config': os.path.join(CONFIG_DIR, 'scope_stage2.cfg'),
+    'simulate': False,
+    'summary': None,
+    'timepoints': 1,
+    'interval_minutes': 0,
+    'defaults': {},
+    'chips': [],
+}
+
+CHIP_DEFAULTS = {
+    'position': None,
+    'start_date': time.strftime('%Y%m%d'),
+    'cell': '',
+    'drug': '',
+    'concentration': '',
+    'chip_index': '00',
+    'folder': '.',
+    'output_pixels': [2688, 2200],
+    'image_rotation': 0,
+    'apartments_in_image': [5, 4],
+    'use_saved_positions': True,
+    'drift_correction': True,
+    'alignment_profile': 'default',
+    'batch_alignment': False,
+    'alignment_camera': 'full',
+    'channels': {'BFF': 1},
+    'focus': {
+        'step_size': 5,
+        'initial_range': 15,
+        'range': 35,
+        'points': [5, 4],
+        'exposure': 1,
+        'camera': 'full',
+        'sweep': False,
+        'jump': False,
+        'check': False,
+        'check_threshold': focus_check.RELATIVE_THRESHOLD,
+        'check_step': focus_check.SEARCH_STEP,
+    },
+}
+
+# Keys every chip must have after the defaults are applied
+REQUIRED_CHIP_KEYS = ['chip', 'alignment_model', 'focus_model',
+                      'frame_to_pixel_ratio', 'first_position']
+
+
+class JobError(Exception):
+    """Raised when a job spec is not valid."""
+    pass
+
+
+def read_yaml(filename):
+    with open(filename, 'r') as stream:
+        return yaml.safe_load(stream)
+
+
+def merge(base, override):
+    ''' Recursively merges two dicts, values in override win '''
+    merged = copy.deepcopy(base)
+    for k, v in override.items():
+        if isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k] = merge(merged[k], v)
+        else:
+            merged[k] = copy.deepcopy(v)
+    return merged
+
+
+def load_job(filename):
+    ''' Reads a job spec and fills in the defaults
+
+    args:
+        filename: path to the job spec yaml file
+    returns:
+        job dict with a fully specified dict for every chip in job['chips']
+    '''
+    spec = read_yaml(filename) or {}
+    job = merge(DEFAULTS, spec)
+    # Paths in the spec are relative to the spec file
+    spec_dir = os.path.dirname(os.path.abspath(filename))
+    for key in ['experiment_config', 'led_intensities', 'stage_config']:
+        if key in spec:
+            job[key] = os.path.join(spec_dir, spec[key])
+
+    chip_configs = read_yaml(job['experiment_config'])['chips']
+    led_intensities = read_yaml(job['led_intensities'])
+
+    chips = []
+    for i, chip_spec in enumerate(job['chips']):
+        chip_job = merge(merge(CHIP_DEFAULTS, job['defaults']), chip_spec)
+        # A chip's channels replace the default channels instead of adding to them
+        if 'channels' in chip_spec:
+            chip_job['channels'] = chip_spec['channels']
+        for key in REQUIRED_CHIP_KEYS:
+            if key not in chip_job:
+                raise JobError('Chip ' + str(i) + ' is missing "' + key + '"')
+        chip_job['config'] = get_chip_config(chip_configs, chip_job['chip'])
+        for channel in chip_job['channels']:
+            if channel not in led_intensities:
+                raise JobError('Channel ' + channel + ' is not in ' + job['led_intensities'])
+        if list(chip_job['channels'])[0] != 'BFF':
+            raise JobError('Chip ' + str(i) + ' must image in BFF first when aligning and focusing')
+        chip_job['led_intensities'] = {c: led_intensities[c][0] for c in chip_job['channels']}
+        chip_job['focus']['points'] = [max(4, int(p)) for p in chip_job['focus']['points']]
+        for profile in [chip_job['alignment_camera'], chip_job['focus']['camera']]:
+            if profile not in sc_utils.CAMERA_PROFILES:
+                raise JobError('Chip ' + str(i) + ' uses unknown camera profile "' + 
+                               str(profile) + '"')
+        if not 0 < float(chip_job['focus']['check_threshold']) <= 1:
+            raise JobError('Chip ' + str(i) + ' focus check_threshold must be between 0 and 1')
+        # Chips image on the job's schedule unless they set their own
+        for key in ['timepoints', 'interval_minutes']:
+            chip_job.setdefault(key, job[key])
+        chips.append(chip_job)
+    if not chips:
+        raise JobError('Job has no chips')
+    job['chips'] = chips
+    return job
+
+
+def get_chip_config(chip_configs, name):
+    ''' Finds a chip by name in the experiment_config.yml chip list '''
+    for chip in chip_configs:
+        if chip['name'] == name:
+            return chip
+    raise JobError('Chip type "' + name + '" is not in the experiment config')
+
+
+def get_chip_dir(chip_job):
+    return run.get_chip_dir(chip_job['folder'], str(chip_job['start_date']),
+                            chip_job['chip'], chip_job['cell'], chip_job['drug'],
+                            str(chip_job['concentration']), str(chip_job['chip_index']))
+
+
+class ModelCache:
+    ''' Loads each alignment and focus model once and hands the same 
+    model to every chip that uses it
+
+    args:
+        client: inference.InferenceClient, when given the models run in 
+            the inference server instead of this process
+    '''
+    def __init__(self, client=None):
+        self.client = client
+        self.alignment = {}
+        self.locators = {}
+        self.focus = {}
+
+    def alignment_model(self, path, profile='default', batch_size=1):
+        key = (path, profile, batch_size)
+        if key not in self.alignment:
+            if self.client is not None:
+                self.alignment[key] = self.client.alignment_model(path, profile, batch_size)
+            else:
+                self.alignment[key] = alignment.get_inference_model(path, profile=profile,
+                                                                    batch_size=batch_size)
+        return self.alignment[key]
+
+    def mark_locator(self, path, chip_name, profile='default', batch_size=1):
+        ''' Alignment mark locator for a chip type, the model is only 
+        loaded if a template match is not confident
+        '''
+        key = (path, chip_name, profile, batch_size)
+        if key not in self.locators:
+            self.locators[key] = alignment.MarkLocator(
+                model_loader=lambda: self.alignment_model(path, profile, batch_size),
+                template_path=alignment.template_path(chip_name))
+        return self.locators[key]
+
+    def focus_model(self, path):
+        if path not in self.focus:
+            if self.client is not None:
+                self.focus[path] = self.client.focus_model(path)
+            else:
+                self.focus[path] = miq.get_classifier(path)
+        return self.focus[path]
+
+
+class PhaseTimer:
+    ''' Progress callback that records how long each phase took and
+    prints a line when a phase starts
+    '''
+    def __init__(self):
+        self.phases = {}
+        self.positions = {}
+        self._current = None
+        self._start = None
+
+    def __call__(self, event):
+        now = time.time()
+        if event.phase != self._current:
+            self._finish(now)
+            self._current = event.phase
+            self._start = now
+            sc_utils.print_info(prog.format_event(event))
+        self.positions[event.phase] = event.done
+
+    def _finish(self, now):
+        if self._current is not None:
+            self.phases[self._current] = self.phases.get(self._current, 0) + now - self._start
+
+    def finish(self):
+        self._finish(time.time())
+        self._current = None
+
+
+def focus_calibration(chip_job):
+    ''' The chip type's DefocusCalibration for jump focus, None if there 
+    is none or it was made with another focus model or camera profile 
+    '''
+    calibration = defocus.load_calibration(chip_job['chip'])
+    if calibration is None:
+        sc_utils.print_error('No defocus calibration for ' + chip_job['chip'] +
+                             ', focusing with a search')
+        return None
+    reason = calibration.mismatch(miq.checkpoint_path(chip_job['focus_model']),
+                                  chip_job['focus']['camera'])
+    if reason is not None:
+        sc_utils.print_error('Defocus calibration for ' + chip_job['chip'] + ' was ' + reason +
+                             ', focusing with a search')
+        return None
+    return calibration
+
+def image_chip(chip_job, time_point, mmc, progress=None, models=None):
+    ''' Images every channel of one chip at one timepoint
+
+    args:
+        chip_job: chip dict from load_job()
+        time_point: timepoint name, eg. 't00'
+        mmc: stage controller
+        progress: progress.Progress instance
+        models: ModelCache to reuse loaded models, the models are loaded
+            for this chip only if None
+    returns:
+        summary dict
+    '''
+    chip_dir = get_chip_dir(chip_job)
+    save_dir = chip_dir + time_point
+    positions_dir = chip_dir + 't00'
+    saved_focus = time_point != 't00' and chip_job['use_saved_positions']
+    summary = {
+        'chip': chip_job['chip'],
+        'chip_index': str(chip_job['chip_index']),
+        'time_point': time_point,
+        'save_dir': save_dir,
+        'channels': chip_job['channels'],
+        'start': time.time(),
+        'status': 'ok',
+        'error': None,
+    }
+    sc_utils.print_info('Imaging ' + chip_job['chip'] + ' ' + time_point + ' to ' + save_dir)
+    os.makedirs(save_dir, exist_ok=True)
+    with open(os.path.join(save_dir, 'job.yml'), 'w') as f:
+        yaml.safe_dump(chip_job, f, default_flow_style=False)
+
+    if chip_job['position'] is not None:
+        x, y, z = chip_job['position']
+        pos.set_pos(mmc, x=x, y=y, z=z)
+    original_point = pos.current(mmc)
+    channels = list(chip_job['channels'].items())
+    focus = chip_job['focus']
+    # Shared by the channels, so the corrections found in the first are used by the others
+    checker = None
+    if focus['check']:
+        checker = focus_check.FocusCheck(relative=float(focus['check_threshold']),
+                                         step=float(focus['check_step']))
+
+    # Record the phase times while passing the events on
+    timer = PhaseTimer()
+    if progress is None:
+        progress = prog.Progress()
+    callback = progress.callback
+
+    def record(event):
+        timer(event)
+        if callback is not None:
+            callback(event)
+    progress.callback = record
+    try:
+        for i, (channel, exposure) in enumerate(channels):
+            sc_utils.set_led_and_shutter(mmc, chip_job['led_intensities'][channel])
+            if i == 0 and saved_focus and chip_job['drift_correction']:
+                positions_dir = drift.correct_saved_positions(
+                    mmc, positions_dir, save_dir, int(exposure),
+                    float(chip_job['frame_to_pixel_ratio']), progress=progress)
+            if i == 0 and not saved_focus:
+                if models is None:
+                    models = ModelCache()
+                batch = bool(chip_job['batch_alignment'])
+                alignment_model = models.mark_locator(chip_job['alignment_model'],
+                                                      chip_job['chip'],
+                                                      chip_job['alignment_profile'],
+                                                      alignment.BATCH_SIZE if batch else 1)
+                focus_model = models.focus_model(miq.checkpoint_path(chip_job['focus_model']))
+                calibration = focus_calibration(chip_job) if focus['jump'] else None
+                run.auto_image_chip(chip_job['config'], mmc, save_dir,
+                                    str(chip_job['chip_index']),
+                                    chip_job['alignment_model'],
+                                    miq.checkpoint_path(chip_job['focus_model']),
+                                    channel,
+                                    float(focus['step_size']),
+                                    int(focus['initial_range']),
+                                    int(focus['range']),
+                                    focus['points'][0],
+                                    focus['points'][1],
+                                    int(focus['exposure']),
+                                    int(chip_job['image_rotation']),
+                                    float(chip_job['frame_to_pixel_ratio']),
+                                    sc_utils.get_frame_size(),
+                                    int(exposure),
+                                    [float(p) for p in chip_job['first_position']],
+                                    int(chip_job['apartments_in_image'][0]),
+                                    int(chip_job['apartments_in_image'][1]),
+                                    list(chip_job['output_pixels']),
+                                    progress=progress,
+                                    alignment_model=alignment_model,
+                                    focus_model=focus_model,
+                                    batch_alignment=batch,
+                                    alignment_camera=chip_job['alignment_camera'],
+                                    focus_camera=focus['camera'],
+                                    focus_sweep=bool(focus['sweep']),
+                                    focus_calibration=calibration,
+                                    focus_check=checker)
+            else:
+                run.image_from_saved_positions(chip_job['config'], positions_dir, save_dir, mmc,
+                                               channel, int(chip_job['image_rotation']), int(exposure),
+                                               [float(p) for p in chip_job['first_position']],
+                                               int(chip_job['apartments_in_image'][0]),
+                                               int(chip_job['apartments_in_image'][1]),
+                                               list(chip_job['output_pixels']),
+                                               progress=progress, focus_check=checker)
+            sc_utils.in_between_channels()
+        pos.set_pos(mmc, x=original_point.x, y=original_point.y, z=original_point.z)
+    except (prog.RunCancelled, KeyboardInterrupt):
+        summary['status'] = 'cancelled'
+        run.stop_safely(mmc, original_point)
+        raise
+    except Exception as e:
+        summary['status'] = 'failed'
+        summary['error'] = repr(e)
+        sc_utils.print_error('Imaging ' + chip_job['chip'] + ' ' + time_point + ' failed: ' + repr(e))
+        run.stop_safely(mmc, original_point)
+    finally:
+        timer.finish()
+        progress.callback = callback
+        summary['end'] = time.time()
+        summary['duration'] = summary['end'] - summary['start']
+        summary['phases'] = timer.phases
+        summary['positions'] = timer.positions
+        if checker is not None:
+            checker.close()
+            summary['focus_check'] = checker.summary()
+        with open(os.path.join(save_dir, 'run_summary.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+
+def run_job(job, mmc, progress=None, summary_path=None, models=None):
+    ''' Runs every timepoint of every chip in the job
+
+    args:
+        job: dict from load_job()
+        mmc: stage controller
+        progress: progress.Progress instance
+        summary_path: json file that is rewritten after every chip
+        models: ModelCache shared by every chip (a new one if None)
+    returns:
+        list of summary dicts
+    '''
+    if models is None:
+        models = ModelCache()
+    summaries = []
+    interval = float(job['interval_minutes']) * 60
+    start = time.time()
+    sc_utils.before_imaging()
+    try:
+        for t in range(int(job['timepoints'])):
+            planned = start + t * interval
+            if time.time() < planned:
+                sc_utils.print_info('Waiting until ' + time.ctime(planned) + ' for the next timepoint')
+                while time.time() < planned:
+                    if progress is not None:
+                        progress.check()
+                    time.sleep(min(1.0, planned - time.time()))
+            for chip_job in job['chips']:
+                time_point = run.get_time_point(get_chip_dir(chip_job))
+                summary = image_chip(chip_job, time_point, mmc, progress=progress, models=models)
+                summary['planned_start'] = planned
+                summaries.append(summary)
+                if summary_path is not None:
+                    write_summary(summaries, summary_path)
+    finally:
+        sc_utils.after_imaging()
+    return summaries
+
+
+def write_summary(summaries, path):
+    with open(path, 'w') as f:
+        json.dump({'runs': summaries,
+                   'failed': sum(s['status'] != 'ok' for s in summaries)}, f, indent=2)
+
+
+def simulate(job):
+    ''' Switches to the simulated camera and stage with the job's first 
+    chip on the stage
+
+    returns:
+        simulation.SimulatedScope
+    '''
+    first = job['chips'][0]
+    origin = first['position'][:2] if first['position'] is not None else (0.0, 0.0)
+    scope = simulation.SimulatedScope(chip=first['config'], origin=origin,
+                                      pixel_size=float(first['frame_to_pixel_ratio']))
+    sc_utils.use_simulated_hardware(scope)
+    return scope
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run SmartScope imaging jobs without the GUI')
+    parser.add_argument('job', help='job spec yaml file')
+    parser.add_argument('--simulate', action='store_true',
+                        help='use the simulated camera and stage')
+    parser.add_argument('--summary', help='json file for the run summary')
+    parser.add_argument('--server', action='store_true',
+                        help='run the models in the inference server, starting it if needed')
+    args = parser.parse_args(argv)
+
+    job = load_job(args.job)
+    models = ModelCache(inference.connect(start=True) if args.server else None)
+    if args.simulate or job['simulate']:
+        simulate(job)
+    mmc = sc_utils.get_stage_controller(job['stage_config'])
+
+    summary_path = args.summary or job['summary']
+    if summary_path is None:
+        summary_path = os.path.join(job['chips'][0]['folder'],
+                                    'run_summary_' + time.strftime('%Y%m%d%H%M') + '.json')
+    try:
+        summaries = run_job(job, mmc, summary_path=summary_path, models=models)
+    except KeyboardInterrupt:
+        sc_utils.print_info('Job stopped, summary written to ' + summary_path)
+        return 1
+    sc_utils.print_info('Job finished, summary written to ' + summary_path)
+    return 1 if any(s['status'] != 'ok' for s in summaries) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -174,6 +174,12 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     DETECTION_NMS_THRESHOLD = 0.3
 
+    # Build the inference graph without the mask head. detect() then
+    # returns boxes, class IDs and scores only (masks is None). The mask
+    # head weights in a trained model file are skipped when loading with
+    # by_name=True.
+    DETECTION_ONLY = False
+
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimizer
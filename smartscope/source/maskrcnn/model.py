@@ -1455,15 +1455,28 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
                1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_bbox: [N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
     """
+    rpn_match, anchor_gt = match_rpn_anchors(anchors, gt_class_ids, gt_boxes)
+    return sample_rpn_targets(rpn_match, anchor_gt, anchors, gt_boxes, config)
+
+
+def match_rpn_anchors(anchors, gt_class_ids, gt_boxes):
+    """The deterministic part of build_rpn_targets(): matches every anchor
+    to the GT boxes before the positive and negative anchors are sampled.
+
+    Returns:
+    rpn_match: [N] (int32) 1 = positive anchor, -1 = negative anchor,
+               0 = neutral
+    anchor_gt: [N] (int32) index into gt_boxes of the closest GT box of
+               each anchor
+    """
     # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
-    # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
-    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
 
     # Handle COCO crowds
     # A crowd box in COCO is a bounding box around several instances. Exclude
     # them from training. A crowd box is given a negative class ID.
     crowd_ix = np.where(gt_class_ids < 0)[0]
+    non_crowd_ix = np.arange(gt_boxes.shape[0])
     if crowd_ix.shape[0] > 0:
         # Filter out crowds from ground truth class IDs and boxes
         non_crowd_ix = np.where(gt_class_ids > 0)[0]
@@ -1501,13 +1514,30 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     # 3. Set anchors with high overlap as positive.
     rpn_match[anchor_iou_max >= 0.7] = 1
 
+    return rpn_match, non_crowd_ix[anchor_iou_argmax].astype(np.int32)
+
+
+def sample_rpn_targets(rpn_match, anchor_gt, anchors, gt_boxes, config, rng=None):
+    """The random part of build_rpn_targets(): balances the positive and
+    negative anchors from match_rpn_anchors() and computes the deltas of
+    the positive anchors. rpn_match is changed in place.
+
+    rng: Optional. np.random.RandomState to sample with, np.random if None.
+
+    Returns rpn_match and rpn_bbox as build_rpn_targets().
+    """
+    if rng is None:
+        rng = np.random
+    # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
+    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
+
     # Subsample to balance positive and negative anchors
     # Don't let positives be more than half the anchors
     ids = np.where(rpn_match == 1)[0]
     extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
     if extra > 0:
         # Reset the extra ones to neutral
-        ids = np.random.choice(ids, extra, replace=False)
+        ids = rng.choice(ids, extra, replace=False)
         rpn_match[ids] = 0
     # Same for negative proposals
     ids = np.where(rpn_match == -1)[0]
@@ -1515,7 +1545,7 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
                         np.sum(rpn_match == 1))
     if extra > 0:
         # Rest the extra ones to neutral
-        ids = np.random.choice(ids, extra, replace=False)
+        ids = rng.choice(ids, extra, replace=False)
         rpn_match[ids] = 0
 
     # For positive anchors, compute shift and scale needed to transform them
@@ -1525,7 +1555,7 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     # TODO: use box_refinement() rather than duplicating the code here
     for i, a in zip(ids, anchors[ids]):
         # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i]]
+        gt = gt_boxes[anchor_gt[i]]
 
         # Convert coordinates to center plus width/height.
         # GT Box
@@ -2043,18 +2073,24 @@ class MaskRCNN():
             detections = DetectionLayer(config, name="mrcnn_detection")(
                 [rpn_rois, mrcnn_class, mrcnn_bbox, input_image_meta])
 
-            # Create masks for detections
-            detection_boxes = KL.Lambda(lambda x: x[..., :4])(detections)
-            mrcnn_mask = build_fpn_mask_graph(detection_boxes, mrcnn_feature_maps,
-                                              input_image_meta,
-                                              config.MASK_POOL_SIZE,
-                                              config.NUM_CLASSES,
-                                              train_bn=config.TRAIN_BN)
-
-            model = KM.Model([input_image, input_image_meta, input_anchors],
-                             [detections, mrcnn_class, mrcnn_bbox,
-                                 mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
-                             name='mask_rcnn')
+            if config.DETECTION_ONLY:
+                model = KM.Model([input_image, input_image_meta, input_anchors],
+                                 [detections, mrcnn_class, mrcnn_bbox,
+                                     rpn_rois, rpn_class, rpn_bbox],
+                                 name='mask_rcnn')
+            else:
+                # Create masks for detections
+                detection_boxes = KL.Lambda(lambda x: x[..., :4])(detections)
+                mrcnn_mask = build_fpn_mask_graph(detection_boxes, mrcnn_feature_maps,
+                                                  input_image_meta,
+                                                  config.MASK_POOL_SIZE,
+                                                  config.NUM_CLASSES,
+                                                  train_bn=config.TRAIN_BN)
+
+                model = KM.Model([input_image, input_image_meta, input_anchors],
+                                 [detections, mrcnn_class, mrcnn_bbox,
+                                     mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
+                                 name='mask_rcnn')
 
         # Add multi-GPU support.
         if config.GPU_COUNT > 1:
@@ -2274,7 +2310,8 @@ class MaskRCNN():
             "*epoch*", "{epoch:04d}")
 
     def train(self, train_dataset, val_dataset, learning_rate, epochs, layers,
-              augmentation=None, custom_callbacks=None, no_augmentation_sources=None):
+              augmentation=None, custom_callbacks=None, no_augmentation_sources=None,
+              data_workers=None, cache_dir=None, seed=0):
         """Train the model.
         train_dataset, val_dataset: Training and validation Dataset objects.
         learning_rate: The learning rate to train with
@@ -2306,6 +2343,12 @@ class MaskRCNN():
         no_augmentation_sources: Optional. List of sources to exclude for
             augmentation. A source is string that identifies a dataset and is
             defined in the Dataset class.
+        data_workers: Optional. Prepare the training data with
+            pipeline.DataPipeline in this many worker processes instead of
+            data_generator(). 0 prepares it in the training process.
+        cache_dir: Optional. Directory of the DataPipeline sample cache.
+            Samples are only cached without augmentation.
+        seed: Seed of the DataPipeline image order and augmentation.
         """
         assert self.mode == "training", "Create model in training mode."
 
@@ -2324,12 +2367,24 @@ class MaskRCNN():
             layers = layer_regex[layers]
 
         # Data generators
-        train_generator = data_generator(train_dataset, self.config, shuffle=True,
-                                         augmentation=augmentation,
-                                         batch_size=self.config.BATCH_SIZE,
-                                         no_augmentation_sources=no_augmentation_sources)
-        val_generator = data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
+        pipelines = []
+        if data_workers is not None or cache_dir is not None:
+            from smartscope.source.maskrcnn import pipeline
+            for dataset, name in [(train_dataset, 'train'), (val_dataset, 'val')]:
+                pipelines.append(pipeline.DataPipeline(
+                    dataset, self.config, shuffle=True,
+                    augmentation=augmentation if name == 'train' else None,
+                    batch_size=self.config.BATCH_SIZE, workers=data_workers,
+                    cache_dir=os.path.join(cache_dir, name) if cache_dir else None,
+                    seed=seed, no_augmentation_sources=no_augmentation_sources))
+            train_generator, val_generator = [iter(p) for p in pipelines]
+        else:
+            train_generator = data_generator(train_dataset, self.config, shuffle=True,
+                                             augmentation=augmentation,
+                                             batch_size=self.config.BATCH_SIZE,
+                                             no_augmentation_sources=no_augmentation_sources)
+            val_generator = data_generator(val_dataset, self.config, shuffle=True,
+                                           batch_size=self.config.BATCH_SIZE)
 
         # Create log_dir if it does not exist
         if not os.path.exists(self.log_dir):
@@ -2343,6 +2398,11 @@ class MaskRCNN():
                                             verbose=0, save_weights_only=True),
         ]
 
+        if pipelines:
+            callbacks.append(keras.callbacks.LambdaCallback(
+                on_epoch_end=lambda epoch, logs: log("Data pipeline: {}".format(
+                    pipelines[0].format_report()))))
+
         # Add custom callbacks to the list
         if custom_callbacks:
             callbacks += custom_callbacks
@@ -2356,23 +2416,28 @@ class MaskRCNN():
         # Work-around for Windows: Keras fails on Windows when using
         # multiprocessing workers. See discussion here:
         # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
-        if os.name is 'nt':
+        # The data pipeline has its own worker processes.
+        if os.name == 'nt' or pipelines:
             workers = 0
         else:
             workers = multiprocessing.cpu_count()
 
-        self.keras_model.fit_generator(
-            train_generator,
-            initial_epoch=self.epoch,
-            epochs=epochs,
-            steps_per_epoch=self.config.STEPS_PER_EPOCH,
-            callbacks=callbacks,
-            validation_data=val_generator,
-            validation_steps=self.config.VALIDATION_STEPS,
-            max_queue_size=100,
-            workers=workers,
-            use_multiprocessing=True,
-        )
+        try:
+            self.keras_model.fit_generator(
+                train_generator,
+                initial_epoch=self.epoch,
+                epochs=epochs,
+                steps_per_epoch=self.config.STEPS_PER_EPOCH,
+                callbacks=callbacks,
+                validation_data=val_generator,
+                validation_steps=self.config.VALIDATION_STEPS,
+                max_queue_size=100,
+                workers=workers,
+                use_multiprocessing=workers > 0,
+            )
+        finally:
+            for p in pipelines:
+                p.close()
         self.epoch = max(self.epoch, epochs)
 
     def mold_inputs(self, images):
@@ -2421,7 +2486,7 @@ class MaskRCNN():
         application.
 
         detections: [N, (y1, x1, y2, x2, class_id, score)] in normalized coordinates
-        mrcnn_mask: [N, height, width, num_classes]
+        mrcnn_mask: [N, height, width, num_classes], or None to skip the masks
         original_image_shape: [H, W, C] Original image shape before resizing
         image_shape: [H, W, C] Shape of the image after resizing and padding
         window: [y1, x1, y2, x2] Pixel coordinates of box in the image where the real
@@ -2431,7 +2496,8 @@ class MaskRCNN():
         boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
         class_ids: [N] Integer class IDs for each bounding box
         scores: [N] Float probability scores of the class_id
-        masks: [height, width, num_instances] Instance masks
+        masks: [height, width, num_instances] Instance masks, None if
+            mrcnn_mask is None
         """
         # How many detections do we have?
         # Detections array is padded with zeros. Find the first class_id == 0.
@@ -2442,7 +2508,7 @@ class MaskRCNN():
         boxes = detections[:N, :4]
         class_ids = detections[:N, 4].astype(np.int32)
         scores = detections[:N, 5]
-        masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+        masks = None if mrcnn_mask is None else mrcnn_mask[np.arange(N), :, :, class_ids]
 
         # Translate normalized coordinates in the resized image to pixel
         # coordinates in the original image before resizing
@@ -2465,20 +2531,55 @@ class MaskRCNN():
             boxes = np.delete(boxes, exclude_ix, axis=0)
             class_ids = np.delete(class_ids, exclude_ix, axis=0)
             scores = np.delete(scores, exclude_ix, axis=0)
-            masks = np.delete(masks, exclude_ix, axis=0)
+            if masks is not None:
+                masks = np.delete(masks, exclude_ix, axis=0)
             N = class_ids.shape[0]
 
+        if masks is None:
+            return boxes, class_ids, scores, None
+
         # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = utils.unmold_mask(masks[i], boxes[i], original_image_shape)
-            full_masks.append(full_mask)
-        full_masks = np.stack(full_masks, axis=-1)\
-            if full_masks else np.empty(original_image_shape[:2] + (0,))
+        full_masks = utils.unmold_masks(masks[:N], boxes, original_image_shape)\
+            if N else np.empty(original_image_shape[:2] + (0,))
 
         return boxes, class_ids, scores, full_masks
 
+    def predict(self, molded_images, image_metas, anchors):
+        """Runs the Keras model.
+
+        Returns the detections and the masks, the masks are None when the
+        model was built with DETECTION_ONLY.
+        """
+        outputs = self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        if self.config.DETECTION_ONLY:
+            return outputs[0], None
+        return outputs[0], outputs[3]
+
+    def export_frozen(self, path):
+        """Writes the inference graph to a GraphDef file with the weights
+        folded in as constants, training nodes removed and constant
+        expressions folded. Load it with FrozenMaskRCNN.
+
+        Build the model after K.set_learning_phase(0) so the graph does not
+        depend on the learning phase.
+
+        path: .pb file to write
+
+        Returns the op names of the inputs and outputs.
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        from tensorflow.tools.graph_transforms import TransformGraph
+        session = K.get_session()
+        inputs = [t.op.name for t in self.keras_model.inputs]
+        outputs = [t.op.name for t in self.keras_model.outputs]
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            session, session.graph.as_graph_def(), outputs)
+        graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=outputs)
+        graph_def = TransformGraph(graph_def, inputs, outputs, FROZEN_GRAPH_TRANSFORMS)
+        with tf.gfile.GFile(path, "wb") as f:
+            f.write(graph_def.SerializeToString())
+        return inputs, outputs
+
     def detect(self, images, verbose=0):
         """Runs the detection pipeline.
 
@@ -2488,7 +2589,7 @@ class MaskRCNN():
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks (None with DETECTION_ONLY)
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(
@@ -2520,13 +2621,13 @@ class MaskRCNN():
             log("image_metas", image_metas)
             log("anchors", anchors)
         # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        detections, mrcnn_mask = self.predict(molded_images, image_metas, anchors)
         # Process detections
         results = []
         for i, image in enumerate(images):
             final_rois, final_class_ids, final_scores, final_masks =\
-                self.unmold_detections(detections[i], mrcnn_mask[i],
+                self.unmold_detections(detections[i],
+                                       None if mrcnn_mask is None else mrcnn_mask[i],
                                        image.shape, molded_images[i].shape,
                                        windows[i])
             results.append({
@@ -2549,7 +2650,7 @@ class MaskRCNN():
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks (None with DETECTION_ONLY)
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(molded_images) == self.config.BATCH_SIZE,\
@@ -2577,14 +2678,14 @@ class MaskRCNN():
             log("image_metas", image_metas)
             log("anchors", anchors)
         # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        detections, mrcnn_mask = self.predict(molded_images, image_metas, anchors)
         # Process detections
         results = []
         for i, image in enumerate(molded_images):
             window = [0, 0, image.shape[0], image.shape[1]]
             final_rois, final_class_ids, final_scores, final_masks =\
-                self.unmold_detections(detections[i], mrcnn_mask[i],
+                self.unmold_detections(detections[i],
+                                       None if mrcnn_mask is None else mrcnn_mask[i],
                                        image.shape, molded_images[i].shape,
                                        window)
             results.append({
@@ -2718,6 +2819,50 @@ class MaskRCNN():
         return outputs_np
 
 
+# Graph transforms applied to exported inference graphs
+FROZEN_GRAPH_TRANSFORMS = [
+    "strip_unused_nodes",
+    "fold_constants(ignore_errors=true)",
+    "fold_batch_norms",
+    "fold_old_batch_norms",
+    "sort_by_execution_order",
+]
+
+
+class FrozenMaskRCNN(MaskRCNN):
+    """Inference only Mask R-CNN loaded from a graph written by
+    MaskRCNN.export_frozen(). Nothing is built in Keras and no h5 weights
+    are loaded, so it starts much faster. detect() works the same.
+
+    path: .pb file written by export_frozen()
+    config: the Config the model was exported with
+    inputs: input op names returned by export_frozen()
+    outputs: output op names returned by export_frozen()
+    session_config: TensorFlow session configuration
+    """
+
+    def __init__(self, path, config, inputs, outputs, session_config=None):
+        self.mode = "inference"
+        self.config = config
+        self.keras_model = None
+        self.graph = tf.Graph()
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=self.graph, config=session_config)
+        self.inputs = [self.graph.get_tensor_by_name(n + ":0") for n in inputs]
+        self.outputs = [self.graph.get_tensor_by_name(n + ":0") for n in outputs]
+
+    def predict(self, molded_images, image_metas, anchors):
+        outputs = self.session.run(self.outputs, feed_dict=dict(
+            zip(self.inputs, [molded_images, image_metas, anchors])))
+        if self.config.DETECTION_ONLY:
+            return outputs[0], None
+        return outputs[0], outputs[3]
+
+
 ############################################################
 #  Data Formatting
 ############################################################
@@ -0,0 +1,444 @@
+"""
+SmartScope
+Parallel, prefetching training data pipeline for Mask R-CNN.
+
+model.data_generator() prepares every training sample in the training
+process, one at a time: it reads the image, rasterizes and resizes the
+masks, augments them and matches the anchors to the GT boxes.
+DataPipeline does the same work in a pool of worker processes and keeps
+a bounded number of samples ready ahead of training. Every sample is
+seeded from (seed, epoch, position), so a run can be repeated exactly
+with any number of workers.
+
+Without augmentation, the part of a sample that is the same every epoch
+is written to a memory-mapped SampleCache: the resized image, the mini
+masks and the anchor matches. Later epochs and later runs read the
+cache instead of preparing the sample again. The positive and negative
+anchors are still sampled every epoch.
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+import collections
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+
+from smartscope.source.maskrcnn import model as modellib
+from smartscope.source.maskrcnn import utils
+
+
+def sample_seed(seed, epoch, position):
+    ''' Seed of the sample at position in the given epoch '''
+    return ((seed * 1000003 + epoch) * 1000003 + position) % (2 ** 32)
+
+
+def get_anchors(config):
+    ''' Anchors of the training images, as in data_generator() '''
+    backbone_shapes = modellib.compute_backbone_shapes(config, config.IMAGE_SHAPE)
+    return utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                          config.RPN_ANCHOR_RATIOS,
+                                          backbone_shapes,
+                                          config.BACKBONE_STRIDES,
+                                          config.RPN_ANCHOR_STRIDE)
+
+
+############################################################
+#  Sample Cache
+############################################################
+
+class SampleCache:
+    ''' Prepared samples of a dataset in memory-mapped .npy files, one
+    row per image. Rows are filled the first time an image is prepared.
+    A row is emptied when the image's info or the image file changes,
+    and the whole cache is emptied when the configuration changes.
+
+    Only samples that are the same every epoch can be cached, see
+    SampleCache.usable().
+
+    args:
+        cache_dir: directory of the cache files
+        dataset: the Dataset the samples come from
+        config: the model config
+        anchor_count: number of anchors per image
+    '''
+
+    def __init__(self, cache_dir, dataset, config, anchor_count):
+        self.cache_dir = cache_dir
+        capacity = config.MAX_GT_INSTANCES
+        n = len(dataset.image_ids)
+        image_dtype = dataset.load_image(dataset.image_ids[0]).dtype
+        meta_length = 1 + 3 + 3 + 4 + 1 + config.NUM_CLASSES
+        mask_shape = tuple(int(d) for d in config.MINI_MASK_SHAPE)
+        # name: (shape, dtype)
+        self.fields = collections.OrderedDict([
+            ('image', ((n,) + tuple(int(d) for d in config.IMAGE_SHAPE[:2]) + (3,), image_dtype)),
+            ('image_meta', ((n, meta_length), np.float64)),
+            ('class_ids', ((n, capacity), np.int32)),
+            ('boxes', ((n, capacity, 4), np.int32)),
+            ('masks', ((n,) + mask_shape + (capacity,), bool)),
+            ('rpn_match', ((n, int(anchor_count)), np.int8)),
+            ('anchor_gt', ((n, int(anchor_count)), np.int16)),
+            # Instances in each row, -1 until the row is filled
+            ('count', ((n,), np.int32)),
+        ])
+        self._arrays = None
+        self._open(dataset, config, image_dtype)
+
+    @staticmethod
+    def usable(config, augmentation=None, augment=False):
+        ''' True if the samples are the same every epoch: no augmentation,
+        no random crops and mini masks
+        '''
+        return (not augmentation and not augment and config.USE_MINI_MASK
+                and config.IMAGE_RESIZE_MODE == 'square'
+                and config.MAX_GT_INSTANCES < np.iinfo(np.int16).max)
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name + '.npy')
+
+    def _open(self, dataset, config, image_dtype):
+        ''' Creates the cache or empties the rows that are out of date '''
+        signature = {
+            'images': len(dataset.image_ids),
+            'image_dtype': np.dtype(image_dtype).str,
+            'config': {key: getattr(config, key) for key in [
+                'IMAGE_MIN_DIM', 'IMAGE_MAX_DIM', 'IMAGE_MIN_SCALE', 'IMAGE_RESIZE_MODE',
+                'MINI_MASK_SHAPE', 'MAX_GT_INSTANCES', 'NUM_CLASSES', 'RPN_ANCHOR_SCALES',
+                'RPN_ANCHOR_RATIOS', 'BACKBONE_STRIDES', 'RPN_ANCHOR_STRIDE']},
+        }
+        signature = json.loads(json.dumps(signature, default=str))
+        keys = [self.image_key(dataset, image_id) for image_id in dataset.image_ids]
+        index_path = os.path.join(self.cache_dir, 'index.json')
+        index = None
+        if os.path.isfile(index_path):
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+        fresh = (index is None or index['signature'] != signature or
+                 not all(os.path.isfile(self.path(name)) for name in self.fields))
+        if fresh:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for name, (shape, dtype) in self.fields.items():
+                array = np.lib.format.open_memmap(self.path(name), mode='w+',
+                                                  dtype=dtype, shape=shape)
+                if name == 'count':
+                    array[:] = -1
+                array.flush()
+                del array
+        else:
+            stale = [i for i, (old, new) in enumerate(zip(index['keys'], keys)) if old != new]
+            if stale:
+                logging.info('Sample cache: {} changed images'.format(len(stale)))
+                count = np.load(self.path('count'), mmap_mode='r+')
+                count[stale] = -1
+                count.flush()
+                del count
+        with open(index_path, 'w') as f:
+            json.dump({'signature': signature, 'keys': keys}, f)
+
+    @staticmethod
+    def image_key(dataset, image_id):
+        ''' Changes when the image's info or image file changes '''
+        info = dataset.image_info[image_id]
+        text = json.dumps(info, sort_keys=True, default=str)
+        path = info.get('path')
+        if isinstance(path, str) and os.path.isfile(path):
+            text += str(os.path.getmtime(path))
+        return hashlib.md5(text.encode()).hexdigest()
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = {name: np.load(self.path(name), mmap_mode='r+')
+                            for name in self.fields}
+        return self._arrays
+
+    def __getstate__(self):
+        # The memory maps are opened again in each worker
+        state = dict(self.__dict__)
+        state['_arrays'] = None
+        return state
+
+    def has(self, image_id):
+        return self.arrays['count'][image_id] >= 0
+
+    def read(self, image_id):
+        ''' returns:
+            image, image_meta, class_ids, boxes, masks, rpn_match,
+            anchor_gt of a filled row, the image is a memory-mapped view
+        '''
+        a = self.arrays
+        n = a['count'][image_id]
+        return (a['image'][image_id], np.array(a['image_meta'][image_id]),
+                np.array(a['class_ids'][image_id, :n]), np.array(a['boxes'][image_id, :n]),
+                np.array(a['masks'][image_id, :, :, :n]),
+                a['rpn_match'][image_id].astype(np.int32), a['anchor_gt'][image_id].astype(np.int32))
+
+    def write(self, image_id, image, image_meta, class_ids, boxes, masks, rpn_match, anchor_gt):
+        ''' Fills a row, returns False if the sample does not fit '''
+        a = self.arrays
+        n = len(class_ids)
+        if n > a['class_ids'].shape[1] or image.shape != a['image'].shape[1:]:
+            return False
+        a['image'][image_id] = image
+        a['image_meta'][image_id] = image_meta
+        a['class_ids'][image_id, :n] = class_ids
+        a['boxes'][image_id, :n] = boxes
+        a['masks'][image_id, :, :, :n] = masks
+        a['rpn_match'][image_id] = rpn_match
+        a['anchor_gt'][image_id] = anchor_gt
+        for name in self.fields:
+            if name != 'count':
+                a[name].flush()
+        # The count marks the row as filled, so it is written last
+        a['count'][image_id] = n
+        a['count'].flush()
+        return True
+
+    def write_empty(self, image_id):
+        ''' Marks an image without instances, it is skipped in training '''
+        self.arrays['count'][image_id] = 0
+        self.arrays['count'].flush()
+
+
+############################################################
+#  Sample Preparation
+############################################################
+
+def prepare_sample(dataset, config, anchors, image_id, seed, augmentation=None, cache=None):
+    ''' Loads an image and its GT and matches the anchors. Runs in the
+    worker processes.
+
+    returns:
+        None if the image has no instances, 'cached' if the sample was
+        written to the cache, otherwise (image, image_meta, class_ids,
+        boxes, masks, rpn_match, anchor_gt)
+    '''
+    np.random.seed(seed)
+    random.seed(seed)
+    if augmentation:
+        import imgaug
+        imgaug.seed(seed)
+    image, image_meta, class_ids, boxes, masks = modellib.load_image_gt(
+        dataset, config, image_id, augmentation=augmentation,
+        use_mini_mask=config.USE_MINI_MASK)
+    # Skip images that have no instances. This can happen in cases
+    # where we train on a subset of classes and the image doesn't
+    # have any of the classes we care about.
+    if not np.any(class_ids > 0):
+        if cache is not None:
+            cache.write_empty(image_id)
+        return None
+    rpn_match, anchor_gt = modellib.match_rpn_anchors(anchors, class_ids, boxes)
+    sample = (image, image_meta, class_ids, boxes, masks, rpn_match, anchor_gt)
+    if cache is not None and cache.write(image_id, *sample):
+        return 'cached'
+    return sample
+
+
+# Set in each worker process by _init_worker()
+_worker = {}
+
+
+def _init_worker(dataset, config, anchors, augmentation, cache):
+    _worker.update(dataset=dataset, config=config, anchors=anchors,
+                   augmentation=augmentation, cache=cache)
+
+
+def _prepare(image_id, seed, augment):
+    w = _worker
+    return prepare_sample(w['dataset'], w['config'], w['anchors'], image_id, seed,
+                          w['augmentation'] if augment else None, w['cache'])
+
+
+############################################################
+#  Data Pipeline
+############################################################
+
+class DataPipeline:
+    ''' Drop in replacement for data_generator() in training. Iterating
+    gives the same [inputs], [outputs] batches, forever.
+
+    args:
+        dataset: the Dataset to pick data from
+        config: the model config
+        shuffle: shuffle the images every epoch
+        augmentation: optional imgaug augmentation
+        batch_size: images in each batch
+        workers: worker processes, 0 prepares the samples in this process.
+            Defaults to one less than the number of CPUs.
+        prefetch: samples prepared ahead of training, defaults to two per
+            worker and at least two batches
+        cache_dir: directory of the SampleCache, not cached if None
+        seed: seed of the image order and of every sample
+        no_augmentation_sources: dataset sources that are not augmented
+    '''
+
+    def __init__(self, dataset, config, shuffle=True, augmentation=None, batch_size=1,
+                 workers=None, prefetch=None, cache_dir=None, seed=0,
+                 no_augmentation_sources=None):
+        self.dataset = dataset
+        self.config = config
+        self.shuffle = shuffle
+        self.augmentation = augmentation
+        self.batch_size = batch_size
+        if workers is None:
+            workers = max(1, multiprocessing.cpu_count() - 1)
+        self.workers = workers
+        self.prefetch = prefetch or max(2 * workers, 2 * batch_size, 1)
+        self.seed = seed
+        self.no_augmentation_sources = no_augmentation_sources or []
+        self.anchors = get_anchors(config)
+        self.cache = None
+        if cache_dir is not None:
+            if SampleCache.usable(config, augmentation):
+                self.cache = SampleCache(cache_dir, dataset, config, self.anchors.shape[0])
+            else:
+                logging.warning('Samples change every epoch with this augmentation '
+                                'or config, they are not cached')
+        self.pool = None
+        self.stats = collections.Counter()
+        self.start = None
+
+    def tasks(self):
+        ''' (epoch, position, image_id) of every sample, forever '''
+        image_ids = np.copy(self.dataset.image_ids)
+        for epoch in itertools.count():
+            if self.shuffle:
+                np.random.RandomState(sample_seed(self.seed, epoch, 0)).shuffle(image_ids)
+            for position, image_id in enumerate(image_ids):
+                yield epoch, position, image_id
+
+    def submit(self, image_id, seed):
+        ''' Starts preparing a sample, returns an object with get() '''
+        augment = (self.augmentation is not None and self.dataset.image_info[image_id]['source']
+                   not in self.no_augmentation_sources)
+        if self.cache is not None and self.cache.has(image_id):
+            self.stats['cache_hits'] += 1
+            return utils.DoneResult('cached')
+        self.stats['prepared'] += 1
+        if self.workers == 0:
+            return utils.DoneResult(prepare_sample(
+                self.dataset, self.config, self.anchors, image_id, seed,
+                self.augmentation if augment else None, self.cache))
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(
+                self.workers, initializer=_init_worker,
+                initargs=(self.dataset, self.config, self.anchors, self.augmentation, self.cache))
+        return self.pool.apply_async(_prepare, (image_id, seed, augment))
+
+    def finish(self, image_id, seed, result):
+        ''' Samples the anchors of a prepared sample
+
+        returns:
+            image, image_meta, rpn_match, rpn_bbox, class_ids, boxes, masks
+            or None if the image has no instances
+        '''
+        if result == 'cached':
+            result = self.cache.read(image_id)
+            if len(result[2]) == 0:
+                return None
+        if result is None:
+            return None
+        image, image_meta, class_ids, boxes, masks, rpn_match, anchor_gt = result
+        rng = np.random.RandomState(seed)
+        rpn_match, rpn_bbox = modellib.sample_rpn_targets(
+            np.array(rpn_match, dtype=np.int32), anchor_gt, self.anchors, boxes, self.config, rng)
+        # If more instances than fits in the array, sub-sample from them.
+        if boxes.shape[0] > self.config.MAX_GT_INSTANCES:
+            ids = rng.choice(np.arange(boxes.shape[0]), self.config.MAX_GT_INSTANCES, replace=False)
+            class_ids = class_ids[ids]
+            boxes = boxes[ids]
+            masks = masks[:, :, ids]
+        return image, image_meta, rpn_match, rpn_bbox, class_ids, boxes, masks
+
+    def samples(self):
+        ''' Prepared samples in order, the next ones are prepared while
+        each one is used
+        '''
+        pending = collections.deque()
+        tasks = self.tasks()
+        error_count = 0
+        self.start = time.time()
+        while True:
+            while len(pending) < self.prefetch:
+                epoch, position, image_id = next(tasks)
+                seed = sample_seed(self.seed, epoch, position + 1)
+                pending.append((image_id, seed, self.submit(image_id, seed)))
+            image_id, seed, job = pending.popleft()
+            wait = time.time()
+            try:
+                sample = self.finish(image_id, seed, job.get())
+            except (GeneratorExit, KeyboardInterrupt):
+                raise
+            except Exception:
+                # Log it and skip the image
+                logging.exception("Error processing image {}".format(
+                    self.dataset.image_info[image_id]))
+                error_count += 1
+                if error_count > 5:
+                    raise
+                continue
+            finally:
+                self.stats['wait_seconds'] += time.time() - wait
+            if sample is not None:
+                self.stats['samples'] += 1
+                yield sample
+
+    def __iter__(self):
+        config = self.config
+        samples = self.samples()
+        while True:
+            batch = [next(samples) for _ in range(self.batch_size)]
+            image, image_meta, rpn_match, rpn_bbox, _, _, masks = batch[0]
+            batch_images = np.zeros((self.batch_size,) + image.shape, dtype=np.float32)
+            batch_image_meta = np.zeros((self.batch_size,) + image_meta.shape, dtype=image_meta.dtype)
+            batch_rpn_match = np.zeros([self.batch_size, rpn_match.shape[0], 1], dtype=rpn_match.dtype)
+            batch_rpn_bbox = np.zeros([self.batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4],
+                                      dtype=rpn_bbox.dtype)
+            batch_gt_class_ids = np.zeros((self.batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
+            batch_gt_boxes = np.zeros((self.batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32)
+            batch_gt_masks = np.zeros((self.batch_size, masks.shape[0], masks.shape[1],
+                                       config.MAX_GT_INSTANCES), dtype=masks.dtype)
+            for b, (image, image_meta, rpn_match, rpn_bbox, class_ids, boxes, masks) in enumerate(batch):
+                batch_images[b] = modellib.mold_image(image.astype(np.float32), config)
+                batch_image_meta[b] = image_meta
+                batch_rpn_match[b] = rpn_match[:, np.newaxis]
+                batch_rpn_bbox[b] = rpn_bbox
+                batch_gt_class_ids[b, :class_ids.shape[0]] = class_ids
+                batch_gt_boxes[b, :boxes.shape[0]] = boxes
+                batch_gt_masks[b, :, :, :masks.shape[-1]] = masks
+            yield [batch_images, batch_image_meta, batch_rpn_match, batch_rpn_bbox,
+                   batch_gt_class_ids, batch_gt_boxes, batch_gt_masks], []
+
+    def report(self):
+        ''' Throughput since the first sample '''
+        seconds = time.time() - self.start if self.start else 0.0
+        return {
+            'samples': self.stats['samples'],
+            'seconds': seconds,
+            'samples_per_sec': self.stats['samples'] / seconds if seconds else 0.0,
+            'wait_seconds': self.stats['wait_seconds'],
+            'cache_hits': self.stats['cache_hits'],
+            'prepared': self.stats['prepared'],
+        }
+
+    def format_report(self):
+        r = self.report()
+        return ('{samples} samples in {seconds:.1f}s ({samples_per_sec:.2f} samples/sec), '
+                'waited {wait_seconds:.1f}s, {cache_hits} from cache, {prepared} prepared'.format(**r))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
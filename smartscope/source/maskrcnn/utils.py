@@ -37,24 +37,19 @@ def extract_bboxes(mask):
 
     Returns: bbox array [num_instances, (y1, x1, y2, x2)].
     """
-    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
-    for i in range(mask.shape[-1]):
-        m = mask[:, :, i]
-        # Bounding box.
-        horizontal_indicies = np.where(np.any(m, axis=0))[0]
-        vertical_indicies = np.where(np.any(m, axis=1))[0]
-        if horizontal_indicies.shape[0]:
-            x1, x2 = horizontal_indicies[[0, -1]]
-            y1, y2 = vertical_indicies[[0, -1]]
-            # x2 and y2 should not be part of the box. Increment by 1.
-            x2 += 1
-            y2 += 1
-        else:
-            # No mask for this instance. Might happen due to
-            # resizing or cropping. Set bbox to zeros
-            x1, x2, y1, y2 = 0, 0, 0, 0
-        boxes[i] = np.array([y1, x1, y2, x2])
-    return boxes.astype(np.int32)
+    # Rows and columns that have any pixel of each instance
+    horizontal = np.any(mask, axis=0)
+    vertical = np.any(mask, axis=1)
+    # First and last True index, x2 and y2 should not be part of the box
+    x1 = np.argmax(horizontal, axis=0)
+    x2 = mask.shape[1] - np.argmax(horizontal[::-1], axis=0)
+    y1 = np.argmax(vertical, axis=0)
+    y2 = mask.shape[0] - np.argmax(vertical[::-1], axis=0)
+    boxes = np.stack([y1, x1, y2, x2], axis=1).astype(np.int32)
+    # No mask for this instance. Might happen due to
+    # resizing or cropping. Set bbox to zeros
+    boxes[~horizontal.any(axis=0)] = 0
+    return boxes
 
 
 def compute_iou(box, boxes, box_area, boxes_area):
@@ -78,6 +73,10 @@ def compute_iou(box, boxes, box_area, boxes_area):
     return iou
 
 
+# Largest number of box pairs compute_overlaps() works on at once
+OVERLAP_BLOCK = 2 ** 20
+
+
 def compute_overlaps(boxes1, boxes2):
     """Computes IoU overlaps between two sets of boxes.
     boxes1, boxes2: [N, (y1, x1, y2, x2)].
@@ -89,11 +88,18 @@ def compute_overlaps(boxes1, boxes2):
     area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
 
     # Compute overlaps to generate matrix [boxes1 count, boxes2 count]
-    # Each cell contains the IoU value.
+    # Each cell contains the IoU value. Blocks of boxes2 are done at once,
+    # with boxes1 along the rows of the block so the memory is contiguous.
+    y1, x1, y2, x2 = [np.ascontiguousarray(boxes1[:, i]) for i in range(4)]
     overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]))
-    for i in range(overlaps.shape[1]):
-        box2 = boxes2[i]
-        overlaps[:, i] = compute_iou(box2, boxes1, area2[i], area1)
+    step = max(1, OVERLAP_BLOCK // max(1, boxes1.shape[0]))
+    for i in range(0, boxes2.shape[0], step):
+        b = boxes2[i:i + step, :, None]
+        h = np.maximum(np.minimum(b[:, 2], y2) - np.maximum(b[:, 0], y1), 0)
+        w = np.maximum(np.minimum(b[:, 3], x2) - np.maximum(b[:, 1], x1), 0)
+        intersection = w * h
+        union = area2[i:i + step, None] + area1 - intersection
+        overlaps[:, i:i + step] = (intersection / union).T
     return overlaps
 
 
@@ -129,31 +135,31 @@ def non_max_suppression(boxes, scores, threshold):
     if boxes.dtype.kind != "f":
         boxes = boxes.astype(np.float32)
 
-    # Compute box areas
-    y1 = boxes[:, 0]
-    x1 = boxes[:, 1]
-    y2 = boxes[:, 2]
-    x2 = boxes[:, 3]
-    area = (y2 - y1) * (x2 - x1)
-
-    # Get indicies of boxes sorted by scores (highest first)
+    # Sort the boxes by score (highest first) and compute their areas
     ixs = scores.argsort()[::-1]
-
-    pick = []
-    while len(ixs) > 0:
-        # Pick top box and add its index to the list
-        i = ixs[0]
-        pick.append(i)
-        # Compute IoU of the picked box with the rest
-        iou = compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
-        # Identify boxes with IoU over the threshold. This
-        # returns indices into ixs[1:], so add 1 to get
-        # indices into ixs.
-        remove_ixs = np.where(iou > threshold)[0] + 1
-        # Remove indices of the picked and overlapped boxes.
-        ixs = np.delete(ixs, remove_ixs)
-        ixs = np.delete(ixs, 0)
-    return np.array(pick, dtype=np.int32)
+    boxes = boxes[ixs]
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+    # Greedy suppression: each kept box removes the lower scoring boxes
+    # that overlap it. The IoUs with the lower scoring boxes are computed
+    # for blocks of rows at once, so each pick only looks up its overlaps.
+    y1, x1, y2, x2 = [np.ascontiguousarray(boxes[:, i]) for i in range(4)]
+    n = boxes.shape[0]
+    keep = np.ones(n, dtype=bool)
+    step = max(1, OVERLAP_BLOCK // n)
+    for start in range(0, n, step):
+        stop = min(n, start + step)
+        b = boxes[start:stop, :, None]
+        h = np.maximum(np.minimum(b[:, 2], y2[start:]) - np.maximum(b[:, 0], y1[start:]), 0)
+        w = np.maximum(np.minimum(b[:, 3], x2[start:]) - np.maximum(b[:, 1], x1[start:]), 0)
+        intersection = w * h
+        union = area[start:stop, None] + area[start:] - intersection
+        rows, cols = np.nonzero(np.triu(intersection / union > threshold, 1))
+        bounds = np.searchsorted(rows, np.arange(stop - start + 1))
+        for i in range(stop - start):
+            if keep[start + i]:
+                keep[start + cols[bounds[i]:bounds[i + 1]]] = False
+    return ixs[keep].astype(np.int32)
 
 
 def apply_box_deltas(boxes, deltas):
@@ -522,10 +528,9 @@ def minimize_mask(bbox, mask, mini_shape):
     """
     mini_mask = np.zeros(mini_shape + (mask.shape[-1],), dtype=bool)
     for i in range(mask.shape[-1]):
-        # Pick slice and cast to bool in case load_mask() returned wrong dtype
-        m = mask[:, :, i].astype(bool)
+        # Crop first, then cast to bool in case load_mask() returned wrong dtype
         y1, x1, y2, x2 = bbox[i][:4]
-        m = m[y1:y2, x1:x2]
+        m = mask[y1:y2, x1:x2, i].astype(bool)
         if m.size == 0:
             raise Exception("Invalid bounding box with area of zero")
         # Resize with bilinear interpolation
@@ -565,15 +570,24 @@ def unmold_mask(mask, bbox, image_shape):
 
     Returns a binary mask with the same size as the original image.
     """
-    threshold = 0.5
-    y1, x1, y2, x2 = bbox
-    mask = resize(mask, (y2 - y1, x2 - x1))
-    mask = np.where(mask >= threshold, 1, 0).astype(np.bool)
+    return unmold_masks(mask[None], np.asarray(bbox)[None], image_shape)[:, :, 0]
+
 
-    # Put the mask in the right location.
-    full_mask = np.zeros(image_shape[:2], dtype=np.bool)
-    full_mask[y1:y2, x1:x2] = mask
-    return full_mask
+def unmold_masks(masks, bboxes, image_shape):
+    """Converts the masks of several detections at once, see unmold_mask().
+    masks: [N, height, width] of type float.
+    bboxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+
+    Returns binary masks [height, width, N] the size of the original image.
+    """
+    threshold = 0.5
+    # One array for all the masks instead of a full size array per mask
+    full_masks = np.zeros(image_shape[:2] + (len(masks),), dtype=np.bool)
+    for i, (mask, (y1, x1, y2, x2)) in enumerate(zip(masks, bboxes)):
+        mask = resize(mask, (y2 - y1, x2 - x1))
+        # Put the mask in the right location.
+        full_masks[y1:y2, x1:x2, i] = mask >= threshold
+    return full_masks
 
 
 ############################################################
@@ -653,82 +667,106 @@ def trim_zeros(x):
     return x[~np.all(x == 0, axis=1)]
 
 
-def compute_matches(gt_boxes, gt_class_ids, gt_masks,
-                    pred_boxes, pred_class_ids, pred_scores, pred_masks,
-                    iou_threshold=0.5, score_threshold=0.0):
-    """Finds matches between prediction and ground truth instances.
+def compute_match_overlaps(gt_boxes, gt_class_ids, gt_masks,
+                           pred_boxes, pred_class_ids, pred_scores, pred_masks):
+    """Prepares the predictions and ground truth of an image for
+    match_overlaps(). The overlaps do not depend on the IoU threshold, so
+    they can be computed once and matched at every threshold.
+
+    gt_masks, pred_masks: [Height, Width, instances] or None to use the
+        box overlaps.
 
     Returns:
-        gt_match: 1-D array. For each GT box it has the index of the matched
-                  predicted box.
-        pred_match: 1-D array. For each predicted box, it has the index of
-                    the matched ground truth box.
-        overlaps: [pred_boxes, gt_boxes] IoU overlaps.
+        gt_class_ids: GT class IDs without zero padding
+        pred_class_ids: Predicted class IDs sorted by score from high to low
+        overlaps: [pred_boxes, gt_boxes] IoU overlaps, in the same order
     """
     # Trim zero padding
     # TODO: cleaner to do zero unpadding upstream
     gt_boxes = trim_zeros(gt_boxes)
-    gt_masks = gt_masks[..., :gt_boxes.shape[0]]
+    gt_class_ids = gt_class_ids[:gt_boxes.shape[0]]
     pred_boxes = trim_zeros(pred_boxes)
     pred_scores = pred_scores[:pred_boxes.shape[0]]
     # Sort predictions by score from high to low
     indices = np.argsort(pred_scores)[::-1]
     pred_boxes = pred_boxes[indices]
     pred_class_ids = pred_class_ids[indices]
-    pred_scores = pred_scores[indices]
-    pred_masks = pred_masks[..., indices]
 
     # Compute IoU overlaps [pred_masks, gt_masks]
-    overlaps = compute_overlaps_masks(pred_masks, gt_masks)
+    if gt_masks is None or pred_masks is None:
+        overlaps = compute_overlaps(pred_boxes, gt_boxes)
+    else:
+        gt_masks = gt_masks[..., :gt_boxes.shape[0]]
+        pred_masks = pred_masks[..., indices]
+        overlaps = compute_overlaps_masks(pred_masks, gt_masks)
+    return gt_class_ids, pred_class_ids, overlaps
+
 
-    # Loop through predictions and find matching ground truth boxes
-    match_count = 0
-    pred_match = -1 * np.ones([pred_boxes.shape[0]])
-    gt_match = -1 * np.ones([gt_boxes.shape[0]])
-    for i in range(len(pred_boxes)):
+def match_overlaps(overlaps, gt_class_ids, pred_class_ids,
+                   iou_threshold=0.5, score_threshold=0.0):
+    """Matches predictions to ground truth instances from the output of
+    compute_match_overlaps().
+
+    Returns:
+        gt_match: 1-D array. For each GT box it has the index of the matched
+                  predicted box.
+        pred_match: 1-D array. For each predicted box, it has the index of
+                    the matched ground truth box.
+    """
+    pred_match = -1 * np.ones([overlaps.shape[0]])
+    gt_match = -1 * np.ones([overlaps.shape[1]])
+    # Sort the matches of every prediction by overlap, all at once
+    sorted_ixs = np.argsort(overlaps, axis=1)[:, ::-1]
+    sorted_overlaps = np.take_along_axis(overlaps, sorted_ixs, axis=1)
+    for i in range(overlaps.shape[0]):
         # Find best matching ground truth box
-        # 1. Sort matches by score
-        sorted_ixs = np.argsort(overlaps[i])[::-1]
-        # 2. Remove low scores
-        low_score_idx = np.where(overlaps[i, sorted_ixs] < score_threshold)[0]
-        if low_score_idx.size > 0:
-            sorted_ixs = sorted_ixs[:low_score_idx[0]]
-        # 3. Find the match
-        for j in sorted_ixs:
+        for j, iou in zip(sorted_ixs[i], sorted_overlaps[i]):
+            # Remove low scores
+            if iou < score_threshold:
+                break
             # If ground truth box is already matched, go to next one
             if gt_match[j] > -1:
                 continue
             # If we reach IoU smaller than the threshold, end the loop
-            iou = overlaps[i, j]
             if iou < iou_threshold:
                 break
             # Do we have a match?
             if pred_class_ids[i] == gt_class_ids[j]:
-                match_count += 1
                 gt_match[j] = i
                 pred_match[i] = j
                 break
 
+    return gt_match, pred_match
+
+
+def compute_matches(gt_boxes, gt_class_ids, gt_masks,
+                    pred_boxes, pred_class_ids, pred_scores, pred_masks,
+                    iou_threshold=0.5, score_threshold=0.0):
+    """Finds matches between prediction and ground truth instances.
+
+    Returns:
+        gt_match: 1-D array. For each GT box it has the index of the matched
+                  predicted box.
+        pred_match: 1-D array. For each predicted box, it has the index of
+                    the matched ground truth box.
+        overlaps: [pred_boxes, gt_boxes] IoU overlaps.
+    """
+    gt_class_ids, pred_class_ids, overlaps = compute_match_overlaps(
+        gt_boxes, gt_class_ids, gt_masks,
+        pred_boxes, pred_class_ids, pred_scores, pred_masks)
+    gt_match, pred_match = match_overlaps(overlaps, gt_class_ids, pred_class_ids,
+                                          iou_threshold, score_threshold)
     return gt_match, pred_match, overlaps
 
 
-def compute_ap(gt_boxes, gt_class_ids, gt_masks,
-               pred_boxes, pred_class_ids, pred_scores, pred_masks,
-               iou_threshold=0.5):
-    """Compute Average Precision at a set IoU threshold (default 0.5).
+def compute_ap_from_matches(gt_match, pred_match):
+    """Average Precision of the matches from match_overlaps().
 
     Returns:
     mAP: Mean Average Precision
     precisions: List of precisions at different class score thresholds.
     recalls: List of recall values at different class score thresholds.
-    overlaps: [pred_boxes, gt_boxes] IoU overlaps.
     """
-    # Get matches and overlaps
-    gt_match, pred_match, overlaps = compute_matches(
-        gt_boxes, gt_class_ids, gt_masks,
-        pred_boxes, pred_class_ids, pred_scores, pred_masks,
-        iou_threshold)
-
     # Compute precision and recall at each prediction box step
     precisions = np.cumsum(pred_match > -1) / (np.arange(len(pred_match)) + 1)
     recalls = np.cumsum(pred_match > -1).astype(np.float32) / len(gt_match)
@@ -740,14 +778,33 @@ def compute_ap(gt_boxes, gt_class_ids, gt_masks,
     # Ensure precision values decrease but don't increase. This way, the
     # precision value at each recall threshold is the maximum it can be
     # for all following recall thresholds, as specified by the VOC paper.
-    for i in range(len(precisions) - 2, -1, -1):
-        precisions[i] = np.maximum(precisions[i], precisions[i + 1])
+    precisions = np.maximum.accumulate(precisions[::-1])[::-1]
 
     # Compute mean AP over recall range
     indices = np.where(recalls[:-1] != recalls[1:])[0] + 1
     mAP = np.sum((recalls[indices] - recalls[indices - 1]) *
                  precisions[indices])
 
+    return mAP, precisions, recalls
+
+
+def compute_ap(gt_boxes, gt_class_ids, gt_masks,
+               pred_boxes, pred_class_ids, pred_scores, pred_masks,
+               iou_threshold=0.5):
+    """Compute Average Precision at a set IoU threshold (default 0.5).
+
+    Returns:
+    mAP: Mean Average Precision
+    precisions: List of precisions at different class score thresholds.
+    recalls: List of recall values at different class score thresholds.
+    overlaps: [pred_boxes, gt_boxes] IoU overlaps.
+    """
+    # Get matches and overlaps
+    gt_match, pred_match, overlaps = compute_matches(
+        gt_boxes, gt_class_ids, gt_masks,
+        pred_boxes, pred_class_ids, pred_scores, pred_masks,
+        iou_threshold)
+    mAP, precisions, recalls = compute_ap_from_matches(gt_match, pred_match)
     return mAP, precisions, recalls, overlaps
 
 
@@ -757,14 +814,17 @@ def compute_ap_range(gt_box, gt_class_id, gt_mask,
     """Compute AP over a range or IoU thresholds. Default range is 0.5-0.95."""
     # Default is 0.5 to 0.95 with increments of 0.05
     iou_thresholds = iou_thresholds or np.arange(0.5, 1.0, 0.05)
-    
+
+    # The overlaps are the same at every threshold
+    gt_class_id, pred_class_id, overlaps = compute_match_overlaps(
+        gt_box, gt_class_id, gt_mask, pred_box, pred_class_id, pred_score, pred_mask)
+
     # Compute AP over range of IoU thresholds
     AP = []
     for iou_threshold in iou_thresholds:
-        ap, precisions, recalls, overlaps =\
-            compute_ap(gt_box, gt_class_id, gt_mask,
-                        pred_box, pred_class_id, pred_score, pred_mask,
-                        iou_threshold=iou_threshold)
+        gt_match, pred_match = match_overlaps(overlaps, gt_class_id, pred_class_id,
+                                              iou_threshold)
+        ap, precisions, recalls = compute_ap_from_matches(gt_match, pred_match)
         if verbose:
             print("AP @{:.2f}:\t {:.3f}".format(iou_threshold, ap))
         AP.append(ap)
@@ -893,6 +953,9 @@ def resize(image, output_shape, order=1, mode='constant', cval=0, clip=True,
     of skimage. This solves the problem by using different parameters per
     version. And it provides a central place to control resizing defaults.
     """
+    if image.dtype == bool and order > 0:
+        # New in 0.19: bool images are no longer converted to float
+        image = image.astype(np.float64)
     if LooseVersion(skimage.__version__) >= LooseVersion("0.14"):
         # New in 0.14: anti_aliasing. Default it to False for backward
         # compatibility with skimage 0.13.
@@ -906,3 +969,14 @@ def resize(image, output_shape, order=1, mode='constant', cval=0, clip=True,
             image, output_shape,
             order=order, mode=mode, cval=cval, clip=clip,
             preserve_range=preserve_range)
+
+
+class DoneResult(object):
+    """A value computed in this process, used like the AsyncResult a
+    multiprocessing.Pool returns so that callers handle both the same way.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
@@ -5,8 +5,7 @@ https://github.com/google/microscopeimagequality/blob/main/microscopeimagequalit
 
 import collections
 import numpy
-import scipy.misc
-import scipy.stats
+import scipy.special
 import tensorflow
 import tensorflow.contrib.slim
 import tensorflow.python.ops
@@ -59,20 +58,7 @@ def get_certainty(probabilities):
     A float in the range [0.0, 1.0] representing the certainty of the
     distribution.
   """
-    sum_prob = numpy.sum(probabilities)
-    num_classes = probabilities.shape[0]
-    if sum_prob > 0:
-        normalized_probabilities = probabilities / sum_prob
-
-        certainty_proxy = 1.0 - scipy.stats.entropy(
-            normalized_probabilities) / numpy.log(num_classes)
-
-    else:
-        certainty_proxy = 0.0
-    assert certainty_proxy - 1 < 1e-6, 'certainty: ' ' %g' % certainty_proxy
-    assert certainty_proxy > -1e-6, 'certainty:' ' %g' % certainty_proxy
-    certainty_proxy = numpy.clip(certainty_proxy, 0.0, 1.0)
-    return certainty_proxy
+    return certainties_from_probabilities(probabilities[numpy.newaxis])[0]
 
 
 def certainties_from_probabilities(probabilities):
@@ -80,70 +66,119 @@ def certainties_from_probabilities(probabilities):
 
   Certainty is a number from 0.0 to 1.0, with 1.0 indicating a prediction with
   100% probability in one class, and 0.0 indicating a uniform probability over
-  all classes.
+  all classes. It is one minus the entropy of the normalized probabilities
+  divided by its largest value, computed for all rows at once.
 
   Args:
     probabilities: Numpy array of marginal probabilities, shape
-     (batch_size, num_classes).
+     (..., num_classes), eg. (batch_size, num_classes) or
+     (frames, patches, num_classes).
 
   Returns:
-    Numpy array of certainties, of shape (batch_size).
+    Numpy array of certainties, of shape (...).
   """
-    certainties = numpy.zeros(probabilities.shape[0])
-    for i in range(probabilities.shape[0]):
-        certainties[i] = get_certainty(probabilities[i, :])
-    return certainties
+    probabilities = numpy.asarray(probabilities, dtype=numpy.float64)
+    num_classes = probabilities.shape[-1]
+    sums = probabilities.sum(-1, keepdims=True)
+    normalized = probabilities / numpy.where(sums > 0, sums, 1.0)
+    # 0 * log(0) is 0, as in scipy.stats.entropy
+    entropy = -(normalized * numpy.log(numpy.where(normalized > 0, normalized, 1.0))).sum(-1)
+    certainties = numpy.where(sums[..., 0] > 0, 1.0 - entropy / numpy.log(num_classes), 0.0)
+    return numpy.clip(certainties, 0.0, 1.0)
 
 
-def aggregate_prediction_from_probabilities(probabilities,
-                                            aggregation_method=METHOD_AVERAGE):
-    """Determine the whole-image class prediction from patch probabilities.
+def aggregate_probabilities(probabilities, aggregation_method=METHOD_AVERAGE):
+    """Aggregate the patch probabilities of any number of images.
 
   Args:
     probabilities: Numpy array of marginal probabilities, shape
-     (batch_size, num_classes).
+     (..., patches, num_classes).
     aggregation_method: String, the method of aggregating the patch
       probabilities.
 
   Returns:
-    A WholeImagePrediction object.
+    The aggregated probabilities, shape (..., num_classes), and the patch
+    certainties, shape (..., patches).
 
   Raises:
     ValueError: If the aggregation method is not valid.
   """
+    probabilities = numpy.asarray(probabilities, dtype=numpy.float64)
     certainties = certainties_from_probabilities(probabilities)
-
-    certainty_dict = {
-        'mean': numpy.round(numpy.mean(certainties), 3),
-        'max': numpy.round(numpy.max(certainties), 3)
-    }
-
-    weights = certainties
-    weights = None if numpy.sum(weights) == 0 else weights
-
     if aggregation_method == METHOD_AVERAGE:
-        probabilities_aggregated = numpy.average(probabilities, 0, weights=weights)
+        # Patches are weighted by their certainty, or equally if none is certain
+        weights = _certainty_weights(certainties)
+        probabilities_aggregated = (
+            (probabilities * weights[..., numpy.newaxis]).sum(-2) /
+            weights.sum(-1)[..., numpy.newaxis])
     elif aggregation_method == METHOD_PRODUCT:
         # For i denoting index within batch and c the class:
         #   Q_c = product_over_i(p_c(i))
         # probabilities_aggregated = Q_c / sum_over_c(Q_c)
         # The following computes this using logs for numerical stability.
-        sum_log_probabilities = numpy.sum(numpy.log(probabilities), 0)
+        sum_log_probabilities = numpy.sum(numpy.log(probabilities), -2)
         probabilities_aggregated = numpy.exp(
-            sum_log_probabilities - scipy.misc.logsumexp(sum_log_probabilities))
+            sum_log_probabilities -
+            scipy.special.logsumexp(sum_log_probabilities, axis=-1, keepdims=True))
     else:
         raise ValueError('Invalid aggregation method %s.' % aggregation_method)
-    predicted_class = numpy.argmax(probabilities_aggregated)
-    certainty_dict['aggregate'] = numpy.round(
-        get_certainty(probabilities_aggregated), 3)
-    certainty_dict['weighted'] = numpy.round(
-        numpy.average(
-            certainties, 0, weights=weights), 3)
+    return probabilities_aggregated, certainties
+
+
+def _certainty_weights(certainties):
+    sums = certainties.sum(-1, keepdims=True)
+    return numpy.where(sums > 0, certainties, 1.0)
+
+
+def aggregate_predictions_from_probabilities(probabilities,
+                                             aggregation_method=METHOD_AVERAGE):
+    """Determine the whole-image class prediction of several images.
+
+  Args:
+    probabilities: Numpy array of marginal probabilities, shape
+     (images, patches, num_classes).
+    aggregation_method: String, the method of aggregating the patch
+      probabilities.
 
-    assert sorted(CERTAINTY_TYPES.values()) == sorted(certainty_dict.keys())
+  Returns:
+    A list of WholeImagePrediction objects, one for each image.
+  """
+    probabilities_aggregated, certainties = aggregate_probabilities(
+        probabilities, aggregation_method)
+    aggregate_certainties = certainties_from_probabilities(probabilities_aggregated)
+    weights = _certainty_weights(certainties)
+    weighted = (certainties * weights).sum(-1) / weights.sum(-1)
+    rounded = {
+        'mean': numpy.round(numpy.mean(certainties, -1), 3),
+        'max': numpy.round(numpy.max(certainties, -1), 3),
+        'aggregate': numpy.round(aggregate_certainties, 3),
+        'weighted': numpy.round(weighted, 3),
+    }
+    predicted_classes = numpy.argmax(probabilities_aggregated, -1)
+    return [WholeImagePrediction(predicted_classes[i],
+                                 {name: values[i] for name, values in rounded.items()},
+                                 probabilities_aggregated[i])
+            for i in range(len(probabilities_aggregated))]
+
+
+def aggregate_prediction_from_probabilities(probabilities,
+                                            aggregation_method=METHOD_AVERAGE):
+    """Determine the whole-image class prediction from patch probabilities.
+
+  Args:
+    probabilities: Numpy array of marginal probabilities, shape
+     (batch_size, num_classes).
+    aggregation_method: String, the method of aggregating the patch
+      probabilities.
 
-    return WholeImagePrediction(predicted_class, certainty_dict,
-                                probabilities_aggregated)
+  Returns:
+    A WholeImagePrediction object.
+
+  Raises:
+    ValueError: If the aggregation method is not valid.
+  """
+    return aggregate_predictions_from_probabilities(
+        numpy.asarray(probabilities)[numpy.newaxis], aggregation_method)[0]
 
 
 def _patches_to_image(patches, image_shape):
@@ -171,15 +206,10 @@ def _patches_to_image(patches, image_shape):
         raise ValueError('image_shape %s not valid for %d %dx%d patches.' %
                          (str(image_shape), num_patches, patch_width, patch_width))
 
-    image = numpy.zeros([num_rows * patch_width, num_cols * patch_width, patches.shape[3]], dtype=patches.dtype)
-
-    index = 0
-    for i in range(0, num_rows * patch_width, patch_width):
-        for j in range(0, num_cols * patch_width, patch_width):
-            image[i:i + patch_width, j:j + patch_width, :] = patches[index, :, :, :]
-            index += 1
-
-    return image
+    # Patches are in row major order
+    image = patches.reshape(num_rows, num_cols, patch_width, patch_width, patches.shape[3])
+    return image.transpose(0, 2, 1, 3, 4).reshape(
+        num_rows * patch_width, num_cols * patch_width, patches.shape[3])
 
 
 def _set_border_pixels(patch, value, border_size=2):
@@ -6,10 +6,12 @@ import logging
 import os
 import os.path as osp
 import pkg_resources
+import re
 
 import tensorflow
 import tensorflow.contrib.slim
 
+from smartscope.source import frozen
 from smartscope.source.miq import constants
 from smartscope.source.miq import prediction
 
@@ -33,9 +35,26 @@ def get_model_path(path):
     # return osp.join(celldom.get_cache_dir(), cache_path, osp.basename(REMOTE_MODEL_CHECKPOINT_PATH))
 
 
-def get_classifier(model_path, tf_session_config=None):
+def checkpoint_path(path):
+    """Checkpoint prefix of any of its files, eg.
+    model.ckpt-1000042.index -> model.ckpt-1000042"""
+    for extension in ['.index', '.meta']:
+        if path.endswith(extension):
+            return path[:-len(extension)]
+    return re.sub(r'\.data-\d+-of-\d+$', '', path)
+
+
+def get_classifier(model_path, tf_session_config=None, use_frozen=True):
     # model_path = path
     # model_path = 'model.ckpt-1000042'
+    # Use the frozen model from export_models.py if it matches the checkpoint
+    path = frozen.frozen_path(model_path, 'frozen')
+    info = frozen.read_info(path, model_path) if use_frozen else None
+    if info is not None:
+        return prediction.FrozenImageQualityClassifier(
+            path, info['inputs'], info['outputs'], model_patch_side_length=84,
+            num_classes=11, session_config=tf_session_config
+        )
     return prediction.ImageQualityClassifier(
         model_path, model_patch_side_length=84, num_classes=11,
         graph=tensorflow.Graph(), session_config=tf_session_config
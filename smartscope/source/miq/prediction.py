@@ -2,13 +2,13 @@
 https://github.com/google/microscopeimagequality/blob/main/microscopeimagequality/prediction.py
 """
 
+import collections
 import logging
 import sys
 
 import numpy
 import tensorflow
 
-from smartscope.source.miq import constants
 from smartscope.source.miq import evaluation
 
 # logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
@@ -20,6 +20,76 @@ _TFRECORD_FILE_PATTERN = 'data_%s-%05d-of-%05d.tfrecord'
 logger = logging.getLogger(__name__)
 
 
+class PatchMap(collections.namedtuple('PatchMap', ['probabilities', 'certainties', 'patch_width'])):
+    """
+    Predictions for every patch of one or more images.
+
+    Properties:
+        probabilities: Numpy float array of the class probabilities, shape [images x rows x
+          columns x num_classes]. Patch (r, c) covers pixels [r * patch_width, (r + 1) *
+          patch_width) x [c * patch_width, (c + 1) * patch_width) of its image.
+        certainties: Numpy float array of the certainty of each patch, shape [images x rows x
+          columns].
+        patch_width: Integer, the side length in pixels of each patch.
+    """
+
+    @property
+    def predictions(self):
+        """Class with the highest probability of each patch, uint16 [images x rows x columns]."""
+        return numpy.argmax(self.probabilities, -1).astype(numpy.uint16)
+
+    def scores(self, invert=False):
+        """Probability-weighted class of each patch, see ImageQualityClassifier.score()."""
+        classes = numpy.arange(self.probabilities.shape[-1])
+        if invert:
+            classes = classes[::-1]
+        return self.probabilities.dot(classes)
+
+    def heatmap(self, values, image_shape=None, fill=0):
+        """Assemble per-patch values into per-pixel images, eg. for QC overlays.
+
+        Args:
+          values: Numpy array of shape [images x rows x columns], eg. predictions, certainties
+            or scores().
+          image_shape: (height, width) of the images. The pixels right of and below the last
+            whole patch are set to fill. If None, only the patches are covered.
+          fill: Value of the pixels not covered by a patch.
+
+        Returns:
+          Numpy array of shape [images x height x width] with the dtype of values.
+        """
+        values = numpy.asarray(values)
+        maps = numpy.repeat(numpy.repeat(values, self.patch_width, axis=-2), self.patch_width, axis=-1)
+        if image_shape is None:
+            return maps
+        full = numpy.full(values.shape[:-2] + tuple(image_shape), fill, dtype=values.dtype)
+        full[..., :maps.shape[-2], :maps.shape[-1]] = maps
+        return full
+
+    def prediction_heatmaps(self, image_shape=None):
+        """Predicted class of every pixel as uint16, like patch_values_to_mask()."""
+        return self.heatmap(self.predictions, image_shape)
+
+    def certainty_heatmaps(self, image_shape=None):
+        """Certainty of every pixel as float."""
+        return self.heatmap(self.certainties, image_shape)
+
+    def aggregate(self, aggregation_method=None):
+        """Whole image predictions from the patches, the same as predict() of each image.
+
+        Args:
+          aggregation_method: evaluation.METHOD_AVERAGE (default) or METHOD_PRODUCT.
+
+        Returns:
+          List of evaluation.WholeImagePrediction, one for each image.
+        """
+        if aggregation_method is None:
+            aggregation_method = evaluation.METHOD_AVERAGE
+        shape = self.probabilities.shape
+        return evaluation.aggregate_predictions_from_probabilities(
+            self.probabilities.reshape(shape[0], -1, shape[-1]), aggregation_method)
+
+
 class ImageQualityClassifier(object):
     """Object for running image quality model inference.
 
@@ -66,6 +136,25 @@ class ImageQualityClassifier(object):
     def __del__(self):
         self._sess.close()
 
+    def export_frozen(self, path):
+        """Writes the graph with the checkpoint folded in as constants to a
+        GraphDef file. Load it with FrozenImageQualityClassifier.
+
+        Args:
+          path: String, .pb file to write.
+
+        Returns:
+          The op names of the image placeholder and the probabilities.
+        """
+        inputs = self._image_placeholder.op.name
+        outputs = self._probabilities.op.name
+        graph_def = tensorflow.graph_util.convert_variables_to_constants(
+            self._sess, self.graph.as_graph_def(), [outputs])
+        graph_def = tensorflow.graph_util.remove_training_nodes(graph_def, protected_nodes=[outputs])
+        with tensorflow.gfile.GFile(path, 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        return inputs, outputs
+
     def _probabilities_from_image(self, image_placeholder,
                                   model_patch_side_length, num_classes):
         """Get probabilities tensor from input image tensor.
@@ -131,6 +220,46 @@ class ImageQualityClassifier(object):
         return evaluation.aggregate_prediction_from_probabilities(
             np_probabilities, evaluation.METHOD_AVERAGE)
 
+    def predict_patch_map(self, images):
+        """Run inference once on one or more images, keeping the prediction of each patch.
+
+        The images are cropped to whole patches and stacked vertically, so the
+        tiles of the stack are the tiles of each image in turn and a single
+        session run predicts every patch of every image.
+
+        Args:
+          images: Numpy float array of shape (height, width), or a list of them
+            with the same shape.
+
+        Returns:
+          A PatchMap object.
+
+        Raises:
+          ValueError: If the images are smaller than a patch or differ in shape.
+        """
+        w = self._model_patch_side_length
+        images = self._as_list(images)
+        if len(set(numpy.shape(image) for image in images)) != 1:
+            raise ValueError('Images must have the same shape.')
+        images = numpy.asarray(images, dtype=numpy.float32)
+        rows, cols = images.shape[1] // w, images.shape[2] // w
+        if rows == 0 or cols == 0:
+            raise ValueError('Images must be at least %d x %d pixels.' % (w, w))
+        stack = images[:, :rows * w, :cols * w].reshape(-1, cols * w)
+        feed_dict = {self._image_placeholder: numpy.expand_dims(stack, 2)}
+        [np_probabilities] = self._sess.run(
+            [self._probabilities], feed_dict=feed_dict)
+
+        probabilities = np_probabilities.reshape(len(images), rows, cols, -1)
+        return PatchMap(probabilities,
+                        evaluation.certainties_from_probabilities(probabilities), w)
+
+    @staticmethod
+    def _as_list(images):
+        if isinstance(images, numpy.ndarray) and images.ndim == 2:
+            return [images]
+        return list(images)
+
     def get_patch_predictions(self, image):
         """Run inference on each patch in an image, returning each patch score.
 
@@ -142,12 +271,52 @@ class ImageQualityClassifier(object):
           evaluation.WholeImagePrediction) which denote the patch location,
           dimensions and predition result.
         """
-        results = []
-        w = constants.PATCH_SIDE_LENGTH
-        for i in range(0, image.shape[0] - w, w):
-            for j in range(0, image.shape[1] - w, w):
-                results.append((i, j, w, w, self.predict(image[i:i + w, j:j + w])))
-        return results
+        patch_map = self.predict_patch_map(image)
+        _, rows, cols, num_classes = patch_map.probabilities.shape
+        w = patch_map.patch_width
+        # A patch on its own aggregates to its own probabilities
+        predictions = evaluation.aggregate_predictions_from_probabilities(
+            patch_map.probabilities.reshape(-1, 1, num_classes), evaluation.METHOD_AVERAGE)
+        return [(i * w, j * w, w, w, predictions[i * cols + j])
+                for i in range(rows) for j in range(cols)]
+
+
+class FrozenImageQualityClassifier(ImageQualityClassifier):
+    """ImageQualityClassifier loaded from a graph written by
+    ImageQualityClassifier.export_frozen(), which skips building the slim
+    model and restoring the checkpoint.
+    """
+
+    def __init__(self,
+                 path,
+                 inputs,
+                 outputs,
+                 model_patch_side_length,
+                 num_classes,
+                 session_config=None):
+        """Load the model from a frozen graph.
+
+        Args:
+          path: String, .pb file written by export_frozen().
+          inputs: String, op name of the image placeholder.
+          outputs: String, op name of the probabilities.
+          model_patch_side_length: Integer, the side length in pixels of the square
+            image passed to the model.
+          num_classes: Integer, the number of classes the model predicts.
+          session_config: TensorFlow session configuration.
+        """
+        self._model_patch_side_length = model_patch_side_length
+        self._num_classes = num_classes
+        self.graph = tensorflow.Graph()
+        graph_def = tensorflow.GraphDef()
+        with tensorflow.gfile.GFile(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        with self.graph.as_default():
+            tensorflow.import_graph_def(graph_def, name='')
+        self._image_placeholder = self.graph.get_tensor_by_name(inputs + ':0')
+        self._probabilities = self.graph.get_tensor_by_name(outputs + ':0')
+        self._sess = tensorflow.Session(graph=self.graph, config=session_config)
+        logger.debug('Loaded frozen image focus prediction model from %s.', path)
 
 
 def patch_values_to_mask(values, patch_width):
@@ -168,20 +337,7 @@ def patch_values_to_mask(values, patch_width):
         logging.info('dtype: %s shape: %s', values.dtype, values.shape)
         raise ValueError('Input must be a 2D np.uint16 array.')
 
-    patches_per_column = values.shape[0]
-    patches_per_row = values.shape[1]
-
-    mask = numpy.zeros(
-        (patches_per_column * patch_width, patches_per_row * patch_width),
-        dtype=numpy.uint16)
-
-    for i in range(patches_per_column):
-        for j in range(patches_per_row):
-            ymin = i * patch_width
-            xmin = j * patch_width
-            mask[ymin:ymin + patch_width, xmin:xmin + patch_width] = values[i, j]
-
-    return mask
+    return numpy.repeat(numpy.repeat(values, patch_width, axis=0), patch_width, axis=1)
 
 
 def _get_image_tiles_tensor(image, label, image_path, patch_width):
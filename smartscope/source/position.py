@@ -23,6 +23,7 @@ import cv2
 
 from smartscope.source import chip
 from smartscope.source import sc_utils
+from smartscope.source import progress as prog
 
 
 class PositionList:
@@ -92,30 +93,40 @@ class PositionList:
             plt.xlabel('X')
             plt.ylabel('Y')
     
-    def image(self, mmc, save_dir, naming_scheme, save_jpg=False, rotation=0, exposure=1, output_pixels=[2688,2200]):
+    def image(self, mmc, save_dir, naming_scheme, save_jpg=False, rotation=0, exposure=1, output_pixels=[2688,2200],
+              progress=None, focus_check=None):
         ''' Images the positions in the PositionList
 
         args: 
             mmc: Micro-manager instance
             save_dir: Directory to save tiff files 
+            progress: progress.Progress instance used to report each 
+                position and to cancel the run
+            focus_check: focus_check.FocusCheck instance. Each frame is 
+                checked while it is saved, a blurry frame is replaced by 
+                the sharpest one of a small z search and the z of the 
+                positions after it is corrected.
         '''
+        if progress is None:
+            progress = prog.Progress()
         # Make the directory to save to and change into it
         orig_dir = os.getcwd()
-        dir_name = save_dir+'\\'+naming_scheme
+        dir_name = os.path.join(save_dir, naming_scheme)
         os.makedirs(dir_name)
         os.chdir(dir_name)
 
+        progress.phase('Imaging ' + naming_scheme, len(self.positions))
         cam = sc_utils.start_cam()
 
-        for ctr, pos in enumerate(self.positions):
-            # set position and wait
-            set_pos(mmc, pos.x, pos.y, z=pos.z)
+        def capture(z=None):
+            if z is not None:
+                set_pos(mmc, z=z)
             sc_utils.before_every_image()
-            
-            # Get image and save 
             frame = sc_utils.get_live_frame(cam, exposure)
-
             sc_utils.after_every_image()
+            return frame
+
+        def orient(frame):
             frame = np.flipud(frame)
             if rotation >= 90:
                 frame = np.rot90(frame)
@@ -123,12 +134,37 @@ class PositionList:
                 frame = np.rot90(frame)
             if rotation >= 270:
                 frame = np.rot90(frame)
-            
-            convert_and_save(frame, save_jpg, pos, naming_scheme, output_pixels, convert_to_16bit=True)
-            time.sleep(0.01)
-        
-        sc_utils.close_cam(cam)
-        os.chdir(orig_dir)
+            return frame
+
+        if focus_check is not None:
+            focus_check.start()
+        try:
+            for ctr, pos in enumerate(self.positions):
+                # set position and wait
+                z = pos.z if focus_check is None else focus_check.z_at(pos)
+                set_pos(mmc, pos.x, pos.y, z=z)
+                
+                # Get image and save 
+                frame = capture()
+                if focus_check is not None:
+                    result = focus_check.submit(frame)
+                paths = convert_and_save(orient(frame), save_jpg, pos, naming_scheme, output_pixels,
+                                         convert_to_16bit=True)
+                if focus_check is not None:
+                    checked, _ = focus_check.check(result, frame, pos, z, capture)
+                    if checked is not frame:
+                        for path in paths:
+                            os.remove(path)
+                        convert_and_save(orient(checked), save_jpg, pos, naming_scheme, output_pixels,
+                                         convert_to_16bit=True)
+                time.sleep(0.01)
+                progress.step()
+        finally:
+            sc_utils.close_cam(cam)
+            os.chdir(orig_dir)
+        if focus_check is not None:
+            sc_utils.print_info('Focus check: ' + str(focus_check.searched) + ' of ' +
+                                str(focus_check.checked) + ' frames refocused')
     
     def save(self, filename, path):
         ''' Save PositionList() as a json file
@@ -147,14 +183,23 @@ class PositionList:
             json.dump(data, outfile)
 
 def convert_and_save(frame, save_jpg, pos, naming_scheme, output_pixels, convert_to_16bit=True):
+    ''' Saves a frame as a tif, and a jpg if save_jpg
+
+    returns:
+        the paths of the files written
+    '''
     if convert_to_16bit:
         frame = sc_utils.bytescale(frame)
     if output_pixels != [2688, 2200]:
         frame = cv2.resize(frame, tuple(output_pixels), interpolation = cv2.INTER_AREA)
-    tif.imwrite(naming_scheme + pos.name + time.strftime("%Y%m%d%H%M") + '.tif', frame)
+    name = naming_scheme + pos.name + time.strftime("%Y%m%d%H%M")
+    tif.imwrite(name + '.tif', frame)
+    paths = [name + '.tif']
     if save_jpg:
         os.makedirs('jpg', exist_ok=True)
-        scipy.misc.imsave('jpg/'+naming_scheme + pos.name + time.strftime("%Y%m%d%H%M") + '.jpg', frame)
+        scipy.misc.imsave('jpg/' + name + '.jpg', frame)
+        paths.append('jpg/' + name + '.jpg')
+    return paths
 
 
 def load(filename, path):
@@ -295,3 +340,76 @@ class StagePosition:
             mmc.waitForSystem()
 
    
+
+
+class RigidTransform:
+    ''' Rotation by angle (radians) about the origin followed by a
+    translation (tx, ty), used to move saved positions with the chip
+
+    args:
+        angle: rotation in radians
+        tx, ty: translation in um
+        residual: rms distance (um) between the fitted and measured
+            points, None if unknown
+    '''
+    def __init__(self, angle=0.0, tx=0.0, ty=0.0, residual=None):
+        self.angle = angle
+        self.tx = tx
+        self.ty = ty
+        self.residual = residual
+
+    @property
+    def R(self):
+        c, s = np.cos(self.angle), np.sin(self.angle)
+        return np.array([[c, -s], [s, c]])
+
+    def apply(self, xy):
+        ''' Transforms an (N, 2) array of (x, y) points '''
+        return np.matmul(np.asarray(xy, dtype=float), self.R.T) + [self.tx, self.ty]
+
+    def apply_to(self, position_list):
+        ''' Returns a transformed copy of a PositionList, z is kept '''
+        xy = self.apply([[p.x, p.y] for p in position_list])
+        return PositionList(positions=[
+            StagePosition(x=float(x), y=float(y), z=p.z, theta=p.theta, name=p.name)
+            for (x, y), p in zip(xy, position_list)])
+
+    def to_dict(self):
+        return {'angle': self.angle, 'tx': self.tx, 'ty': self.ty,
+                'residual': self.residual}
+
+    def __str__(self):
+        return ('(dx={:.2f}um, dy={:.2f}um, angle={:.4f}deg)'
+                .format(self.tx, self.ty, np.degrees(self.angle)))
+
+
+def fit_rigid_transform(src, dst, weights=None):
+    ''' Least squares rotation and translation that maps the src points 
+    onto the dst points. A single point gives a translation only.
+
+    args:
+        src, dst: (N, 2) arrays of matching (x, y) points
+        weights: (N,) confidence of each point, equal if None
+    returns:
+        RigidTransform with the rms residual of the fit
+    '''
+    src = np.asarray(src, dtype=float)
+    dst = np.asarray(dst, dtype=float)
+    if len(src) == 0 or src.shape != dst.shape:
+        raise ValueError('Need matching points to fit a transform')
+    w = np.ones(len(src)) if weights is None else np.asarray(weights, dtype=float)
+    w = w / w.sum()
+    src_mean = np.sum(src * w[:, None], axis=0)
+    dst_mean = np.sum(dst * w[:, None], axis=0)
+    a = src - src_mean
+    b = dst - dst_mean
+    # 2D Procrustes, the angle that best lines up the centered points
+    angle = 0.0
+    if len(src) > 1:
+        angle = np.arctan2(np.sum(w * (a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0])),
+                           np.sum(w * (a[:, 0] * b[:, 0] + a[:, 1] * b[:, 1])))
+    transform = RigidTransform(angle=float(angle))
+    transform.tx, transform.ty = (dst_mean - np.matmul(transform.R, src_mean)).tolist()
+    error = transform.apply(src) - dst
+    transform.residual = float(np.sqrt(np.mean(np.sum(error ** 2, axis=1))))
+    return transform
@@ -0,0 +1,114 @@
+"""
+SmartScope
+Progress reporting and cancellation for imaging runs.
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+import threading
+import time
+from collections import deque, namedtuple
+
+# phase: name of the current step (eg. 'Focus', 'Alignment', 'Imaging')
+# done: positions finished in this phase
+# total: positions in this phase (0 if unknown)
+# rate: rolling positions per second
+# eta: estimated seconds left in this phase (None if unknown)
+# elapsed: seconds since the run started
+ProgressEvent = namedtuple('ProgressEvent',
+                           ['phase', 'done', 'total', 'rate', 'eta', 'elapsed'])
+
+
+class RunCancelled(Exception):
+    """Raised inside an imaging run when it has been cancelled."""
+    pass
+
+
+class Progress:
+    ''' Tracks the progress of an imaging run and lets another thread
+    cancel it. The imaging functions call phase() and step(), both of
+    which raise RunCancelled once cancel() has been called, so a run only
+    stops between positions.
+
+    args:
+        callback: function called with a ProgressEvent on every update.
+            It is called from the thread doing the imaging.
+        window: number of recent positions used for the rate
+    '''
+    def __init__(self, callback=None, window=20):
+        self.callback = callback
+        self.window = window
+        self.start = time.time()
+        self._cancel = threading.Event()
+        self.phase_name = ''
+        self.done = 0
+        self.total = 0
+        self._times = deque(maxlen=window)
+
+    def phase(self, name, total=0):
+        ''' Starts a new phase with total positions '''
+        self.check()
+        self.phase_name = name
+        self.done = 0
+        self.total = total
+        self._times.clear()
+        self._times.append((time.time(), 0))
+        self.emit()
+
+    def step(self, n=1):
+        ''' Marks n positions as done '''
+        self.check()
+        self.done += n
+        self._times.append((time.time(), self.done))
+        self.emit()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check(self):
+        ''' Raises RunCancelled if the run has been cancelled '''
+        if self._cancel.is_set():
+            raise RunCancelled('Run cancelled during ' + self.phase_name)
+
+    @property
+    def rate(self):
+        ''' Positions per second over the last window positions '''
+        if len(self._times) < 2:
+            return 0.0
+        (t0, d0), (t1, d1) = self._times[0], self._times[-1]
+        if t1 <= t0:
+            return 0.0
+        return (d1 - d0) / (t1 - t0)
+
+    @property
+    def eta(self):
+        rate = self.rate
+        if rate == 0 or self.total == 0:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def event(self):
+        return ProgressEvent(self.phase_name, self.done, self.total,
+                             self.rate, self.eta, time.time() - self.start)
+
+    def emit(self):
+        if self.callback is not None:
+            self.callback(self.event())
+
+
+def format_event(event):
+    ''' One line description of a ProgressEvent for the GUI and logs '''
+    text = event.phase
+    if event.total:
+        text += ': ' + str(event.done) + '/' + str(event.total)
+    if event.rate:
+        text += ' - {:.2f} pos/s'.format(event.rate)
+    if event.eta is not None:
+        text += ' - ETA ' + time.strftime('%H:%M:%S', time.gmtime(event.eta))
+    return text
@@ -9,14 +9,17 @@ Written by Caleb Sanford
 
 import time
 import os
+import json
 import math
 import numpy as np
 
 from smartscope.source import position as pos
 from smartscope.source import focus
 from smartscope.source import alignment
+from smartscope.source import drift
 from smartscope.source import sc_utils
 from smartscope.source import chip
+from smartscope.source import progress as prog
 
 
 def auto_image_chip(cur_chip,
@@ -39,7 +42,16 @@ def auto_image_chip(cur_chip,
                     first_position,
                     number_of_apartments_in_frame_x,
                     number_of_apartments_in_frame_y,
-                    output_pixels):
+                    output_pixels,
+                    progress=None,
+                    alignment_model=None,
+                    focus_model=None,
+                    batch_alignment=False,
+                    alignment_camera=sc_utils.DEFAULT_PROFILE,
+                    focus_camera=sc_utils.DEFAULT_PROFILE,
+                    focus_sweep=False,
+                    focus_calibration=None,
+                    focus_check=None):
     ''' Aligns, focuses, and images given chip
 
     args:
@@ -65,11 +77,41 @@ def auto_image_chip(cur_chip,
                        direction (must be greater than 3 for interpolation to 
                        work propertly)
         save_jpg: Saves images as both tiff files and jpg files if True
+        progress: progress.Progress instance that receives progress 
+                       events and can cancel the run between positions
+        alignment_model: an already loaded alignment model or an 
+                       alignment.MarkLocator. If None the model is loaded 
+                       from alignment_model_path, but only if the mark 
+                       template for this chip type does not match
+        focus_model: an already loaded focus model (loaded from 
+                       focus_model_path if None)
+        batch_alignment: capture the alignment fields first and find 
+                       their marks with one batched Mask R-CNN call 
+                       (see alignment.align_chip)
+        alignment_camera: sc_utils.CAMERA_PROFILES entry to take the 
+                       alignment fields with
+        focus_camera: sc_utils.CAMERA_PROFILES entry to focus with
+        focus_sweep: take each focus point's frames in one continuous 
+                       move of the focus drive (see focus.sweep_frames)
+        focus_calibration: defocus.DefocusCalibration of the chip type, 
+                       focus points are then found from two frames 
+                       (see defocus.jump_focus)
+        focus_check: focus_check.FocusCheck that checks the focus of 
+                       every frame while imaging (see PositionList.image)
     '''
+    if progress is None:
+        progress = prog.Progress()
     start = time.time()
     sc_utils.print_info("Starting: Alignment, Focus, and Imaging")
 
-    model = alignment.get_inference_model(alignment_model_path)
+    if isinstance(alignment_model, alignment.MarkLocator):
+        model = alignment_model
+    else:
+        model = alignment.MarkLocator(
+            alignment_model,
+            model_loader=lambda: alignment.get_inference_model(
+                alignment_model_path, batch_size=alignment.BATCH_SIZE if batch_alignment else 1),
+            template_path=alignment.template_path(cur_chip['name']))
     p1 = pos.current(mmc)
     p2 = pos.StagePosition(x=p1.x + cur_chip['chip_width'], y=p1.y)
     p3 = pos.StagePosition(
@@ -89,42 +131,51 @@ def auto_image_chip(cur_chip,
                                              delta_z=focus_delta_z,
                                              total_z=focus_total_z,
                                              next_point_range=focus_next_point_range,
-                                             exposure=focus_exposure)
+                                             exposure=focus_exposure,
+                                             progress=progress,
+                                             focus_model=focus_model,
+                                             camera_profile=focus_camera,
+                                             sweep=focus_sweep,
+                                             calibration=focus_calibration)
     focused_pl.save('focused_pl', save_dir)
 
-    p1.z = focus.predict_z_height(focused_pl, xy_location=(p1.x, p1.y))[0][0]
-    p2.z = focus.predict_z_height(focused_pl, xy_location=(p2.x, p2.y))[0][0]
-    p3.z = focus.predict_z_height(focused_pl, xy_location=(p3.x, p3.y))[0][0]
+    def z_at(x, y):
+        return focus.predict_z_height(focused_pl, xy_location=(x, y))[0][0]
 
-    print(p1)
-
-    p1 = alignment.search_and_find_center(
-        mmc, p1, model, exposure, frame_to_pixel_ratio, camera_pixels[0], camera_pixels[1])
-    p2 = alignment.search_and_find_center(
-        mmc, p2, model, exposure, frame_to_pixel_ratio, camera_pixels[0], camera_pixels[1])
-    p3 = alignment.search_and_find_center(
-        mmc, p3, model, exposure, frame_to_pixel_ratio, camera_pixels[0], camera_pixels[1])
+    # Every mark in each field is used, extra fields are only visited 
+    # until the chip rotation is known
+    corners, pose, (frames, fields) = alignment.align_chip(
+        mmc, p1, cur_chip, model, exposure, frame_to_pixel_ratio,
+        camera_pixels[0], camera_pixels[1], z_at=z_at, progress=progress,
+        batch=batch_alignment, camera_profile=alignment_camera)
+    with open(os.path.join(save_dir, 'chip_pose.json'), 'w') as f:
+        json.dump(pose.to_dict(), f, indent=2)
+    # The alignment frames are kept as reference fields for drift correction
+    drift.save_references(frames, fields, save_dir, alignment_camera)
 
     align_time = time.time()
     sc_utils.print_info('Time for alignment:' + str(align_time-start))
 
-    # Create a Position List of the corners and save it
-    corners = pos.PositionList(positions=[p1, p2, p3])
+    # Save the Position List of the corners
     corners.save('corners_pl', save_dir)
     # # Create a chip instance
     imaging_chip = chip.Chip(corners, first_position, cur_chip,
                              number_of_apartments_in_frame_x, number_of_apartments_in_frame_y)
     imaging_pl = imaging_chip.get_position_list(focused_pl)
     imaging_pl.image(mmc, save_dir, naming_scheme,
-                     rotation=image_rotation, exposure=exposure, output_pixels=output_pixels)
+                     rotation=image_rotation, exposure=exposure, output_pixels=output_pixels,
+                     progress=progress, focus_check=focus_check)
 
     end = time.time()
     sc_utils.print_info('Total time:' + str(end-start))
 
 
 def image_from_saved_positions(cur_chip, positions_dir, save_dir, mmc, naming_scheme, image_rotation, exposure,
-                               first_position, number_of_apartments_in_frame_x, number_of_apartments_in_frame_y, output_pixels):
+                               first_position, number_of_apartments_in_frame_x, number_of_apartments_in_frame_y, output_pixels,
+                               progress=None, focus_check=None):
     ''' Images a chip from previously saved positions '''
+    if progress is None:
+        progress = prog.Progress()
     start = time.time()
     sc_utils.print_info('Starting: Loading and Imaging')
     loaded_chip = chip.Chip(pos.load('corners_pl', positions_dir), first_position,
@@ -132,6 +183,47 @@ def image_from_saved_positions(cur_chip, positions_dir, save_dir, mmc, naming_sc
     focused_pl = pos.load('focused_pl', positions_dir)
     imaging_pl = loaded_chip.get_position_list(focused_pl)
     imaging_pl.image(mmc, save_dir, naming_scheme, 
-                     rotation=image_rotation, exposure=exposure, output_pixels=output_pixels)
+                     rotation=image_rotation, exposure=exposure, output_pixels=output_pixels,
+                     progress=progress, focus_check=focus_check)
     end = time.time()
     sc_utils.print_info('Total time:' + str(end-start))
+
+
+def get_chip_dir(folder, start_date, chip_name, cell, drug, concentration, chip_index):
+    ''' Directory that holds every timepoint of one chip '''
+    return (folder
+            + '/' + start_date
+            + '-' + chip_name
+            + '-' + cell
+            + '-' + drug
+            + '/' + concentration + '-' + drug
+            + '/' + chip_index
+            + '/').replace(' ', '-')
+
+
+def get_time_point(chip_dir):
+    ''' Uses the directories in chip_dir to determine the number of times 
+    the chip has been imaged 
+
+    returns:
+        the next timepoint name eg. 't00'
+    '''
+    if not os.path.isdir(chip_dir):
+        return 't00'
+    points = len(next(os.walk(chip_dir))[1])
+    return "t{0:0=2d}".format(points)
+
+
+def stop_safely(mmc, return_position=None):
+    ''' Puts the scope in a safe state after a run stops early: the stage 
+    finishes its current move, the LEDs are turned off and, if given, the 
+    stage goes back to return_position. The camera is already closed by 
+    the function that opened it.
+    '''
+    try:
+        sc_utils.wait_for_system(mmc)
+    finally:
+        sc_utils.set_LEDs_off(mmc)
+        if return_position is not None:
+            pos.set_pos(mmc, x=return_position.x, y=return_position.y, 
+                        z=return_position.z)
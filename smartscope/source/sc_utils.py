@@ -7,29 +7,200 @@ Licensed under the MIT License (see LICENSE for details)
 Written by Caleb Sanford
 """
 
+import time
 
 ####################################################
-# Change these lines to import different camera package
+# Simulated hardware
 ####################################################
-from pyvcam import pvc
-from pyvcam.camera import Camera
+from smartscope.source import simulation
+
+# When set to a simulation.SimulatedScope, the camera and stage 
+# functions below use it instead of the real hardware
+simulated_scope = None
+
+def use_simulated_hardware(scope=None):
+    ''' Switches the camera and stage functions to a simulated scope 
+    args:
+        scope: simulation.SimulatedScope (a default one is made if None)
+    returns:
+        the SimulatedScope in use
+    '''
+    global simulated_scope
+    if scope is None:
+        scope = simulation.SimulatedScope()
+    simulated_scope = scope
+    return scope
 
-def start_cam():
+####################################################
+# Change these lines to import different camera package
+####################################################
+try:
+    from pyvcam import pvc
+    from pyvcam.camera import Camera
+except ImportError:
+    # Only the simulated camera can be used
+    pvc = None
+    Camera = None
+
+# Camera kept open between runs by open_camera_session()
+shared_cam = None
+
+# Written to the camera when it is opened
+CAMERA_SETTINGS = {
+    'clear_mode': 'Never',
+    'exp_mode': 'Ext Trig Trig First',
+    'readout_port': 0,
+    'speed_table_index': 0,
+    'gain': 1,
+}
+
+# Named acquisition profiles. roi is the (width, height) in sensor 
+# pixels of a window centered on the sensor, None reads the whole 
+# sensor. binning combines binning x binning pixels into one. Readout 
+# time scales with the pixels read, so focus and alignment frames that 
+# do not need every pixel are much faster to take.
+CAMERA_PROFILES = {
+    'full': {'roi': None, 'binning': 1},
+    'center': {'roi': (1024, 1024), 'binning': 1},
+    'bin2': {'roi': None, 'binning': 2},
+    'bin4': {'roi': None, 'binning': 4},
+}
+
+# Profile used when none is requested, the saved images are full frames
+DEFAULT_PROFILE = 'full'
+
+def open_camera_session():
+    ''' Opens the camera once and keeps it open. Until 
+    close_camera_session() is called, start_cam() returns this camera 
+    and close_cam() leaves it open, which saves initializing PVCAM for 
+    every focus, alignment and imaging step.
+    '''
+    global shared_cam
+    if shared_cam is None:
+        shared_cam = start_cam()
+    return shared_cam
+
+def close_camera_session():
+    global shared_cam
+    if shared_cam is not None:
+        cam = shared_cam
+        shared_cam = None
+        close_cam(cam)
+
+def start_cam(profile=DEFAULT_PROFILE):
     ''' Initializes the PVCAM
 
+    args:
+        profile: name of the CAMERA_PROFILES entry to use. The camera of 
+            an open session is switched to it.
     returns: cam instance
     '''
-    try:
-        pvc.init_pvcam()
-        cam = next(Camera.detect_camera())
+    if shared_cam is not None:
+        set_camera_profile(shared_cam, profile)
+        return shared_cam
+    if simulated_scope is not None:
+        cam = simulated_scope.camera()
         cam.open()
-        cam.clear_mode = 'Never'
-        cam.exp_mode = "Ext Trig Trig First"
-        cam.readout_port = 0
-        cam.speed_table_index = 0
-        cam.gain = 1
+    else:
+        try:
+            pvc.init_pvcam()
+            cam = next(Camera.detect_camera())
+            cam.open()
+        except:
+            raise RuntimeError('Could not start Camera')
+    try:
+        set_camera_profile(cam, profile)
     except:
-        raise RuntimeError('Could not start Camera')
+        close_cam(cam)
+        raise
+    return cam
+
+class CameraConfig:
+    ''' Keeps track of the parameters written to an open camera so 
+    that switching profiles only writes the ones that change.
+
+    args:
+        cam: open camera instance
+    '''
+    def __init__(self, cam):
+        self.cam = cam
+        self.invalidate()
+
+    def invalidate(self):
+        ''' Forget the cached parameters so that the next call to use() 
+        rewrites all of them 
+        '''
+        self.params = {}
+        self.profile = None
+
+    def use(self, profile):
+        ''' Switches the camera to a profile
+
+        args:
+            profile: name of a CAMERA_PROFILES entry
+        returns:
+            number of parameters that were written
+        '''
+        if profile == self.profile:
+            return 0
+        if profile not in CAMERA_PROFILES:
+            raise ValueError('Unknown camera profile "' + str(profile) + '", use one of ' +
+                             ', '.join(CAMERA_PROFILES))
+        params = dict(CAMERA_SETTINGS)
+        params.update(camera_params(self.cam.sensor_size, profile))
+        writes = 0
+        for name, value in params.items():
+            if self.params.get(name) != value:
+                setattr(self.cam, name, value)
+                self.params[name] = value
+                writes += 1
+        self.profile = profile
+        return writes
+
+def camera_params(sensor_size, profile):
+    ''' PVCAM roi (x start, x end, y start, y end) and binning (x, y) 
+    of a profile 
+    '''
+    binning = CAMERA_PROFILES[profile]['binning']
+    width, height = profile_field(sensor_size, profile)
+    x = (sensor_size[0] - width) // 2
+    y = (sensor_size[1] - height) // 2
+    return {'roi': (x, x + width, y, y + height), 'binning': (binning, binning)}
+
+def profile_field(sensor_size, profile):
+    ''' (width, height) in sensor pixels of the field a profile reads, 
+    rounded down to whole binned pixels
+    '''
+    roi = CAMERA_PROFILES[profile]['roi'] or sensor_size
+    binning = CAMERA_PROFILES[profile]['binning']
+    return tuple(int(min(r, s)) // binning * binning for r, s in zip(roi, sensor_size))
+
+def to_sensor_pixels(frame, profile):
+    ''' Scales a binned frame back up to one value per sensor pixel, so 
+    that its features have the size they have in a full resolution frame
+    '''
+    binning = CAMERA_PROFILES[profile]['binning']
+    if binning == 1:
+        return frame
+    return frame.repeat(binning, axis=0).repeat(binning, axis=1)
+
+_camera_configs = {}
+
+def get_camera_config(cam):
+    ''' Gets the CameraConfig of an open camera. The same instance is 
+    returned every time so the cached parameters are shared by everything 
+    using the camera.
+    '''
+    key = id(cam)
+    if key not in _camera_configs or _camera_configs[key].cam is not cam:
+        _camera_configs[key] = CameraConfig(cam)
+    return _camera_configs[key]
+
+def set_camera_profile(cam, profile):
+    ''' Switches an open camera to a CAMERA_PROFILES entry, only the 
+    parameters that differ from the current profile are written 
+    '''
+    get_camera_config(cam).use(profile)
     return cam
 
 def get_frame_size():
@@ -46,20 +217,30 @@ def close_cam(cam):
     args:
         - camera instance 
     '''
+    if cam is shared_cam:
+        return
+    _camera_configs.pop(id(cam), None)
+    if isinstance(cam, simulation.SimulatedCamera):
+        cam.close()
+        return
     try:
         cam.close()
         pvc.uninit_pvcam()
     except:
         print_error('Could not close Camera')
 
-def get_frame(exposure):
-    ''' Gets a frame from the camera '''
-    cam = start_cam()
+def get_frame(exposure, profile=DEFAULT_PROFILE):
+    ''' Gets a frame from the camera 
+
+    args:
+        profile: name of the CAMERA_PROFILES entry to take the frame with
+    '''
+    cam = start_cam(profile)
     frame = cam.get_frame(exp_time=exposure)
     close_cam(cam)
     return frame
 
-def get_live_frame(cam, exposure):
+def get_live_frame(cam, exposure, profile=None):
     ''' Gets a frame from the passed camera instance. This is a faster 
     way to get consecutive frames from a camera, used for focus and 
     imaging.
@@ -67,20 +248,66 @@ def get_live_frame(cam, exposure):
     args:
         - cam: camera instance 
         - exposure: exposure time
+        - profile: CAMERA_PROFILES entry to switch to first, the camera's 
+          current profile is kept if None
 
     '''
+    if profile is not None:
+        set_camera_profile(cam, profile)
     return cam.get_frame(exp_time=exposure)
 
+# Readout time (ms) of a full sensor frame, frames that read fewer 
+# pixels take proportionally less
+FULL_FRAME_READOUT_MS = 30.0
+
+def clock():
+    ''' Time in seconds, from the simulated clock when the simulated 
+    hardware is used 
+    '''
+    if simulated_scope is not None:
+        return simulated_scope.clock
+    return time.perf_counter()
+
+def readout_time(cam):
+    ''' Readout time (s) of a frame with the camera's current profile '''
+    if isinstance(cam, simulation.SimulatedCamera):
+        return cam.readout_time
+    width, height = cam.sensor_size
+    return FULL_FRAME_READOUT_MS * cam.shape[0] * cam.shape[1] / float(width * height) / 1000.0
+
+def start_stream(cam, exposure):
+    ''' Starts taking frames back to back in sequence mode '''
+    cam.start_live(exp_time=exposure)
+
+def get_stream_frame(cam, exposure):
+    ''' Waits for the next frame of the stream
+
+    returns:
+        frame, clock() time of the middle of its exposure
+    '''
+    frame = cam.get_live_frame().reshape(cam.shape[::-1])
+    # The frame arrives once it has been read out
+    return frame, clock() - readout_time(cam) - exposure / 2000.0
+
+def stop_stream(cam):
+    cam.stop_live()
+
 ####################################################
 # To use an XYZ controller other than micro-manager,
 # change the following lines to fit your stages
 ####################################################
-import MMCorePy
+try:
+    import MMCorePy
+except ImportError:
+    # Only the simulated stage can be used
+    MMCorePy = None
 
 def get_stage_controller(cfg="../../config/scope_stage2.cfg"):
     ''' Gets an instance of the stage controller (micro-manager).
     This function can be changed to return other python controllers.
     '''
+    if simulated_scope is not None:
+        return simulated_scope.stage()
     mmc = MMCorePy.CMMCore()
     mmc.loadSystemConfiguration(cfg)
     mmc.setFocusDevice('FocusDrive')
@@ -103,6 +330,22 @@ def set_z_pos(stage_controller, z):
 
 def wait_for_system(stage_controller):
     return stage_controller.waitForSystem()
+
+# Property of the focus drive that sets its speed in um/s, check the 
+# drive's name for it in the Micro-manager device property browser
+FOCUS_SPEED_PROPERTY = 'Speed'
+
+def get_focus_speed(stage_controller):
+    return float(stage_controller.getProperty(stage_controller.getFocusDevice(), 
+                                              FOCUS_SPEED_PROPERTY))
+
+def set_focus_speed(stage_controller, speed):
+    stage_controller.setProperty(stage_controller.getFocusDevice(), 
+                                 FOCUS_SPEED_PROPERTY, speed)
+
+def focus_busy(stage_controller):
+    ''' True while the focus drive is moving '''
+    return stage_controller.deviceBusy(stage_controller.getFocusDevice())
  
 # LED and Shutter Control
 # Uncomment the following lines for manual control and be sure to comment 
@@ -133,18 +376,150 @@ def change_LED_values(controller, LED, value):
         controller.setProperty('Thorlabs DC4100', 'Percental Brightness LED-'+str(LED), value)
 #################################################################
 
+# Set to False when change_LED_values() is replaced (eg. manual control) 
+# so that IlluminationController calls it instead of sending DC4100 
+# serial commands itself
+BATCH_LED_COMMANDS = True
+
+class IlluminationController:
+    ''' Keeps track of the last commanded LED and shutter state so that
+    only the values that changed are sent to the hardware. All of the
+    LED on/off changes in one call are sent as a single serial command.
+
+    args:
+        controller: Micro-manager instance
+        leds: LED numbers on the DC4100
+    '''
+    def __init__(self, controller, leds=(1, 2, 3, 4)):
+        self.controller = controller
+        self.leds = tuple(leds)
+        self._port = None
+        self.invalidate()
+
+    def invalidate(self):
+        ''' Forget the cached state so that the next call to set() 
+        rewrites every LED and the shutter 
+        '''
+        self.led_values = {led: None for led in self.leds}
+        self.shutter = None
+
+    @property
+    def port(self):
+        if self._port is None:
+            self._port = self.controller.getProperty('Thorlabs DC4100', 'Port')
+        return self._port
+
+    def set(self, val, verify=False):
+        ''' Sets the LEDs and shutter, sending only the differences from 
+        the last commanded state
+
+        args:
+            val: dict of {'shutter': state, <LED number>: brightness}, as 
+                stored in led_intensities.yml
+            verify: if True, read the state back from the hardware after 
+                setting it and resend anything that does not match
+        returns:
+            number of hardware writes that were sent
+        '''
+        writes = 0
+        if 'shutter' in val and val['shutter'] != self.shutter:
+            change_shutter(self.controller, val['shutter'])
+            self.shutter = val['shutter']
+            writes += 1
+
+        turn_on = []
+        turn_off = []
+        for led, value in val.items():
+            if led == 'shutter' or value == self.led_values.get(led):
+                continue
+            if not BATCH_LED_COMMANDS:
+                change_LED_values(self.controller, led, value)
+                self.led_values[led] = value
+                writes += 1
+                continue
+            previous = self.led_values.get(led)
+            if value != 0:
+                # Brightness is set before the LED is switched on
+                self.controller.setProperty('Thorlabs DC4100', 
+                                            'Percental Brightness LED-'+str(led), value)
+                writes += 1
+                if previous is None or previous == 0:
+                    turn_on.append(led)
+            else:
+                turn_off.append(led)
+            self.led_values[led] = value
+
+        if turn_on or turn_off:
+            self.controller.setSerialPortCommand(
+                self.port, _led_serial_command(turn_on, turn_off), "")
+            writes += 1
+        # Brightness is zeroed after the LED is switched off
+        for led in turn_off:
+            self.controller.setProperty('Thorlabs DC4100', 
+                                        'Percental Brightness LED-'+str(led), 0)
+            writes += 1
+
+        if verify and not self.verify():
+            writes += self.set(val)
+        return writes
+
+    def off(self):
+        ''' Turns off every LED '''
+        return self.set({led: 0 for led in self.leds})
+
+    def verify(self):
+        ''' Reads the LED brightness and shutter state back from the 
+        hardware. Any value that does not match the cached state is 
+        forgotten so the next set() will rewrite it.
+
+        returns:
+            True if the hardware matches the cached state
+        '''
+        matches = True
+        if self.shutter is not None:
+            state = self.controller.getProperty('IL-Turret', 'State')
+            if str(state) != str(self.shutter):
+                self.shutter = None
+                matches = False
+        for led, value in self.led_values.items():
+            if value is None:
+                continue
+            brightness = self.controller.getProperty('Thorlabs DC4100', 
+                                                     'Percental Brightness LED-'+str(led))
+            if float(brightness) != float(value):
+                self.led_values[led] = None
+                matches = False
+        return matches
+
+def _led_serial_command(turn_on, turn_off):
+    ''' Builds one DC4100 serial command that switches every given LED 
+    on or off followed by a single error query 
+    '''
+    command = ''
+    for led in turn_on:
+        command += bytearray.fromhex("4F203" + str(led-1) + "2031" + "0A").decode()
+    for led in turn_off:
+        command += bytearray.fromhex("4F203" + str(led-1) + "2030" + "0A").decode()
+    return command + bytearray.fromhex("453F0A").decode()
+
+_illumination_controllers = {}
+
+def get_illumination_controller(controller):
+    ''' Gets the IlluminationController for a Micro-manager instance. 
+    The same instance is returned every time so the cached state is 
+    shared by the GUI and the imaging functions.
+    '''
+    key = id(controller)
+    if (key not in _illumination_controllers or 
+            _illumination_controllers[key].controller is not controller):
+        _illumination_controllers[key] = IlluminationController(controller)
+    return _illumination_controllers[key]
+
 def set_LEDs_off(controller):
-    change_LED_values(controller, 1, 0)
-    change_LED_values(controller, 2, 0)
-    change_LED_values(controller, 3, 0)
-    change_LED_values(controller, 4, 0)
-
-def set_led_and_shutter(controller, val):
-    for k, v in val.items():
-        if k == 'shutter':
-            change_shutter(controller, v)
-        else:
-            change_LED_values(controller, k, v)
+    get_illumination_controller(controller).off()
+
+def set_led_and_shutter(controller, val, verify=False):
+    get_illumination_controller(controller).set(val, verify=verify)
 
 ####################################################
 # General hardware control
@@ -177,7 +552,6 @@ def in_between_channels():
 from numba import autojit
 import numpy as np
 
-@autojit
 def convert_frame_to_mrcnn_format(frame):
     ''' Converts the output from the PVCAM frame 
     into the format that the mrcnn model was trained on
@@ -187,13 +561,8 @@ def convert_frame_to_mrcnn_format(frame):
     returns:
         frame in mrcnn fromat
     '''
-    new_im = np.zeros((frame.shape[0], frame.shape[1], 3))
     frame = bytescale(frame, high=255)
-    for ix, iy in np.ndindex(frame.shape):
-        val = frame[ix,iy]
-        new_im[ix,iy] = [val,val,val]
-    new_im = new_im.astype('uint8')
-    return new_im
+    return np.repeat(frame[:, :, np.newaxis], 3, axis=2)
 
 @autojit
 def bytescale(data, current_min=0, current_max=None, high=65535, low=0):
@@ -231,6 +600,39 @@ def bytescale(data, current_min=0, current_max=None, high=65535, low=0):
     else:
         return (bytedata.clip(low, high) + 0.5)
 
+def decimate(frame, factor):
+    ''' Mean of every factor x factor block of pixels, the pixels past
+    the last whole block are dropped
+    args:
+        frame: 2D array
+        factor: block size
+    returns:
+        2D float32 array
+    '''
+    h = frame.shape[0] // factor * factor
+    w = frame.shape[1] // factor * factor
+    blocks = frame[:h, :w].reshape(h // factor, factor, w // factor, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+def sharpness(frame, decimation=4):
+    ''' Cheap focus metric, the mean squared difference between
+    neighbouring pixels of a decimated copy of the frame over its
+    squared mean. Dividing by the mean makes it independent of the
+    exposure. Higher is sharper.
+    args:
+        frame: 2D array
+        decimation: block size of the decimated copy
+    returns:
+        float
+    '''
+    small = decimate(frame, decimation)
+    mean = float(small.mean())
+    if small.shape[0] < 2 or small.shape[1] < 2 or mean <= 0:
+        return 0.0
+    gradient = (np.mean(np.square(np.diff(small, axis=0))) +
+                np.mean(np.square(np.diff(small, axis=1))))
+    return float(gradient) / mean ** 2
+
 ####################################################
 # Scope Calibration 
 ####################################################
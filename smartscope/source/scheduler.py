@@ -0,0 +1,418 @@
+"""
+SmartScope
+Time-lapse scheduler for several chips on the stage.
+
+Every chip in a job spec can set its own timepoints and interval_minutes.
+The scheduler plans every acquisition up front: the chips are visited in
+a short path around the stage and their first timepoints are staggered
+so they run back to back, after which each chip repeats on its own
+interval. After every acquisition the duration estimates are updated
+and the pending acquisitions are planned again, so chips that take
+longer than expected push back the chips that have not started rather
+than the intervals of the ones that have. While running, the
+acquisitions that are due go nearest chip first, and while nothing is
+due the stage moves to the next chip. The models and the camera are
+loaded once for the whole run and the summary records the planned and
+actual start of every timepoint.
+
+    python -m smartscope.source.scheduler config/job_example.yml --plan
+    python -m smartscope.source.scheduler config/job_example.yml
+    python -m smartscope.source.scheduler config/job_example.yml --simulate
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+import sys
+sys.path.append('C:\\Program Files\\Micro-Manager-2.0beta')
+import argparse
+import json
+import math
+import os
+import time
+
+from smartscope.source import inference
+from smartscope.source import jobs
+from smartscope.source import position as pos
+from smartscope.source import progress as prog
+from smartscope.source import run
+from smartscope.source import sc_utils
+
+# Minutes a chip is expected to take the first time (focus and alignment)
+# and every time after (saved positions), until it has been timed.
+# A chip can set its own with estimated_minutes: [first, later]
+ESTIMATED_MINUTES = [20.0, 5.0]
+
+# Weight of the newest duration in the running estimate
+ESTIMATE_WEIGHT = 0.5
+
+# Stage speed (um/s) used to plan the moves between chips
+STAGE_SPEED = 5000.0
+
+
+class Acquisition:
+    ''' One timepoint of one chip
+
+    args:
+        chip: index of the chip in job['chips']
+        index: timepoint number of this run (0 is the first)
+        planned: planned start in seconds after the run starts
+    '''
+    def __init__(self, chip, index, planned):
+        self.chip = chip
+        self.index = index
+        self.planned = planned
+        self.start = None
+        self.end = None
+        self.status = 'planned'
+
+    @property
+    def lateness(self):
+        ''' Seconds the acquisition started after its planned time '''
+        if self.start is None:
+            return None
+        return self.start - self.planned
+
+    def __repr__(self):
+        return 'Acquisition(chip={}, index={}, planned={:.0f})'.format(
+            self.chip, self.index, self.planned)
+
+
+def _first_free(busy, start, length):
+    ''' Earliest time from start that a task of length seconds does not
+    overlap any of the busy (start, end) spans
+    '''
+    moved = True
+    while moved:
+        moved = False
+        for b0, b1 in busy:
+            if start < b1 and b0 < start + length:
+                start = b1
+                moved = True
+    return start
+
+
+def chip_xy(chip_job):
+    ''' Stage (x, y) of a chip, None if the chip has no position '''
+    if chip_job['position'] is None:
+        return None
+    return (float(chip_job['position'][0]), float(chip_job['position'][1]))
+
+
+def distance(a, b):
+    ''' Stage distance between two (x, y) points, 0 if either is unknown '''
+    if a is None or b is None:
+        return 0.0
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+
+def tour_order(positions, start=None):
+    ''' Orders the chips by always going to the nearest chip not yet
+    visited
+
+    args:
+        positions: list of (x, y) or None for every chip
+        start: (x, y) of the stage before the first chip
+    returns:
+        list of chip indexes
+    '''
+    remaining = list(range(len(positions)))
+    order = []
+    current = start
+    while remaining:
+        nearest = min(remaining, key=lambda i: (distance(current, positions[i]), i))
+        order.append(nearest)
+        remaining.remove(nearest)
+        if positions[nearest] is not None:
+            current = positions[nearest]
+    return order
+
+
+class Scheduler:
+    ''' Plans and runs the timepoints of every chip in a job
+
+    args:
+        job: dict from jobs.load_job()
+        start_position: stage (x, y) when the run starts
+        clock: function returning the current time in seconds
+        sleep: function that waits for a number of seconds
+    '''
+    def __init__(self, job, start_position=None, clock=time.time, sleep=time.sleep):
+        self.job = job
+        self.chips = job['chips']
+        self.clock = clock
+        self.sleep = sleep
+        self.positions = [chip_xy(c) for c in self.chips]
+        self.estimates = [[60 * float(m) for m in c.get('estimated_minutes', ESTIMATED_MINUTES)]
+                          for c in self.chips]
+        # Whether each estimate has been measured
+        self.timed = [[False, False] for _ in self.chips]
+        self.order = tour_order(self.positions, start_position)
+        self.acquisitions = self.plan(start_position)
+        self.summaries = []
+        self.idle = 0.0
+        self.travel = 0.0
+        self.start = None
+
+    def interval(self, chip):
+        return 60 * float(self.chips[chip]['interval_minutes'])
+
+    def plan(self, start_position=None):
+        ''' Plans every acquisition. The chips start one after the other
+        in tour order, each one once the previous chip's first timepoint
+        is expected to be done, and then repeat on their own interval.
+
+        returns:
+            list of Acquisition sorted by planned start
+        '''
+        acquisitions = [Acquisition(chip, t, 0.0) for chip in self.order
+                        for t in range(int(self.chips[chip]['timepoints']))]
+        self._place(acquisitions, 0.0, start_position)
+        return acquisitions
+
+    def replan(self, now, position=None):
+        ''' Plans the pending acquisitions again from the current 
+        estimates. A chip that has started keeps its interval from its 
+        actual first start. The chips that have not started follow one 
+        another from now, after the time the started chips need.
+
+        args:
+            now: seconds since the run started
+            position: current stage (x, y)
+        '''
+        self._place(self.acquisitions, now, position)
+
+    def _place(self, acquisitions, now, position):
+        ''' Sets the planned start of every pending acquisition and sorts
+        acquisitions by it
+        '''
+        by_chip = {chip: sorted((a for a in acquisitions if a.chip == chip), key=lambda a: a.index)
+                   for chip in self.order}
+        started = [c for c in self.order if by_chip[c] and by_chip[c][0].start is not None]
+        # (start, end) of the time that is already spoken for
+        busy = []
+        for chip in started:
+            first = by_chip[chip][0]
+            for a in by_chip[chip]:
+                if a.status == 'planned':
+                    a.planned = first.start + a.index * self.interval(chip)
+                    busy.append((a.planned, a.planned + self.estimates[chip][1]))
+        offset = now
+        previous = position
+        for chip in self.order:
+            if chip in started or not by_chip[chip]:
+                continue
+            offset += distance(previous, self.positions[chip]) / STAGE_SPEED
+            offset = _first_free(busy, offset, self.estimates[chip][0])
+            for a in by_chip[chip]:
+                a.planned = offset + a.index * self.interval(chip)
+                busy.append((a.planned, a.planned + self.estimates[chip][0 if a.index == 0 else 1]))
+            offset += self.estimates[chip][0]
+            if self.positions[chip] is not None:
+                previous = self.positions[chip]
+        acquisitions.sort(key=lambda a: (a.planned, self.order.index(a.chip)))
+
+    def pending(self):
+        ''' The next acquisition of every chip that still has one '''
+        nxt = {}
+        for a in self.acquisitions:
+            if a.status == 'planned' and a.chip not in nxt:
+                nxt[a.chip] = a
+        return list(nxt.values())
+
+    def next_acquisition(self, now, position=None):
+        ''' Picks what to image next. Of the acquisitions that are due the
+        one on the nearest chip goes first, if none are due it is the one
+        planned soonest.
+
+        args:
+            now: seconds since the run started
+            position: current stage (x, y)
+        returns:
+            Acquisition or None when everything has run
+        '''
+        pending = self.pending()
+        if not pending:
+            return None
+        due = [a for a in pending if a.planned <= now]
+        if not due:
+            return min(pending, key=lambda a: a.planned)
+        return min(due, key=lambda a: (distance(position, self.positions[a.chip]), a.planned))
+
+    def update_estimate(self, acquisition):
+        ''' Blends the measured duration into the chip's estimate. Chips 
+        of the same type that have not been timed yet take the same 
+        estimate.
+        '''
+        i = 0 if acquisition.index == 0 else 1
+        duration = acquisition.end - acquisition.start
+        estimate = self.estimates[acquisition.chip]
+        estimate[i] = (1 - ESTIMATE_WEIGHT) * estimate[i] + ESTIMATE_WEIGHT * duration
+        self.timed[acquisition.chip][i] = True
+        chip_type = self.chips[acquisition.chip]['chip']
+        for other, chip_job in enumerate(self.chips):
+            if chip_job['chip'] == chip_type and not self.timed[other][i]:
+                self.estimates[other][i] = estimate[i]
+
+    def wait_until(self, planned, progress=None):
+        ''' Sleeps until planned (seconds since the run started) '''
+        while True:
+            left = planned - (self.clock() - self.start)
+            if left <= 0:
+                return
+            if progress is not None:
+                progress.check()
+            self.sleep(min(1.0, left))
+
+    def run(self, mmc, progress=None, summary_path=None, models=None):
+        ''' Runs every planned acquisition
+
+        args:
+            mmc: stage controller
+            progress: progress.Progress instance
+            summary_path: json file that is rewritten after every acquisition
+            models: jobs.ModelCache shared by every chip (a new one if None)
+        returns:
+            list of summary dicts
+        '''
+        if models is None:
+            models = jobs.ModelCache()
+        # Timepoint names continue from what is already in each chip folder
+        first_time_point = [int(run.get_time_point(jobs.get_chip_dir(c))[1:]) for c in self.chips]
+        position = (sc_utils.get_x_pos(mmc), sc_utils.get_y_pos(mmc))
+        self.start = self.clock()
+        sc_utils.before_imaging()
+        sc_utils.open_camera_session()
+        try:
+            while True:
+                acquisition = self.next_acquisition(self.clock() - self.start, position)
+                if acquisition is None:
+                    break
+                chip_job = self.chips[acquisition.chip]
+                target = self.positions[acquisition.chip]
+                waiting = acquisition.planned - (self.clock() - self.start)
+                if waiting > 0:
+                    # Move to the chip while there is nothing else to do
+                    if target is not None and distance(position, target) > 0:
+                        x, y, z = chip_job['position']
+                        pos.set_pos(mmc, x=x, y=y, z=z)
+                        self.travel += distance(position, target)
+                        position = target
+                    sc_utils.print_info('Waiting until ' + self.describe(acquisition))
+                    idle_start = self.clock()
+                    self.wait_until(acquisition.planned, progress)
+                    self.idle += self.clock() - idle_start
+                self.travel += distance(position, target)
+                if target is not None:
+                    position = target
+
+                time_point = 't{0:0=2d}'.format(first_time_point[acquisition.chip] + acquisition.index)
+                acquisition.start = self.clock() - self.start
+                acquisition.status = 'running'
+                summary = jobs.image_chip(chip_job, time_point, mmc,
+                                          progress=progress, models=models)
+                acquisition.end = self.clock() - self.start
+                acquisition.status = summary['status']
+                self.update_estimate(acquisition)
+                self.replan(acquisition.end, position)
+                summary['planned_start'] = self.start + acquisition.planned
+                summary['actual_start'] = self.start + acquisition.start
+                summary['lateness'] = acquisition.lateness
+                self.summaries.append(summary)
+                if summary_path is not None:
+                    self.write_summary(summary_path)
+        except (prog.RunCancelled, KeyboardInterrupt):
+            for a in self.acquisitions:
+                if a.status in ('planned', 'running'):
+                    a.status = 'cancelled'
+            raise
+        finally:
+            sc_utils.close_camera_session()
+            sc_utils.after_imaging()
+            if summary_path is not None:
+                self.write_summary(summary_path)
+        return self.summaries
+
+    def describe(self, acquisition):
+        chip_job = self.chips[acquisition.chip]
+        text = chip_job['chip'] + ' ' + str(chip_job['chip_index']) + ' #' + str(acquisition.index)
+        if self.start is None:
+            return text + ' at +' + time.strftime('%H:%M:%S', time.gmtime(acquisition.planned))
+        return text + ' at ' + time.ctime(self.start + acquisition.planned)
+
+    def chip_report(self):
+        ''' Planned against actual timing for every chip '''
+        report = []
+        for chip, chip_job in enumerate(self.chips):
+            done = [a for a in self.acquisitions if a.chip == chip and a.start is not None]
+            lateness = [a.lateness for a in done]
+            starts = [a.start for a in done]
+            intervals = [b - a for a, b in zip(starts, starts[1:])]
+            report.append({
+                'chip': chip_job['chip'],
+                'chip_index': str(chip_job['chip_index']),
+                'interval_minutes': float(chip_job['interval_minutes']),
+                'planned': [a.planned for a in self.acquisitions if a.chip == chip],
+                'actual': starts,
+                'mean_lateness': sum(lateness) / len(lateness) if lateness else None,
+                'max_lateness': max(lateness) if lateness else None,
+                'actual_intervals': intervals,
+                'estimated_seconds': self.estimates[chip],
+            })
+        return report
+
+    def write_summary(self, path):
+        with open(path, 'w') as f:
+            json.dump({'runs': self.summaries,
+                       'failed': sum(s['status'] != 'ok' for s in self.summaries),
+                       'chips': self.chip_report(),
+                       'order': self.order,
+                       'idle_seconds': self.idle,
+                       'travel_um': self.travel}, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a multi-chip time-lapse without the GUI')
+    parser.add_argument('job', help='job spec yaml file')
+    parser.add_argument('--plan', action='store_true',
+                        help='print the planned acquisitions and exit')
+    parser.add_argument('--simulate', action='store_true',
+                        help='use the simulated camera and stage on a simulated clock')
+    parser.add_argument('--summary', help='json file for the run summary')
+    parser.add_argument('--server', action='store_true',
+                        help='run the models in the inference server, starting it if needed')
+    args = parser.parse_args(argv)
+
+    job = jobs.load_job(args.job)
+    if args.plan:
+        scheduler = Scheduler(job)
+        for a in scheduler.acquisitions:
+            sc_utils.print_info(scheduler.describe(a))
+        return 0
+
+    if args.simulate or job['simulate']:
+        scope = jobs.simulate(job)
+        mmc = sc_utils.get_stage_controller(job['stage_config'])
+        scheduler = Scheduler(job, (scope.x, scope.y),
+                              clock=lambda: scope.clock, sleep=scope.advance)
+    else:
+        mmc = sc_utils.get_stage_controller(job['stage_config'])
+        scheduler = Scheduler(job, (sc_utils.get_x_pos(mmc), sc_utils.get_y_pos(mmc)))
+
+    summary_path = args.summary or job['summary']
+    if summary_path is None:
+        summary_path = os.path.join(job['chips'][0]['folder'],
+                                    'schedule_summary_' + time.strftime('%Y%m%d%H%M') + '.json')
+    try:
+        models = jobs.ModelCache(inference.connect(start=True) if args.server else None)
+        summaries = scheduler.run(mmc, summary_path=summary_path, models=models)
+    except KeyboardInterrupt:
+        sc_utils.print_info('Schedule stopped, summary written to ' + summary_path)
+        return 1
+    sc_utils.print_info('Schedule finished, summary written to ' + summary_path)
+    return 1 if any(s['status'] != 'ok' for s in summaries) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,312 @@
+"""
+SmartScope
+Simulated camera and stage for running without hardware.
+
+Duke University - 2019
+Licensed under the MIT License (see LICENSE for details)
+Written by Caleb Sanford
+"""
+
+import time
+import numpy as np
+
+
+class SimulatedScope:
+    ''' A simulated microscope with one chip on the stage. The stage and
+    camera objects returned by stage() and camera() follow the parts of
+    the Micro-manager and PyVCAM interfaces that SmartScope uses.
+
+    Time is tracked on a simulated clock. Stage moves and exposures
+    advance the clock, and when realtime is True they also sleep for
+    the same amount of time.
+
+    args:
+        chip: chip dict from experiment_config.yml
+        origin: stage (x, y) of the first alignment mark (top left corner)
+        pixel_size: microns per camera pixel (the Frame to Pixel Ratio)
+        sensor_size: camera (width, height) in pixels
+        focus_z: z of the focal plane at the origin
+        tilt: (dz/dx, dz/dy) tilt of the chip
+        rotation: rotation of the chip in degrees about the first mark
+        depth_of_field: z distance (um) at which the contrast halves
+        xy_speed: stage speed in um/s
+        z_speed: focus drive speed in um/s, unless the stage's 'Speed' 
+            property of the focus drive is set
+        readout_ms: camera readout time per full frame
+        settle_ms: time the stage takes to settle after a move
+        realtime: sleep for the simulated time
+        seed: random seed for the camera noise
+    '''
+    def __init__(self, chip=None, origin=(0.0, 0.0), pixel_size=0.45,
+                 sensor_size=(2688, 2200), focus_z=0.0, tilt=(0.0, 0.0), rotation=0.0,
+                 depth_of_field=5.0, xy_speed=5000.0, z_speed=1000.0,
+                 readout_ms=30.0, settle_ms=0.0, realtime=False, seed=0):
+        if chip is None:
+            chip = {'name': 'Simulated Chip',
+                    'number_of_apartments': 34,
+                    'number_of_streets': 128,
+                    'apartment_spacing': 280.6,
+                    'street_spacing': 194.4,
+                    'chip_width': 26000.0,
+                    'chip_height': 9500.0}
+        self.chip = chip
+        self.origin = origin
+        self.pixel_size = pixel_size
+        self.sensor_size = tuple(sensor_size)
+        self.focus_z = focus_z
+        self.tilt = tilt
+        self.rotation = rotation
+        self.depth_of_field = depth_of_field
+        self.xy_speed = xy_speed
+        self.z_speed = z_speed
+        self.readout_ms = readout_ms
+        self.settle_ms = settle_ms
+        self.realtime = realtime
+        self.random = np.random.RandomState(seed)
+        self.clock = 0.0
+        self.x = origin[0]
+        self.y = origin[1]
+        self.z = focus_z
+        self.properties = {}
+        self._stage = None
+
+    def advance(self, seconds):
+        ''' Moves the simulated clock forward '''
+        self.clock += seconds
+        if self.realtime and seconds > 0:
+            time.sleep(seconds)
+
+    @property
+    def z(self):
+        return self.z_at(self.clock)
+
+    @z.setter
+    def z(self, z):
+        self._z_move = (z, z, self.clock, 1.0)
+
+    def move_z(self, z, speed):
+        ''' Starts a focus move to z at speed (um/s) from the current z 
+        
+        returns:
+            clock time the move ends
+        '''
+        start = self.z
+        self._z_move = (start, z, self.clock, speed)
+        return self.clock + abs(z - start) / speed
+
+    def z_at(self, t):
+        ''' z of the focus drive at clock time t '''
+        start, end, t0, speed = self._z_move
+        travel = max(0.0, t - t0) * speed
+        if travel >= abs(end - start):
+            return end
+        return start + np.sign(end - start) * travel
+
+    def marks(self):
+        ''' Stage (x, y) of the alignment marks, the chip's 
+        'alignment_marks' or one at each corner 
+        '''
+        x0, y0 = self.origin
+        return [(x0 + u, y0 + v) for u, v in self._rotate(*np.array(self._layout()).T, 1)]
+
+    def _layout(self):
+        ''' Mark (x, y) relative to the first mark on an unrotated chip '''
+        if self.chip.get('alignment_marks'):
+            return [tuple(m) for m in self.chip['alignment_marks']]
+        w = self.chip['chip_width']
+        h = self.chip['chip_height']
+        return [(0.0, 0.0), (w, 0.0), (w, -h), (0.0, -h)]
+
+    def _rotate(self, dx, dy, direction):
+        ''' Rotates offsets by the chip rotation (direction 1) or back (-1) '''
+        angle = np.radians(self.rotation) * direction
+        c, s = np.cos(angle), np.sin(angle)
+        return np.stack([c * dx - s * dy, s * dx + c * dy], -1)
+
+    def focus_z_at(self, x, y):
+        ''' z of best focus at stage position (x, y) '''
+        return (self.focus_z + self.tilt[0] * (x - self.origin[0])
+                + self.tilt[1] * (y - self.origin[1]))
+
+    def render(self, x, y, z, exposure, roi=None, binning=1):
+        ''' Renders a uint16 frame centered on stage (x, y) at height z.
+
+        args:
+            roi: (x, y, width, height) of the sensor to read, full frame
+                if None
+            binning: pixels combined in each direction
+        '''
+        width, height = self.sensor_size
+        if roi is None:
+            roi = (0, 0, width, height)
+        rx, ry, rw, rh = roi
+        # Render on a coarse grid and upsample, the pattern is much
+        # larger than a pixel
+        step = max(4, binning)
+        cols = rx + np.arange(0, rw, step) + step / 2.0
+        rows = ry + np.arange(0, rh, step) + step / 2.0
+        stage_x = x - (cols - width / 2.0) * self.pixel_size
+        stage_y = y - (rows - height / 2.0) * self.pixel_size
+        sx, sy = np.meshgrid(stage_x, stage_y)
+
+        pattern = self._pattern(sx, sy)
+        dz = z - self.focus_z_at(x, y)
+        contrast = 1.0 / (1.0 + (dz / self.depth_of_field) ** 2)
+        signal = min(float(exposure), 100.0) / 100.0
+        image = 2000 + 10000 * signal * (0.5 + contrast * (pattern - 0.5))
+        image = np.repeat(np.repeat(image, step // binning, axis=0), step // binning, axis=1)
+        image = image[:rh // binning, :rw // binning]
+        image = image + self.random.normal(0, 40, image.shape)
+        return np.clip(image, 0, 16383).astype(np.uint16)
+
+    def _pattern(self, sx, sy):
+        ''' Chip pattern in [0, 1]: street and apartment walls plus a
+        cross shaped alignment mark at every mark position
+        '''
+        x0, y0 = self.origin
+        chip_xy = self._rotate(sx - x0, sy - y0, -1)
+        cx, cy = chip_xy[..., 0], chip_xy[..., 1]
+        u = cx
+        v = -cy
+        inside = ((u > 0) & (u < self.chip['chip_width']) &
+                  (v > 0) & (v < self.chip['chip_height']))
+        walls = ((np.mod(u, self.chip['street_spacing']) < 8) |
+                 (np.mod(v, self.chip['apartment_spacing']) < 8))
+        pattern = np.where(inside & walls, 1.0, 0.0)
+        for mx, my in self._layout():
+            dx = np.abs(cx - mx)
+            dy = np.abs(cy - my)
+            cross = ((dx < 60) & (dy < 8)) | ((dy < 60) & (dx < 8))
+            pattern = np.where(cross, 1.0, pattern)
+        return pattern
+
+    def stage(self):
+        if self._stage is None:
+            self._stage = SimulatedStage(self)
+        return self._stage
+
+    def camera(self):
+        return SimulatedCamera(self)
+
+
+class SimulatedStage:
+    ''' Stand in for MMCorePy.CMMCore. XY moves are applied immediately. 
+    The focus drive moves at its speed as the clock advances. 
+    waitForSystem() advances the clock to the end of the moves.
+    '''
+    def __init__(self, scope):
+        self.scope = scope
+        self.focus_device = 'FocusDrive'
+        self._xy_end = 0.0
+        self._z_end = 0.0
+        self._moved = False
+
+    def loadSystemConfiguration(self, cfg):
+        pass
+
+    def setFocusDevice(self, device):
+        self.focus_device = device
+
+    def getFocusDevice(self):
+        return self.focus_device
+
+    def getXPosition(self):
+        return self.scope.x
+
+    def getYPosition(self):
+        return self.scope.y
+
+    def getPosition(self):
+        return self.scope.z
+
+    def setXYPosition(self, x, y):
+        distance = np.hypot(x - self.scope.x, y - self.scope.y)
+        self._xy_end = max(self._xy_end, self.scope.clock + distance / self.scope.xy_speed)
+        self._moved = True
+        self.scope.x = x
+        self.scope.y = y
+
+    def setPosition(self, z):
+        speed = float(self.scope.properties.get((self.focus_device, 'Speed')) or 
+                      self.scope.z_speed)
+        self._z_end = self.scope.move_z(z, speed)
+        self._moved = True
+
+    def deviceBusy(self, device):
+        end = self._z_end if device == self.focus_device else self._xy_end
+        return self.scope.clock < end
+
+    def waitForSystem(self):
+        self.scope.advance(max(0.0, self._xy_end - self.scope.clock, 
+                               self._z_end - self.scope.clock))
+        if self._moved:
+            self.scope.advance(self.scope.settle_ms / 1000.0)
+            self._moved = False
+
+    def getProperty(self, device, prop):
+        if (device, prop) == ('Thorlabs DC4100', 'Port'):
+            return 'SIM'
+        return self.scope.properties.get((device, prop), 0)
+
+    def setProperty(self, device, prop, value):
+        self.scope.properties[(device, prop)] = value
+
+    def setSerialPortCommand(self, port, command, term):
+        pass
+
+
+class SimulatedCamera:
+    ''' Stand in for a PyVCAM Camera. roi is (x start, x end, y start, 
+    y end) of the sensor and binning is (x, y), as in PyVCAM.
+    '''
+    def __init__(self, scope):
+        self.scope = scope
+        self.sensor_size = scope.sensor_size
+        self.clear_mode = 'Never'
+        self.exp_mode = 'Ext Trig Trig First'
+        self.readout_port = 0
+        self.speed_table_index = 0
+        self.gain = 1
+        self.roi = (0, self.sensor_size[0], 0, self.sensor_size[1])
+        self.binning = (1, 1)
+        self.is_open = False
+
+    @property
+    def shape(self):
+        ''' (width, height) of the frames '''
+        x0, x1, y0, y1 = self.roi
+        return ((x1 - x0) // self.binning[0], (y1 - y0) // self.binning[1])
+
+    @property
+    def readout_time(self):
+        ''' Readout time (s) of a frame, binned pixels are read out as one '''
+        scope = self.scope
+        return scope.readout_ms * float(np.prod(self.shape)) / np.prod(scope.sensor_size) / 1000.0
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def get_frame(self, exp_time=1):
+        scope = self.scope
+        x0, x1, y0, y1 = self.roi
+        # The focus drive can move during the exposure, the frame is 
+        # rendered at its z in the middle of the exposure
+        z = scope.z_at(scope.clock + exp_time / 2000.0)
+        frame = scope.render(scope.x, scope.y, z, exp_time,
+                             roi=(x0, y0, x1 - x0, y1 - y0), binning=self.binning[0])
+        scope.advance(exp_time / 1000.0 + self.readout_time)
+        return frame
+
+    def start_live(self, exp_time=1):
+        ''' Starts streaming frames in sequence mode '''
+        self._live_exposure = exp_time
+
+    def get_live_frame(self):
+        ''' Next frame of the stream '''
+        return self.get_frame(self._live_exposure)
+
+    def stop_live(self):
+        self._live_exposure = None
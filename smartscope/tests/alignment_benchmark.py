@@ -0,0 +1,71 @@
+''' Benchmark for finding alignment marks.
+
+Renders corner frames on the simulated scope with the stage a random
+distance from the mark and times the template match, and Mask R-CNN
+when a model is given, printing the time per corner and the error of
+the mark center in pixels.
+
+    python alignment_benchmark.py
+    python alignment_benchmark.py --model path/to/alignment_30.h5
+'''
+import argparse
+import time
+
+import numpy as np
+
+from smartscope.source import alignment
+from smartscope.source import sc_utils
+from smartscope.source import simulation
+
+
+def mark_pixel(scope, x, y):
+    width, height = scope.sensor_size
+    return (width / 2.0 + x / scope.pixel_size, height / 2.0 + y / scope.pixel_size)
+
+
+def run(name, locate, frames):
+    times = []
+    errors = []
+    misses = 0
+    for frame, expected in frames:
+        start = time.perf_counter()
+        center = locate(frame)
+        times.append(time.perf_counter() - start)
+        if center is None:
+            misses += 1
+        else:
+            errors.append(np.hypot(center[0] - expected[0], center[1] - expected[1]))
+    print('{:<12} {:>10.1f} {:>10.1f} {:>10.2f} {:>8d}'.format(
+        name, 1000 * np.mean(times), 1000 * np.max(times),
+        np.mean(errors) if errors else float('nan'), misses))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Alignment mark benchmark')
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--offset', type=float, default=300,
+                        help='largest stage distance (um) from the mark')
+    parser.add_argument('--model', help='Mask R-CNN weights to compare against')
+    args = parser.parse_args()
+
+    scope = simulation.SimulatedScope()
+    random = np.random.RandomState(1)
+    frames = []
+    for _ in range(args.frames):
+        x, y = random.uniform(-args.offset, args.offset, 2)
+        frames.append((scope.render(x, y, 0, 50), mark_pixel(scope, x, y)))
+    matcher = alignment.TemplateMatcher.from_frame(scope.render(0, 0, 0, 50), mark_pixel(scope, 0, 0))
+
+    def template(frame):
+        center, confidence = matcher.match(frame)
+        return center if confidence >= alignment.MIN_CONFIDENCE else None
+
+    print('{:<12} {:>10} {:>10} {:>10} {:>8}'.format('method', 'mean (ms)', 'max (ms)', 'error (px)', 'misses'))
+    run('template', template, frames)
+    if args.model:
+        model = alignment.get_inference_model(args.model)
+
+        def maskrcnn(frame):
+            r = model.detect([sc_utils.convert_frame_to_mrcnn_format(frame)], verbose=0)[0]
+            return alignment.get_mark_center(r['rois'][0]) if len(r['rois']) else None
+        run('maskrcnn', maskrcnn, frames)
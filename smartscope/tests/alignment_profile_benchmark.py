@@ -0,0 +1,118 @@
+''' Benchmark for the alignment model inference profiles.
+
+Runs each profile in mark_dataset.INFERENCE_PROFILES in its own process
+on a held-out set of labeled alignment mark images and prints the
+latency, peak memory and the error of the mark center in pixels, so the
+speed of a profile can be weighed against its accuracy.
+
+The held-out set is a Labelbox json export (the same format as the
+training labels) and the folder of images it labels. Without one the
+marks are rendered on the simulated scope.
+
+    python alignment_profile_benchmark.py --model path/to/alignment_30.h5
+    python alignment_profile_benchmark.py --model path/to/alignment_30.h5 \\
+        --model light=path/to/alignment_resnet50.h5 --labels val.json --images path/to/images
+'''
+import sys
+sys.path.append('C:\\Program Files\\Micro-Manager-2.0beta')
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import skimage.io
+
+from smartscope.tests.maskrcnn_benchmark import peak_memory_mb
+
+
+def load_marks(labels, images, count):
+    ''' Frames and the (x, y) center of the first mark in each '''
+    marks = []
+    if labels:
+        for a in json.load(open(labels, 'r')):
+            if 'Mark' not in a['Label']:
+                continue
+            points = a['Label']['Mark'][0]['geometry']
+            x = [p['x'] for p in points]
+            y = [p['y'] for p in points]
+            frame = skimage.io.imread(os.path.join(images, a['External ID']))
+            marks.append((frame, ((min(x) + max(x)) / 2.0, (min(y) + max(y)) / 2.0)))
+        return marks[:count]
+    from smartscope.source import simulation
+    scope = simulation.SimulatedScope()
+    width, height = scope.sensor_size
+    random = np.random.RandomState(1)
+    for x, y in random.uniform(-300, 300, (count, 2)):
+        marks.append((scope.render(x, y, 0, 50),
+                      (width / 2.0 + x / scope.pixel_size, height / 2.0 + y / scope.pixel_size)))
+    return marks
+
+
+def run_profile(profile, model_path, labels, images, count, output):
+    from smartscope.source import alignment
+    from smartscope.source import sc_utils
+    start = time.perf_counter()
+    model = alignment.get_inference_model(model_path, profile=profile)
+    load_time = time.perf_counter() - start
+    marks = load_marks(labels, images, count)
+    model.detect([sc_utils.convert_frame_to_mrcnn_format(marks[0][0])])  # warm up
+    times = []
+    errors = []
+    for frame, (x, y) in marks:
+        frame = sc_utils.convert_frame_to_mrcnn_format(frame)
+        start = time.perf_counter()
+        r = model.detect([frame])[0]
+        times.append(time.perf_counter() - start)
+        if len(r['rois']):
+            cx, cy = alignment.get_mark_center(r['rois'][0])
+            errors.append(np.hypot(cx - x, cy - y))
+    np.savez(output, times=np.array(times), errors=np.array(errors),
+             misses=len(marks) - len(errors), load_time=load_time, memory=peak_memory_mb())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Alignment profile benchmark')
+    parser.add_argument('--model', action='append', required=True,
+                        help='weights for every profile, or profile=weights for one profile')
+    parser.add_argument('--labels', help='Labelbox json of the held-out marks')
+    parser.add_argument('--images', help='folder of the held-out images')
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--profile', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.profile:
+        run_profile(args.profile, args.model[0], args.labels, args.images, args.count, args.output)
+        sys.exit(0)
+
+    from smartscope.source.dataset import mark_dataset
+    models = {}
+    for m in args.model:
+        if '=' in m:
+            profile, path = m.split('=', 1)
+            models[profile] = path
+        else:
+            # ResNet-101 weights work with every profile except light
+            for profile in mark_dataset.INFERENCE_PROFILES:
+                if profile != 'light':
+                    models.setdefault(profile, m)
+
+    out = tempfile.mkdtemp()
+    print('{:<10} {:>9} {:>10} {:>10} {:>12} {:>11} {:>10} {:>7}'.format(
+        'profile', 'load (s)', 'mean (ms)', 'p95 (ms)', 'memory (MB)', 'error (px)', 'max (px)', 'misses'))
+    for profile, path in models.items():
+        output = os.path.join(out, profile + '.npz')
+        command = [sys.executable, os.path.abspath(__file__), '--model', path, '--profile', profile,
+                   '--output', output, '--count', str(args.count)]
+        if args.labels:
+            command += ['--labels', args.labels, '--images', args.images]
+        subprocess.check_call(command)
+        s = np.load(output)
+        errors = s['errors'] if len(s['errors']) else np.array([np.nan])
+        print('{:<10} {:>9.1f} {:>10.1f} {:>10.1f} {:>12.0f} {:>11.2f} {:>10.2f} {:>7d}'.format(
+            profile, float(s['load_time']), 1000 * s['times'].mean(),
+            1000 * np.percentile(s['times'], 95), float(s['memory']),
+            np.mean(errors), np.max(errors), int(s['misses'])))
@@ -0,0 +1,76 @@
+''' Cold start benchmark for the alignment and focus models.
+
+Starts a fresh python process for every model and format and times the
+imports, the model load and the first inference, which is what the GUI
+or a worker waits for when it launches. Run export_models.py first to
+make the frozen models.
+
+    python cold_start_benchmark.py --alignment-model path/to/alignment_30.h5 \
+        --focus-model path/to/model.ckpt-1000042
+'''
+import sys
+sys.path.append('C:\\Program Files\\Micro-Manager-2.0beta')
+import argparse
+import json
+import subprocess
+import time
+
+
+def cold_start(kind, path, use_frozen, profile):
+    ''' Runs in the fresh process, prints the times as json '''
+    start = time.perf_counter()
+    import numpy as np
+    from smartscope.source import sc_utils
+    if kind == 'alignment':
+        from smartscope.source import alignment
+        imported = time.perf_counter()
+        model = alignment.get_inference_model(path, profile=profile, use_frozen=use_frozen)
+        loaded = time.perf_counter()
+        frame = np.random.randint(0, 16383, size=(2200, 2688)).astype(np.uint16)
+        model.detect([sc_utils.convert_frame_to_mrcnn_format(frame)])
+    else:
+        from smartscope.source.miq import miq
+        imported = time.perf_counter()
+        model = miq.get_classifier(miq.checkpoint_path(path), use_frozen=use_frozen)
+        loaded = time.perf_counter()
+        frame = np.random.randint(0, 16383, size=(2200, 2688)).astype(np.uint16)
+        model.score(sc_utils.bytescale(frame, high=65535))
+    done = time.perf_counter()
+    print(json.dumps({'import': imported - start, 'load': loaded - imported,
+                      'first': done - loaded, 'total': done - start}))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Model cold start benchmark')
+    parser.add_argument('--alignment-model', help='alignment model weights (.h5)')
+    parser.add_argument('--profile', default='default', help='alignment inference profile')
+    parser.add_argument('--focus-model', help='focus model checkpoint')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument('--frozen', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        cold_start(args.child[0], args.child[1], args.frozen, args.profile)
+        sys.exit(0)
+
+    models = []
+    if args.alignment_model:
+        models.append(('alignment', args.alignment_model))
+    if args.focus_model:
+        models.append(('focus', args.focus_model))
+
+    print('{:<10} {:<8} {:>10} {:>10} {:>12} {:>10}'.format(
+        'model', 'format', 'import (s)', 'load (s)', 'first (s)', 'total (s)'))
+    for kind, path in models:
+        for name, frozen in [('original', False), ('frozen', True)]:
+            command = [sys.executable, __file__, '--child', kind, path, '--profile', args.profile]
+            if frozen:
+                command.append('--frozen')
+            runs = []
+            for _ in range(args.runs):
+                output = subprocess.check_output(command).decode().strip().splitlines()
+                runs.append(json.loads(output[-1]))
+            mean = {k: sum(r[k] for r in runs) / len(runs) for k in runs[0]}
+            print('{:<10} {:<8} {:>10.2f} {:>10.2f} {:>12.2f} {:>10.2f}'.format(
+                kind, name, mean['import'], mean['load'], mean['first'], mean['total']))
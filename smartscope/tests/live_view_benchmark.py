@@ -0,0 +1,100 @@
+''' Soak benchmark for the live view rendering.
+
+Runs a live view window for a long time and prints the process memory,
+the number of canvas items and the time spent drawing each frame. With
+the persistent canvas items all three should stay flat.
+
+    python live_view_benchmark.py --minutes 60
+    python live_view_benchmark.py --minutes 60 --camera    (use the real camera)
+'''
+import sys
+sys.path.append('C:\\Program Files\\Micro-Manager-2.0beta')
+import argparse
+import os
+import time
+import tkinter as tk
+
+import numpy as np
+
+from smartscope.gui import live_view
+
+
+class SyntheticCamera:
+    ''' Stands in for the PVCAM camera, returns random 14-bit frames '''
+    def __init__(self, sensor_size=(2688, 2200)):
+        self.sensor_size = sensor_size
+        self.shape = sensor_size
+        self.frames = [np.random.randint(0, 16383, size=sensor_size[::-1], dtype=np.uint16)
+                       for _ in range(4)]
+        self.count = 0
+
+    def get_frame(self, exp_time=1):
+        time.sleep(exp_time / 1000.0)
+        self.count += 1
+        return self.frames[self.count % len(self.frames)]
+
+
+def rss_mb():
+    ''' Resident memory of this process in MB '''
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().rss / 1e6
+    except ImportError:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+
+
+class Soak:
+    def __init__(self, window, minutes, report_seconds, cam, scale=3):
+        self.window = window
+        dim = (2688 // scale, 2200 // scale)
+        self.canvas = tk.Canvas(window, width=dim[0], height=dim[1])
+        self.canvas.pack()
+        self.view = live_view.CanvasView(self.canvas, dim)
+        self.view.cross('cross', dim[0] / 2, dim[1] / 2)
+        self.live = live_view.LiveView(dim, exposure=1, cam=cam).start()
+
+        self.end = time.time() + minutes * 60
+        self.report_seconds = report_seconds
+        self.next_report = time.time()
+        self.draw_times = []
+        print('{:>8} {:>8} {:>10} {:>10} {:>8} {:>8}'.format(
+            'minutes', 'frames', 'draw (ms)', 'rss (MB)', 'items', 'dropped'))
+        self.start = time.time()
+        self.update()
+
+    def update(self):
+        frame = self.live.latest()
+        if frame is not None:
+            t = time.perf_counter()
+            self.view.show(frame)
+            self.window.update_idletasks()
+            self.draw_times.append(time.perf_counter() - t)
+        now = time.time()
+        if now >= self.next_report:
+            self.report(now)
+            self.next_report = now + self.report_seconds
+        if now > self.end:
+            self.live.stop()
+            self.window.destroy()
+            return
+        self.window.after(15, self.update)
+
+    def report(self, now):
+        draw = 1000 * np.mean(self.draw_times) if self.draw_times else 0
+        print('{:8.1f} {:8d} {:10.2f} {:10.1f} {:8d} {:8d}'.format(
+            (now - self.start) / 60, self.live.buffer.written, draw, rss_mb(),
+            len(self.canvas.find_all()), self.live.buffer.dropped))
+        self.draw_times = []
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Live view soak benchmark')
+    parser.add_argument('--minutes', type=float, default=60)
+    parser.add_argument('--report', type=float, default=60, help='seconds between reports')
+    parser.add_argument('--camera', action='store_true', help='use the real camera')
+    args = parser.parse_args()
+
+    root = tk.Tk()
+    Soak(root, args.minutes, args.report, None if args.camera else SyntheticCamera())
+    root.mainloop()
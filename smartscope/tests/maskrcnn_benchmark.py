@@ -0,0 +1,102 @@
+''' Benchmark for the detection only Mask R-CNN inference mode.
+
+Loads the alignment model with and without the mask head, each in its
+own process so the memory numbers do not mix, and runs detect() on the
+same frames. Prints the latency, the peak memory of each process and
+whether the boxes, class IDs and scores of the two modes match.
+
+    python maskrcnn_benchmark.py path/to/alignment_30.h5
+    python maskrcnn_benchmark.py path/to/alignment_30.h5 --images path/to/frames
+'''
+import sys
+sys.path.append('C:\\Program Files\\Micro-Manager-2.0beta')
+import argparse
+import glob
+import os
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import skimage.io
+
+
+def peak_memory_mb():
+    ''' Peak resident memory of this process in MB '''
+    try:
+        import psutil
+        info = psutil.Process(os.getpid()).memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 1e6
+    except ImportError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def load_frames(images, count):
+    ''' Camera frames from a folder, or simulated alignment mark frames '''
+    if images:
+        files = sorted(glob.glob(os.path.join(images, '*.tif')))[:count]
+        return [skimage.io.imread(f) for f in files]
+    from smartscope.source import simulation
+    scope = simulation.SimulatedScope()
+    random = np.random.RandomState(1)
+    return [scope.render(x, y, 0, 50) for x, y in random.uniform(-300, 300, (count, 2))]
+
+
+def run_mode(model_path, detection_only, images, count, repeat, output):
+    from smartscope.source import alignment
+    from smartscope.source import sc_utils
+    start = time.perf_counter()
+    model = alignment.get_inference_model(model_path, detection_only=detection_only)
+    load_time = time.perf_counter() - start
+    frames = [sc_utils.convert_frame_to_mrcnn_format(f) for f in load_frames(images, count)]
+    model.detect([frames[0]])  # warm up
+    times = []
+    for _ in range(repeat):
+        for frame in frames:
+            start = time.perf_counter()
+            model.detect([frame])
+            times.append(time.perf_counter() - start)
+    r_all = [model.detect([f])[0] for f in frames]
+    np.savez(output, times=np.array(times), load_time=load_time, memory=peak_memory_mb(),
+             rois=np.array([r['rois'] for r in r_all], dtype=object),
+             class_ids=np.array([r['class_ids'] for r in r_all], dtype=object),
+             scores=np.array([r['scores'] for r in r_all], dtype=object))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Detection only Mask R-CNN benchmark')
+    parser.add_argument('model', help='alignment model weights (.h5)')
+    parser.add_argument('--images', help='folder of .tif frames (default: simulated frames)')
+    parser.add_argument('--count', type=int, default=10, help='frames to detect on')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--mode', choices=['full', 'detection'], help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.model, args.mode == 'detection', args.images,
+                 args.count, args.repeat, args.output)
+        sys.exit(0)
+
+    out = tempfile.mkdtemp()
+    stats = {}
+    for mode in ['full', 'detection']:
+        output = os.path.join(out, mode + '.npz')
+        command = [sys.executable, os.path.abspath(__file__), args.model, '--mode', mode,
+                   '--output', output, '--count', str(args.count), '--repeat', str(args.repeat)]
+        if args.images:
+            command += ['--images', args.images]
+        subprocess.check_call(command)
+        stats[mode] = np.load(output, allow_pickle=True)
+
+    print('{:<10} {:>10} {:>10} {:>10} {:>12}'.format('mode', 'load (s)', 'mean (ms)', 'p95 (ms)', 'memory (MB)'))
+    for mode in ['full', 'detection']:
+        s = stats[mode]
+        print('{:<10} {:>10.1f} {:>10.1f} {:>10.1f} {:>12.0f}'.format(
+            mode, float(s['load_time']), 1000 * s['times'].mean(),
+            1000 * np.percentile(s['times'], 95), float(s['memory'])))
+
+    same = all(a.shape == b.shape and np.allclose(a, b) for key in ['rois', 'class_ids', 'scores']
+               for a, b in zip(stats['full'][key], stats['detection'][key]))
+    print('Boxes, class IDs and scores match: ' + str(same))
@@ -0,0 +1,65 @@
+''' Microbenchmarks of the vectorized Mask R-CNN utils.
+
+Times each function in smartscope/source/maskrcnn/utils.py against the
+loop based version it replaced (kept in test_maskrcnn_utils.py) on
+inputs the size of training target generation and inference
+post-processing, and checks that the outputs are the same.
+
+    python maskrcnn_utils_benchmark.py
+'''
+import argparse
+import timeit
+
+import numpy as np
+
+from smartscope.source.maskrcnn import utils
+from smartscope.tests import test_maskrcnn_utils as reference
+
+
+def anchors(count, rng):
+    ''' Anchor sized boxes on a 1024 x 1024 image '''
+    return reference.random_boxes(rng, count, size=1024)
+
+
+def cases(rng):
+    ''' (name, new function, old function, args) for every benchmark '''
+    masks = reference.random_masks(rng, 20, shape=(1024, 1024))
+    masks = masks[:, :, masks.any(axis=(0, 1))]
+    bbox = utils.extract_bboxes(masks)
+    mrcnn_masks = rng.rand(20, 28, 28).astype(np.float32)
+    detections = reference.random_boxes(rng, 20, size=900, integer=True)
+    detections[:, 2:] = np.maximum(detections[:, 2:], detections[:, :2] + 1)
+    unmold_old = lambda m, b, s: np.stack(
+        [reference.reference_unmold_mask(mi, bi, s) for mi, bi in zip(m, b)], -1)
+    proposals = anchors(6000, rng)
+    scores = rng.rand(6000)
+    return [
+        ('extract_bboxes 20 x 1024^2', utils.extract_bboxes,
+         reference.reference_extract_bboxes, (masks,)),
+        ('compute_overlaps 65472 x 20', utils.compute_overlaps,
+         reference.reference_compute_overlaps, (anchors(65472, rng), anchors(20, rng))),
+        ('compute_overlaps 1000 x 1000', utils.compute_overlaps,
+         reference.reference_compute_overlaps, (anchors(1000, rng), anchors(1000, rng))),
+        ('non_max_suppression 6000', utils.non_max_suppression,
+         reference.reference_non_max_suppression, (proposals, scores, 0.7)),
+        ('minimize_mask 20 x 1024^2', utils.minimize_mask,
+         reference.reference_minimize_mask, (bbox, masks, (56, 56))),
+        ('unmold_masks 20 x 1024^2', utils.unmold_masks,
+         unmold_old, (mrcnn_masks, detections, (1024, 1024, 3))),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Mask R-CNN utils microbenchmarks')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    print('{:<30} {:>10} {:>10} {:>8} {:>6}'.format('function', 'old (ms)', 'new (ms)',
+                                                   'speedup', 'same'))
+    for name, new, old, inputs in cases(rng):
+        same = np.array_equal(new(*inputs), old(*inputs), equal_nan=True)
+        old_time = min(timeit.repeat(lambda: old(*inputs), number=1, repeat=args.runs))
+        new_time = min(timeit.repeat(lambda: new(*inputs), number=1, repeat=args.runs))
+        print('{:<30} {:>10.2f} {:>10.2f} {:>7.1f}x {:>6}'.format(
+            name, old_time * 1000, new_time * 1000, old_time / new_time, str(same)))
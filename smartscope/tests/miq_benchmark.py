@@ -0,0 +1,70 @@
+''' Microbenchmarks of the batched focus model post-processing.
+
+Times the certainty, aggregation and mask functions of
+smartscope/source/miq against the loop based versions they replaced
+(kept in test_miq_evaluation.py). The inputs are the patch probabilities
+of full frames: a 2688 x 2200 frame has 32 x 26 patches of 84 pixels.
+Each benchmark also checks that the outputs are the same.
+
+    python miq_benchmark.py --frames 15
+'''
+import argparse
+import timeit
+
+import numpy as np
+
+from smartscope.source.miq import evaluation
+from smartscope.source.miq import prediction
+from smartscope.tests import test_miq_evaluation as reference
+
+# Patches in a full frame
+ROWS, COLUMNS = 2200 // 84, 2688 // 84
+
+
+def cases(rng, frames):
+    ''' (name, new function, old function, args, compare) for every benchmark '''
+    probabilities = reference.random_probabilities(rng, (frames, ROWS * COLUMNS))
+    flat = probabilities.reshape(-1, probabilities.shape[-1])
+    patches = rng.randint(0, 65535, (ROWS * COLUMNS, 84, 84, 1)).astype(np.uint16)
+    values = rng.randint(0, 11, (ROWS, COLUMNS)).astype(np.uint16)
+
+    def same_predictions(a, b):
+        return all(x.predictions == y.predictions and x.certainties == y.certainties and
+                   np.allclose(x.probabilities, y.probabilities) for x, y in zip(a, b))
+
+    return [
+        ('certainties {} x {}'.format(frames, ROWS * COLUMNS),
+         evaluation.certainties_from_probabilities,
+         reference.reference_certainties_from_probabilities, (flat,), np.allclose),
+        ('aggregate {} frames'.format(frames),
+         evaluation.aggregate_predictions_from_probabilities,
+         lambda p: [reference.reference_aggregate_prediction(f) for f in p],
+         (probabilities,), same_predictions),
+        ('aggregate product {} frames'.format(frames),
+         lambda p: evaluation.aggregate_predictions_from_probabilities(
+             p, evaluation.METHOD_PRODUCT),
+         lambda p: [reference.reference_aggregate_prediction(f, evaluation.METHOD_PRODUCT)
+                    for f in p],
+         (probabilities,), same_predictions),
+        ('patches_to_image', evaluation._patches_to_image, reference.reference_patches_to_image,
+         (patches, (2200, 2688)), np.array_equal),
+        ('patch_values_to_mask', prediction.patch_values_to_mask,
+         reference.reference_patch_values_to_mask, (values, 84), np.array_equal),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Focus model post-processing microbenchmarks')
+    parser.add_argument('--frames', type=int, default=15, help='frames in a focus scan')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    print('{:<30} {:>10} {:>10} {:>8} {:>6}'.format('function', 'old (ms)', 'new (ms)',
+                                                   'speedup', 'same'))
+    for name, new, old, inputs, compare in cases(rng, args.frames):
+        same = compare(new(*inputs), old(*inputs))
+        old_time = min(timeit.repeat(lambda: old(*inputs), number=1, repeat=args.runs))
+        new_time = min(timeit.repeat(lambda: new(*inputs), number=1, repeat=args.runs))
+        print('{:<30} {:>10.2f} {:>10.2f} {:>7.1f}x {:>6}'.format(
+            name, old_time * 1000, new_time * 1000, old_time / new_time, str(same)))
@@ -0,0 +1,160 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from smartscope.source import alignment
+from smartscope.source import position as pos
+from smartscope.source import sc_utils
+from smartscope.source import simulation
+
+
+class FakeModel:
+    ''' Mask R-CNN stand in that finds marks at fixed boxes '''
+    def __init__(self, *boxes, scores=None):
+        self.boxes = boxes
+        self.scores = [0.99] * len(boxes) if scores is None else scores
+        self.calls = 0
+
+    def detect(self, images, verbose=0):
+        self.calls += 1
+        return [{'rois': np.array(self.boxes), 'class_ids': np.ones(len(self.boxes), dtype=int),
+                 'scores': np.array(self.scores)}]
+
+
+class BatchModel:
+    ''' Batched Mask R-CNN stand in that finds marks with a template '''
+    def __init__(self, matcher, batch_size):
+        self.matcher = matcher
+        self.config = type('Config', (), {'BATCH_SIZE': batch_size})
+        self.batches = []
+
+    def detect(self, images, verbose=0):
+        assert len(images) == self.config.BATCH_SIZE, 'batch size error'
+        self.batches.append(len(images))
+        results = []
+        for image in images:
+            matches = self.matcher.match_all(image[:, :, 0])
+            results.append({'rois': np.array([[y - 50, x - 50, y + 50, x + 50]
+                                              for (x, y), _ in matches]).reshape(-1, 4),
+                            'class_ids': np.ones(len(matches), dtype=int),
+                            'scores': np.array([c for _, c in matches])})
+        return results
+
+
+class TestAlignment(unittest.TestCase):
+
+    def setUp(self):
+        self.scope = simulation.SimulatedScope()
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def mark_pixel(self, x, y):
+        ''' Pixel of the mark at the origin with the stage at (x, y) '''
+        width, height = self.scope.sensor_size
+        return (width / 2.0 + x / self.scope.pixel_size,
+                height / 2.0 + y / self.scope.pixel_size)
+
+    def test_template_match(self):
+        matcher = alignment.TemplateMatcher.from_frame(
+            self.scope.render(0, 0, 0, 50), self.mark_pixel(0, 0))
+        for x, y in [(30, -20), (-400, 300)]:
+            center, confidence = matcher.match(self.scope.render(x, y, 0, 50))
+            expected = self.mark_pixel(x, y)
+            assert confidence > alignment.MIN_CONFIDENCE, 'template confidence error'
+            assert np.hypot(center[0] - expected[0], center[1] - expected[1]) < 3, 'template center error'
+        # No mark in the frame
+        _, confidence = matcher.match(self.scope.render(5000, 5000, 0, 50))
+        assert confidence < alignment.MIN_CONFIDENCE, 'template matched without a mark'
+
+    def test_locator_fallback(self):
+        path = os.path.join(self.dir, 'templates', 'KL_Chip.tif')
+        cx, cy = self.mark_pixel(0, 0)
+        model = FakeModel([cy - 50, cx - 50, cy + 50, cx + 50])
+        locator = alignment.MarkLocator(model_loader=lambda: model, template_path=path)
+        # No template yet, Mask R-CNN finds the mark and a template is saved
+        center, r = locator.locate(self.scope.render(0, 0, 0, 50))
+        assert r['method'] == 'maskrcnn' and model.calls == 1, 'fallback error'
+        assert os.path.isfile(path), 'template not saved'
+        # The template is used from then on
+        locator = alignment.MarkLocator(model_loader=lambda: model, template_path=path)
+        center, r = locator.locate(self.scope.render(30, -20, 0, 50))
+        assert r['method'] == 'template' and model.calls == 1, 'template not used'
+
+    def test_template_min_score(self):
+        path = os.path.join(self.dir, 'templates', 'KL_Chip.tif')
+        cx, cy = self.mark_pixel(0, 0)
+        mark = [cy - 50, cx - 50, cy + 50, cx + 50]
+        debris = [100, 100, 200, 200]
+        # A doubtful detection is used for this frame but not learned
+        locator = alignment.MarkLocator(FakeModel(debris, scores=[0.7]), template_path=path)
+        center, r = locator.locate(self.scope.render(0, 0, 0, 50))
+        assert r['method'] == 'maskrcnn' and center[0] == 150, 'detection not used'
+        assert locator.matcher is None and not os.path.isfile(path), 'low score template saved'
+        # The template is cut from the best mark, not the first one
+        locator = alignment.MarkLocator(FakeModel(debris, mark, scores=[0.9, 0.99]),
+                                        template_path=path)
+        locator.locate(self.scope.render(0, 0, 0, 50))
+        center, confidence = locator.matcher.match(self.scope.render(30, -20, 0, 50))
+        expected = self.mark_pixel(30, -20)
+        assert np.hypot(center[0] - expected[0], center[1] - expected[1]) < 3, 'template not of the best mark'
+
+    def align(self, scope, locator=None, batch=False, camera_profile='full'):
+        ''' Aligns the chip on scope from an estimate 40um off the first mark '''
+        sc_utils.use_simulated_hardware(scope)
+        try:
+            if locator is None:
+                locator = alignment.MarkLocator()
+                locator.matcher = alignment.TemplateMatcher.from_frame(
+                    self.scope.render(0, 0, 0, 50), self.mark_pixel(0, 0))
+            estimate = pos.StagePosition(x=40.0, y=-25.0, z=0.0)
+            return alignment.align_chip(scope.stage(), estimate, scope.chip, locator, 50,
+                                        scope.pixel_size, *scope.sensor_size, batch=batch,
+                                        camera_profile=camera_profile)
+        finally:
+            sc_utils.simulated_scope = None
+
+    def test_align_chip(self):
+        scope = simulation.SimulatedScope(rotation=0.1)
+        corners, pose, (frames, fields) = self.align(scope)
+        # The far corner fixes the rotation, the middle corner is not visited
+        assert len(fields) == 2, 'alignment visited too many fields'
+        assert abs(np.degrees(pose.angle) - 0.1) < 0.005, 'chip rotation error'
+        for corner, (x, y) in zip(corners, scope.marks()[:3]):
+            assert np.hypot(corner.x - x, corner.y - y) < 3, 'chip corner error'
+
+    def test_align_chip_batch(self):
+        scope = simulation.SimulatedScope(rotation=0.1)
+        matcher = alignment.TemplateMatcher.from_frame(
+            self.scope.render(0, 0, 0, 50), self.mark_pixel(0, 0))
+        model = BatchModel(matcher, alignment.BATCH_SIZE)
+        locator = alignment.MarkLocator(model, learn=False)
+        corners, pose, (frames, fields) = self.align(scope, locator, batch=True)
+        # Both fields are found by one detect() call
+        assert model.batches == [2] and len(fields) == 2, 'fields not batched'
+        assert abs(np.degrees(pose.angle) - 0.1) < 0.005, 'batched chip rotation error'
+        for corner, (x, y) in zip(corners, scope.marks()[:3]):
+            assert np.hypot(corner.x - x, corner.y - y) < 3, 'batched chip corner error'
+
+    def test_align_chip_binned(self):
+        scope = simulation.SimulatedScope(rotation=0.1)
+        # The template is cut from a full resolution frame
+        corners, pose, (frames, fields) = self.align(scope, camera_profile='bin2')
+        assert frames[0].shape == scope.sensor_size[::-1], 'binned frame not scaled up'
+        assert abs(np.degrees(pose.angle) - 0.1) < 0.01, 'binned chip rotation error'
+        for corner, (x, y) in zip(corners, scope.marks()[:3]):
+            assert np.hypot(corner.x - x, corner.y - y) < 3, 'binned chip corner error'
+
+    def test_align_chip_one_field(self):
+        chip = dict(self.scope.chip, alignment_marks=[[0, 0], [400, 300], [-400, -300]])
+        scope = simulation.SimulatedScope(chip=chip, rotation=-0.2)
+        corners, pose, (frames, fields) = self.align(scope)
+        assert len(fields) == 1, 'marks in one field not used together'
+        assert abs(np.degrees(pose.angle) + 0.2) < 0.05, 'chip rotation error'
+        assert pose.residual < 2, 'chip pose residual error'
+
+
+if __name__ == '__main__':
+    unittest.main()
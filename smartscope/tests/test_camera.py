@@ -0,0 +1,71 @@
+import unittest
+from smartscope.source import sc_utils
+from smartscope.source import simulation
+
+
+class CountingCamera(simulation.SimulatedCamera):
+    ''' Simulated camera that counts the parameters written to it '''
+    def __init__(self, scope):
+        super().__init__(scope)
+        self.__dict__['writes'] = []
+
+    def __setattr__(self, name, value):
+        if name in sc_utils.CAMERA_SETTINGS or name in ('roi', 'binning'):
+            self.__dict__.setdefault('writes', []).append(name)
+        object.__setattr__(self, name, value)
+
+
+class TestCameraProfiles(unittest.TestCase):
+
+    def setUp(self):
+        self.scope = sc_utils.use_simulated_hardware(simulation.SimulatedScope())
+        self.scope.camera = lambda: CountingCamera(self.scope)
+
+    def tearDown(self):
+        sc_utils.close_camera_session()
+        sc_utils.simulated_scope = None
+
+    def test_profile_shapes(self):
+        cam = sc_utils.open_camera_session()
+        width, height = self.scope.sensor_size
+        expected = {'full': (width, height), 'center': (1024, 1024),
+                    'bin2': (width // 2, height // 2), 'bin4': (width // 4, height // 4)}
+        for profile, shape in expected.items():
+            frame = sc_utils.get_frame(50, profile)
+            assert cam.shape == shape, 'camera shape error'
+            assert frame.shape == shape[::-1], 'frame shape error'
+            assert sc_utils.profile_field(self.scope.sensor_size, profile) == (
+                shape if profile == 'center' else (width, height)), 'field size error'
+            assert sc_utils.to_sensor_pixels(frame, profile).shape == (
+                sc_utils.profile_field(self.scope.sensor_size, profile)[::-1]), 'upscale error'
+
+    def test_only_changes_are_written(self):
+        cam = sc_utils.open_camera_session()
+        assert sorted(cam.writes) == sorted(list(sc_utils.CAMERA_SETTINGS) + ['binning', 'roi'])
+        cam.writes = []
+        assert sc_utils.start_cam() is cam and cam.writes == [], 'same profile written again'
+        sc_utils.set_camera_profile(cam, 'bin2')
+        assert cam.writes == ['binning'], 'unchanged parameters written'
+        cam.writes = []
+        sc_utils.set_camera_profile(cam, 'center')
+        assert sorted(cam.writes) == ['binning', 'roi']
+        # A new camera starts without cached parameters
+        sc_utils.close_camera_session()
+        cam = sc_utils.start_cam('center')
+        assert len(cam.writes) == len(sc_utils.CAMERA_SETTINGS) + 2, 'stale camera parameters'
+        sc_utils.close_cam(cam)
+        with self.assertRaises(ValueError):
+            sc_utils.start_cam('bin3')
+
+    def test_readout_time(self):
+        cam = sc_utils.open_camera_session()
+        times = {}
+        for profile in ['full', 'bin2', 'bin4']:
+            start = self.scope.clock
+            sc_utils.get_live_frame(cam, 1, profile)
+            times[profile] = self.scope.clock - start
+        assert times['bin2'] < times['full'] / 2 and times['bin4'] < times['bin2'], 'readout time'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from smartscope.source import drift
+from smartscope.source import position as pos
+from smartscope.source import sc_utils
+from smartscope.source import simulation
+
+
+class TestDrift(unittest.TestCase):
+
+    def setUp(self):
+        self.scope = sc_utils.use_simulated_hardware(simulation.SimulatedScope())
+        self.mmc = self.scope.stage()
+        self.dir = tempfile.mkdtemp()
+        self.t00 = os.path.join(self.dir, 't00')
+        self.t01 = os.path.join(self.dir, 't01')
+        os.makedirs(self.t00)
+        # Reference fields at the first three marks, as taken during alignment
+        self.marks = self.scope.marks()[:3]
+        positions = [pos.StagePosition(x=x + 40, y=y - 25, z=0.0) for x, y in self.marks]
+        frames = [self.scope.render(p.x, p.y, 0, 50) for p in positions]
+        drift.save_references(frames, positions, self.t00)
+        corners = pos.PositionList(positions=[pos.StagePosition(x=x, y=y, z=0.0) for x, y in self.marks])
+        corners.save('corners_pl', self.t00)
+        corners.save('focused_pl', self.t00)
+
+    def tearDown(self):
+        sc_utils.simulated_scope = None
+        shutil.rmtree(self.dir)
+
+    def test_estimate_drift(self):
+        self.scope.origin = (12.3, -7.8)
+        transform = drift.estimate_drift(self.mmc, drift.load_references(self.t00), 50,
+                                         self.scope.pixel_size)
+        assert abs(transform.tx - 12.3) < 0.5 and abs(transform.ty + 7.8) < 0.5, 'drift error'
+        assert abs(transform.angle) < 1e-4, 'drift rotation error'
+
+    def test_correct_saved_positions(self):
+        self.scope.origin = (-20.0, 15.0)
+        positions_dir = drift.correct_saved_positions(self.mmc, self.t00, self.t01, 50,
+                                                      self.scope.pixel_size)
+        assert positions_dir == self.t01, 'corrected positions not used'
+        corners = pos.load('corners_pl', self.t01)
+        for p, (x, y) in zip(corners, self.scope.marks()[:3]):
+            assert np.hypot(p.x - x, p.y - y) < 0.5, 'corrected corner error'
+        # A chip that is no longer under the reference fields keeps its saved positions
+        self.scope.origin = (1e6, 1e6)
+        shutil.rmtree(self.t01)
+        positions_dir = drift.correct_saved_positions(self.mmc, self.t00, self.t01, 50,
+                                                      self.scope.pixel_size)
+        assert positions_dir == self.t00, 'unmatched drift used'
+
+    def save_profile_references(self, profile):
+        ''' References taken like alignment.align_chip() takes them '''
+        positions = pos.load(drift.REFERENCE_PL, self.t00)
+        frames = []
+        for p in positions:
+            p.goto(self.mmc)
+            frame = sc_utils.get_frame(50, profile)
+            frames.append(sc_utils.to_sensor_pixels(frame, profile))
+        drift.save_references(frames, positions, self.t00, profile)
+
+    def test_camera_profiles(self):
+        # The center field is smaller, so its drift is less exact
+        for profile in ['center', 'bin2']:
+            self.scope.origin = (0.0, 0.0)
+            self.save_profile_references(profile)
+            self.scope.origin = (-20.0, 15.0)
+            shutil.rmtree(self.t01, ignore_errors=True)
+            positions_dir = drift.correct_saved_positions(self.mmc, self.t00, self.t01, 50,
+                                                          self.scope.pixel_size)
+            assert positions_dir == self.t01, profile + ' drift not corrected'
+            corners = pos.load('corners_pl', self.t01)
+            for p, (x, y) in zip(corners, self.scope.marks()[:3]):
+                assert np.hypot(p.x - x, p.y - y) < 1.0, profile + ' corrected corner error'
+
+    def test_profile_mismatch(self):
+        # Center references with the profile lost fall back to the saved positions
+        self.save_profile_references('center')
+        os.remove(os.path.join(self.t00, drift.REFERENCE_INFO))
+        positions_dir = drift.correct_saved_positions(self.mmc, self.t00, self.t01, 50,
+                                                      self.scope.pixel_size)
+        assert positions_dir == self.t00, 'mismatched references used'
+
+
+if __name__ == '__main__':
+    unittest.main()
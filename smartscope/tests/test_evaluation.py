@@ -0,0 +1,67 @@
+import unittest
+import numpy as np
+from smartscope.source import evaluation
+from smartscope.tests.test_training_pipeline import RectangleDataset, TinyConfig
+
+
+class ShiftedDetector:
+    ''' Detects the bright rectangle of an image shifted by a few pixels '''
+
+    def __init__(self, config, shift):
+        self.config = config
+        self.shift = shift
+        self.calls = 0
+
+    def detect(self, images):
+        assert len(images) == self.config.BATCH_SIZE, 'batch size error'
+        results = []
+        for image in images:
+            # The rectangles are the only bright pixels
+            ys, xs = np.nonzero(image[:, :, 0] > 100)
+            boxes = np.array([[ys.min(), xs.min(), ys.max() + 1, xs.max() + 1]]) + self.shift
+            results.append({'rois': boxes, 'class_ids': np.array([1]), 'scores': np.array([0.9]),
+                            'masks': None})
+        self.calls += 1
+        return results
+
+
+class TestEvaluation(unittest.TestCase):
+
+    def setUp(self):
+        self.config = TinyConfig()
+        self.config.DETECTION_ONLY = True
+        self.dataset = RectangleDataset()
+        self.dataset.load_rectangles(6)
+        # One box an image, so the detector can find it
+        for info in self.dataset.image_info[:-1]:
+            info['boxes'] = info['boxes'][:1]
+        self.dataset.prepare()
+
+    def test_score_image(self):
+        gt = np.array([[10, 10, 50, 50], [60, 60, 80, 80]])
+        pred = np.array([[12, 10, 52, 50]])
+        score = evaluation.score_image(gt, np.array([1, 1]), None, pred, np.array([1]),
+                                       np.array([0.9]), None, [0.5, 0.95])
+        assert score['ap'] == [0.5, 0.0], 'AP error'
+        assert score['center_errors'] == [2.0] and score['missed'] == 1, 'center error'
+
+    def test_evaluate(self):
+        model = ShiftedDetector(self.config, np.array([0, 2, 0, 2]))
+        scores = evaluation.evaluate(model, self.dataset, workers=0)
+        # The image without instances is skipped, 5 images in batches of 2
+        assert len(scores) == 5 and model.calls == 3, 'batch error'
+        assert np.allclose([s['center_errors'] for s in scores], 2.0), 'center error'
+        parallel = evaluation.evaluate(model, self.dataset, workers=2)
+        for a, b in zip(scores, parallel):
+            a.pop('latency'), b.pop('latency')
+            assert a == b, 'workers change the scores'
+        for s in scores:
+            s['latency'] = 0.01
+        summary = evaluation.summarize(scores, frame_to_pixel_ratio=0.5)
+        scale = scores[0]['scale']
+        assert np.isclose(summary['error_um'], 2.0 / scale * 0.5), 'error in um'
+        assert summary['missed'] == 0 and summary['mAP@0.5'] == 1.0, 'summary error'
+
+
+if __name__ == '__main__':
+    unittest.main()
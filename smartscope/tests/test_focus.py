@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from smartscope.source import defocus
+from smartscope.source import focus
+from smartscope.source import position as pos
+from smartscope.source import sc_utils
+from smartscope.source import simulation
+
+
+class ContrastModel:
+    ''' Focus model stand in, the score falls as the frame contrast rises '''
+    def score(self, image):
+        return -float(np.std(image))
+
+
+class LevelModel:
+    ''' Focus model stand in with 11 defocus levels, the level rises as 
+    the frame contrast falls. Like the real model it can not tell the 
+    side of focus.
+    '''
+    def __init__(self, in_focus_contrast):
+        self.in_focus_contrast = in_focus_contrast
+        self.calls = 0
+
+    def predict(self, image):
+        self.calls += 1
+        contrast = np.std(image) / np.mean(image)
+        level = 10 * (1 - min(1.0, contrast / self.in_focus_contrast)) ** 0.5
+        probabilities = np.exp(-0.5 * (np.arange(11) - level) ** 2)
+        return type('Prediction', (), {'probabilities': probabilities / probabilities.sum()})
+
+
+class TestSweepFocus(unittest.TestCase):
+
+    def setUp(self):
+        self.scope = sc_utils.use_simulated_hardware(
+            simulation.SimulatedScope(focus_z=7.3, settle_ms=50, sensor_size=(512, 512)))
+        self.mmc = sc_utils.get_stage_controller()
+
+    def tearDown(self):
+        sc_utils.simulated_scope = None
+
+    def test_frame_z(self):
+        cam = sc_utils.start_cam()
+        frames, z = focus.sweep_frames(self.mmc, cam, 20.0, -20.0, 10, 2.0)
+        sc_utils.close_cam(cam)
+        # Frames are delta_z apart and the last one is at the end of the sweep
+        assert np.allclose(np.diff(z)[:-1], -2.0), 'frame z spacing error'
+        assert z[0] < 20.0 and np.isclose(z[-1], -20.0), 'sweep range error'
+        assert len(frames) == len(z) and self.scope.z == -20.0, 'sweep end error'
+        # The drive speed is restored
+        assert sc_utils.get_focus_speed(self.mmc) == 0, 'focus speed not restored'
+
+    def test_sweep_matches_steps(self):
+        model = ContrastModel()
+        start = self.scope.clock
+        steps = focus.focus_point(self.mmc, model, delta_z=2, total_z=60, exposure=10)
+        step_time = self.scope.clock - start
+        self.scope.z = 0.0
+        start = self.scope.clock
+        sweep = focus.focus_point(self.mmc, model, delta_z=2, total_z=60, exposure=10,
+                                  sweep=True)
+        sweep_time = self.scope.clock - start
+        assert abs(steps - 7.3) < 1.5 and abs(sweep - 7.3) < 1.5, 'focus error'
+        assert sweep_time < step_time / 2, 'sweep is not faster'
+
+    def test_sweep_points(self):
+        # Focus rises 2um from point to point
+        self.scope.tilt = (0.002, 0.0)
+        points = pos.PositionList(positions=[pos.StagePosition(x=1000.0 * i, y=0.0)
+                                             for i in range(5)])
+        sweeps = []
+        messages = []
+        sweep_frames, print_info = focus.sweep_frames, sc_utils.print_info
+
+        def record_sweep(mmc, cam, start_z, end_z, *args):
+            sweeps.append((start_z, end_z))
+            return sweep_frames(mmc, cam, start_z, end_z, *args)
+        focus.sweep_frames = record_sweep
+        sc_utils.print_info = messages.append
+        try:
+            focused = focus.focus_from_last_point(points, self.mmc, None, delta_z=2, total_z=60,
+                                                  exposure=10, focus_model=ContrastModel(),
+                                                  sweep=True)
+        finally:
+            focus.sweep_frames, sc_utils.print_info = sweep_frames, print_info
+        for p in focused:
+            assert abs(p.z - self.scope.focus_z_at(p.x, p.y)) < 1.5, 'focus error'
+        # Every point after the second starts above, where the focus moved to
+        assert all(start > end for start, end in sweeps[2:]), 'sweep direction error'
+        assert len(messages) == 4 and all(m.endswith('Good focus') for m in messages), \
+            'focus quality not logged'
+
+
+class TestDefocus(unittest.TestCase):
+
+    def setUp(self):
+        self.scope = sc_utils.use_simulated_hardware(
+            simulation.SimulatedScope(focus_z=4.0, tilt=(0.0005, 0.0), sensor_size=(512, 512)))
+        self.mmc = sc_utils.get_stage_controller()
+        frame = self.scope.render(0, 0, 4.0, 10)
+        self.model = LevelModel(np.std(frame) / np.mean(frame))
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        sc_utils.simulated_scope = None
+        shutil.rmtree(self.dir)
+
+    def test_jump_focus(self):
+        # The z of the calibration points only has to be close to focus
+        positions = pos.PositionList(positions=[pos.StagePosition(x=0, y=0, z=3.0),
+                                                pos.StagePosition(x=2000, y=0, z=6.0)])
+        calibration = defocus.calibrate(self.mmc, self.model, positions, total_z=40, delta_z=2,
+                                        exposure=10)
+        path = os.path.join(self.dir, 'KL_Chip.json')
+        calibration.save(path)
+        calibration = defocus.DefocusCalibration.load(path)
+        assert calibration.camera_profile == 'full', 'camera profile not saved'
+        # Distances are from the best frame of each point
+        assert calibration.distances[0] <= -18 and calibration.distances[-1] >= 18, 'calibration range'
+        assert np.argmin(calibration.probabilities.dot(np.arange(11))) == list(
+            calibration.distances).index(0), 'calibration focus error'
+
+        cam = sc_utils.start_cam()
+        x = 4000.0
+        best = self.scope.focus_z_at(x, 0)
+        for start in [best - 12, best - 3, best + 8]:
+            pos.set_pos(self.mmc, x=x, y=0, z=start)
+            self.model.calls = 0
+            z, in_focus = defocus.jump_focus(self.mmc, cam, self.model, calibration,
+                                             exposure=10)
+            assert in_focus and abs(z - best) < defocus.TOLERANCE, 'defocus estimate error'
+            assert self.model.calls <= 4, 'too many frames'
+        sc_utils.close_cam(cam)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import unittest
+import tifffile as tif
+from smartscope.source import focus_check
+from smartscope.source import position as pos
+from smartscope.source import sc_utils
+from smartscope.source import simulation
+
+
+class TestFocusCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # The chip rises to the right, the focus surface is flat
+        self.scope = sc_utils.use_simulated_hardware(simulation.SimulatedScope(
+            sensor_size=(512, 512), tilt=(0.003, 0.0), depth_of_field=3.0))
+        self.mmc = sc_utils.get_stage_controller()
+        self.positions = pos.PositionList(positions=[
+            pos.StagePosition(x=300.0 + 400 * i, y=-300.0 - 300 * j, z=0.0,
+                              name='_ST_{:03d}_APT_{:03d}_'.format(i, j))
+            for j in range(2) for i in range(12)])
+
+    def tearDown(self):
+        sc_utils.simulated_scope = None
+        shutil.rmtree(self.dir)
+
+    def image(self, name, checker=None):
+        self.positions.image(self.mmc, self.dir, name, exposure=10,
+                             output_pixels=[2688, 2200], focus_check=checker)
+        folder = os.path.join(self.dir, name)
+        # Sharpness of each position's frame, by its position name
+        return {f[len(name):-len('201901011200.tif')]: sc_utils.sharpness(
+            tif.imread(os.path.join(folder, f))) for f in sorted(os.listdir(folder))}
+
+    def test_corrects_focus(self):
+        plain = self.image('plain')
+        checker = focus_check.FocusCheck()
+        checked = self.image('checked', checker)
+        checker.close()
+        assert len(checked) == len(self.positions), 'replaced frames not removed'
+        # The far end of the chip is out of focus on the surface alone
+        far = [p for p in plain if p.startswith('_ST_011_')]
+        assert all(checked[f] > 2 * plain[f] for f in far), 'far frames not refocused'
+        assert min(checked.values()) > 0.5 * max(checked.values()), 'frame left out of focus'
+        # The second row starts from the corrections of the first
+        rows = [sum(1 for c in checker.corrections if c[1] == y) for y in [-300.0, -600.0]]
+        assert 0 < rows[1] < rows[0] / 2, 'corrections not used'
+        assert checker.checked == len(self.positions)
+        x, y, dz = checker.corrections[-1]
+        true_dz = self.scope.focus_z_at(x, y) - 0.0
+        assert abs(dz - true_dz) <= checker.step, 'correction error'
+        # The next channel starts from the corrected z
+        second = focus_check.FocusCheck()
+        second.corrections = list(checker.corrections)
+        self.image('second', second)
+        second.close()
+        assert second.searched < checker.searched, 'corrections not kept between channels'
+
+    def test_blurry_field(self):
+        # The chip is in focus, but one field is empty and never sharp
+        self.scope.tilt = (0.0, 0.0)
+        render = self.scope.render
+
+        def empty_field(x, y, z, exposure, **args):
+            frame = render(x, y, z, exposure, **args)
+            if (x, y) == (2300.0, -300.0):
+                frame = self.scope.random.normal(2500, 40, frame.shape).astype(frame.dtype)
+            return frame
+        self.scope.render = empty_field
+        checker = focus_check.FocusCheck()
+        checked = self.image('checked', checker)
+        checker.close()
+        assert checker.searched >= 1, 'empty field not searched'
+        assert checker.corrections == [], 'empty field kept as a correction'
+        blurry = checked.pop('_ST_005_APT_000_')
+        assert min(checked.values()) > 10 * blurry, 'positions near the empty field moved'
+
+    def test_search(self):
+        checker = focus_check.FocusCheck(step=2.0, steps=3)
+        frames = []
+
+        def capture(z):
+            frames.append(z)
+            return self.scope.render(300.0, -300.0, z, 10)
+        # Focus is 4.6um above
+        self.scope.tilt = (0.0, 0.0)
+        self.scope.focus_z = 4.6
+        frame = self.scope.render(300.0, -300.0, 0.0, 10)
+        score, best, z = checker.search(frame, 0.0, checker.sharpness(frame), capture)
+        assert z == 4.0 and frames == [-2.0, 2.0, 4.0, 6.0], 'search did not climb to focus'
+        assert score > checker.sharpness(frame), 'sharper frame not kept'
+        # In focus already, only the two first steps are taken
+        frames = []
+        self.scope.focus_z = 0.0
+        frame = self.scope.render(300.0, -300.0, 0.0, 10)
+        _, _, z = checker.search(frame, 0.0, checker.sharpness(frame), capture)
+        assert z == 0.0 and len(frames) == 2, 'in focus frame searched'
+
+    def test_threshold(self):
+        checker = focus_check.FocusCheck(relative=0.5)
+        checker.start()
+        # The first frame of a channel passes
+        assert checker.passes(0.0) and checker.limit() is None
+        # A few blurry frames do not lower the limit
+        checker.scores = [2.0, 0.1, 2.0, 2.0, 0.2, 2.0]
+        assert checker.limit() == 1.0 and not checker.passes(0.9), 'relative limit error'
+        assert focus_check.FocusCheck(threshold=0.2).passes(0.3), 'fixed limit error'
+        checker.close()
+
+    def test_correction(self):
+        checker = focus_check.FocusCheck(radius=100.0)
+        p = pos.StagePosition(x=0.0, y=0.0, z=10.0)
+        assert checker.z_at(p) == 10.0, 'correction without searches'
+        checker.corrections = [(0.0, 0.0, 4.0)]
+        assert 3.5 < checker.correction(0.0, 0.0) < 4.0, 'correction at a search error'
+        assert abs(checker.correction(1000.0, 0.0)) < 1e-6, 'correction does not fade out'
+        assert checker.z_at(p) > 13.5
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import scipy.ndimage
+import tifffile as tif
+from smartscope.source import focus_qc
+from smartscope.source import progress as prog
+from smartscope.source import sc_utils
+
+
+def chip_image(rng, blur):
+    image = scipy.ndimage.gaussian_filter(rng.uniform(0, 65535, (220, 268)), blur)
+    return sc_utils.bytescale(image, current_min=None).astype(np.uint16)
+
+
+class CountingProgress(prog.Progress):
+    ''' Records the number of images each run had to read '''
+    def phase(self, name, total=0):
+        self.total = total
+        super().phase(name, total)
+
+
+class TestFocusQC(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.rng = np.random.RandomState(0)
+        # Two timepoints of a chip, 3 streets x 2 apartments, one blurred position
+        for time_point in ['t00', 't01']:
+            channel_dir = os.path.join(self.dir, 'chip', '1', time_point, 'BF')
+            os.makedirs(channel_dir)
+            for street in [0, 4, 8]:
+                for apartment in [0, 5]:
+                    blur = 6 if (street, apartment) == (4, 5) else 1
+                    self.write(time_point, street, apartment, chip_image(self.rng, blur))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, time_point, street, apartment, image, stamp='201901011200'):
+        name = 'BF_ST_{:03d}_APT_{:03d}_{}.tif'.format(street, apartment, stamp)
+        path = os.path.join(self.dir, 'chip', '1', time_point, 'BF', name)
+        tif.imwrite(path, image)
+        return path
+
+    def run_qc(self, workers=0):
+        progress = CountingProgress()
+        images = focus_qc.find_images([self.dir])
+        scored = focus_qc.score_images(images, focus_qc.metric_keys(['sharpness']),
+                                       workers=workers, progress=progress)
+        return scored, progress.total
+
+    def test_sharpness(self):
+        image = chip_image(self.rng, 1)
+        sharp = sc_utils.sharpness(image)
+        assert sharp > sc_utils.sharpness(chip_image(self.rng, 6)), 'blur not detected'
+        assert np.isclose(sharp, sc_utils.sharpness(image // 2), rtol=0.01), 'exposure changed sharpness'
+        assert sc_utils.decimate(np.ones((10, 9)), 4).shape == (2, 2), 'decimate shape error'
+        assert sc_utils.sharpness(np.zeros((100, 100))) == 0.0, 'blank frame error'
+
+    def test_find_images(self):
+        self.write('t00', 0, 0, chip_image(self.rng, 1), stamp='201901011300')
+        images = focus_qc.find_images([os.path.join(self.dir, 'chip')])
+        assert [os.path.basename(d) for d in images] == ['t00', 't01'], 'timepoint error'
+        t00 = list(images.values())[0]
+        assert len(t00) == 6, 'position count error'
+        assert t00[0]['time'] == '201901011300', 'latest image not kept'
+        assert (t00[1]['street'], t00[1]['apartment'], t00[1]['channel']) == (0, 5, 'BF')
+        assert focus_qc.parse_image_name('BF_ST_000_APT_005_201901011200.jpg') is None
+
+    def test_score_and_cache(self):
+        scored, total = self.run_qc(workers=2)
+        assert total == 12, 'not every image scored'
+        rows = list(scored.values())[0]
+        worst = min(rows, key=lambda r: r['sharpness'])
+        assert (worst['street'], worst['apartment']) == (4, 5), 'blurred position not found'
+        # Unchanged files are not read again
+        again, total = self.run_qc()
+        assert total == 0, 'cached images scored again'
+        assert list(again.values())[0] == rows, 'cached scores changed'
+        # A touched file is read, but its scores are found by its hash
+        path = rows[0]['path']
+        os.utime(path, (0, 0))
+        _, total = self.run_qc()
+        assert total == 1, 'touched file not checked'
+        # A changed file is scored again
+        self.write('t01', 4, 5, chip_image(self.rng, 1))
+        scored, total = self.run_qc()
+        assert total == 1, 'changed file not scored'
+        fixed = [r for r in list(scored.values())[1] if (r['street'], r['apartment']) == (4, 5)]
+        assert fixed[0]['sharpness'] > worst['sharpness'] * 2, 'changed file kept old score'
+
+    def test_reports(self):
+        scored, _ = self.run_qc()
+        written = focus_qc.write_reports(scored, ['sharpness'])
+        t00 = list(scored)[0]
+        assert os.path.join(t00, 'focus_qc.csv') in written
+        assert os.path.isfile(os.path.join(t00, 'focus_qc_BF_sharpness.png')), 'heatmap not written'
+        with open(os.path.join(t00, 'focus_qc.csv')) as f:
+            lines = f.read().splitlines()
+        assert lines[0] == 'channel,street,apartment,file,sharpness', 'table header error'
+        assert len(lines) == 7, 'table row count error'
+        streets, apartments, grid = focus_qc.chip_grid(scored[t00], 'sharpness')
+        assert streets == [0, 4, 8] and apartments == [0, 5], 'grid axes error'
+        assert np.argmin(grid) == 4, 'grid layout error'
+
+    def test_miq_keys(self):
+        with self.assertRaises(ValueError):
+            focus_qc.metric_keys(['miq'])
+        with self.assertRaises(ValueError):
+            focus_qc.metric_keys(['contrast'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+import unittest
+from smartscope.source import frozen
+
+
+class TestFrozen(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def touch(self, name):
+        path = os.path.join(self.dir, name)
+        open(path, 'w').close()
+        return path
+
+    def test_frozen_path(self):
+        assert frozen.frozen_path('m/alignment_30.h5', 'default', 'detection') == \
+            'm/alignment_30.default.detection.pb', 'h5 frozen path error'
+        assert frozen.frozen_path('m/model.ckpt-1000042', 'frozen') == \
+            'm/model.ckpt-1000042.frozen.pb', 'checkpoint frozen path error'
+
+    def test_read_info(self):
+        weights = self.touch('alignment_30.h5')
+        path = frozen.frozen_path(weights, 'default')
+        assert frozen.read_info(path, weights) is None, 'missing frozen model error'
+        self.touch(os.path.basename(path))
+        frozen.write_info(path, weights, inputs=['input_image'])
+        assert frozen.read_info(path, weights)['inputs'] == ['input_image'], 'info error'
+        # Retrained weights make the frozen model stale
+        os.utime(weights, (0, 0))
+        assert frozen.read_info(path, weights) is None, 'stale frozen model used'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+import smartscope.source.sc_utils as sc_utils
+
+
+class FakeController:
+    ''' Records the calls that would be sent to Micro-manager '''
+    def __init__(self):
+        self.properties = {('Thorlabs DC4100', 'Port'): 'COM3'}
+        self.calls = []
+
+    def getProperty(self, device, prop):
+        return self.properties.get((device, prop), 0)
+
+    def setProperty(self, device, prop, value):
+        self.calls.append(('setProperty', device, prop, value))
+        self.properties[(device, prop)] = value
+
+    def setSerialPortCommand(self, port, command, term):
+        self.calls.append(('setSerialPortCommand', port, command))
+
+
+class TestIllumination(unittest.TestCase):
+
+    def setUp(self):
+        self.mmc = FakeController()
+        self.illumination = sc_utils.IlluminationController(self.mmc)
+        self.bff = {'shutter': 0, 1: 0, 2: 0, 3: 50, 4: 0}
+        self.gfp = {'shutter': 1, 1: 0, 2: 50, 3: 0, 4: 0}
+
+    def test_only_changes_are_sent(self):
+        self.illumination.set(self.bff)
+        serial = [c for c in self.mmc.calls if c[0] == 'setSerialPortCommand']
+        assert len(serial) == 1, 'LED on/off commands should be batched'
+        assert serial[0][2] == 'O 2 1\nO 0 0\nO 1 0\nO 3 0\nE?\n'
+
+        self.mmc.calls = []
+        assert self.illumination.set(self.bff) == 0
+        assert self.mmc.calls == []
+
+        self.illumination.set(self.gfp)
+        assert ('setProperty', 'IL-Turret', 'State', 1) in self.mmc.calls
+        serial = [c for c in self.mmc.calls if c[0] == 'setSerialPortCommand']
+        assert serial[0][2] == 'O 1 1\nO 2 0\nE?\n'
+
+    def test_verify(self):
+        self.illumination.set(self.bff)
+        assert self.illumination.verify() is True
+        self.mmc.properties[('Thorlabs DC4100', 'Percental Brightness LED-3')] = 10
+        assert self.illumination.verify() is False
+        self.mmc.calls = []
+        self.illumination.set(self.bff)
+        assert ('setProperty', 'Thorlabs DC4100', 'Percental Brightness LED-3', 50) in self.mmc.calls
+
+    def test_unbatched(self):
+        changes = []
+        original = sc_utils.change_LED_values
+        sc_utils.change_LED_values = lambda controller, LED, value: changes.append((LED, value))
+        sc_utils.BATCH_LED_COMMANDS = False
+        try:
+            self.illumination.set(self.bff)
+            assert sorted(changes) == [(1, 0), (2, 0), (3, 50), (4, 0)], 'LED not sent'
+            assert not [c for c in self.mmc.calls if c[0] == 'setSerialPortCommand'], \
+                'serial command sent directly'
+            changes[:] = []
+            self.illumination.set(self.gfp)
+            assert sorted(changes) == [(2, 50), (3, 0)], 'only changed LEDs should be sent'
+        finally:
+            sc_utils.change_LED_values = original
+            sc_utils.BATCH_LED_COMMANDS = True
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+import numpy as np
+from smartscope.source import inference
+
+
+def use_temp_authkey(test):
+    ''' Keeps the key file of a test out of the home folder '''
+    test.key_dir = tempfile.mkdtemp()
+    test.key_path = inference.AUTHKEY_PATH
+    test.key_env = os.environ.pop(inference.AUTHKEY_ENV, None)
+    inference.AUTHKEY_PATH = os.path.join(test.key_dir, 'inference.key')
+
+
+def restore_authkey(test):
+    inference.AUTHKEY_PATH = test.key_path
+    if test.key_env is not None:
+        os.environ[inference.AUTHKEY_ENV] = test.key_env
+    shutil.rmtree(test.key_dir)
+
+
+class FakeDetector:
+    def detect(self, images, verbose=0):
+        return [{'rois': np.array([[0, 0, image.shape[0], image.shape[1]]]),
+                 'scores': np.array([float(image.sum())])} for image in images]
+
+
+class FakeClassifier:
+    def score(self, image):
+        return float(image.mean())
+
+    def predict_patch_map(self, images):
+        return [image.shape for image in images]
+
+
+class TestInference(unittest.TestCase):
+
+    def setUp(self):
+        use_temp_authkey(self)
+        self.server = inference.InferenceServer(('localhost', 0))
+        self.server.alignment[('mark.h5', 'default', 1)] = FakeDetector()
+        self.server.focus['miq'] = FakeClassifier()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.client = inference.InferenceClient(self.server.address)
+
+    def tearDown(self):
+        self.client.shutdown()
+        self.thread.join(5)
+        restore_authkey(self)
+
+    def test_detect_and_score(self):
+        model = self.client.alignment_model('mark.h5')
+        frames = [np.full((220, 268, 3), 2, np.uint8), np.ones((110, 134, 3), np.uint8)]
+        results = model.detect(frames)
+        assert results[0]['scores'][0] == frames[0].sum(), 'frame not passed to the server'
+        assert list(results[1]['rois'][0]) == [0, 0, 110, 134], 'frame shape error'
+
+        focus = self.client.focus_model('miq')
+        frame = np.arange(2200 * 2688, dtype=np.uint16).reshape(2200, 2688)
+        assert focus.score(frame) == frame.mean(), 'focus score error'
+        assert self.client.ping()['requests'] == 5, 'request count error'
+
+    def test_patch_map(self):
+        focus = self.client.focus_model('miq')
+        frame = np.zeros((2200, 2688), np.uint16)
+        assert focus.predict_patch_map(frame) == [(2200, 2688)], 'single frame not sent'
+        assert focus.predict_patch_map([frame, frame]) == [(2200, 2688)] * 2, 'frames not sent'
+
+    def test_error(self):
+        with self.assertRaises(inference.InferenceError):
+            self.client.call('unknown')
+
+
+class TestAuthkey(unittest.TestCase):
+
+    def setUp(self):
+        use_temp_authkey(self)
+
+    def tearDown(self):
+        os.environ.pop(inference.AUTHKEY_ENV, None)
+        restore_authkey(self)
+
+    def test_random_key_file(self):
+        key = inference.get_authkey()
+        assert len(key) == 64 and key != inference.INSECURE_AUTHKEY, 'key not random'
+        assert inference.get_authkey() == key, 'key not kept'
+        if os.name != 'nt':
+            assert os.stat(inference.AUTHKEY_PATH).st_mode & 0o777 == 0o600, 'key readable by others'
+            os.chmod(inference.AUTHKEY_PATH, 0o644)
+            with self.assertRaises(inference.InferenceError):
+                inference.get_authkey()
+        os.environ[inference.AUTHKEY_ENV] = 'abc'
+        assert inference.get_authkey() == b'abc', 'environment key not used'
+
+    def test_default_key_refused(self):
+        with self.assertRaises(inference.InferenceError):
+            inference.InferenceServer(('localhost', 0), authkey=inference.INSECURE_AUTHKEY)
+        os.environ[inference.AUTHKEY_ENV] = 'smartscope'
+        with self.assertRaises(inference.InferenceError):
+            inference.InferenceServer(('localhost', 0))
+
+    def test_key_passed_to_server(self):
+        started = []
+        popen = subprocess.Popen
+        subprocess.Popen = lambda command, env, **args: started.append((command, env))
+        try:
+            inference.start_server(('localhost', 6150))
+        finally:
+            subprocess.Popen = popen
+        command, env = started[0]
+        key = inference.get_authkey().decode()
+        assert env[inference.AUTHKEY_ENV] == key, 'key not passed to the server'
+        assert key not in ' '.join(command), 'key on the command line'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+import yaml
+from smartscope.source import defocus
+from smartscope.source import jobs
+
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.spec = os.path.join(self.dir, 'job.yml')
+        shutil.copy(os.path.join(jobs.CONFIG_DIR, 'experiment_config.yml'), self.dir)
+        shutil.copy(os.path.join(jobs.CONFIG_DIR, 'led_intensities.yml'), self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, spec):
+        with open(self.spec, 'w') as f:
+            yaml.safe_dump(spec, f)
+
+    def test_load_job(self):
+        self.write({
+            'experiment_config': 'experiment_config.yml',
+            'led_intensities': 'led_intensities.yml',
+            'defaults': {'alignment_model': 'a.h5', 'focus_model': 'f.ckpt',
+                         'frame_to_pixel_ratio': 0.45, 'first_position': [-584.5, -35.4],
+                         'focus': {'step_size': 2}},
+            'chips': [{'chip': 'KL Chip', 'channels': {'BFF': 1, 'GFP': 10}},
+                      {'chip': 'ML Chip', 'focus': {'points': [2, 6]}}],
+        })
+        job = jobs.load_job(self.spec)
+        kl, ml = job['chips']
+        assert kl['config']['number_of_apartments'] == 34, 'chip config lookup error'
+        assert kl['focus']['step_size'] == 2, 'defaults merge error'
+        assert kl['focus']['range'] == 35, 'nested defaults merge error'
+        assert list(kl['channels']) == ['BFF', 'GFP'], 'chip channels error'
+        assert kl['led_intensities']['GFP']['shutter'] == 1, 'led intensities error'
+        assert ml['channels'] == {'BFF': 1}, 'default channels error'
+        assert ml['focus']['points'] == [4, 6], 'focus points must be at least 4'
+
+    def test_bad_spec(self):
+        self.write({'experiment_config': 'experiment_config.yml',
+                    'led_intensities': 'led_intensities.yml',
+                    'chips': [{'chip': 'KL Chip'}]})
+        with self.assertRaises(jobs.JobError):
+            jobs.load_job(self.spec)
+
+    def test_focus_calibration(self):
+        calibration_dir = defocus.CALIBRATION_DIR
+        defocus.CALIBRATION_DIR = self.dir
+        try:
+            chip_job = {'chip': 'KL Chip', 'focus_model': os.path.join('models', 'model.ckpt-1.index'),
+                        'focus': {'camera': 'center'}}
+            assert jobs.focus_calibration(chip_job) is None, 'missing calibration used'
+            calibration = defocus.DefocusCalibration([-2, 0, 2], [[0, 1], [1, 0], [0, 1]],
+                                                     'model.ckpt-1', 'center')
+            calibration.save(defocus.calibration_path('KL Chip'))
+            assert jobs.focus_calibration(chip_job).camera_profile == 'center', 'calibration not used'
+            # A calibration of another camera profile or focus model is not used
+            chip_job['focus']['camera'] = 'full'
+            assert jobs.focus_calibration(chip_job) is None, 'other camera profile used'
+            chip_job['focus']['camera'] = 'center'
+            chip_job['focus_model'] = os.path.join('models', 'model.ckpt-2')
+            assert jobs.focus_calibration(chip_job) is None, 'other focus model used'
+        finally:
+            defocus.CALIBRATION_DIR = calibration_dir
+
+
+if __name__ == '__main__':
+    unittest.main()
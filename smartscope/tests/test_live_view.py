@@ -0,0 +1,61 @@
+import time
+import unittest
+from smartscope.gui import live_view
+from smartscope.source import sc_utils
+from smartscope.source import simulation
+
+
+def make_frame(number):
+    return live_view.Frame(number, None, None, 0, 0)
+
+
+class TestFrameBuffer(unittest.TestCase):
+
+    def test_newest_frame_only(self):
+        buffer = live_view.FrameBuffer()
+        assert buffer.read() is None, 'FrameBuffer read() on empty buffer'
+        for i in range(1, 6):
+            buffer.write(make_frame(i))
+        assert buffer.read().number == 5, 'FrameBuffer should return the newest frame'
+        assert buffer.read() is None, 'FrameBuffer returned the same frame twice'
+        assert buffer.dropped == 4, 'FrameBuffer dropped count'
+
+    def test_reading_slot_is_not_overwritten(self):
+        buffer = live_view.FrameBuffer()
+        buffer.write(make_frame(1))
+        frame = buffer.read()
+        buffer.write(make_frame(2))
+        buffer.write(make_frame(3))
+        assert frame in buffer._slots, 'FrameBuffer overwrote the slot being displayed'
+        assert buffer.read().number == 3
+
+
+class TestLiveView(unittest.TestCase):
+
+    def setUp(self):
+        self.scope = sc_utils.use_simulated_hardware(simulation.SimulatedScope())
+
+    def tearDown(self):
+        sc_utils.simulated_scope = None
+
+    def test_full_resolution_snapshot(self):
+        width, height = self.scope.sensor_size
+        live = live_view.LiveView((width // 3, height // 3), profile='bin2').start()
+        try:
+            request = live.snapshot()
+            snapshot = request.result(timeout=5)
+            assert snapshot.shape == (height, width), 'snapshot is not a sensor frame'
+            # The live view goes back to its binned frames
+            after = live._count + 1
+            frame = None
+            while frame is None or frame.number <= after:
+                frame = live.latest() or frame
+                time.sleep(0.001)
+            assert frame.frame.shape == (height // 2, width // 2), 'live profile not restored'
+        finally:
+            live.stop()
+        assert live.error is None, 'live view error'
+
+
+if __name__ == '__main__':
+    unittest.main()
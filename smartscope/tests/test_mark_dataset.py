@@ -0,0 +1,97 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import skimage.io
+from smartscope.source.dataset import mark_cache
+from smartscope.source.dataset import mark_dataset
+
+
+def polygon(x, y, r):
+    return [{'x': x + r * np.cos(a), 'y': y + r * np.sin(a)} for a in np.linspace(0, 6, 7)]
+
+
+class TestMarkDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.dir, 'cache')
+        self.labels = os.path.join(self.dir, 'train.json')
+        annotations = []
+        for i in range(3):
+            name = 'mark_' + str(i) + '.png'
+            skimage.io.imsave(os.path.join(self.dir, name), np.zeros((60, 80), dtype=np.uint8),
+                              check_contrast=False)
+            marks = [{'geometry': polygon(20 + 10 * i, 30, 8)}, {'geometry': polygon(60, 20, 5 + i)}]
+            annotations.append({'External ID': name, 'Label': {'Mark': marks[:i + 1]}})
+        annotations.append({'External ID': 'none.png', 'Label': 'Skip'})
+        self.write(annotations)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, annotations):
+        self.annotations = annotations
+        with open(self.labels, 'w') as f:
+            json.dump(annotations, f)
+
+    def dataset(self, cache_dir=None):
+        dataset = mark_dataset.MarkDataset()
+        dataset.load_shapes('train', self.dir, self.labels, cache_dir)
+        dataset.prepare()
+        return dataset
+
+    def test_cached_masks(self):
+        expected = self.dataset()
+        cached = self.dataset(self.cache)
+        assert cached.mask_store.rasterized == 3, 'store not built'
+        assert len(cached.image_ids) == len(expected.image_ids) == 3, 'image count error'
+        for image_id in expected.image_ids:
+            a, b = expected.image_info[image_id], cached.image_info[image_id]
+            assert (a['height'], a['width']) == (b['height'], b['width']) == (60, 80), 'size error'
+            mask, class_ids = expected.load_mask(image_id)
+            cached_mask, cached_class_ids = cached.load_mask(image_id)
+            assert np.array_equal(mask, cached_mask), 'cached mask error'
+            assert np.array_equal(class_ids, cached_class_ids), 'class id error'
+        # The store on disk has every labeled image and its masks
+        store = mark_cache.MaskStore(*mark_cache.store_paths(self.labels, self.cache))
+        assert [e['id'] for e in store.entries] == ['mark_0.png', 'mark_1.png', 'mark_2.png'], \
+            'store entry error'
+        assert [len(e['instances']) for e in store.entries] == [1, 2, 2], 'store instance error'
+        assert np.array_equal(store.load_mask(2)[0], expected.load_mask(2)[0]), 'stored mask error'
+
+    def test_cached_matches_uncached(self):
+        # An annotation without marks and marks that cross the image edge
+        self.annotations[0]['Label']['Mark'].append({'geometry': polygon(-2, 30, 6)})
+        self.annotations[1]['Label']['Mark'].append({'geometry': polygon(78, 58, 9)})
+        self.annotations.append({'External ID': 'mark_2.png', 'Label': {'Mark': []}})
+        self.write(self.annotations)
+        expected = self.dataset()
+        cached = self.dataset(self.cache)
+        ids = [info['id'] for info in expected.image_info]
+        assert ids == [info['id'] for info in cached.image_info], 'image list error'
+        assert ids == ['mark_0.png', 'mark_1.png', 'mark_2.png'], 'empty annotation not skipped'
+        for image_id in expected.image_ids:
+            mask, class_ids = expected.load_mask(image_id)
+            cached_mask, cached_class_ids = cached.load_mask(image_id)
+            assert np.array_equal(mask, cached_mask), 'clipped mask error'
+            assert np.array_equal(class_ids, cached_class_ids), 'class id error'
+        assert expected.load_mask(0)[0][:, :4, -1].any(), 'mask on the image edge lost'
+
+    def test_invalidation(self):
+        self.dataset(self.cache)
+        assert self.dataset(self.cache).mask_store.rasterized == 0, 'unchanged store rebuilt'
+        self.annotations[1]['Label']['Mark'][0]['geometry'] = polygon(50, 40, 6)
+        self.write(self.annotations)
+        dataset = self.dataset(self.cache)
+        assert dataset.mask_store.rasterized == 1, 'changed image not rebuilt'
+        mask, _ = dataset.load_mask(1)
+        assert mask[40, 50, 0] and not mask[30, 30, 0], 'changed mask error'
+        assert np.array_equal(dataset.load_mask(2)[0], self.dataset().load_mask(2)[0]), \
+            'reused mask error'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,239 @@
+import unittest
+import numpy as np
+from smartscope.source.maskrcnn import utils
+
+
+# The loop based versions the vectorized utils replaced, kept to check
+# that the outputs did not change
+def reference_extract_bboxes(mask):
+    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
+    for i in range(mask.shape[-1]):
+        m = mask[:, :, i]
+        horizontal_indicies = np.where(np.any(m, axis=0))[0]
+        vertical_indicies = np.where(np.any(m, axis=1))[0]
+        if horizontal_indicies.shape[0]:
+            x1, x2 = horizontal_indicies[[0, -1]]
+            y1, y2 = vertical_indicies[[0, -1]]
+            x2 += 1
+            y2 += 1
+        else:
+            x1, x2, y1, y2 = 0, 0, 0, 0
+        boxes[i] = np.array([y1, x1, y2, x2])
+    return boxes.astype(np.int32)
+
+
+def reference_compute_overlaps(boxes1, boxes2):
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]))
+    for i in range(overlaps.shape[1]):
+        overlaps[:, i] = utils.compute_iou(boxes2[i], boxes1, area2[i], area1)
+    return overlaps
+
+
+def reference_non_max_suppression(boxes, scores, threshold):
+    if boxes.dtype.kind != "f":
+        boxes = boxes.astype(np.float32)
+    y1, x1, y2, x2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    area = (y2 - y1) * (x2 - x1)
+    ixs = scores.argsort()[::-1]
+    pick = []
+    while len(ixs) > 0:
+        i = ixs[0]
+        pick.append(i)
+        iou = utils.compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
+        remove_ixs = np.where(iou > threshold)[0] + 1
+        ixs = np.delete(ixs, remove_ixs)
+        ixs = np.delete(ixs, 0)
+    return np.array(pick, dtype=np.int32)
+
+
+def reference_minimize_mask(bbox, mask, mini_shape):
+    mini_mask = np.zeros(mini_shape + (mask.shape[-1],), dtype=bool)
+    for i in range(mask.shape[-1]):
+        m = mask[:, :, i].astype(bool)
+        y1, x1, y2, x2 = bbox[i][:4]
+        m = m[y1:y2, x1:x2]
+        m = utils.resize(m, mini_shape)
+        mini_mask[:, :, i] = np.around(m).astype(bool)
+    return mini_mask
+
+
+def reference_unmold_mask(mask, bbox, image_shape):
+    y1, x1, y2, x2 = bbox
+    mask = utils.resize(mask, (y2 - y1, x2 - x1))
+    mask = np.where(mask >= 0.5, 1, 0).astype(bool)
+    full_mask = np.zeros(image_shape[:2], dtype=bool)
+    full_mask[y1:y2, x1:x2] = mask
+    return full_mask
+
+
+def reference_compute_matches(gt_boxes, gt_class_ids, gt_masks,
+                              pred_boxes, pred_class_ids, pred_scores, pred_masks,
+                              iou_threshold=0.5, score_threshold=0.0):
+    gt_boxes = utils.trim_zeros(gt_boxes)
+    gt_masks = gt_masks[..., :gt_boxes.shape[0]]
+    pred_boxes = utils.trim_zeros(pred_boxes)
+    pred_scores = pred_scores[:pred_boxes.shape[0]]
+    indices = np.argsort(pred_scores)[::-1]
+    pred_boxes = pred_boxes[indices]
+    pred_class_ids = pred_class_ids[indices]
+    pred_masks = pred_masks[..., indices]
+    overlaps = utils.compute_overlaps_masks(pred_masks, gt_masks)
+    pred_match = -1 * np.ones([pred_boxes.shape[0]])
+    gt_match = -1 * np.ones([gt_boxes.shape[0]])
+    for i in range(len(pred_boxes)):
+        sorted_ixs = np.argsort(overlaps[i])[::-1]
+        low_score_idx = np.where(overlaps[i, sorted_ixs] < score_threshold)[0]
+        if low_score_idx.size > 0:
+            sorted_ixs = sorted_ixs[:low_score_idx[0]]
+        for j in sorted_ixs:
+            if gt_match[j] > -1:
+                continue
+            iou = overlaps[i, j]
+            if iou < iou_threshold:
+                break
+            if pred_class_ids[i] == gt_class_ids[j]:
+                gt_match[j] = i
+                pred_match[i] = j
+                break
+    return gt_match, pred_match, overlaps
+
+
+def reference_compute_ap(*args, iou_threshold=0.5):
+    gt_match, pred_match, overlaps = reference_compute_matches(*args, iou_threshold=iou_threshold)
+    precisions = np.cumsum(pred_match > -1) / (np.arange(len(pred_match)) + 1)
+    recalls = np.cumsum(pred_match > -1).astype(np.float32) / len(gt_match)
+    precisions = np.concatenate([[0], precisions, [0]])
+    recalls = np.concatenate([[0], recalls, [1]])
+    for i in range(len(precisions) - 2, -1, -1):
+        precisions[i] = np.maximum(precisions[i], precisions[i + 1])
+    indices = np.where(recalls[:-1] != recalls[1:])[0] + 1
+    mAP = np.sum((recalls[indices] - recalls[indices - 1]) * precisions[indices])
+    return mAP, precisions, recalls, overlaps
+
+
+def random_boxes(rng, n, size=200, integer=False):
+    ''' Random boxes, some of them repeated, zero area or touching '''
+    y1 = rng.randint(0, size, n)
+    x1 = rng.randint(0, size, n)
+    boxes = np.stack([y1, x1, y1 + rng.randint(0, 60, n), x1 + rng.randint(0, 60, n)], 1)
+    if n > 3:
+        boxes[1] = boxes[0]
+        boxes[2, 2:] = boxes[2, :2]
+    if integer:
+        return boxes.astype(np.int32)
+    return (boxes + rng.rand(n, 4).round(1)).astype(np.float32)
+
+
+def random_masks(rng, n, shape=(64, 80)):
+    ''' Random blobs with a few empty masks '''
+    masks = np.zeros(shape + (n,), dtype=np.uint8)
+    for i in range(n):
+        if rng.rand() < 0.2:
+            continue
+        y, x = rng.randint(0, shape[0]), rng.randint(0, shape[1])
+        masks[y:y + rng.randint(1, 30), x:x + rng.randint(1, 30), i] = 1
+        masks[:, :, i] &= (rng.rand(*shape) < 0.9).astype(np.uint8)
+    return masks
+
+
+class TestMaskRCNNUtils(unittest.TestCase):
+
+    trials = 50
+
+    def test_extract_bboxes(self):
+        rng = np.random.RandomState(0)
+        for trial in range(self.trials):
+            masks = random_masks(rng, rng.randint(0, 8))
+            assert np.array_equal(utils.extract_bboxes(masks), reference_extract_bboxes(masks)), \
+                'extract_bboxes error'
+
+    def test_compute_overlaps(self):
+        rng = np.random.RandomState(1)
+        for trial in range(self.trials):
+            integer = trial % 2 == 0
+            boxes1 = random_boxes(rng, rng.randint(1, 300), integer=integer)
+            boxes2 = random_boxes(rng, rng.randint(1, 20), integer=integer)
+            assert np.array_equal(utils.compute_overlaps(boxes1, boxes2),
+                                  reference_compute_overlaps(boxes1, boxes2), equal_nan=True), \
+                'compute_overlaps error'
+        # Blocks smaller than the input
+        block = utils.OVERLAP_BLOCK
+        utils.OVERLAP_BLOCK = 7
+        try:
+            assert np.array_equal(utils.compute_overlaps(boxes1, boxes2),
+                                  reference_compute_overlaps(boxes1, boxes2), equal_nan=True), \
+                'compute_overlaps block error'
+        finally:
+            utils.OVERLAP_BLOCK = block
+
+    def test_non_max_suppression(self):
+        rng = np.random.RandomState(2)
+        for trial in range(self.trials):
+            n = rng.randint(1, 400)
+            boxes = random_boxes(rng, n, integer=trial % 3 == 0)
+            # Rounded scores give ties
+            scores = rng.rand(n).round(2)
+            threshold = rng.choice([0.0, 0.3, 0.5, 0.7, 1.0])
+            assert np.array_equal(utils.non_max_suppression(boxes, scores, threshold),
+                                  reference_non_max_suppression(boxes, scores, threshold)), \
+                'non_max_suppression error'
+        # Blocks smaller than the input
+        block = utils.OVERLAP_BLOCK
+        utils.OVERLAP_BLOCK = 1000
+        try:
+            assert np.array_equal(utils.non_max_suppression(boxes, scores, 0.3),
+                                  reference_non_max_suppression(boxes, scores, 0.3)), \
+                'non_max_suppression block error'
+        finally:
+            utils.OVERLAP_BLOCK = block
+
+    def test_minimize_mask(self):
+        rng = np.random.RandomState(3)
+        for trial in range(self.trials // 5):
+            masks = random_masks(rng, 6)
+            keep = masks.any(axis=(0, 1))
+            masks = masks[:, :, keep]
+            bbox = utils.extract_bboxes(masks)
+            assert np.array_equal(utils.minimize_mask(bbox, masks, (28, 28)),
+                                  reference_minimize_mask(bbox, masks, (28, 28))), \
+                'minimize_mask error'
+
+    def test_unmold_masks(self):
+        rng = np.random.RandomState(4)
+        shape = (160, 160, 3)
+        for trial in range(self.trials // 5):
+            n = rng.randint(1, 6)
+            masks = rng.rand(n, 28, 28).astype(np.float32)
+            boxes = random_boxes(rng, n, size=90, integer=True)
+            boxes[:, 2:] = np.maximum(boxes[:, 2:], boxes[:, :2] + 1)
+            expected = np.stack([reference_unmold_mask(m, b, shape) for m, b in zip(masks, boxes)], -1)
+            assert np.array_equal(utils.unmold_masks(masks, boxes, shape), expected), \
+                'unmold_masks error'
+            assert np.array_equal(utils.unmold_mask(masks[0], boxes[0], shape), expected[:, :, 0]), \
+                'unmold_mask error'
+
+    def test_compute_ap(self):
+        rng = np.random.RandomState(5)
+        for trial in range(self.trials // 5):
+            gt_masks = random_masks(rng, 6)
+            gt_masks = gt_masks[:, :, gt_masks.any(axis=(0, 1))]
+            # Predictions are shifted GT masks and a few random ones
+            pred_masks = np.concatenate([np.roll(gt_masks, rng.randint(-3, 4), axis=0),
+                                         random_masks(rng, 3)], -1)
+            pred_masks = pred_masks[:, :, pred_masks.any(axis=(0, 1))]
+            args = (utils.extract_bboxes(gt_masks), rng.randint(1, 3, gt_masks.shape[-1]), gt_masks,
+                    utils.extract_bboxes(pred_masks), rng.randint(1, 3, pred_masks.shape[-1]),
+                    rng.rand(pred_masks.shape[-1]), pred_masks)
+            for iou_threshold in [0.3, 0.5, 0.75]:
+                for a, b in zip(utils.compute_ap(*args, iou_threshold=iou_threshold),
+                                reference_compute_ap(*args, iou_threshold=iou_threshold)):
+                    assert np.array_equal(a, b, equal_nan=True), 'compute_ap error'
+            expected = np.mean([reference_compute_ap(*args, iou_threshold=t)[0]
+                                for t in np.arange(0.5, 1.0, 0.05)])
+            assert utils.compute_ap_range(*args, verbose=0) == expected, 'compute_ap_range error'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import unittest
+import numpy as np
+import scipy.stats
+from smartscope.source.miq import evaluation
+from smartscope.source.miq import prediction
+
+
+# The loop based versions the batched functions replaced, kept to check
+# that the outputs did not change
+def reference_get_certainty(probabilities):
+    sum_prob = np.sum(probabilities)
+    num_classes = probabilities.shape[0]
+    if sum_prob > 0:
+        normalized_probabilities = probabilities / sum_prob
+        certainty_proxy = 1.0 - scipy.stats.entropy(
+            normalized_probabilities) / np.log(num_classes)
+    else:
+        certainty_proxy = 0.0
+    return np.clip(certainty_proxy, 0.0, 1.0)
+
+
+def reference_certainties_from_probabilities(probabilities):
+    certainties = np.zeros(probabilities.shape[0])
+    for i in range(probabilities.shape[0]):
+        certainties[i] = reference_get_certainty(probabilities[i, :])
+    return certainties
+
+
+def reference_aggregate_prediction(probabilities, aggregation_method=evaluation.METHOD_AVERAGE):
+    certainties = reference_certainties_from_probabilities(probabilities)
+    certainty_dict = {
+        'mean': np.round(np.mean(certainties), 3),
+        'max': np.round(np.max(certainties), 3)
+    }
+    weights = certainties
+    weights = None if np.sum(weights) == 0 else weights
+    if aggregation_method == evaluation.METHOD_AVERAGE:
+        probabilities_aggregated = np.average(probabilities, 0, weights=weights)
+    else:
+        sum_log_probabilities = np.sum(np.log(probabilities), 0)
+        # scipy.misc.logsumexp
+        top = np.max(sum_log_probabilities)
+        logsumexp = top + np.log(np.sum(np.exp(sum_log_probabilities - top)))
+        probabilities_aggregated = np.exp(sum_log_probabilities - logsumexp)
+    predicted_class = np.argmax(probabilities_aggregated)
+    certainty_dict['aggregate'] = np.round(reference_get_certainty(probabilities_aggregated), 3)
+    certainty_dict['weighted'] = np.round(np.average(certainties, 0, weights=weights), 3)
+    return evaluation.WholeImagePrediction(predicted_class, certainty_dict,
+                                           probabilities_aggregated)
+
+
+def reference_patches_to_image(patches, image_shape):
+    patch_width = patches.shape[1]
+    num_rows = image_shape[0] // patch_width
+    num_cols = image_shape[1] // patch_width
+    image = np.zeros([num_rows * patch_width, num_cols * patch_width, patches.shape[3]],
+                     dtype=patches.dtype)
+    index = 0
+    for i in range(0, num_rows * patch_width, patch_width):
+        for j in range(0, num_cols * patch_width, patch_width):
+            image[i:i + patch_width, j:j + patch_width, :] = patches[index, :, :, :]
+            index += 1
+    return image
+
+
+def reference_patch_values_to_mask(values, patch_width):
+    mask = np.zeros((values.shape[0] * patch_width, values.shape[1] * patch_width),
+                    dtype=np.uint16)
+    for i in range(values.shape[0]):
+        for j in range(values.shape[1]):
+            ymin = i * patch_width
+            xmin = j * patch_width
+            mask[ymin:ymin + patch_width, xmin:xmin + patch_width] = values[i, j]
+    return mask
+
+
+def random_probabilities(rng, shape, num_classes=11):
+    ''' Softmax of random logits, sharp for some patches and flat for others '''
+    logits = rng.randn(*(shape + (num_classes,))) * rng.uniform(0, 8, shape + (1,))
+    probabilities = np.exp(logits - logits.max(-1, keepdims=True))
+    return probabilities / probabilities.sum(-1, keepdims=True)
+
+
+class TestMiqEvaluation(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def test_certainties(self):
+        probabilities = random_probabilities(self.rng, (200,))
+        # One-hot, uniform, unnormalized and all zero rows
+        probabilities[0] = np.eye(11)[3]
+        probabilities[1] = 1.0 / 11
+        probabilities[2] *= 5
+        probabilities[3] = 0
+        assert np.allclose(evaluation.certainties_from_probabilities(probabilities),
+                           reference_certainties_from_probabilities(probabilities)), 'certainty error'
+        assert np.isclose(evaluation.get_certainty(probabilities[5]),
+                          reference_get_certainty(probabilities[5])), 'get_certainty error'
+        batched = evaluation.certainties_from_probabilities(probabilities.reshape(8, 25, 11))
+        assert batched.shape == (8, 25), 'batched certainty shape'
+        assert np.allclose(batched.ravel(), reference_certainties_from_probabilities(probabilities))
+
+    def test_aggregate(self):
+        probabilities = random_probabilities(self.rng, (5, 40))
+        # No certain patch, every patch is weighted equally
+        probabilities[4] = 1.0 / 11
+        for method in [evaluation.METHOD_AVERAGE, evaluation.METHOD_PRODUCT]:
+            batched = evaluation.aggregate_predictions_from_probabilities(probabilities, method)
+            for image, b in zip(probabilities, batched):
+                single = evaluation.aggregate_prediction_from_probabilities(image, method)
+                expected = reference_aggregate_prediction(image, method)
+                for p in [b, single]:
+                    assert p.predictions == expected.predictions, 'prediction error'
+                    assert np.allclose(p.probabilities, expected.probabilities), 'probability error'
+                    assert p.certainties == expected.certainties, 'certainty error'
+        with self.assertRaises(ValueError):
+            evaluation.aggregate_prediction_from_probabilities(probabilities[0], 'median')
+
+    def test_masks(self):
+        patches = self.rng.randint(0, 1000, (12, 84, 84, 1)).astype(np.uint16)
+        image = evaluation._patches_to_image(patches, (3 * 84 + 10, 4 * 84))
+        assert np.array_equal(image, reference_patches_to_image(patches, (3 * 84 + 10, 4 * 84)))
+        values = self.rng.randint(0, 11, (3, 4)).astype(np.uint16)
+        mask = prediction.patch_values_to_mask(values, 84)
+        assert mask.dtype == np.uint16 and np.array_equal(
+            mask, reference_patch_values_to_mask(values, 84)), 'mask error'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+import numpy as np
+from smartscope.source.miq import evaluation
+from smartscope.source.miq import prediction
+
+W = 84
+
+
+class TileSession:
+    ''' Stands in for the model's session. Tiles the image like
+    _get_image_tiles_tensor and gives each tile probabilities from its
+    mean, counting the runs.
+    '''
+    def __init__(self, num_classes=11):
+        self.num_classes = num_classes
+        self.runs = 0
+
+    def run(self, tensors, feed_dict):
+        self.runs += 1
+        image = list(feed_dict.values())[0][:, :, 0]
+        rows, cols = image.shape[0] // W, image.shape[1] // W
+        tiles = image[:rows * W, :cols * W].reshape(rows, W, cols, W).transpose(0, 2, 1, 3)
+        means = tiles.reshape(-1, W * W).mean(-1)
+        logits = -(np.arange(self.num_classes)[np.newaxis] - means[:, np.newaxis] / 10.0) ** 2
+        probabilities = np.exp(logits)
+        return [probabilities / probabilities.sum(-1, keepdims=True)]
+
+    def close(self):
+        pass
+
+
+def get_classifier():
+    classifier = prediction.ImageQualityClassifier.__new__(prediction.ImageQualityClassifier)
+    classifier._model_patch_side_length = W
+    classifier._num_classes = 11
+    classifier._image_placeholder = 'image'
+    classifier._probabilities = 'probabilities'
+    classifier._sess = TileSession()
+    return classifier
+
+
+def reference_get_patch_predictions(classifier, image):
+    ''' The per patch loop get_patch_predictions replaced '''
+    results = []
+    for i in range(0, image.shape[0] - W, W):
+        for j in range(0, image.shape[1] - W, W):
+            results.append((i, j, W, W, classifier.predict(image[i:i + W, j:j + W])))
+    return results
+
+
+class TestPatchMap(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.classifier = get_classifier()
+        # Patches with different levels, 3 x 4 whole patches
+        levels = rng.uniform(0, 100, (2, 3, 4))
+        self.images = np.repeat(np.repeat(levels, W, 1), W, 2)
+        self.images = np.pad(self.images, ((0, 0), (0, 30), (0, 20)), 'constant')
+        self.images += rng.uniform(0, 1, self.images.shape)
+
+    def test_patch_map(self):
+        patch_map = self.classifier.predict_patch_map(self.images)
+        assert self.classifier._sess.runs == 1, 'more than one run for all images'
+        assert patch_map.probabilities.shape == (2, 3, 4, 11), 'probability grid shape'
+        assert patch_map.certainties.shape == (2, 3, 4), 'certainty grid shape'
+        for n, image in enumerate(self.images):
+            # Each patch matches a run on the patch alone
+            for i in range(3):
+                for j in range(4):
+                    patch = self.classifier.predict(image[i * W:(i + 1) * W, j * W:(j + 1) * W])
+                    assert np.allclose(patch_map.probabilities[n, i, j], patch.probabilities), \
+                        'patch probability error'
+                    assert np.isclose(patch_map.certainties[n, i, j],
+                                      evaluation.get_certainty(patch.probabilities))
+            # The whole image prediction is unchanged
+            whole = self.classifier.predict(image)
+            aggregate = patch_map.aggregate()[n]
+            assert aggregate.predictions == whole.predictions, 'aggregate error'
+            assert np.allclose(aggregate.probabilities, whole.probabilities), 'aggregate error'
+        single = self.classifier.predict_patch_map(self.images[1])
+        assert np.allclose(single.probabilities[0], patch_map.probabilities[1]), 'single image error'
+        with self.assertRaises(ValueError):
+            self.classifier.predict_patch_map([self.images[0], self.images[1][:-1]])
+        with self.assertRaises(ValueError):
+            self.classifier.predict_patch_map(np.zeros((W - 1, 500)))
+
+    def test_heatmaps(self):
+        patch_map = self.classifier.predict_patch_map(self.images)
+        predictions = patch_map.prediction_heatmaps(self.images.shape[1:])
+        assert predictions.shape == self.images.shape and predictions.dtype == np.uint16
+        assert np.array_equal(predictions[1, :3 * W, :4 * W], prediction.patch_values_to_mask(
+            patch_map.predictions[1], W)), 'prediction heatmap error'
+        assert not predictions[:, 3 * W:].any() and not predictions[:, :, 4 * W:].any(), \
+            'uncovered pixels not filled'
+        certainties = patch_map.certainty_heatmaps()
+        assert certainties.shape == (2, 3 * W, 4 * W), 'certainty heatmap shape'
+        assert certainties[0, W + 5, 2 * W + 7] == patch_map.certainties[0, 1, 2]
+        scores = patch_map.heatmap(patch_map.scores(), self.images.shape[1:], fill=np.nan)
+        assert np.isnan(scores[0, -1, -1]) and np.isclose(
+            scores[0, 0, 0], self.classifier.score(self.images[0][:W, :W])), 'score heatmap error'
+
+    def test_get_patch_predictions(self):
+        results = self.classifier.get_patch_predictions(self.images[0])
+        assert self.classifier._sess.runs == 1, 'more than one run for the patches'
+        expected = reference_get_patch_predictions(get_classifier(), self.images[0])
+        assert len(results) == len(expected) == 12, 'patch count error'
+        for result, e in zip(results, expected):
+            assert result[:4] == e[:4], 'patch location error'
+            assert result[4].predictions == e[4].predictions, 'patch prediction error'
+            assert result[4].certainties == e[4].certainties, 'patch certainty error'
+            assert np.allclose(result[4].probabilities, e[4].probabilities)
+
+
+if __name__ == '__main__':
+    unittest.main()
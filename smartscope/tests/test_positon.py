@@ -1,4 +1,5 @@
 import unittest
+import numpy as np
 import smartscope.source.position as pos
 
 class TestPosition(unittest.TestCase):
@@ -75,6 +76,17 @@ class TestPosition(unittest.TestCase):
                 same = False
         assert same is True, 'PositionList save/load error'
 
+    def test_fit_rigid_transform(self):
+        src = np.array([[0, 0], [26000, 0], [26000, -9500]], dtype=float)
+        truth = pos.RigidTransform(angle=np.radians(0.05), tx=12.0, ty=-30.0)
+        transform = pos.fit_rigid_transform(src, truth.apply(src))
+        assert abs(transform.angle - truth.angle) < 1e-9, 'fit_rigid_transform angle error'
+        assert abs(transform.tx - 12.0) < 1e-6 and abs(transform.ty + 30.0) < 1e-6, \
+            'fit_rigid_transform translation error'
+        assert transform.residual < 1e-6, 'fit_rigid_transform residual error'
+        moved = transform.apply_to(pos.PositionList(positions=[pos.StagePosition(x=0, y=0, z=7)]))
+        assert moved[0].z == 7 and abs(moved[0].x - 12.0) < 1e-6, 'RigidTransform apply_to() error'
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,40 @@
+import unittest
+import smartscope.source.progress as prog
+
+
+class TestProgress(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.progress = prog.Progress(callback=self.events.append)
+
+    def test_events(self):
+        self.progress.phase('Imaging', 10)
+        self.progress.step()
+        self.progress.step(2)
+        event = self.events[-1]
+        assert event.phase == 'Imaging', 'Progress phase error'
+        assert event.done == 3, 'Progress step() error'
+        assert event.total == 10, 'Progress total error'
+        assert len(self.events) == 3, 'Progress should emit on every update'
+
+    def test_rate_and_eta(self):
+        self.progress.phase('Imaging', 10)
+        self.progress._times.clear()
+        self.progress._times.append((100.0, 0))
+        self.progress._times.append((102.0, 4))
+        self.progress.done = 4
+        assert self.progress.rate == 2.0, 'Progress rate error'
+        assert self.progress.eta == 3.0, 'Progress eta error'
+
+    def test_cancel(self):
+        self.progress.phase('Focus', 5)
+        self.progress.cancel()
+        with self.assertRaises(prog.RunCancelled):
+            self.progress.step()
+        with self.assertRaises(prog.RunCancelled):
+            self.progress.phase('Imaging', 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
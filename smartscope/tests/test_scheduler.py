@@ -0,0 +1,75 @@
+import unittest
+from smartscope.source import scheduler
+
+
+def chip(position, timepoints, interval_minutes, estimated_minutes=(10, 2)):
+    return {'chip': 'KL Chip', 'chip_index': '00', 'position': position,
+            'timepoints': timepoints, 'interval_minutes': interval_minutes,
+            'estimated_minutes': list(estimated_minutes)}
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_tour_order(self):
+        positions = [(10000, 0), (0, 0), (20000, 0), (5000, 0)]
+        assert scheduler.tour_order(positions, (0, 0)) == [1, 3, 0, 2], 'tour order error'
+
+    def test_plan(self):
+        job = {'chips': [chip([20000, 0, 0], 3, 60), chip([0, 0, 0], 2, 30)]}
+        s = scheduler.Scheduler(job, start_position=(0, 0))
+        assert s.order == [1, 0], 'nearest chip should go first'
+        planned = [(a.chip, a.index, a.planned) for a in s.acquisitions]
+        # chip 1 starts at 0, chip 0 after chip 1's first timepoint and the move
+        first = 600 + 20000 / scheduler.STAGE_SPEED
+        assert planned == [(1, 0, 0.0), (0, 0, first), (1, 1, 1800.0),
+                           (0, 1, first + 3600), (0, 2, first + 7200)], 'plan error'
+
+    def test_next_acquisition(self):
+        job = {'chips': [chip([0, 0, 0], 2, 10), chip([5000, 0, 0], 2, 10),
+                         chip([1000, 0, 0], 2, 10)]}
+        s = scheduler.Scheduler(job, start_position=(0, 0))
+        for a in s.acquisitions:
+            if a.index == 0:
+                a.status = 'ok'
+        # Everything is due, the nearest chip goes first
+        a = s.next_acquisition(10000, position=(6000, 0))
+        assert (a.chip, a.index) == (1, 1), 'nearest due chip error'
+        # Nothing is due, the soonest planned goes next
+        a = s.next_acquisition(0, position=(6000, 0))
+        assert (a.chip, a.index) == (0, 1), 'soonest planned error'
+
+    def test_replan(self):
+        job = {'chips': [chip([0, 0, 0], 2, 30), chip([1000, 0, 0], 1, 30),
+                         chip([2000, 0, 0], 1, 30)]}
+        s = scheduler.Scheduler(job, start_position=(0, 0))
+        first = s.acquisitions[0]
+        assert (first.chip, first.index) == (0, 0), 'first acquisition error'
+        # The first timepoint takes 1500 s instead of 600 s
+        first.start, first.end, first.status = 0.0, 1500.0, 'ok'
+        s.update_estimate(first)
+        assert s.estimates[0][0] == 1050, 'estimate error'
+        assert s.estimates[2][0] == 1050, 'untimed chips of the same type should share the estimate'
+        s.replan(first.end, (0, 0))
+        planned = {(a.chip, a.index): a.planned for a in s.pending()}
+        move = 1000 / scheduler.STAGE_SPEED
+        # Chip 0 keeps its interval, chip 1 waits until chip 0's second
+        # timepoint is done and chip 2 follows chip 1
+        assert planned[(0, 1)] == 1800, 'started chip should keep its interval'
+        assert planned[(1, 0)] == 1800 + 120, 'chip 1 should not overlap chip 0'
+        assert planned[(2, 0)] == 1920 + 1050 + move, 'chip 2 should follow chip 1'
+        assert [(a.chip, a.index) for a in s.pending()] == [(0, 1), (1, 0), (2, 0)], 'order error'
+
+    def test_replan_earlier(self):
+        job = {'chips': [chip([0, 0, 0], 1, 30), chip([1000, 0, 0], 1, 30)]}
+        s = scheduler.Scheduler(job, start_position=(0, 0))
+        first = s.acquisitions[0]
+        first.start, first.end, first.status = 0.0, 200.0, 'ok'
+        s.update_estimate(first)
+        s.replan(first.end, (0, 0))
+        later = [a for a in s.acquisitions if a.chip == 1][0]
+        assert later.planned == 200 + 1000 / scheduler.STAGE_SPEED, \
+            'a chip that finishes early should pull the next one forward'
+
+
+if __name__ == '__main__':
+    unittest.main()
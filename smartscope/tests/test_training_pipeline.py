@@ -0,0 +1,97 @@
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from smartscope.source.maskrcnn import utils
+from smartscope.source.maskrcnn import pipeline
+from smartscope.source.maskrcnn.config import Config
+
+
+class TinyConfig(Config):
+    NAME = 'tiny'
+    NUM_CLASSES = 1 + 1
+    IMAGE_MIN_DIM = 128
+    IMAGE_MAX_DIM = 128
+    RPN_ANCHOR_SCALES = (8, 16, 32, 64, 128)
+    RPN_TRAIN_ANCHORS_PER_IMAGE = 32
+    MAX_GT_INSTANCES = 8
+    IMAGES_PER_GPU = 2
+
+
+class RectangleDataset(utils.Dataset):
+    ''' Random rectangles, the last image has none '''
+
+    def load_rectangles(self, count):
+        self.add_class('shapes', 1, 'rectangle')
+        for i in range(count):
+            rng = np.random.RandomState(i)
+            n = 0 if i == count - 1 else rng.randint(1, 7)
+            y = rng.randint(0, 70, n)
+            x = rng.randint(0, 70, n)
+            boxes = np.stack([y, x, y + rng.randint(8, 50, n), x + rng.randint(8, 50, n)], 1)
+            self.add_image('shapes', image_id=i, path=None, boxes=boxes.tolist())
+
+    def load_image(self, image_id):
+        image = np.full((120, 120, 3), 30, dtype=np.uint8)
+        for y1, x1, y2, x2 in self.image_info[image_id]['boxes']:
+            image[y1:y2, x1:x2] = 200
+        return image
+
+    def load_mask(self, image_id):
+        boxes = self.image_info[image_id]['boxes']
+        masks = np.zeros((120, 120, len(boxes)), dtype=bool)
+        for i, (y1, x1, y2, x2) in enumerate(boxes):
+            masks[y1:y2, x1:x2, i] = True
+        return masks, np.ones(len(boxes), dtype=np.int32)
+
+
+class TestTrainingPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = TinyConfig()
+        self.dataset = RectangleDataset()
+        self.dataset.load_rectangles(6)
+        self.dataset.prepare()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def batches(self, n=5, **kwargs):
+        data = pipeline.DataPipeline(self.dataset, self.config, batch_size=2, seed=3, **kwargs)
+        try:
+            batches = iter(data)
+            batches = [next(batches)[0] for _ in range(n)]
+        finally:
+            data.close()
+        return batches, data.report()
+
+    def assert_same(self, a, b, msg):
+        for batch_a, batch_b in zip(a, b):
+            for x, y in zip(batch_a, batch_b):
+                assert np.array_equal(x, y), msg
+
+    def test_deterministic(self):
+        inline, report = self.batches(workers=0)
+        assert report['samples'] == 10, 'sample count error'
+        # The image without instances is skipped
+        assert all(np.all(b[4][:, 0] > 0) for b in inline), 'empty image used'
+        self.assert_same(inline, self.batches(workers=0)[0], 'pipeline not repeatable')
+        self.assert_same(inline, self.batches(workers=2)[0], 'workers change the samples')
+
+    def test_cache(self):
+        expected, _ = self.batches(workers=0)
+        cold, report = self.batches(workers=2, cache_dir=self.dir)
+        assert report['prepared'] > 0, 'cache not filled'
+        warm, report = self.batches(workers=2, cache_dir=self.dir)
+        assert report['prepared'] == 0 and report['cache_hits'] > 0, 'cache not used'
+        self.assert_same(expected, cold, 'cold cache error')
+        self.assert_same(expected, warm, 'warm cache error')
+        # Changed images are prepared again
+        self.dataset.image_info[0]['boxes'] = [[10, 10, 40, 40]]
+        cache = pipeline.SampleCache(self.dir, self.dataset, self.config, 1)
+        assert not cache.has(0) and cache.has(1), 'changed image not invalidated'
+
+
+if __name__ == '__main__':
+    unittest.main()
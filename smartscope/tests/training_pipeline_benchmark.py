@@ -0,0 +1,99 @@
+''' Throughput of the Mask R-CNN training data pipeline.
+
+Times how many training samples per second data_generator() and
+pipeline.DataPipeline prepare on images the size of the alignment mark
+training set, with and without the sample cache, and checks that
+DataPipeline gives the same batches with any number of workers.
+
+    python -m smartscope.tests.training_pipeline_benchmark --workers 4
+'''
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from smartscope.source.maskrcnn import model as modellib
+from smartscope.source.maskrcnn import pipeline
+from smartscope.tests.test_training_pipeline import RectangleDataset, TinyConfig
+
+SCALE = 8
+
+
+class MarkSizeConfig(TinyConfig):
+    IMAGE_MIN_DIM = 1024
+    IMAGE_MAX_DIM = 1024
+    RPN_ANCHOR_SCALES = (32, 64, 128, 256, 512)
+    RPN_TRAIN_ANCHORS_PER_IMAGE = 256
+    MAX_GT_INSTANCES = 8
+
+
+class MarkSizeDataset(RectangleDataset):
+    ''' The rectangles at 960 x 960 '''
+
+    def load_image(self, image_id):
+        image = super().load_image(image_id).repeat(SCALE, 0).repeat(SCALE, 1)
+        return image + np.random.RandomState(image_id).randint(0, 20, image.shape).astype(np.uint8)
+
+    def load_mask(self, image_id):
+        masks, class_ids = super().load_mask(image_id)
+        return masks.repeat(SCALE, 0).repeat(SCALE, 1), class_ids
+
+
+def throughput(generator, batches, batch_size):
+    ''' Samples per second of the first batches of a generator '''
+    next(generator)
+    start = time.time()
+    for _ in range(batches):
+        next(generator)
+    return batches * batch_size / (time.time() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Training data pipeline benchmark')
+    parser.add_argument('--images', type=int, default=40)
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    config = MarkSizeConfig()
+    dataset = MarkSizeDataset()
+    dataset.load_rectangles(args.images)
+    dataset.prepare()
+    batch_size = config.BATCH_SIZE
+    cache_dir = tempfile.mkdtemp()
+    try:
+        runs = [
+            ('data_generator', lambda: None),
+            ('pipeline, 0 workers', lambda: pipeline.DataPipeline(
+                dataset, config, batch_size=batch_size, workers=0)),
+            ('pipeline, {} workers'.format(args.workers), lambda: pipeline.DataPipeline(
+                dataset, config, batch_size=batch_size, workers=args.workers)),
+            ('pipeline, cold cache', lambda: pipeline.DataPipeline(
+                dataset, config, batch_size=batch_size, workers=args.workers, cache_dir=cache_dir)),
+            ('pipeline, warm cache', lambda: pipeline.DataPipeline(
+                dataset, config, batch_size=batch_size, workers=args.workers, cache_dir=cache_dir)),
+        ]
+        print('{:<24} {:>12}'.format('generator', 'samples/sec'))
+        for name, make in runs:
+            data = make()
+            if data is None:
+                generator = modellib.data_generator(dataset, config, batch_size=batch_size)
+            else:
+                generator = iter(data)
+            rate = throughput(generator, args.batches, batch_size)
+            if data is not None:
+                data.close()
+            print('{:<24} {:>12.1f}'.format(name, rate))
+
+        inline = iter(pipeline.DataPipeline(dataset, config, batch_size=batch_size, workers=0))
+        data = pipeline.DataPipeline(dataset, config, batch_size=batch_size, workers=args.workers)
+        parallel = iter(data)
+        same = True
+        for _ in range(args.batches):
+            same &= all(np.array_equal(a, b) for a, b in zip(next(inline)[0], next(parallel)[0]))
+        data.close()
+        print('same batches with any number of workers:', same)
+    finally:
+        shutil.rmtree(cache_dir)